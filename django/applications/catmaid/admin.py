@@ -9,6 +9,7 @@ from catmaid.models import Project, DataView, Stack, ProjectStack, UserProfile
 from catmaid.models import BrokenSlice, Overlay
 from catmaid.control.importer import importer_admin_view
 from catmaid.control.classificationadmin import classification_admin_view
+from catmaid.control.profiling import profiling_admin_view
 from catmaid.views import UseranalyticsView, UserProficiencyView
 
 
@@ -155,4 +156,6 @@ admin.site.register_view('userproficiency', 'User Proficiency',
 admin.site.register_view('classifcationadmin',
                          'Tag Based Classification Graph Linker',
                          view=classification_admin_view)
+admin.site.register_view('profiling', 'Request Profiling',
+                         view=profiling_admin_view)
 admin.site.register(Overlay)
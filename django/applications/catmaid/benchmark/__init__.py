@@ -0,0 +1,14 @@
+""" Benchmarks of CATMAID's most frequently used and most expensive requests.
+
+The package has three parts:
+
+generator: writes a synthetic connectome (neurons with branched arbors,
+synapses, tags, review states and annotations) into a project, using COPY.
+
+scenarios: reproducible benchmark scenarios of views and analyses, e.g. the
+node list, the 3D viewer export, skeleton measurements, skeleton graphs,
+circles of hell and annotation queries.
+
+The catmaid_benchmark management command generates data, runs the scenarios
+and writes the results as JSON, so that they can be compared across releases.
+"""
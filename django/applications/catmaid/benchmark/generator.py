@@ -0,0 +1,205 @@
+""" Generation of synthetic connectomes for benchmarks.
+
+All rows are written with COPY. The triggers that maintain the skeleton
+summary and connectivity tables stay enabled, so that generating data doesn't
+affect other projects or concurrent writers.
+"""
+
+from StringIO import StringIO
+
+import numpy as np
+
+from django.db import connection, transaction
+
+from catmaid.control.arbor import accumulate_to_root
+from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
+from catmaid.control.tracing import setup_tracing
+
+# Labels used for tags, the most common ones first
+LABELS = ('TODO', 'ends', 'uncertain end', 'uncertain continuation', 'soma',
+        'mitochondrion', 'microtubules end', 'not a branch')
+
+def synthetic_arbors(n_skeletons, n_nodes, first_skeleton_id=1,
+        random=np.random):
+    """ Returns the arrays of node IDs, parent IDs, skeleton IDs and positions
+    of n_skeletons random arbors with n_nodes nodes each. Most nodes continue
+    the previous node, about every tenth node branches off a random earlier
+    node. Every node is placed a short random step away from its parent, roots
+    are spread over a volume of 100 x 100 um and 100 sections of 50 nm.
+    Random numbers are taken from the given numpy RandomState. """
+    ids = np.arange(n_skeletons * n_nodes, dtype=np.int64) + 1
+    local = np.tile(np.arange(n_nodes, dtype=np.int64), n_skeletons)
+    offsets = np.repeat(np.arange(n_skeletons, dtype=np.int64) * n_nodes,
+            n_nodes)
+    branching = random.rand(len(ids)) < 0.1
+    parents = np.where(branching,
+            (random.rand(len(ids)) * local).astype(np.int64), local - 1)
+    parent_ids = np.where(local == 0, -1, parents + offsets + 1)
+    skeleton_ids = offsets / n_nodes + first_skeleton_id
+    steps = random.uniform(-50, 50, (len(ids), 3))
+    steps[:, 2] = random.randint(-1, 2, len(ids)) * 50
+    roots = local == 0
+    steps[roots, :2] = random.uniform(0, 100000, (roots.sum(), 2))
+    steps[roots, 2] = random.randint(0, 100, roots.sum()) * 50
+    # The position of a node is the sum of the steps of its ancestors
+    positions = accumulate_to_root(np.where(roots, -1, parents + offsets),
+            steps)
+    return ids, parent_ids, skeleton_ids, positions
+
+def _allocate_ids(cursor, n):
+    """ Returns an array of n new concept IDs. """
+    cursor.execute('''
+    SELECT nextval('concept_id_seq') FROM generate_series(1, %s)
+    ''', (int(n),))
+    return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+def _copy(cursor, table, columns, rows):
+    """ Writes the rows into the given columns of the table with COPY. None is
+    written as NULL. """
+    data = StringIO()
+    for row in rows:
+        data.write('\t'.join('\\N' if v is None else str(v) for v in row))
+        data.write('\n')
+    data.seek(0)
+    cursor.copy_from(data, table, columns=columns)
+
+def _location(position):
+    return '(%s,%s,%s)' % tuple(position)
+
+def generate_connectome(project_id, user, n_neurons, n_nodes, seed=0,
+        synapses_per_neuron=200, tag_fraction=0.01, n_annotations=20):
+    """ Writes n_neurons neurons with skeletons of n_nodes nodes each into the
+    project, along with synapses between them, tags, review states and
+    annotations. The data only depends on the seed. Returns a dictionary with
+    the numbers of created objects and the skeleton IDs. """
+    random = np.random.RandomState(seed)
+    setup_tracing(project_id, user)
+    classes = get_class_to_id_map(project_id,
+            ('neuron', 'skeleton', 'label', 'annotation'))
+    relations = get_relation_to_id_map(project_id, ('model_of',
+            'annotated_with', 'labeled_as', 'presynaptic_to',
+            'postsynaptic_to'))
+    user_id = user.id
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+
+        # Neurons, skeletons, labels and annotations
+        neuron_ids = _allocate_ids(cursor, n_neurons)
+        skeleton_ids = _allocate_ids(cursor, n_neurons)
+        label_ids = _allocate_ids(cursor, len(LABELS))
+        annotation_ids = _allocate_ids(cursor, n_annotations)
+        instances = []
+        for i in xrange(n_neurons):
+            instances.append((neuron_ids[i], 'neuron %s' % neuron_ids[i],
+                    classes['neuron']))
+            instances.append((skeleton_ids[i], 'skeleton %s' %
+                    skeleton_ids[i], classes['skeleton']))
+        instances.extend((label_id, name, classes['label'])
+                for label_id, name in zip(label_ids, LABELS))
+        instances.extend((annotation_id, 'benchmark annotation %s' % i,
+                classes['annotation'])
+                for i, annotation_id in enumerate(annotation_ids))
+        _copy(cursor, 'class_instance', ('id', 'user_id', 'project_id',
+                'class_id', 'name'), ((row[0], user_id, project_id, row[2],
+                row[1]) for row in instances))
+
+        # Every neuron is modeled by a skeleton and has one to three
+        # annotations, the first annotations are the most common ones.
+        links = [(skeleton_ids[i], neuron_ids[i], relations['model_of'])
+                for i in xrange(n_neurons)]
+        weights = 1.0 / np.arange(1, n_annotations + 1)
+        weights /= weights.sum()
+        for neuron_id in neuron_ids:
+            n = random.randint(1, min(3, n_annotations) + 1)
+            for annotation_id in random.choice(annotation_ids, n,
+                    replace=False, p=weights):
+                links.append((neuron_id, annotation_id,
+                        relations['annotated_with']))
+        link_ids = _allocate_ids(cursor, len(links))
+        _copy(cursor, 'class_instance_class_instance', ('id', 'user_id',
+                'project_id', 'relation_id', 'class_instance_a',
+                'class_instance_b'), ((link_id, user_id, project_id, row[2],
+                row[0], row[1]) for link_id, row in zip(link_ids, links)))
+
+        # Treenodes: arbors are placed one after another in a volume of
+        # positive coordinates. Each skeleton is reviewed up to a random
+        # fraction of its nodes and a few edges have a lower confidence.
+        n_total = n_neurons * n_nodes
+        local_ids, local_parents, local_skeletons, positions = \
+                synthetic_arbors(n_neurons, n_nodes, random=random)
+        positions -= positions.min(axis=0)
+        positions[:, 0:2] += 1000
+        node_ids = _allocate_ids(cursor, n_total)
+        parent_ids = np.where(local_parents > 0,
+                node_ids[np.maximum(local_parents, 1) - 1], -1)
+        node_skeleton_ids = skeleton_ids[local_skeletons - 1]
+        reviewed_share = random.rand(n_neurons)
+        reviewed = np.tile(np.arange(n_nodes), n_neurons) < \
+                np.repeat(reviewed_share * n_nodes, n_nodes)
+        confidences = np.where(random.rand(n_total) < 0.02,
+                random.randint(1, 5, n_total), 5)
+
+        _copy(cursor, 'treenode', ('id', 'user_id', 'editor_id', 'project_id',
+                'location', 'parent_id', 'skeleton_id', 'radius',
+                'confidence', 'reviewer_id', 'review_time'),
+                ((node_ids[i], user_id, user_id, project_id,
+                  _location(positions[i]),
+                  parent_ids[i] if parent_ids[i] > 0 else None,
+                  node_skeleton_ids[i], -1, confidences[i],
+                  user_id if reviewed[i] else -1,
+                  'now' if reviewed[i] else None)
+                 for i in xrange(n_total)))
+
+        # Synapses: every connector is close to its presynaptic node and has
+        # one to three postsynaptic partners in random other places.
+        n_connectors = n_neurons * synapses_per_neuron
+        connector_ids = _allocate_ids(cursor, n_connectors)
+        pre_nodes = random.randint(0, n_total, n_connectors)
+        connector_positions = positions[pre_nodes].copy()
+        connector_positions[:, 0:2] += random.uniform(-100, 100,
+                (n_connectors, 2))
+        _copy(cursor, 'connector', ('id', 'user_id', 'editor_id',
+                'project_id', 'location', 'confidence'),
+                ((connector_ids[i], user_id, user_id, project_id,
+                  _location(connector_positions[i]), 5)
+                 for i in xrange(n_connectors)))
+        synapses = [(pre_nodes[i], connector_ids[i],
+                relations['presynaptic_to']) for i in xrange(n_connectors)]
+        for i in xrange(n_connectors):
+            for post_node in random.randint(0, n_total,
+                    random.randint(1, 4)):
+                synapses.append((post_node, connector_ids[i],
+                        relations['postsynaptic_to']))
+        synapse_ids = _allocate_ids(cursor, len(synapses))
+        _copy(cursor, 'treenode_connector', ('id', 'user_id', 'project_id',
+                'relation_id', 'treenode_id', 'connector_id', 'skeleton_id',
+                'confidence'),
+                ((synapse_id, user_id, project_id, row[2], node_ids[row[0]],
+                  row[1], node_skeleton_ids[row[0]], 5)
+                 for synapse_id, row in zip(synapse_ids, synapses)))
+
+        # Tags: a small fraction of random nodes, the first labels are used
+        # most often
+        n_tags = int(n_total * tag_fraction)
+        tagged_nodes = random.choice(n_total, n_tags, replace=False)
+        tag_weights = 1.0 / np.arange(1, len(LABELS) + 1)
+        tag_weights /= tag_weights.sum()
+        tag_labels = random.choice(label_ids, n_tags, p=tag_weights)
+        tag_ids = _allocate_ids(cursor, n_tags)
+        _copy(cursor, 'treenode_class_instance', ('id', 'user_id',
+                'project_id', 'relation_id', 'treenode_id',
+                'class_instance_id'),
+                ((tag_ids[i], user_id, project_id, relations['labeled_as'],
+                  node_ids[tagged_nodes[i]], tag_labels[i])
+                 for i in xrange(n_tags)))
+
+    return {
+        'neurons': n_neurons,
+        'nodes': n_total,
+        'connectors': n_connectors,
+        'synapses': len(synapses),
+        'tags': n_tags,
+        'annotations': n_annotations,
+        'skeleton_ids': [int(skid) for skid in skeleton_ids],
+    }
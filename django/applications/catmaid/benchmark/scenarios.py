@@ -0,0 +1,179 @@
+""" Reproducible benchmark scenarios.
+
+A scenario prepares one call of a view or an analysis with inputs that are
+drawn from the project's data by a seeded random number generator. Only the
+call itself is timed. The same seed and the same data result in the same
+sequence of calls, which makes results of different releases comparable.
+
+Views are called with requests of the benchmark user, created by Django's
+RequestFactory. Analyses whose views cache their results (the skeleton graph
+split by confidence) are called directly, so that every call computes them.
+"""
+
+import json
+import random
+import time
+
+from django.db import connection
+from django.test.client import RequestFactory
+
+from catmaid.control import circles, graph2, neuron_annotations, node, \
+        skeletonexport
+from catmaid.control.common import get_class_to_id_map
+
+class BenchmarkContext(object):
+    """ The project, user and data that scenarios draw their inputs from. """
+
+    def __init__(self, project_id, user):
+        self.project_id = int(project_id)
+        self.user = user
+        self.factory = RequestFactory()
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT skeleton_id, num_nodes FROM skeleton_summary
+        WHERE project_id = %s AND num_nodes > 0
+        ORDER BY skeleton_id
+        ''', (self.project_id,))
+        self.skeletons = cursor.fetchall()
+        if not self.skeletons:
+            raise Exception("Project %s has no skeletons" % self.project_id)
+        annotation_class = get_class_to_id_map(self.project_id,
+                ('annotation',)).get('annotation')
+        cursor.execute('''
+        SELECT id FROM class_instance
+        WHERE project_id = %s AND class_id = %s
+        ORDER BY id
+        ''', (self.project_id, annotation_class))
+        self.annotation_ids = [row[0] for row in cursor.fetchall()]
+
+    def post(self, data):
+        request = self.factory.post('/', data)
+        request.user = self.user
+        return request
+
+    def random_skeletons(self, rng, n):
+        return [row[0] for row in rng.sample(self.skeletons,
+                min(n, len(self.skeletons)))]
+
+    def random_node(self, rng):
+        """ Returns the ID and location of a random treenode. """
+        skeleton_id, num_nodes = rng.choice(self.skeletons)
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT id, (location).x, (location).y, (location).z FROM treenode
+        WHERE skeleton_id = %s
+        ORDER BY id LIMIT 1 OFFSET %s
+        ''', (skeleton_id, rng.randint(0, num_nodes - 1)))
+        return cursor.fetchone()
+
+
+def node_list(context, rng):
+    """ The nodes in a field of view of 4000 x 3000 nm around a random node,
+    with labels. """
+    node_id, x, y, z = context.random_node(rng)
+    request = context.post({'left': x - 2000, 'top': y - 1500, 'z': z,
+            'width': 4000, 'height': 3000, 'zres': 50, 'labels': 'true',
+            'atnid': node_id})
+    return lambda: node.node_list_tuples(request,
+            project_id=context.project_id)
+
+def skeleton_for_3d_viewer(context, rng):
+    """ A random skeleton with connectors and tags, as JSON. """
+    skeleton_id = context.random_skeletons(rng, 1)[0]
+    request = context.post({})
+    return lambda: skeletonexport.skeleton_for_3d_viewer(request,
+            project_id=context.project_id, skeleton_id=skeleton_id)
+
+def measure_skeletons(context, rng):
+    """ Measurements of ten random skeletons. """
+    data = dict(('skeleton_ids[%s]' % i, skid) for i, skid in
+            enumerate(context.random_skeletons(rng, 10)))
+    request = context.post(data)
+    return lambda: skeletonexport.measure_skeletons(request,
+            project_id=context.project_id)
+
+def skeleton_graph(context, rng):
+    """ The synapse graph of ten random skeletons, from the connectivity
+    table. """
+    data = dict(('skeleton_list[%s]' % i, skid) for i, skid in
+            enumerate(context.random_skeletons(rng, 10)))
+    request = context.post(data)
+    return lambda: graph2.skeleton_graph(request,
+            project_id=context.project_id)
+
+def skeleton_graph_split(context, rng):
+    """ The synapse graph of ten random skeletons that are split at edges
+    with a confidence below 3. """
+    skeleton_ids = context.random_skeletons(rng, 10)
+    return lambda: graph2._skeleton_graph(context.project_id, skeleton_ids,
+            3, 0, [], False, 2500, 10)
+
+def circles_of_hell(context, rng):
+    """ All partners of a random skeleton. """
+    request = context.post({
+            'skeleton_ids[0]': context.random_skeletons(rng, 1)[0],
+            'n_circles': 1, 'min_pre': 0, 'min_post': 0})
+    return lambda: circles.circles_of_hell(request,
+            project_id=context.project_id)
+
+def list_annotations(context, rng):
+    """ All annotations of the project with their users. """
+    request = context.post({})
+    return lambda: neuron_annotations.list_annotations(request,
+            project_id=context.project_id)
+
+def query_neurons_by_annotations(context, rng):
+    """ The neurons that have a random annotation. """
+    if not context.annotation_ids:
+        raise Exception("Project %s has no annotations" % context.project_id)
+    request = context.post({
+            'neuron_query_by_annotation': rng.choice(context.annotation_ids)})
+    return lambda: neuron_annotations.query_neurons_by_annotations(request,
+            project_id=context.project_id)
+
+# All scenarios in the order in which they are run
+SCENARIOS = (
+    ('node_list', node_list),
+    ('skeleton_for_3d_viewer', skeleton_for_3d_viewer),
+    ('measure_skeletons', measure_skeletons),
+    ('skeleton_graph', skeleton_graph),
+    ('skeleton_graph_split', skeleton_graph_split),
+    ('circles_of_hell', circles_of_hell),
+    ('list_annotations', list_annotations),
+    ('query_neurons_by_annotations', query_neurons_by_annotations),
+)
+
+def _response_size(result):
+    if hasattr(result, 'content'):
+        return len(result.content)
+    return len(json.dumps(result))
+
+def run(context, names=None, repeat=5, seed=0):
+    """ Runs the scenarios with the given names (defaults to all) repeat times
+    each, plus one call that isn't timed to warm up caches. Returns a
+    dictionary of scenario names vs. their results: the times of all calls
+    in seconds, their minimum, median and mean and the mean response size in
+    bytes. """
+    results = {}
+    for name, scenario in SCENARIOS:
+        if names and name not in names:
+            continue
+        rng = random.Random('%s-%s' % (seed, name))
+        scenario(context, rng)()
+        times, sizes = [], []
+        for i in xrange(repeat):
+            call = scenario(context, rng)
+            start = time.time()
+            result = call()
+            times.append(time.time() - start)
+            sizes.append(_response_size(result))
+        ordered = sorted(times)
+        results[name] = {
+            'description': ' '.join(scenario.__doc__.split()),
+            'times': times,
+            'min': ordered[0],
+            'median': ordered[len(ordered) / 2],
+            'mean': sum(times) / len(times),
+            'response_size': sum(sizes) / len(sizes),
+        }
+    return results
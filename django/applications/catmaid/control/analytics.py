@@ -1,6 +1,7 @@
 from django.db import connection
 from django.http import HttpResponse
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
 from catmaid.models import UserRole
 from collections import namedtuple, defaultdict
 from itertools import chain, islice
@@ -18,34 +19,29 @@ def analyze_skeletons(request, project_id=None):
 
     cursor = connection.cursor()
 
-    query = '''
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2,
-             relation r1,
-             relation r2
-        WHERE tc1.skeleton_id IN (%s)
-          AND tc1.relation_id = r1.id
-          AND %s
-          AND tc1.connector_id = tc2.connector_id
-          AND tc2.relation_id = r2.id
-          AND %s
-        GROUP BY tc2.skeleton_id'''
+    downstream = '''
+        SELECT DISTINCT post_skeleton_id
+        FROM skeleton_connectivity
+        WHERE pre_skeleton_id IN (%s)''' % s_skids
+    upstream = '''
+        SELECT DISTINCT pre_skeleton_id
+        FROM skeleton_connectivity
+        WHERE post_skeleton_id IN (%s)''' % s_skids
 
     if 0 == extra:
         # Just skids
         pass
     elif 1 == extra:
         # Include downstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'presynaptic_to'", "r2.relation_name = 'postsynaptic_to'"))
+        cursor.execute(downstream)
         skids.extend([s[0] for s in cursor.fetchall()])
     elif 2 == extra:
         # Include upstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'postsynaptic_to'", "r2.relation_name = 'presynaptic_to'"))
+        cursor.execute(upstream)
         skids.extend([s[0] for s in cursor.fetchall()])
     elif 3 == extra:
         # Include both upstream and downstream skeletons
-        cursor.execute(query % (s_skids, "(r1.relation_name = 'presynaptic_to' OR r1.relation_name = 'postsynaptic_to')", "(r2.relation_name = 'presynaptic_to' OR r2.relation_name = 'postsynaptic_to')"))
+        cursor.execute(downstream + ' UNION ' + upstream)
         skids.extend([s[0] for s in cursor.fetchall()])
 
 
@@ -53,13 +49,12 @@ def analyze_skeletons(request, project_id=None):
     cursor.execute('''
     SELECT cici.class_instance_a, ci.name
     FROM class_instance_class_instance cici,
-         class_instance ci,
-         relation r
+         class_instance ci
     WHERE cici.class_instance_a IN (%s)
       AND cici.class_instance_b = ci.id
-      AND cici.relation_id = r.id
-      AND r.relation_name = 'model_of'
-    ''' % ",".join(str(skid) for skid in skids))
+      AND cici.relation_id = %s
+    ''' % (",".join(str(skid) for skid in skids),
+           get_relation_to_id_map(project_id, ('model_of',))['model_of']))
 
     blob = {'issues': tuple((skid, _analyze_skeleton(project_id, skid, adjacents)) for skid in skids),
             'names': dict(cursor.fetchall()),
@@ -87,18 +82,12 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
     POST = 'postsynaptic_to'
 
     # Retrieve relation IDs vs names
-    cursor.execute('''
-    SELECT id, relation_name
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = '%s'
-           OR relation_name = '%s')
-    ''' % (project_id, PRE, POST))
-    
+    relation_ids = get_relation_to_id_map(project_id, (PRE, POST, 'labeled_as'))
+
     relations = {} # both ways
-    for row in cursor.fetchall():
-        relations[row[0]] = row[1]
-        relations[row[1]] = row[0]
+    for name in (PRE, POST):
+        relations[name] = relation_ids[name]
+        relations[relation_ids[name]] = name
 
     # Transform strings to integer IDs
     PRE = relations[PRE]
@@ -178,10 +167,11 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
            class_instance.name
     FROM treenode
              LEFT OUTER JOIN
-                 (treenode_class_instance INNER JOIN relation ON (treenode_class_instance.relation_id = relation.id AND relation.relation_name = 'labeled_as') INNER JOIN class_instance ON (treenode_class_instance.class_instance_id = class_instance.id))
-             ON (treenode_class_instance.treenode_id = treenode.id)
+                 (treenode_class_instance INNER JOIN class_instance ON (treenode_class_instance.class_instance_id = class_instance.id))
+             ON (treenode_class_instance.treenode_id = treenode.id
+                 AND treenode_class_instance.relation_id = %s)
     WHERE treenode.skeleton_id = %s
-    ''' % skeleton_id)
+    ''' % (relation_ids['labeled_as'], skeleton_id))
 
     # Collapse repeated rows into nodes with none or more tags
     nodes = {}
@@ -0,0 +1,604 @@
+""" Array based representations of arbors (trees of treenodes).
+
+The nodes of one or more arbors are stored in flat NumPy arrays, where the
+parent of each node is given as the index of the parent node in these arrays
+(-1 for root nodes). Operations are expressed as array operations over all
+nodes, and therefore over many arbors at once, instead of loops over Python
+objects.
+"""
+
+import networkx as nx
+import numpy as np
+
+from collections import defaultdict
+
+
+def parent_indices(ids, parent_ids):
+    """ Returns an array with the index of the parent of each node, or -1 if
+    the node is a root. ids and parent_ids are arrays of equal length, with
+    -1 as parent ID of root nodes. """
+    order = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    is_child = parent_ids != -1
+    positions = np.searchsorted(sorted_ids, parent_ids[is_child])
+    positions[positions == len(ids)] = 0
+    if not np.array_equal(sorted_ids[positions], parent_ids[is_child]):
+        raise ValueError("The parents of some nodes are missing")
+    parents = np.empty(len(ids), np.int64)
+    parents.fill(-1)
+    parents[is_child] = order[positions]
+    return parents
+
+def accumulate_to_root(parents, values):
+    """ Returns for every node the sum of the values of the node itself and
+    all of its ancestors. Uses pointer jumping, which takes a number of array
+    operations logarithmic in the depth of the arbors. """
+    total = np.array(values)
+    ancestors = parents.copy()
+    active = np.flatnonzero(ancestors != -1)
+    # Each iteration doubles the reach of the ancestors, so more iterations
+    # than bits in the number of nodes mean that the parents form a cycle.
+    for i in xrange(len(parents).bit_length() + 1):
+        if 0 == len(active):
+            return total
+        reached = ancestors[active]
+        total[active] += total[reached]
+        ancestors[active] = ancestors[reached]
+        active = active[ancestors[active] != -1]
+    raise ValueError("The parents of some nodes form a cycle")
+
+def _edge_lengths(positions, children, parents):
+    return np.sqrt(np.sum((positions[children] - positions[parents]) ** 2, axis=1))
+
+def measure(ids, parent_ids, skeleton_ids, positions):
+    """ Measures all arbors whose nodes are given with the arrays ids,
+    parent_ids (-1 for root nodes), skeleton_ids and positions (an n x 3
+    array). Returns a tuple with the sorted array of the distinct skeleton
+    IDs and a dictionary of measurement names vs arrays of measurements, with
+    one value per skeleton:
+
+    n_nodes: the number of nodes.
+    raw_cable: the sum of the lengths of all edges.
+    smooth_cable: the cable length after moving every slab node towards its
+    neighbors, 60% of the way to their average position weighted by the
+    length of the edge to each neighbor. Root, branch and end nodes stay in
+    place.
+    principal_branch_cable: the smoothed cable length from the end node with
+    the most edges to the root (the node with the lowest ID among equally
+    distant end nodes) to the root.
+    n_ends: the number of end nodes, including a root with a single child.
+    n_branch: the number of branch nodes, including a root with more than two
+    children.
+    """
+    n = len(ids)
+    skids, sk = np.unique(skeleton_ids, return_inverse=True)
+    m = len(skids)
+    parents = parent_indices(ids, parent_ids)
+    has_parent = parents != -1
+    children = np.flatnonzero(has_parent)
+    child_parents = parents[children]
+    distances = _edge_lengths(positions, children, child_parents)
+
+    n_children = np.bincount(child_parents, minlength=n)
+    is_end = np.where(has_parent, n_children == 0, n_children == 1)
+    is_branch = np.where(has_parent, n_children > 1, n_children > 2)
+
+    # Weighted average position of the neighbors of every node, where each
+    # neighbor is weighted with the length of the edge to it.
+    weights = np.bincount(child_parents, weights=distances, minlength=n) \
+            + np.bincount(children, weights=distances, minlength=n)
+    smooth = positions.copy()
+    slab = ~is_end & ~is_branch & (weights > 0)
+    for k in xrange(3):
+        weighted = np.bincount(child_parents,
+                weights=positions[children, k] * distances, minlength=n) \
+                + np.bincount(children,
+                weights=positions[child_parents, k] * distances, minlength=n)
+        smooth[slab, k] = positions[slab, k] * 0.4 \
+                + weighted[slab] / weights[slab] * 0.6
+    smooth_distances = _edge_lengths(smooth, children, child_parents)
+
+    # The principal branch runs from the end node farthest from the root,
+    # in number of edges, to the root.
+    depth = accumulate_to_root(parents, has_parent.astype(np.int64))
+    smooth_to_root = np.zeros(n)
+    smooth_to_root[children] = smooth_distances
+    smooth_to_root = accumulate_to_root(parents, smooth_to_root)
+    leaves = np.flatnonzero(n_children == 0)
+    leaves = leaves[np.lexsort((ids[leaves], -depth[leaves], sk[leaves]))]
+    first = np.ones(len(leaves), np.bool)
+    first[1:] = sk[leaves[1:]] != sk[leaves[:-1]]
+    principal_ends = leaves[first]
+    principal_branch_cable = np.zeros(m)
+    principal_branch_cable[sk[principal_ends]] = smooth_to_root[principal_ends]
+
+    return skids, {
+        'n_nodes': np.bincount(sk, minlength=m),
+        'raw_cable': np.bincount(sk[children], weights=distances, minlength=m),
+        'smooth_cable': np.bincount(sk[children], weights=smooth_distances,
+                minlength=m),
+        'principal_branch_cable': principal_branch_cable,
+        'n_ends': np.bincount(sk, weights=is_end, minlength=m).astype(np.int64),
+        'n_branch': np.bincount(sk, weights=is_branch,
+                minlength=m).astype(np.int64),
+    }
+
+
+def _roots(parents):
+    """ Returns for every node the index of the root of its tree. """
+    roots = np.where(parents == -1, np.arange(len(parents)), parents)
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+class _NodeProperties(object):
+    """ A read-only mapping of node IDs vs dictionaries of node properties,
+    like the 'node' attribute of a networkx graph. The dictionaries are
+    created on access. """
+
+    def __init__(self, arbor):
+        self.arbor = arbor
+
+    def __getitem__(self, node_id):
+        return self.arbor._properties_of(self.arbor.index(node_id))
+
+    def get(self, node_id, default=None):
+        if node_id in self.arbor:
+            return self[node_id]
+        return default
+
+    def __contains__(self, node_id):
+        return node_id in self.arbor
+
+    def __len__(self):
+        return len(self.arbor)
+
+    def __iter__(self):
+        return iter(self.arbor)
+
+    def iterkeys(self):
+        return iter(self.arbor)
+
+    def itervalues(self):
+        return (self.arbor._properties_of(i) for i in xrange(len(self.arbor)))
+
+    def iteritems(self):
+        return self.arbor.nodes_iter(data=True)
+
+
+class Arbor(object):
+    """ A tree of nodes, stored in arrays: the IDs of the nodes, the index of
+    the parent of every node (-1 for the root) and the children of every node
+    as compressed sparse rows (the indices of the children of node i are
+    child_indices[child_offsets[i]:child_offsets[i+1]]). Node properties are
+    stored in a dictionary of property names vs arrays or lists with one
+    entry per node.
+
+    Besides the tree operations of catmaid.control.tree_util, an Arbor
+    provides the read-only part of the networkx.DiGraph interface that is
+    used for skeletons, with edges pointing from parent to child, so that it
+    can be used in place of a DiGraph. Parents that are not among the nodes
+    are ignored, which makes an Arbor with cut edges a forest.
+    """
+
+    def __init__(self, ids, parent_ids, properties=None):
+        """ ids: the node IDs.
+        parent_ids: the ID of the parent of every node, -1 or None for roots.
+        properties: a dictionary of property names vs arrays or lists. """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self._order = np.argsort(self.ids, kind='mergesort')
+        self._sorted_ids = self.ids[self._order]
+        self.properties = properties if properties is not None else {}
+        parent_ids = np.fromiter((-1 if p is None else p for p in parent_ids),
+                np.int64, len(self.ids))
+        self._set_parents(self.indices(parent_ids))
+
+    def _set_parents(self, parents):
+        self.parents = parents
+        children = np.flatnonzero(parents != -1)
+        self.child_indices = children[np.argsort(parents[children], kind='mergesort')]
+        self.child_offsets = np.zeros(len(parents) + 1, np.int64)
+        np.cumsum(np.bincount(parents[children], minlength=len(parents)),
+                out=self.child_offsets[1:])
+
+    def indices(self, node_ids):
+        """ Returns the indices of the given node IDs, -1 for IDs that are not
+        part of the arbor. """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if 0 == len(self.ids):
+            return np.zeros(len(node_ids), np.int64) - 1
+        positions = np.searchsorted(self._sorted_ids, node_ids)
+        positions[positions == len(self.ids)] = 0
+        return np.where(self._sorted_ids[positions] == node_ids,
+                self._order[positions], -1)
+
+    def index(self, node_id):
+        """ Returns the index of the node with the given ID. Raises KeyError if
+        there is no such node. """
+        position = np.searchsorted(self._sorted_ids, node_id)
+        if position == len(self.ids) or self._sorted_ids[position] != node_id:
+            raise KeyError(node_id)
+        return int(self._order[position])
+
+    def _subset(self, indices):
+        """ Returns a new Arbor with the nodes at the given indices. """
+        indices = np.asarray(indices, dtype=np.int64)
+        properties = {}
+        for name, values in self.properties.iteritems():
+            if isinstance(values, np.ndarray):
+                properties[name] = values[indices]
+            else:
+                properties[name] = [values[i] for i in indices.tolist()]
+        parents = self.parents[indices]
+        parent_ids = np.where(parents == -1, -1, self.ids[parents])
+        return Arbor(self.ids[indices], parent_ids, properties)
+
+    def _children_of(self, indices):
+        """ Returns the indices of all children of the nodes at indices. """
+        starts = self.child_offsets[indices]
+        lengths = self.child_offsets[indices + 1] - starts
+        total = lengths.sum()
+        if 0 == total:
+            return np.zeros(0, np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(total) - np.repeat(offsets, lengths) \
+                + np.repeat(starts, lengths)
+        return self.child_indices[positions]
+
+    def _properties_of(self, i):
+        props = {}
+        for name, values in self.properties.iteritems():
+            value = values[i]
+            if isinstance(values, np.ndarray):
+                value = value.tolist()
+            props[name] = value
+        return props
+
+    def copy(self):
+        arbor = Arbor.__new__(Arbor)
+        arbor.ids = self.ids
+        arbor._order = self._order
+        arbor._sorted_ids = self._sorted_ids
+        arbor.properties = self.properties
+        arbor.parents = self.parents.copy()
+        arbor.child_indices = self.child_indices
+        arbor.child_offsets = self.child_offsets
+        return arbor
+
+    # Read-only networkx.DiGraph interface
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __contains__(self, node_id):
+        try:
+            self.index(node_id)
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    @property
+    def node(self):
+        return _NodeProperties(self)
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def nodes(self):
+        return self.ids.tolist()
+
+    def nodes_iter(self, data=False):
+        if data:
+            return ((node_id, self._properties_of(i))
+                    for i, node_id in enumerate(self.ids.tolist()))
+        return iter(self.ids.tolist())
+
+    def successors(self, node_id):
+        i = self.index(node_id)
+        return self.ids[self.child_indices[
+                self.child_offsets[i]:self.child_offsets[i + 1]]].tolist()
+
+    def successors_iter(self, node_id):
+        return iter(self.successors(node_id))
+
+    def predecessors(self, node_id):
+        parent = self.parents[self.index(node_id)]
+        return [] if -1 == parent else [int(self.ids[parent])]
+
+    def predecessors_iter(self, node_id):
+        return iter(self.predecessors(node_id))
+
+    def edges(self):
+        """ Returns a list of (parent ID, child ID) tuples. """
+        children = np.flatnonzero(self.parents != -1)
+        return zip(self.ids[self.parents[children]].tolist(),
+                self.ids[children].tolist())
+
+    def edges_iter(self):
+        return iter(self.edges())
+
+    def to_networkx(self):
+        """ Returns a networkx.DiGraph with the same nodes, properties and
+        edges (from parent to child). """
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.nodes_iter(data=True))
+        graph.add_edges_from(self.edges())
+        return graph
+
+    # Tree operations
+
+    def parent(self, node_id):
+        """ Returns the ID of the parent of the node, or None for a root. """
+        parent = self.parents[self.index(node_id)]
+        return None if -1 == parent else int(self.ids[parent])
+
+    def find_root(self):
+        """ Returns the ID of the first node without a parent. """
+        roots = np.flatnonzero(self.parents == -1)
+        return int(self.ids[roots[0]]) if len(roots) > 0 else None
+
+    def edge_count_to_root(self, root_node=None):
+        """ Returns a dictionary of node ID vs the number of nodes from the
+        root to the node, counting the root as 1. If root_node is given and
+        not the root, only the nodes downstream of root_node are included. """
+        depths = accumulate_to_root(self.parents,
+                (self.parents != -1).astype(np.int64)) + 1
+        if root_node is None or -1 == self.parents[self.index(root_node)]:
+            return dict(zip(self.ids.tolist(), depths.tolist()))
+        i = self.index(root_node)
+        indices = [np.array([i])]
+        while len(indices[-1]) > 0:
+            indices.append(self._children_of(indices[-1]))
+        indices = np.concatenate(indices)
+        return dict(zip(self.ids[indices].tolist(),
+                (depths[indices] - depths[i] + 1).tolist()))
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from new_root to the
+        root. """
+        i = self.index(new_root)
+        parents = self.parents.tolist()
+        path = [i]
+        while -1 != parents[path[-1]]:
+            path.append(parents[path[-1]])
+        if 1 == len(path):
+            return
+        new_parents = self.parents.copy()
+        new_parents[path[1:]] = path[:-1]
+        new_parents[i] = -1
+        self._set_parents(new_parents)
+
+    def partition(self, root_node=None):
+        """ Partition the arbor as a list of sequences of node IDs, with
+        branch nodes repeated as ends of all sequences except the longest one
+        that finishes at the root. Each sequence runs from an end node to
+        either the root or a branch node. root_node is ignored, the arbor
+        is always partitioned from its root. """
+        depths = accumulate_to_root(self.parents,
+                (self.parents != -1).astype(np.int64))
+        ends = np.flatnonzero(np.diff(self.child_offsets) == 0)
+        ends = ends[np.argsort(-depths[ends], kind='mergesort')]
+        parents = self.parents.tolist()
+        ids = self.ids.tolist()
+        seen = set()
+        for end in ends.tolist():
+            sequence = [ids[end]]
+            parent = parents[end]
+            while -1 != parent:
+                sequence.append(ids[parent])
+                if parent in seen:
+                    break
+                seen.add(parent)
+                parent = parents[parent]
+            if len(sequence) > 1:
+                yield sequence
+
+    def simplify(self, keepers):
+        """ Returns a new networkx.Graph where only the nodes to keep and the
+        branch points between them are preserved.
+        WARNING: will reroot the arbor at the first of the keepers.
+        WARNING: keepers can't be empty. """
+        keepers = set(keepers)
+        mini = nx.Graph()
+        mini.add_nodes_from(keepers)
+        root = keepers.pop()
+        self.reroot(root)
+        parents = self.parents.tolist()
+        ids = self.ids.tolist()
+        n_children = np.diff(self.child_offsets).tolist()
+        keeper_indices = set(self.indices(list(mini)).tolist())
+        children = defaultdict(int)
+        seen_branch_nodes = set(self.indices(list(keepers)).tolist())
+        paths = []
+        for node in self.indices(list(keepers)).tolist():
+            path = [node]
+            paths.append(path)
+            parent = parents[node]
+            while -1 != parent:
+                if parent in keeper_indices:
+                    # Reached one of the keeper nodes
+                    path.append(parent)
+                    break
+                elif n_children[parent] > 1:
+                    # Reached a branch node
+                    children[parent] += 1
+                    path.append(parent)
+                    if parent in seen_branch_nodes:
+                        break
+                    seen_branch_nodes.add(parent)
+                parent = parents[parent]
+        for path in paths:
+            # Nodes in the middle of a path are branch nodes, which are added
+            # only if they have been visited more than once.
+            origin = path[0]
+            for i in xrange(1, len(path) - 1):
+                if children[path[i]] > 1:
+                    mini.add_edge(ids[origin], ids[path[i]])
+                    origin = path[i]
+            mini.add_edge(ids[origin], ids[path[-1]])
+        return mini
+
+    def spanning_tree(self, preserve):
+        """ Returns a new Arbor with the smallest subtree that includes all
+        nodes in preserve. It is empty if preserve is. """
+        preserve = self.indices(list(set(preserve)))
+        if 0 == len(preserve):
+            return self._subset([])
+        parents = self.parents.tolist()
+        # Mark the paths from all preserved nodes to the root
+        marked = set()
+        n_marked_children = defaultdict(int)
+        for node in preserve.tolist():
+            while node not in marked:
+                marked.add(node)
+                parent = parents[node]
+                if -1 == parent:
+                    top = node
+                    break
+                n_marked_children[parent] += 1
+                node = parent
+        # Remove the part of the paths above the most downstream node that is
+        # common to all of them.
+        preserved = set(preserve.tolist())
+        node = top
+        while node not in preserved and 1 == n_marked_children[node]:
+            marked.remove(node)
+            node = next(child for child in self._children_of(np.array([node])).tolist()
+                    if child in marked)
+        return self._subset(sorted(marked))
+
+    def cable_length(self, locations=None):
+        """ Returns the sum of the lengths of all edges. locations is a
+        dictionary of node ID vs iterable of node position (1d, 2d, 3d, ...).
+        If it is not given, the 'location' property is used. """
+        if locations is None:
+            positions = np.asarray(self.properties['location'], dtype=np.float64)
+        else:
+            positions = np.array([tuple(locations[node_id]) for node_id in self],
+                    dtype=np.float64)
+        children = np.flatnonzero(self.parents != -1)
+        return float(_edge_lengths(positions, children, self.parents[children]).sum())
+
+    def split(self, cut=()):
+        """ Returns a list of Arbors, one for each tree that results from
+        removing the edges from the nodes in cut to their parents. """
+        parents = self.parents
+        cut = self.indices(list(cut))
+        cut = cut[cut != -1]
+        if len(cut) > 0:
+            parents = parents.copy()
+            parents[cut] = -1
+        roots = _roots(parents)
+        order = np.argsort(roots, kind='mergesort')
+        boundaries = np.flatnonzero(np.diff(roots[order])) + 1
+        groups = np.split(order, boundaries) if len(order) > 0 else []
+        if len(groups) == 1 and 0 == len(cut):
+            return [self]
+        return [self._subset(group) for group in groups]
+
+    def components(self, node_ids):
+        """ Returns the connected components of the subgraph formed by the
+        given nodes, as lists of node IDs. """
+        indices = self.indices(list(node_ids))
+        indices = indices[indices != -1]
+        member = np.zeros(len(self.ids), np.bool)
+        member[indices] = True
+        parents = np.where(member[self.parents] & (self.parents != -1),
+                self.parents, -1)[indices]
+        # Map parents to positions within indices
+        position = np.zeros(len(self.ids), np.int64) - 1
+        position[indices] = np.arange(len(indices))
+        parents = np.where(parents == -1, -1, position[parents])
+        roots = _roots(parents)
+        components = defaultdict(list)
+        for root, node_id in zip(roots.tolist(), self.ids[indices].tolist()):
+            components[root].append(node_id)
+        return components.values()
+
+
+class TreeDistances(object):
+    """ The lengths of the paths between nodes of a forest, computed from the
+    distance of every node to its root and the lowest common ancestor (LCA)
+    of each pair of nodes. The LCA of two nodes is the node with the lowest
+    depth on an Euler tour of the tree between the first visits of both
+    nodes, which is found in constant time with a sparse table of range
+    minima. Preparation takes O(n log n) time and memory, instead of the
+    O(n) memory per source node of a shortest path search. """
+
+    def __init__(self, parents, lengths):
+        """ parents: the index of the parent of every node, -1 for roots.
+        lengths: the length of the edge from every node to its parent,
+        ignored for roots. """
+        n = len(parents)
+        is_child = parents != -1
+        self.roots = _roots(parents)
+        self.depths = accumulate_to_root(parents,
+                np.where(is_child, lengths, 0.0).astype(np.float64))
+        self.levels = accumulate_to_root(parents, is_child.astype(np.int64))
+
+        # Euler tour: every node is visited on the way down and again after
+        # returning from each of its children
+        children = np.flatnonzero(is_child)
+        child_indices = children[np.argsort(parents[children],
+                kind='mergesort')].tolist()
+        offsets = [0] + np.cumsum(np.bincount(parents[children],
+                minlength=n)).tolist()
+        next_child = offsets[:-1]
+        tour = []
+        first = [0] * n
+        for root in np.flatnonzero(~is_child).tolist():
+            first[root] = len(tour)
+            tour.append(root)
+            stack = [root]
+            while stack:
+                node = stack[-1]
+                k = next_child[node]
+                if k < offsets[node + 1]:
+                    next_child[node] = k + 1
+                    child = child_indices[k]
+                    first[child] = len(tour)
+                    tour.append(child)
+                    stack.append(child)
+                else:
+                    stack.pop()
+                    if stack:
+                        tour.append(stack[-1])
+        self.first = np.array(first, np.int64)
+
+        # Row k holds the node of lowest level within the 2^k tour entries
+        # starting at each position
+        m = len(tour)
+        self.table = np.empty((max(1, m.bit_length()), m), np.int32)
+        self.table[0] = tour
+        for k in xrange(1, len(self.table)):
+            half = 1 << (k - 1)
+            a = self.table[k - 1, :m - half]
+            b = self.table[k - 1, half:]
+            self.table[k, :m - half] = np.where(self.levels[a] <= self.levels[b], a, b)
+            self.table[k, m - half:] = self.table[k - 1, m - half:]
+
+    def lca(self, a, b):
+        """ Returns the indices of the lowest common ancestors of the nodes
+        at indices a and b, which are broadcast against each other. Nodes of
+        different trees have no common ancestor and get an arbitrary result. """
+        fa, fb = np.broadcast_arrays(self.first[a], self.first[b])
+        left = np.minimum(fa, fb)
+        right = np.maximum(fa, fb)
+        # The largest k with 2^k <= right - left + 1
+        k = np.frexp(right - left + 1)[1] - 1
+        x = self.table[k, left]
+        y = self.table[k, right - (1 << k) + 1]
+        return np.where(self.levels[x] <= self.levels[y], x, y)
+
+    def distances(self, a, b):
+        """ Returns the lengths of the paths between the nodes at indices a
+        and b, which are broadcast against each other. Nodes of different
+        trees are infinitely far apart. """
+        d = self.depths[a] + self.depths[b] - 2 * self.depths[self.lca(a, b)]
+        return np.where(self.roots[a] == self.roots[b], d, np.inf)
@@ -2,10 +2,14 @@ import sys
 import re
 import urllib
 import json
+import threading
+import uuid
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
 from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.http import HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
@@ -88,6 +92,92 @@ def logout_user(request):
     return HttpResponse(json.dumps(profile_context))
 
 
+# The number of permission lookups that had to query the database in the
+# current thread since the last reset, see PermissionQueryCountMiddleware
+_permission_queries = threading.local()
+
+def reset_permission_query_count():
+    _permission_queries.count = 0
+
+def get_permission_query_count():
+    return getattr(_permission_queries, 'count', 0)
+
+def _count_permission_query():
+    _permission_queries.count = get_permission_query_count() + 1
+
+# Cached permissions are stored under keys that contain a generation token,
+# which is replaced to invalidate all of them at once.
+_PERMISSION_GENERATION_KEY = 'catmaid-permission-generation'
+
+def _permission_cache():
+    """ Returns the cache backend for permissions or None if permissions
+    shouldn't be cached. """
+    if getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 60) <= 0:
+        return None
+    return get_cache(getattr(settings, 'PERMISSION_CACHE', 'default'))
+
+def _permission_key(cache, kind, *ids):
+    generation = cache.get(_PERMISSION_GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(_PERMISSION_GENERATION_KEY, generation, None):
+            generation = cache.get(_PERMISSION_GENERATION_KEY) or generation
+    return 'catmaid-permissions-%s-%s-%s' % (generation, kind,
+            '-'.join(str(i) for i in ids))
+
+def _cached_permissions(kind, ids, fetch):
+    """ Returns the cached result of fetch() for the given kind of lookup
+    and object IDs. On a cache miss, fetch() is called and its result is
+    cached for PERMISSION_CACHE_TIMEOUT seconds. """
+    cache = _permission_cache()
+    if cache is None:
+        _count_permission_query()
+        return fetch()
+    key = _permission_key(cache, kind, *ids)
+    value = cache.get(key)
+    if value is None:
+        _count_permission_query()
+        value = fetch()
+        cache.set(key, value, getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 60))
+    return value
+
+def invalidate_permissions(*args, **kwargs):
+    """ Makes all cached project permissions and user domains invalid. It
+    accepts any arguments so that it can be used as signal receiver. """
+    cache = _permission_cache()
+    if cache is not None:
+        cache.set(_PERMISSION_GENERATION_KEY, uuid.uuid4().hex, None)
+
+def _invalidate_permissions_of_user(sender, **kwargs):
+    # Logins only update the time of the last login, which doesn't change
+    # any permission.
+    if kwargs.get('update_fields') == frozenset(['last_login']):
+        return
+    invalidate_permissions()
+
+# Permissions change if object permissions are assigned or removed (e.g. in
+# the admin interface), if group memberships change or if users, groups or
+# projects are changed.
+post_save.connect(invalidate_permissions, sender=UserObjectPermission)
+post_delete.connect(invalidate_permissions, sender=UserObjectPermission)
+post_save.connect(invalidate_permissions, sender=GroupObjectPermission)
+post_delete.connect(invalidate_permissions, sender=GroupObjectPermission)
+post_save.connect(_invalidate_permissions_of_user, sender=User)
+post_delete.connect(invalidate_permissions, sender=User)
+post_save.connect(invalidate_permissions, sender=Group)
+post_delete.connect(invalidate_permissions, sender=Group)
+m2m_changed.connect(invalidate_permissions, sender=User.groups.through)
+post_delete.connect(invalidate_permissions, sender=Project)
+
+def project_permissions(user, project_id):
+    """ Returns the set of codenames of the permissions the user has on the
+    project, either directly or through groups. Raises Project.DoesNotExist
+    if there is no such project. """
+    def fetch():
+        project = Project.objects.get(pk=project_id)
+        return frozenset(get_perms(user, project))
+    return _cached_permissions('project', (user.id, int(project_id)), fetch)
+
 def requires_user_role(roles):
     """
     This decorator will return a JSON error response unless the user is logged in 
@@ -96,11 +186,11 @@ def requires_user_role(roles):
     
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
+            perms = project_permissions(u, kwargs['project_id'])
             
             # Check for admin privs in all cases.
-            has_role = u.has_perm('can_administer', p)
+            has_role = 'can_administer' in perms
             
             if not has_role:
                 # Check the indicated role(s)
@@ -108,9 +198,9 @@ def requires_user_role(roles):
                     roles = [roles]
                 for role in roles:
                     if role == UserRole.Annotate:
-                        has_role = u.has_perm('can_annotate', p)
+                        has_role = 'can_annotate' in perms
                     elif role == UserRole.Browse:
-                        has_role = u.has_perm('can_browse', p)
+                        has_role = 'can_browse' in perms
                     if has_role:
                         break
             
@@ -315,41 +405,32 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
 
 def user_can_edit(cursor, user_id, other_user_id):
     """ Determine whether the user with id 'user_'id' can edit the work of the user with id 'other_user_id'. This will be the case when the user_id belongs to a group whose name is identical to ther username of other_user_id.
-    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources."""
+    This function is equivalent to 'other_user_id in user_domain(cursor, user_id)', whose result is cached."""
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
-    # Retrieve a value larger than zero when the user_id belongs to a group with name equal to that associated with other_user_id
-    cursor.execute("""
-    SELECT count(*)
-    FROM auth_user u,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u.id = %s
-      AND u.username = g.name
-      AND g.id = ug.group_id
-      AND ug.user_id = %s
-    """ % (other_user_id, user_id))
-    rows = cursor.fetchall()
-    return rows and rows[0][0] > 0
+    return other_user_id in user_domain(cursor, user_id)
 
 
 def user_domain(cursor, user_id):
     """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
     A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
-    If a user can only edit its own nodes, then the returned set contains only its own user_id. """
-    cursor.execute("""
-    SELECT u2.id
-    FROM auth_user u1,
-         auth_user u2,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u1.id = %s
-      AND u1.id = ug.user_id
-      AND ug.group_id = g.id
-      AND u2.username = g.name
-    """ % int(user_id))
-    domain = set(row[0] for row in cursor.fetchall())
+    If a user can only edit its own nodes, then the returned set contains only its own user_id.
+    The domain is cached like project permissions, see _cached_permissions. """
+    def fetch():
+        cursor.execute("""
+        SELECT u2.id
+        FROM auth_user u1,
+             auth_user u2,
+             auth_group g,
+             auth_user_groups ug
+        WHERE u1.id = %s
+          AND u1.id = ug.user_id
+          AND ug.group_id = g.id
+          AND u2.username = g.name
+        """ % int(user_id))
+        return frozenset(row[0] for row in cursor.fetchall())
+    domain = set(_cached_permissions('domain', (int(user_id),), fetch))
     domain.add(user_id)
     return domain
 
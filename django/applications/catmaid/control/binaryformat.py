@@ -0,0 +1,115 @@
+""" A compact binary alternative to the JSON responses of views that return
+large lists of rows, like node lists and skeletons.
+
+A response consists of:
+
+  1. The four magic bytes 'CMBF'.
+  2. The length of the header in bytes as little-endian unsigned 32 bit
+     integer.
+  3. The header: a UTF-8 encoded JSON object with the format version, a list
+     of tables and an optional 'data' entry with values that are not
+     tabular (e.g. labels). Each table has a name, a number of rows and a list
+     of columns, and each column has a name, a NumPy type string (e.g. '<i4',
+     '<f8') and the byte offset of its data relative to the end of the
+     header.
+  4. The column data: one little-endian typed array per column. Each array
+     starts at an offset that is a multiple of eight bytes so that it can be
+     viewed directly as a typed array by clients.
+
+Integer columns use 32 bit integers if all values fit and 64 bit integers
+otherwise. NULL values in integer columns (e.g. the parent of a root node) are
+encoded as -1.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from django.http import HttpResponse
+
+
+MAGIC = 'CMBF'
+VERSION = 1
+CONTENT_TYPE = 'application/octet-stream'
+
+_ALIGNMENT = 8
+
+# Column types as they can be given in table definitions
+INT = 'int'
+FLOAT32 = '<f4'
+FLOAT64 = '<f8'
+BOOL = '|u1'
+
+
+def is_requested(request):
+    """ Returns True if the binary format has been requested with a 'format'
+    parameter set to 'binary'. """
+    return 'binary' == request.POST.get('format', request.GET.get('format'))
+
+def _column_array(values, dtype):
+    if INT == dtype:
+        a = np.fromiter((-1 if v is None else v for v in values), np.int64)
+        if len(a) == 0 or (a.min() >= -2**31 and a.max() < 2**31):
+            return a.astype('<i4')
+        return a.astype('<i8')
+    return np.fromiter(values, dtype)
+
+def encode(tables, data=None):
+    """ Encodes the given tables into a string. Tables are expected as a list
+    of (name, rows, columns) tuples, where rows is a sequence of row tuples
+    and columns a list of (name, type) tuples, one for each leading field of
+    the rows. The type is one of INT, FLOAT32, FLOAT64 and BOOL. The optional
+    data has to be serializable as JSON. """
+    header_tables = []
+    chunks = []
+    offset = 0
+    for name, rows, columns in tables:
+        header_columns = []
+        for i, (column_name, dtype) in enumerate(columns):
+            a = _column_array((row[i] for row in rows), dtype)
+            header_columns.append({
+                'name': column_name,
+                'type': a.dtype.str,
+                'offset': offset})
+            chunk = a.tostring()
+            padding = -len(chunk) % _ALIGNMENT
+            chunks.append(chunk)
+            chunks.append('\0' * padding)
+            offset += len(chunk) + padding
+        header_tables.append({
+            'name': name,
+            'rows': len(rows),
+            'columns': header_columns})
+
+    header = json.dumps({
+        'version': VERSION,
+        'tables': header_tables,
+        'data': data}, separators=(',', ':'))
+    # Pad the header so that column data starts aligned
+    header += ' ' * (-(len(MAGIC) + 4 + len(header)) % _ALIGNMENT)
+    return ''.join([MAGIC, struct.pack('<I', len(header)), header] + chunks)
+
+def decode(content):
+    """ Decodes a string created by encode(). Returns a dictionary of table
+    names vs dictionaries of column names vs NumPy arrays, along with the
+    additional data. """
+    if content[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a CATMAID binary response")
+    start = len(MAGIC) + 4
+    header_length = struct.unpack('<I', content[len(MAGIC):start])[0]
+    header = json.loads(content[start:start + header_length])
+    start += header_length
+    tables = {}
+    for table in header['tables']:
+        columns = {}
+        for column in table['columns']:
+            columns[column['name']] = np.frombuffer(content, column['type'],
+                    table['rows'], start + column['offset'])
+        tables[table['name']] = columns
+    return tables, header['data']
+
+def response(tables, data=None):
+    """ Returns an HttpResponse with the given tables encoded in the binary
+    format. """
+    return HttpResponse(encode(tables, data), content_type=CONTENT_TYPE)
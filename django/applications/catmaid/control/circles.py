@@ -2,26 +2,30 @@ import json
 from django.db import connection
 from django.http import HttpResponse
 from catmaid.control.authentication import requires_user_role, UserRole
+from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.skeleton import _neuronnames
 from itertools import combinations
 import networkx as nx
 from collections import defaultdict
 from functools import partial
 
-def _next_circle(skeleton_set, cursor):
+def _next_circle(skeleton_set, relations, cursor):
     """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
+    skids = ','.join(str(skid) for skid in skeleton_set)
     cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
-    ''' % ','.join(str(skid) for skid in skeleton_set))
+    SELECT pre_skeleton_id, %s, post_skeleton_id, count
+    FROM skeleton_connectivity
+    WHERE pre_skeleton_id IN (%s)
+      AND pre_skeleton_id != post_skeleton_id
+    UNION ALL
+    SELECT post_skeleton_id, %s, pre_skeleton_id, count
+    FROM skeleton_connectivity
+    WHERE post_skeleton_id IN (%s)
+      AND pre_skeleton_id != post_skeleton_id
+    ''' % (relations['presynaptic_to'], skids, relations['postsynaptic_to'], skids))
     connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
     for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
+        connections[row[0]][row[1]][row[2]] += row[3]
     return connections
 
 def _clean_mins(request, cursor, project_id):
@@ -35,8 +39,8 @@ def _clean_mins(request, cursor, project_id):
     if -1 == min_post:
         min_post = float('inf')
 
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
     mins = {}
     mins[relations['presynaptic_to']]  = min_post # inverted: all postsynaptic to the set
     mins[relations['postsynaptic_to']] = min_pre # inverted: all presynaptic to the set
@@ -58,14 +62,14 @@ def circles_of_hell(request, project_id=None):
         raise Exception("No skeletons were provided.")
 
     cursor = connection.cursor()
-    mins, _ = _clean_mins(request, cursor, int(project_id))
+    mins, relations = _clean_mins(request, cursor, int(project_id))
 
     current_circle = first_circle
     all_circles = first_circle
 
     while n_circles > 0 and current_circle:
         n_circles -= 1
-        connections = _next_circle(current_circle, cursor)
+        connections = _next_circle(current_circle, relations, cursor)
         next_circle = set(skID for c in connections.itervalues() for relationID, cs in c.iteritems() for skID, count in cs.iteritems() if count >= mins[relationID])
         current_circle = next_circle - all_circles
         all_circles = all_circles.union(next_circle)
@@ -98,7 +102,7 @@ def find_directed_paths(request, project_id=None):
     # Create a graph by growing the sources
     while length > 0 and next_sources:
         length -= 1
-        next_circles = _next_circle(next_sources, cursor)
+        next_circles = _next_circle(next_sources, relations, cursor)
         next_sources = set()
         for skid1, c in next_circles.iteritems():
             for relationID, targets in c.iteritems():
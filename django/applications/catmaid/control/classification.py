@@ -217,7 +217,7 @@ def create_new_classification( workspace_pid, project_id ):
     Such a new class instance will live in the dummy project -1.
     """
     # Get the classification project class
-    class_map = get_class_to_id_map(workspace_pid)
+    class_map = get_class_to_id_map(workspace_pid, ('classification_project',))
     if 'classification_project' not in class_map:
         raise Exception("Couldn't find 'classification_project' class")
 
@@ -254,8 +254,8 @@ def check_classification_setup(workspace_pid):
     nedded relations are 'is_a' and 'classified_by'.
     """
     # Get classification and relation data
-    class_map = get_class_to_id_map(workspace_pid)
-    relation_map = get_relation_to_id_map(workspace_pid)
+    class_map = get_class_to_id_map(workspace_pid, needed_classes)
+    relation_map = get_relation_to_id_map(workspace_pid, needed_relations)
 
     # Check if all is good
     all_good = True
@@ -276,8 +276,8 @@ def setup_classification(workspace_pid, user):
     from the dummy project''s semantic space and adds those.
     """
     # Get classification and relation data
-    class_map = get_class_to_id_map(workspace_pid)
-    relation_map = get_relation_to_id_map(workspace_pid)
+    class_map = get_class_to_id_map(workspace_pid, needed_classes)
+    relation_map = get_relation_to_id_map(workspace_pid, needed_relations)
 
     # Add what is missing
     for c in needed_classes:
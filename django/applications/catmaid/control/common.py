@@ -1,6 +1,10 @@
 import string
 import random
+import time
 from collections import defaultdict
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
@@ -197,11 +201,98 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
-def get_relation_to_id_map(project_id):
-    return {rname: ID for rname, ID in Relation.objects.filter(project=project_id).values_list("relation_name", "id")}
+# Process-wide cache of the relation and class name to ID maps of projects,
+# as (model, project ID) vs. (time of retrieval, map) entries
+_id_maps = {}
 
-def get_class_to_id_map(project_id):
-    return {cname: ID for cname, ID in Class.objects.filter(project=project_id).values_list("class_name", "id")}
+def _get_id_map(model, name_field, project_id, required):
+    """ Returns a copy of the cached name to ID map of the given model for the
+    project. The map is retrieved again if it is older than
+    ID_MAP_CACHE_TIMEOUT seconds or if one of the required names is missing,
+    which can happen if it has been added by another process.
+    """
+    key = (model, int(project_id))
+    entry = _id_maps.get(key)
+    if entry is not None:
+        retrieved, id_map = entry
+        timeout = getattr(settings, 'ID_MAP_CACHE_TIMEOUT', 300)
+        if time.time() - retrieved < timeout and \
+                all(name in id_map for name in required):
+            return dict(id_map)
+    id_map = dict(model.objects.filter(project=project_id).values_list(
+            name_field, 'id'))
+    _id_maps[key] = (time.time(), id_map)
+    return dict(id_map)
+
+def get_relation_to_id_map(project_id, required=()):
+    """ Returns a dictionary of relation names vs. IDs of the project. The map
+    is cached, see _get_id_map.
+    """
+    return _get_id_map(Relation, 'relation_name', project_id, required)
+
+def get_class_to_id_map(project_id, required=()):
+    """ Returns a dictionary of class names vs. IDs of the project. The map
+    is cached, see _get_id_map.
+    """
+    return _get_id_map(Class, 'class_name', project_id, required)
+
+def invalidate_id_maps(project_id):
+    """ Removes the cached relation and class maps of the project. """
+    for model in (Relation, Class):
+        _id_maps.pop((model, int(project_id)), None)
+
+def _invalidate_id_maps_of(sender, instance, **kwargs):
+    invalidate_id_maps(instance.project_id)
+
+# Relations and classes are added, renamed and removed through their models
+# (e.g. by the ontology editor), which invalidates the cached maps of this
+# process.
+post_save.connect(_invalidate_id_maps_of, sender=Relation)
+post_delete.connect(_invalidate_id_maps_of, sender=Relation)
+post_save.connect(_invalidate_id_maps_of, sender=Class)
+post_delete.connect(_invalidate_id_maps_of, sender=Class)
+
+# Process-wide cache of the label names of projects, as project ID vs. (time of
+# retrieval, label ID vs. name) entries
+_label_names = {}
+
+def get_label_names(project_id, label_ids=()):
+    """ Returns the cached dictionary of label IDs vs. names of the project,
+    which contains at least the given label IDs. The dictionary is retrieved
+    again if it is older than ID_MAP_CACHE_TIMEOUT seconds, so that labels
+    renamed by other processes show up. Missing labels, e.g. those created by
+    another process, are added to it. The returned dictionary is shared and
+    must not be changed.
+    """
+    project_id = int(project_id)
+    entry = _label_names.get(project_id)
+    timeout = getattr(settings, 'ID_MAP_CACHE_TIMEOUT', 300)
+    if entry is None or time.time() - entry[0] >= timeout:
+        label_class = get_class_to_id_map(project_id, ('label',)).get('label')
+        names = dict(ClassInstance.objects.filter(project=project_id,
+                class_column=label_class).values_list('id', 'name'))
+        entry = (time.time(), names)
+        _label_names[project_id] = entry
+    names = entry[1]
+    missing = [label_id for label_id in label_ids if label_id not in names]
+    if missing:
+        names.update(ClassInstance.objects.filter(
+                id__in=missing).values_list('id', 'name'))
+    return names
+
+def _update_label_names_of(sender, instance, **kwargs):
+    entry = _label_names.get(instance.project_id)
+    if entry and instance.id in entry[1]:
+        if 'created' in kwargs:
+            entry[1][instance.id] = instance.name
+        else:
+            # Deleted
+            entry[1].pop(instance.id, None)
+
+# Labels renamed or removed through their model in this process are updated
+# right away.
+post_save.connect(_update_label_names_of, sender=ClassInstance)
+post_delete.connect(_update_label_names_of, sender=ClassInstance)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
@@ -217,3 +308,39 @@ def id_generator(size=6, chars=string.ascii_lowercase + string.digits):
     """ Creates a random string of the specified length.
     """
     return ''.join(random.choice(chars) for x in range(size))
+
+# The number of rows fetched from a server-side cursor by stream_rows() and
+# the number of strings joined by chunked()
+STREAM_CHUNK_SIZE = 2000
+
+def stream_rows(query, params):
+    """ Yields the result rows of the query from a server-side cursor, so
+    that only a chunk of the result is held in memory at a time.
+    """
+    # Make sure the database connection is open
+    connection.cursor()
+    # A cursor that is held open can be used outside of a transaction, e.g.
+    # in autocommit mode while the response is sent. Its name has to be unique
+    # among the open cursors of the connection.
+    cursor = connection.connection.cursor(
+            name='stream_rows_' + id_generator(), withhold=True)
+    cursor.itersize = STREAM_CHUNK_SIZE
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+def chunked(strings):
+    """ Joins the strings into chunks of STREAM_CHUNK_SIZE strings, which is
+    useful to build the content of streaming responses.
+    """
+    chunk = []
+    for s in strings:
+        chunk.append(s)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
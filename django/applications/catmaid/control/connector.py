@@ -9,6 +9,7 @@ from catmaid.models import *
 from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control import nodecache
 
 from itertools import imap
 
@@ -119,8 +120,9 @@ def list_connector(request, project_id=None):
     response_on_error = ''
     try:
         response_on_error = 'Could not fetch relations.'
-        relation_map = get_relation_to_id_map(project_id)
-        for rel in ['presynaptic_to', 'postsynaptic_to', 'element_of', 'labeled_as']:
+        required = ('presynaptic_to', 'postsynaptic_to', 'element_of', 'labeled_as')
+        relation_map = get_relation_to_id_map(project_id, required)
+        for rel in required:
             if rel not in relation_map:
                 raise Exception('Failed to find the required relation %s' % rel)
 
@@ -320,14 +322,8 @@ def _connector_skeletons(connector_ids, project_id):
     and 'postsynaptic_to' with a list of skeleton IDs (maybe empty). """
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
     PRE = relations['presynaptic_to']
     POST = relations['postsynaptic_to']
 
@@ -378,6 +374,7 @@ def create_connector(request, project_id=None):
         location=location,
         confidence=parsed_confidence)
     new_connector.save()
+    nodecache.invalidate_connectors(project_id, [new_connector.id])
 
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
@@ -386,6 +383,7 @@ def create_connector(request, project_id=None):
 def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
+    nodecache.invalidate_connectors(project_id, [connector_id])
     Connector.objects.filter(id=connector_id).delete()
     return HttpResponse(json.dumps({
         'message': 'Removed connector and class_instances',
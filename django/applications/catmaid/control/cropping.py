@@ -11,21 +11,30 @@ from catmaid.control.authentication import *
 from catmaid.control.common import *
 
 import numpy as np
-import urllib2 as urllib
 import os.path
 import glob
+from collections import OrderedDict
 from time import time
-from math import cos, sin, radians
+from math import ceil, cos, sin, radians
 
 # The libuuid import is a workaround for a bug with GraphicsMagick
 # which expects the library to be loaded already. Therefore, it
 # has to be loaded before pgmagick.
 import libuuid
-from pgmagick import Blob, Image, ImageList, Geometry, Color
+from pgmagick import Blob, Image, Geometry, Color
 from pgmagick import CompositeOperator as co, ResolutionType, ChannelType
 
+try:
+    from scipy.ndimage import map_coordinates
+except ImportError:
+    map_coordinates = None
+
 from celery.task import task
 
+from catmaid.control.tilecache import ImageRetrievalError, fetch_tile, \
+        fetch_tiles
+from catmaid.control.tiffwriter import TiffWriter
+
 # Prefix for stored microstacks
 file_prefix = "crop_"
 # File extension of the stored microstacks
@@ -157,12 +166,6 @@ class CropJob:
         raise StandardError("Tile source %s is currently not supported " \
                 "by cropping module" % stack.tile_source_type)
 
-class ImageRetrievalError(IOError):
-    def __init__(self, path, error):
-        IOError.__init__(self, "Couldn't access %s" % (path))
-        self.path = path
-        self.error = error
-
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
@@ -182,16 +185,13 @@ class ImagePart:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
-    def get_image( self ):
-        # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
-
-        blob = Blob( img_file.read() )
+    def get_image( self, data=None ):
+        """ Returns the image part. The tile data is retrieved from the tile
+        cache or the image server, unless it is passed in.
+        """
+        if data is None:
+            data = fetch_tile( self.path )
+        blob = Blob( data )
         image = Image( blob )
         # Check if the whole image should be used and cropped if necessary.
         src_width = image.size().width()
@@ -201,6 +201,19 @@ class ImagePart:
             image.crop( box )
         return image
 
+    def cut( self, tile ):
+        """ Returns the image part of an already decoded tile image. The tile
+        itself isn't changed, so that it can be shared by many image parts.
+        """
+        src_width = tile.size().width()
+        src_height = tile.size().height()
+        if self.width == src_width and self.height == src_height:
+            return tile
+        image = Image( tile )
+        box = Geometry( self.width, self.height, self.x_min_src, self.y_min_src )
+        image.crop( box )
+        return image
+
 def to_x_index( x, job, enforce_bounds=True ):
     """ Converts a real world position to a x pixel position.
     Also, makes sure the value is in bounds.
@@ -228,13 +241,10 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use a separate tool called exiftool to write
-    meta data. Currently, there seems no better solution than this. If the
-    tool is not found, no meta data is produced and no error is raised.
+def tiff_metadata( job, n_images ):
+    """ Returns a dictionary with the resolution, ImageJ description and
+    software meta data of a TIFF file of n_images images of the passed job,
+    which can be passed to a TiffWriter.
     """
     # Add resolution information in pixel per nanometer. The stack info
     # available is nm/px and refers to a zoom-level of zero.
@@ -242,12 +252,9 @@ def addMetaData( path, job, result ):
     res_y_scaled = job.ref_stack.resolution.y * 2**job.zoom_level
     res_x_nm_px = 1.0 / res_x_scaled
     res_y_nm_px = 1.0 / res_y_scaled
-    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
-            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
 
     # ImageJ specific meta data to allow easy embedding of units and
     # display options.
-    n_images = len( result )
     ij_version= "1.45p"
     unit = "nm"
     newline = "\n"
@@ -262,34 +269,57 @@ def addMetaData( path, job, result ):
                     "modulo the channel count is not zero" )
         n_slices = n_images / n_channels
         ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
-    ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
-
-    # Information about the software used
-    sw_args = "-EXIF:Software=\"Created with CATMAID and GraphicsMagic, " \
-            "processed with exiftool.\""
-    # Build up the final tag changing arguments for each slice
-    tag_args = "{0} {1} {2}".format( res_args, ij_args, sw_args )
-    per_slice_tag_args = []
-    for i in range(0, n_images):
-        # the string EXIF gets replaced for every image with IFD<N>
-        slice_args = tag_args.replace( "EXIF", "IFD" + str(i) )
-        per_slice_tag_args.append( slice_args  )
-    final_tag_args = " ".join( per_slice_tag_args )
-    # Create the final call and execute
-    call = "exiftool -overwrite_original {0} {1}".format( final_tag_args, path )
-    os.system( call )
-
-    # Re-save the image with GraphicsMagick, otherwise ImageJ won't read the
-    # images directly.
-    images = ImageList()
-    images.readImages( path )
-    images.writeImages( path )
+
+    return {
+        'x_resolution': res_x_nm_px,
+        'y_resolution': res_y_nm_px,
+        'description': ij_data,
+        # Information about the software used
+        'software': "Created with CATMAID and GraphicsMagick.",
+    }
+
+def write_tiff_page( writer, image, single_channel ):
+    """ Appends a pgmagick image as 8 bit gray (if single_channel is true) or
+    RGB page to the passed TiffWriter.
+    """
+    blob = Blob()
+    if single_channel:
+        image.write( blob, "GRAY", 8 )
+        samples_per_pixel = 1
+    else:
+        image.write( blob, "RGB", 8 )
+        samples_per_pixel = 3
+    size = image.size()
+    writer.write_page( size.width(), size.height(), samples_per_pixel,
+            blob.data )
+
+def count_substack_images( job ):
+    """ Returns the number of images of the sub-stack specified in the passed
+    job: one for each slice and stack.
+    """
+    n_slices = to_z_index(job.z_max, job) + 1 - to_z_index(job.z_min, job)
+    return max(n_slices, 0) * len(job.stacks)
+
+def _transform_slices( slices, transform ):
+    """ Applies the transform function to every slice of the passed iterator
+    when it is consumed.
+    """
+    for img in slices:
+        transform( img )
+        yield img
 
 def extract_substack( job ):
     """ Extracts a sub-stack as specified in the passed job while respecting
     rotation requests. A list of pgmagick images is returned -- one for each
     slice, starting on top.
     """
+    return list( iter_substack( job ) )
+
+def iter_substack( job ):
+    """ Like extract_substack(), but returns an iterator over the images of
+    the sub-stack, which are created one after another while the iterator is
+    consumed. This way, only a single image has to be kept in memory.
+    """
 
     # Make sure tile source getters have been initialized on the job
     if job.needs_initialization:
@@ -298,22 +328,22 @@ def extract_substack( job ):
     # Treat rotation requests special
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        return iter_substack_no_rotation( job )
     elif abs(job.rotation_cw - 90.0) < 0.00001:
         # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(270.0)
+        return _transform_slices( iter_substack_no_rotation( job ),
+                lambda img: img.rotate(270.0) )
     elif abs(job.rotation_cw - 180.0) < 0.00001:
         # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(180.0)
+        return _transform_slices( iter_substack_no_rotation( job ),
+                lambda img: img.rotate(180.0) )
     elif abs(job.rotation_cw - 270.0) < 0.00001:
         # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(90.0)
+        return _transform_slices( iter_substack_no_rotation( job ),
+                lambda img: img.rotate(90.0) )
+    elif map_coordinates is not None:
+        # Map the pixels of the result directly into the stack
+        return iter_rotated_substack( job )
     else:
         # Some methods do counter-clockwise rotation
         rotation_ccw = 360.0 - job.rotation_cw
@@ -341,17 +371,13 @@ def extract_substack( job ):
         job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
         job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        # Plan the enlarged sub-stack
+        cropped_stack = iter_substack_no_rotation( job )
 
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        for img in cropped_stack:
-            img.rotate(rotation_ccw)
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
+        # Each slice is rotated counterclockwise to have the actual ROI axis
+        # aligned. Then a second crop removes the not needed parts. The
+        # region to crop is defined by the relative original crop-box
+        # coordinates to to the rotated bounding box.
         rot_bb_p1 = rotate2d(rotation_ccw,
             [job.x_min, job.y_min], center)
         rot_bb_p2 = rotate2d(rotation_ccw,
@@ -378,11 +404,10 @@ def extract_substack( job ):
         crop_y_max_px = to_y_index(crop_y_max, job, False)
         crop_width_px = crop_x_max_px - crop_x_min_px
         crop_height_px = crop_y_max_px - crop_y_min_px
-        # Crop all images (Geometry: width, height, xOffset, yOffset)
+        # Crop geometry for all images (Geometry: width, height, xOffset,
+        # yOffset)
         crop_geometry = Geometry(crop_width_px, crop_height_px,
             crop_x_min_px, crop_y_min_px)
-        for img in cropped_stack:
-            img.crop(crop_geometry)
 
         # Reset the original job parameters
         job.x_min = real_x_min
@@ -390,13 +415,275 @@ def extract_substack( job ):
         job.y_min = real_y_min
         job.y_max = real_y_max
 
-    return cropped_stack
+        def rotate_and_crop( img ):
+            img.rotate(rotation_ccw)
+            img.crop(crop_geometry)
+
+        return _transform_slices( cropped_stack, rotate_and_crop )
+
+def _tile_array( data, single_channel ):
+    """ Decodes the data of a tile into an array of 8 bit samples: a rows x
+    columns array of the red channel if single_channel is true, a rows x
+    columns x 3 array of all channels otherwise.
+    """
+    image = Image( Blob( data ) )
+    blob = Blob()
+    image.write( blob, "RGB", 8 )
+    size = image.size()
+    samples = np.frombuffer( blob.data, dtype=np.uint8 ).reshape(
+            size.height(), size.width(), 3 )
+    return samples[:, :, 0] if single_channel else samples
+
+def _array_image( samples ):
+    """ Creates a pgmagick image from an array of 8 bit samples, either
+    gray (rows x columns) or RGB (rows x columns x 3).
+    """
+    magick = "GRAY" if samples.ndim == 2 else "RGB"
+    return Image( Blob( samples.tostring() ),
+            Geometry( samples.shape[1], samples.shape[0] ), 8, magick )
+
+def iter_rotated_substack( job ):
+    """ Returns an iterator over the images of a sub-stack with an arbitrary
+    rotation, like iter_substack(). Instead of cropping and rotating an
+    enlarged sub-stack, every pixel of the result is mapped into the stack
+    with a single affine transformation per stack and interpolated linearly
+    between its neighbours. Only the tiles that contain such pixels are
+    fetched. The content is rotated counter-clockwise by the rotation of the
+    job around the center of its bounding box, pixels outside the stack are
+    black. The images are always as wide and high as the unrotated bounding
+    box. This differs from the right angle rotations of iter_substack(), which
+    swap width and height at 90 and 270 degrees, and is why they don't use
+    this path.
+    """
+    scale = 2**job.zoom_level
+    res_x = job.ref_stack.resolution.x * scale
+    res_y = job.ref_stack.resolution.y * scale
+    width = to_x_index(job.x_max - job.x_min, job, False)
+    height = to_y_index(job.y_max - job.y_min, job, False)
+    # World offsets of all result pixels to the center, rotated into the
+    # stack.
+    angle = radians(job.rotation_cw)
+    du = ((np.arange(width) - 0.5 * (width - 1)) * res_x)[np.newaxis, :]
+    dv = ((np.arange(height) - 0.5 * (height - 1)) * res_y)[:, np.newaxis]
+    offset_x = cos(angle) * du - sin(angle) * dv
+    offset_y = sin(angle) * du + cos(angle) * dv
+
+    # Source pixel coordinates and needed tiles of each stack
+    stack_plans = []
+    for stack in job.stacks:
+        translation = ProjectStack.objects.get(
+                project_id=job.project_id, stack_id=stack.id).translation
+        bb = _bounding_box(job, stack, translation, job.x_min, job.x_max,
+                job.y_min, job.y_max, job.z_min, job.z_max)
+        # Without rotation, the result would start at the pixel of the
+        # minimum corner, like other crops.
+        center_x = (job.x_min - translation.x) / res_x + 0.5 * (width - 1)
+        center_y = (job.y_min - translation.y) / res_y + 0.5 * (height - 1)
+        src_x = center_x + offset_x / res_x
+        src_y = center_y + offset_y / res_y
+        # Tiles of the pixels next to every source position that are in
+        # the stack
+        max_x = int(ceil(stack.dimension.x / float(scale))) - 1
+        max_y = int(ceil(stack.dimension.y / float(scale))) - 1
+        left = np.floor(src_x).astype(np.int64)
+        top = np.floor(src_y).astype(np.int64)
+        n_tiles_x = max_x / stack.tile_width + 1
+        tile_indices = []
+        for x in (left, left + 1):
+            for y in (top, top + 1):
+                inside = (x >= 0) & (x <= max_x) & (y >= 0) & (y <= max_y)
+                tile_indices.append(y[inside] / stack.tile_height * n_tiles_x +
+                        x[inside] / stack.tile_width)
+        tile_indices = np.unique(np.concatenate(tile_indices))
+        tiles = [(int(i % n_tiles_x), int(i / n_tiles_x))
+                for i in tile_indices]
+        if tiles:
+            tile_x_min = min(t[0] for t in tiles)
+            tile_y_min = min(t[1] for t in tiles)
+            tile_x_max = max(t[0] for t in tiles)
+            tile_y_max = max(t[1] for t in tiles)
+        else:
+            tile_x_min = tile_y_min = tile_x_max = tile_y_max = 0
+        # Source coordinates relative to the mosaic of all needed tiles
+        coordinates = np.array([src_y - tile_y_min * stack.tile_height,
+                src_x - tile_x_min * stack.tile_width])
+        mosaic_shape = ((tile_y_max - tile_y_min + 1) * stack.tile_height,
+                (tile_x_max - tile_x_min + 1) * stack.tile_width)
+        if not job.single_channel:
+            mosaic_shape += (3,)
+        stack_plans.append((stack, bb, tiles, tile_x_min, tile_y_min,
+                mosaic_shape, coordinates))
+
+    # All channels of one slice, then the next slice
+    n_slices = count_substack_images( job ) / len(job.stacks)
+    slice_plans = [(plan, plan[1].px_z_min + nz) for nz in range(n_slices)
+            for plan in stack_plans]
+    return _resample_slices( job, slice_plans )
+
+def _resample_slices( job, slice_plans ):
+    """ Returns an iterator over the images of the passed list of (stack
+    plan, section) tuples of iter_rotated_substack().
+    """
+    # Fetch the tiles of all slices in parallel, but consume them in order
+    tiles = fetch_tiles( job.get_tile_path(plan[0], (x, y, z))
+            for plan, z in slice_plans for x, y in plan[2] )
+
+    for (stack, bb, tile_coords, tile_x_min, tile_y_min, mosaic_shape,
+            coordinates), z in slice_plans:
+        mosaic = np.zeros(mosaic_shape, dtype=np.uint8)
+        for x, y in tile_coords:
+            samples = _tile_array( next(tiles), job.single_channel )
+            samples = samples[:stack.tile_height, :stack.tile_width]
+            y_dst = (y - tile_y_min) * stack.tile_height
+            x_dst = (x - tile_x_min) * stack.tile_width
+            mosaic[y_dst:y_dst + samples.shape[0],
+                    x_dst:x_dst + samples.shape[1]] = samples
+        if job.single_channel:
+            channels = [mosaic]
+        else:
+            channels = [mosaic[:, :, i] for i in range(3)]
+        resampled = [map_coordinates(channel, coordinates, output=np.float32,
+                order=1, mode='constant', cval=0.0, prefilter=False)
+                for channel in channels]
+        samples = np.clip(np.dstack(resampled) + 0.5, 0, 255).astype(np.uint8)
+        if job.single_channel:
+            samples = samples[:, :, 0]
+        yield _array_image( samples )
+
+def _bounding_box( job, stack, translation, x_min, x_max, y_min, y_max,
+        z_min, z_max ):
+    """ Returns the pixel bounding box of the given region (in project
+    coordinates) in the given stack, which is translated by the passed
+    translation relative to the project.
+    """
+    x_min_t = x_min - translation.x
+    x_max_t = x_max - translation.x
+    y_min_t = y_min - translation.y
+    y_max_t = y_max - translation.y
+    z_min_t = z_min - translation.z
+    z_max_t = z_max - translation.z
+    # Calculate the slice numbers and pixel positions
+    # bound to the stack data.
+    px_x_min = to_x_index(x_min_t, job)
+    px_x_max = to_x_index(x_max_t, job)
+    px_y_min = to_y_index(y_min_t, job)
+    px_y_max = to_y_index(y_max_t, job)
+    px_z_min = to_z_index(z_min_t, job)
+    px_z_max = to_z_index(z_max_t, job)
+    # Because it might be that the cropping goes over the
+    # stack bounds, we need to calculate the unbounded height,
+    # with and an offset.
+    px_x_min_nobound = to_x_index(x_min_t, job, False)
+    px_x_max_nobound = to_x_index(x_max_t, job, False)
+    px_y_min_nobound = to_y_index(y_min_t, job, False)
+    px_y_max_nobound = to_y_index(y_max_t, job, False)
+    width = px_x_max_nobound - px_x_min_nobound
+    height = px_y_max_nobound - px_y_min_nobound
+    px_x_offset = abs(px_x_min_nobound) if px_x_min_nobound < 0 else 0
+    px_y_offset = abs(px_y_min_nobound) if px_y_min_nobound < 0 else 0
+    # Create a simple object
+    class BB: pass
+    bb = BB()
+    bb.px_x_min = px_x_min
+    bb.px_x_max = px_x_max
+    bb.px_y_min = px_y_min
+    bb.px_y_max = px_y_max
+    bb.px_z_min = px_z_min
+    bb.px_z_max = px_z_max
+    bb.px_x_offset = px_x_offset
+    bb.px_y_offset = px_y_offset
+    bb.width = width
+    bb.height = height
+    return bb
+
+def _image_parts( job, stack, bb, z ):
+    """ Returns a list of the image parts that make up the bounding box bb of
+    the given stack on section z, one for each tile.
+    """
+    # Shortcut for tile width and height
+    tile_width = stack.tile_width
+    tile_height = stack.tile_height
+    # Get indices for bounding tiles (0 indexed)
+    tile_x_min = int(bb.px_x_min / tile_width)
+    tile_x_max = int(bb.px_x_max / tile_width)
+    tile_y_min = int(bb.px_y_min / tile_height)
+    tile_y_max = int(bb.px_y_max / tile_height)
+    # Get the number of needed tiles for each direction
+    num_x_tiles = tile_x_max - tile_x_min + 1
+    num_y_tiles = tile_y_max - tile_y_min + 1
+    # Associate image parts with all tiles
+    image_parts = []
+    x_dst = bb.px_x_offset
+    for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
+        # The min x,y for the image part in the current tile are 0
+        # for all tiles except the first one.
+        cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
+        # The max x,y for the image part of current tile are the tile
+        # size minus one except for the last one.
+        if nx < (num_x_tiles - 1):
+            cur_px_x_max = tile_width - 1
+        else:
+            cur_px_x_max = bb.px_x_max - x * tile_width
+        # Reset y destination component
+        y_dst = bb.px_y_offset
+        for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
+            cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
+            if ny < (num_y_tiles - 1):
+                cur_px_y_max = tile_height - 1
+            else:
+                cur_px_y_max = bb.px_y_max - y * tile_height
+            # Create an image part definition
+            path = job.get_tile_path(stack, (x, y, z))
+            try:
+                part = ImagePart(path, cur_px_x_min, cur_px_x_max,
+                        cur_px_y_min, cur_px_y_max, x_dst, y_dst)
+                image_parts.append( part )
+            except:
+                # ignore failed slices
+                pass
+            # Update y component of destination position
+            y_dst += cur_px_y_max - cur_px_y_min
+        # Update x component of destination position
+        x_dst += cur_px_x_max - cur_px_x_min
+    return image_parts
+
+def _compose_slice( job, bb, images ):
+    """ Composes the images of the image parts of one slice, passed as a list
+    of (image part, image) tuples, into a single image of the size of the
+    bounding box bb.
+    """
+    cropped_slice = None
+    for ip, image in images:
+        # It is unfortunately not possible to create proper composite
+        # images based on a canvas image newly created like this:
+        # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
+        # Therefore, this workaround is used.
+        if not cropped_slice:
+            cropped_slice = Image(image)
+            cropped_slice.backgroundColor("black")
+            cropped_slice.erase()
+            # The '!' makes sure the aspect ration is ignored
+            cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
+        # Draw the image onto result image
+        cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
+    # Optionally, use only a single channel
+    if job.single_channel:
+        cropped_slice.channel( ChannelType.RedChannel )
+    return cropped_slice
 
 def extract_substack_no_rotation( job ):
     """ Extracts a sub-stack as specified in the passed job without respecting
     rotation requests. A list of pgmagick images is returned -- one for each
     slice, starting on top.
     """
+    return list( iter_substack_no_rotation( job ) )
+
+def iter_substack_no_rotation( job ):
+    """ Like extract_substack_no_rotation(), but returns an iterator over the
+    images. The sub-stack is planned right away, based on the current
+    bounding box of the job. Tiles are fetched and images are composed while
+    the iterator is consumed.
+    """
 
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
@@ -407,50 +694,11 @@ def extract_substack_no_rotation( job ):
         # Retrieve translation relative to current project
         translation = ProjectStack.objects.get(
                 project_id=job.project_id, stack_id=stack.id).translation
-        x_min_t = job.x_min - translation.x
-        x_max_t = job.x_max - translation.x
-        y_min_t = job.y_min - translation.y
-        y_max_t = job.y_max - translation.y
-        z_min_t = job.z_min - translation.z
-        z_max_t = job.z_max - translation.z
-        # Calculate the slice numbers and pixel positions
-        # bound to the stack data.
-        px_x_min = to_x_index(x_min_t, job)
-        px_x_max = to_x_index(x_max_t, job)
-        px_y_min = to_y_index(y_min_t, job)
-        px_y_max = to_y_index(y_max_t, job)
-        px_z_min = to_z_index(z_min_t, job)
-        px_z_max = to_z_index(z_max_t, job)
-        # Because it might be that the cropping goes over the
-        # stack bounds, we need to calculate the unbounded height,
-        # with and an offset.
-        px_x_min_nobound = to_x_index(x_min_t, job, False)
-        px_x_max_nobound = to_x_index(x_max_t, job, False)
-        px_y_min_nobound = to_y_index(y_min_t, job, False)
-        px_y_max_nobound = to_y_index(y_max_t, job, False)
-        width = px_x_max_nobound - px_x_min_nobound
-        height = px_y_max_nobound - px_y_min_nobound
-        px_x_offset = abs(px_x_min_nobound) if px_x_min_nobound < 0 else 0
-        px_y_offset = abs(px_y_min_nobound) if px_y_min_nobound < 0 else 0
-        # Create a dictionary entry with a simple object
-        class BB: pass
-        bb = BB()
-        bb.px_x_min = px_x_min
-        bb.px_x_max = px_x_max
-        bb.px_y_min = px_y_min
-        bb.px_y_max = px_y_max
-        bb.px_z_min = px_z_min
-        bb.px_z_max = px_z_max
-        bb.px_x_offset = px_x_offset
-        bb.px_y_offset = px_y_offset
-        bb.width = width
-        bb.height = height
-        s_to_bb[stack.id] = bb
+        s_to_bb[stack.id] = _bounding_box(job, stack, translation, job.x_min,
+                job.x_max, job.y_min, job.y_max, job.z_min, job.z_max)
 
     # Get number of wanted slices
-    px_z_min = to_z_index(job.z_min, job)
-    px_z_max = to_z_index(job.z_max, job)
-    n_slices = px_z_max + 1 - px_z_min
+    n_slices = count_substack_images( job ) / len(job.stacks)
 
     # The images are generated per slice, so most of the following
     # calculations refer to 2d images.
@@ -458,84 +706,116 @@ def extract_substack_no_rotation( job ):
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
     # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
+    # First, the image parts of all slices and stacks are collected. This
+    # allows fetching all tiles concurrently afterwards.
+    slice_parts = []
     # Iterate over all slices
     for nz in range(n_slices):
         for stack in job.stacks:
             bb = s_to_bb[stack.id]
-            # Shortcut for tile width and height
-            tile_width = stack.tile_width
-            tile_height = stack.tile_height
-            # Get indices for bounding tiles (0 indexed)
-            tile_x_min = int(bb.px_x_min / tile_width)
-            tile_x_max = int(bb.px_x_max / tile_width)
-            tile_y_min = int(bb.px_y_min / tile_height)
-            tile_y_max = int(bb.px_y_max / tile_height)
-            # Get the number of needed tiles for each direction
-            num_x_tiles = tile_x_max - tile_x_min + 1
-            num_y_tiles = tile_y_max - tile_y_min + 1
-            # Associate image parts with all tiles
-            image_parts = []
-            x_dst = bb.px_x_offset
-            for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
-                # The min x,y for the image part in the current tile are 0
-                # for all tiles except the first one.
-                cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
-                # The max x,y for the image part of current tile are the tile
-                # size minus one except for the last one.
-                if nx < (num_x_tiles - 1):
-                    cur_px_x_max = tile_width - 1
+            image_parts = _image_parts(job, stack, bb, bb.px_z_min + nz)
+            slice_parts.append( (bb, image_parts) )
+
+    return _compose_slices( job, slice_parts )
+
+def _compose_slices( job, slice_parts ):
+    """ Returns an iterator over the composed images of the passed list of
+    (bounding box, image parts) tuples.
+    """
+    # Fetch the tiles of all image parts in parallel, but consume them in
+    # order. This way, only a limited number of tiles is kept in memory.
+    tiles = fetch_tiles( ip.path for bb, image_parts in slice_parts
+            for ip in image_parts )
+
+    for bb, image_parts in slice_parts:
+        # Get (correctly cropped) images and write out the image parts
+        images = [(ip, ip.get_image( next(tiles) )) for ip in image_parts]
+        yield _compose_slice(job, bb, images)
+
+def extract_windows( job, windows ):
+    """ Extracts many small sub-stacks (windows) at once, e.g. the
+    surroundings of all treenodes of a neuron. The windows are given as a list
+    of (key, x_min, x_max, y_min, y_max, z_min, z_max) tuples in project
+    coordinates, the stacks, zoom level and channel selection are taken from
+    the job. Its bounding box and rotation are ignored.
+
+    Windows are planned by section: the tiles all windows need on a section
+    are fetched and decoded only once and every window is cut from the
+    decoded tiles, no matter how many windows overlap the same tile.
+    Sections are processed in ascending order and only the tiles of a single
+    section are kept in memory.
+
+    Returns an iterator over (key, images, error) tuples, which are generated
+    as soon as the last slice of a window is done. The images are a list of
+    pgmagick images like the ones extract_substack() returns. If a tile of a
+    window couldn't be retrieved, images is None and error is the
+    ImageRetrievalError.
+    """
+    # Make sure tile source getters have been initialized on the job
+    if job.needs_initialization:
+        job.initialize()
+
+    translations = {}
+    for stack in job.stacks:
+        translations[stack.id] = ProjectStack.objects.get(
+                project_id=job.project_id, stack_id=stack.id).translation
+
+    # Plan the image parts of every slice of every window and group them by
+    # section. Slices are numbered like the images of extract_substack():
+    # all channels of one section, then the next section.
+    n_stacks = len(job.stacks)
+    sections = {}
+    n_images = []
+    for i, (key, x_min, x_max, y_min, y_max, z_min, z_max) in \
+            enumerate(windows):
+        n_slices = to_z_index(z_max, job) + 1 - to_z_index(z_min, job)
+        n_images.append(n_slices * n_stacks)
+        for ns, stack in enumerate(job.stacks):
+            bb = _bounding_box(job, stack, translations[stack.id], x_min,
+                    x_max, y_min, y_max, z_min, z_max)
+            for nz in range(n_slices):
+                z = bb.px_z_min + nz
+                sections.setdefault(z, []).append((i, nz * n_stacks + ns, bb,
+                        _image_parts(job, stack, bb, z)))
+
+    remaining = list(n_images)
+    slices = {}
+    errors = {}
+    for z in sorted(sections):
+        section = sections.pop(z)
+        # Fetch and decode every tile of this section once
+        paths = []
+        for i, n, bb, image_parts in section:
+            paths.extend(ip.path for ip in image_parts)
+        paths = list(OrderedDict.fromkeys(paths))
+        tiles = {}
+        for path, data in zip(paths, fetch_tiles(paths, return_errors=True)):
+            if isinstance(data, ImageRetrievalError):
+                tiles[path] = data
+            else:
+                tiles[path] = Image( Blob( data ) )
+
+        # Cut all windows from the decoded tiles
+        for i, n, bb, image_parts in section:
+            if i not in errors:
+                for ip in image_parts:
+                    if isinstance(tiles[ip.path], ImageRetrievalError):
+                        errors[i] = tiles[ip.path]
+                        slices.pop(i, None)
+                        break
                 else:
-                    cur_px_x_max = bb.px_x_max - x * tile_width
-                # Reset y destination component
-                y_dst = bb.px_y_offset
-                for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
-                    cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
-                    if ny < (num_y_tiles - 1):
-                        cur_px_y_max = tile_height - 1
-                    else:
-                        cur_px_y_max = bb.px_y_max - y * tile_height
-                    # Create an image part definition
-                    z = bb.px_z_min + nz
-                    path = job.get_tile_path(stack, (x, y, z))
-                    try:
-                        part = ImagePart(path, cur_px_x_min, cur_px_x_max,
-                                cur_px_y_min, cur_px_y_max, x_dst, y_dst)
-                        image_parts.append( part )
-                    except:
-                        # ignore failed slices
-                        pass
-                    # Update y component of destination position
-                    y_dst += cur_px_y_max - cur_px_y_min
-                # Update x component of destination position
-                x_dst += cur_px_x_max - cur_px_x_min
-
-            # write out the image parts
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor("black")
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-            # Optionally, use only a single channel
-            if job.single_channel:
-                cropped_slice.channel( ChannelType.RedChannel )
-            # Add the image to the cropped stack
-            cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+                    images = [(ip, ip.cut( tiles[ip.path] ))
+                            for ip in image_parts]
+                    window_slices = slices.setdefault(i, [None] * n_images[i])
+                    window_slices[n] = _compose_slice(job, bb, images)
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                key = windows[i][0]
+                if i in errors:
+                    yield (key, None, errors.pop(i))
+                else:
+                    yield (key, slices.pop(i), None)
+        del tiles
 
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
@@ -557,22 +837,18 @@ def process_crop_job(job, create_message=True):
     and the creation of the sub-stack. It can be executed as Celery task.
     """
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
-
         # Save the resulting micro_stack to a temporary location
         no_error_occured = True
         error_message = ""
         # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
+        n_images = count_substack_images( job )
+        if n_images > 0:
+            # Write every slice of the sub-stack to the output image as soon
+            # as it is created, along with some meta data.
+            metadata = tiff_metadata( job, n_images )
+            with TiffWriter( job.output_path, **metadata ) as writer:
+                for img in iter_substack( job ):
+                    write_tiff_page( writer, img, job.single_channel )
         else:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
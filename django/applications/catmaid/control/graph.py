@@ -1,54 +1,44 @@
-import json
 from django.db import connection
-from django.http import HttpResponse
 from catmaid.control.authentication import *
-from catmaid.models import Relation
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.graphjob import graph_response, no_progress
 import networkx as nx
-from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
 from itertools import chain, ifilter, imap
 from functools import partial
 from synapseclustering import tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
+import numpy as np
+from arbor import Arbor
 from tree_util import edge_count_to_root, simplify, find_root, reroot, partition, spanning_tree, cable_length
 from math import sqrt
 import sys
 
-def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
-    """ dipgrahs is a dictionary of skeleton IDs as keys and DiGraph instances as values,
-    where the DiGraph does not have any edges yet.
-    WARNING: side effect on contents of digraph: will add the edges
+def split_by_confidence(confidence_threshold, rows):
+    """ rows: tuples of treenode ID, parent ID, confidence, skeleton ID, location and reviewer ID.
+    Returns a dictionary of skeleton IDs as keys and lists of Arbor instances as values,
+    one for each part of the skeleton that results from splitting it at edges with a
+    confidence lower than confidence_threshold. A confidence_threshold of 0 means no splitting.
     """
+    skeleton_rows = defaultdict(list)
+    for row in rows:
+        skeleton_rows[row[3]].append(row)
+
     arbors = {}
-    # Define edges, which may result in multiple subgraphs for each skeleton
-    # when splitting at low-confidence edges:
-    if 0 == confidence_threshold:
-        # Do not split skeletons
-        for row in rows:
-            if row[1]:
-                digraphs[row[3]].add_edge(row[1], row[0])
-        for skid, digraph in digraphs.iteritems():
-            arbors[skid] = [digraph]
-    else:
-        # The DiGraph representing the skeleton may be disconnected at a low-confidence edge
-        to_split = set()
-        for row in rows:
-            if row[2] < confidence_threshold:
-                to_split.add(row[3])
-            elif row[1]:
-                digraphs[row[3]].add_edge(row[1], row[0])
-        for skid, digraph in digraphs.iteritems():
-            if skid in to_split:
-                arbors[skid] = weakly_connected_component_subgraphs(digraph)
-            else:
-                arbors[skid] = [digraph]
+    for skid, srows in skeleton_rows.iteritems():
+        columns = zip(*srows)
+        arbor = Arbor(columns[0], columns[1], {'reviewer_id': list(columns[5])})
+        if 0 == confidence_threshold:
+            # Do not split skeletons
+            arbors[skid] = [arbor]
+        else:
+            # The arbor may be disconnected at a low-confidence edge
+            arbors[skid] = arbor.split(row[0] for row in srows if row[2] < confidence_threshold)
 
     return arbors
 
 def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, minis):
     """ locations: dictionary of treenode ID vs tuple with x,y,z
-        arbors: dictionary of skeleton ID vs list of DiGraph (that were, or not, split by confidence)
+        arbors: dictionary of skeleton ID vs list of Arbor (that were, or not, split by confidence)
         treenode_connectors: dictionary of treenode ID vs list of tuples of connector_id, string of 'presynaptic_to' or 'postsynaptic_to'
     """
     arbors2 = {} # Some arbors will be split further
@@ -70,13 +60,10 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(graph)
                 continue
 
-            for parent_id, treenode_id in graph.edges_iter():
-                loc0 = locations[treenode_id]
-                loc1 = locations[parent_id]
-                graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
+            graph.properties['location'] = np.array([locations[node] for node in graph.nodes_iter()])
 
             # Invoke Casey's magic
-            synapse_group = tree_max_density(graph.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
+            synapse_group = tree_max_density(graph, treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
             # The list of nodes of each synapse_group contains only nodes that have connectors
             # A local_max is the skeleton node most central to a synapse_group
             anchors = {}
@@ -105,8 +92,9 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
     return arbors2, minis
 
 
-def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence):
-    """ Assumes all skeleton_ids belong to project_id. """
+def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence, progress=no_progress):
+    """ Assumes all skeleton_ids belong to project_id. The progress callback
+    is called with the fraction of work done. """
     skeletons_string = ",".join(str(int(x)) for x in skeleton_ids)
     cursor = connection.cursor()
 
@@ -117,20 +105,17 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
     WHERE skeleton_id IN (%s)
     ''' % skeletons_string)
     rows = tuple(cursor.fetchall())
-    # Each skeleton is represented with a DiGraph
-    arbors = defaultdict(nx.DiGraph)
+    progress(0.1)
 
-    # Create a DiGraph for every skeleton
-    for row in rows:
-        arbors[row[3]].add_node(row[0], {'reviewer_id': row[5]})
-
-    # Dictionary of skeleton IDs vs list of DiGraph instances
-    arbors = split_by_confidence_and_add_edges(confidence_threshold, arbors, rows)
+    # Dictionary of skeleton IDs vs list of Arbor instances
+    arbors = split_by_confidence(confidence_threshold, rows)
+    progress(0.3)
 
     # Fetch all synapses
-    relations = {'presynaptic_to': -1, 'postsynaptic_to': -1}
-    for r in Relation.objects.filter(relation_name__in=('presynaptic_to', 'postsynaptic_to'), project_id=project_id).values_list('relation_name', 'id'):
-        relations[r[0]] = r[1]
+    relation_ids = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
+    relations = {name: relation_ids.get(name, -1)
+            for name in ('presynaptic_to', 'postsynaptic_to')}
     cursor.execute('''
     SELECT connector_id, relation_id, treenode_id, skeleton_id
     FROM treenode_connector
@@ -157,19 +142,18 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
         arbors_to_expand = {skid: ls for skid, ls in arbors.iteritems() if skid in expand}
         expanded_arbors, minis = split_by_synapse_domain(bandwidth, locations, arbors_to_expand, treenode_connector, minis)
         arbors.update(expanded_arbors)
+    progress(0.5)
 
 
     # Obtain neuron names
     cursor.execute('''
     SELECT cici.class_instance_a, ci.name
     FROM class_instance ci,
-         class_instance_class_instance cici,
-         relation r
+         class_instance_class_instance cici
     WHERE cici.class_instance_a IN (%s)
       AND cici.class_instance_b = ci.id
-      AND cici.relation_id = r.id
-      AND r.relation_name = 'model_of'
-    ''' % skeletons_string)
+      AND cici.relation_id = %s
+    ''' % (skeletons_string, relation_ids.get('model_of', -1)))
     names = dict(cursor.fetchall())
 
     # A DiGraph representing the connections between the arbors (every node is an arbor)
@@ -200,11 +184,11 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
         for pre_treenode, pre_skeleton in c[relations['presynaptic_to']]:
             for pre_arbor in arbors.get(pre_skeleton, ()):
                 if pre_treenode in pre_arbor:
-                    # Found the DiGraph representing an arbor derived from the skeleton to which the presynaptic treenode belongs.
+                    # Found the Arbor representing an arbor derived from the skeleton to which the presynaptic treenode belongs.
                     for post_treenode, post_skeleton in c[relations['postsynaptic_to']]:
                         for post_arbor in arbors.get(post_skeleton, ()):
                             if post_treenode in post_arbor:
-                                # Found the DiGraph representing an arbor derived from the skeleton to which the postsynaptic treenode belongs.
+                                # Found the Arbor representing an arbor derived from the skeleton to which the postsynaptic treenode belongs.
                                 edge_props = circuit.get_edge_data(pre_arbor, post_arbor)
                                 if edge_props:
                                     edge_props['c'] += 1
@@ -215,10 +199,13 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                                 break
                     break
 
+    progress(0.6)
+
     if compute_risk and bandwidth <= 0:
         # Compute synapse risk:
         # Compute synapse centrality of every node in every arbor that has synapses
-        for skeleton_id, arbors in whole_arbors.iteritems():
+        for i, (skeleton_id, arbors) in enumerate(whole_arbors.iteritems()):
+            progress(0.6 + 0.2 * i / len(whole_arbors))
             synapses = skeleton_synapses[skeleton_id]
             pre = synapses[relations['presynaptic_to']]
             post = synapses[relations['postsynaptic_to']]
@@ -243,13 +230,15 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                 arbor.treenode_synapse_counts = tc
 
         if not locations:
-            locations = {row[0]: imap(float, row[4][1:-1].split(',')) for row in rows}
+            locations = {row[0]: tuple(imap(float, row[4][1:-1].split(','))) for row in rows}
 
         # Estimate the risk factor of the edge between two arbors,
         # as a function of the number of synapses and their location within the arbor.
         # Algorithm by Casey Schneider-Mizell
         # Implemented by Albert Cardona
-        for pre_arbor, post_arbor, edge_props in circuit.edges_iter(data=True):
+        n_edges = circuit.number_of_edges()
+        for i, (pre_arbor, post_arbor, edge_props) in enumerate(circuit.edges_iter(data=True)):
+            progress(0.8 + 0.2 * i / n_edges)
             if pre_arbor == post_arbor:
                 # Signal autapse
                 edge_props['risk'] = -2
@@ -299,18 +288,9 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
     return circuit
 
 
-@requires_user_role([UserRole.Annotate, UserRole.Browse])
-def skeleton_graph(request, project_id=None):
-    project_id = int(project_id)
-    skeleton_ids = set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_list['))
-    confidence_threshold = int(request.POST.get('confidence_threshold', 0))
-    bandwidth = float(request.POST.get('bandwidth', 0)) # in nanometers
-    cable_spread = float(request.POST.get('cable_spread', 2500)) # in nanometers
-    path_confluence = int(request.POST.get('path_confluence', 10)) # a count
-    compute_risk = 1 == int(request.POST.get('risk', 0))
-    expand = set(int(v) for k,v in request.POST.iteritems() if k.startswith('expand['))
-
-    circuit = _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence)
+def _skeleton_graph_json(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence, progress=no_progress):
+    """ Returns the circuit of the skeletons as nodes and edges of a JSON graph. """
+    circuit = _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, set(expand), compute_risk, cable_spread, path_confluence, progress)
     package = {'nodes': [{'data': props} for props in circuit.node.itervalues()],
                'edges': []}
     edges = package['edges']
@@ -328,7 +308,21 @@ def skeleton_graph(request, project_id=None):
             data['risk'] = props.get('risk')
         edges.append({'data': data})
 
-    return HttpResponse(json.dumps(package))
+    return package
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def skeleton_graph(request, project_id=None):
+    project_id = int(project_id)
+    skeleton_ids = set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_list['))
+    confidence_threshold = int(request.POST.get('confidence_threshold', 0))
+    bandwidth = float(request.POST.get('bandwidth', 0)) # in nanometers
+    cable_spread = float(request.POST.get('cable_spread', 2500)) # in nanometers
+    path_confluence = int(request.POST.get('path_confluence', 10)) # a count
+    compute_risk = 1 == int(request.POST.get('risk', 0))
+    expand = sorted(int(v) for k,v in request.POST.iteritems() if k.startswith('expand['))
+
+    return graph_response(request, 'graph', project_id, skeleton_ids,
+            (confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence))
 
 class Counts():
     def __init__(self):
@@ -378,7 +372,7 @@ def _node_centrality_by_synapse_db(skeleton_id):
     return nodes
 
 def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
-    """ tree: a DiGraph
+    """ tree: a DiGraph or an Arbor
         nodes: a dictionary of treenode ID vs Counts instance
         totalOutputs: the total number of output synapses of the tree
         totalInputs: the total number of input synapses of the tree
@@ -1,90 +1,41 @@
 import json
 from django.db import connection
-from django.http import HttpResponse
 from catmaid.control.authentication import *
-from catmaid.models import Relation
-import networkx as nx
-from networkx.algorithms import weakly_connected_component_subgraphs
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.graphjob import graph_response, result_response, no_progress
 from collections import defaultdict
-from itertools import chain, ifilter, imap, izip, count
+from itertools import chain, ifilter, imap, izip, count, groupby
 from functools import partial
 from synapseclustering import tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
+import numpy as np
+from arbor import Arbor
 from tree_util import edge_count_to_root, simplify, find_root, reroot, partition, spanning_tree, cable_length
 from math import sqrt
 import sys
-from operator import getitem
+from operator import getitem, itemgetter
 
 def basic_graph(project_id, skeleton_ids):
     cursor = connection.cursor()
 
+    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
     cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
+    SELECT pre_skeleton_id, post_skeleton_id, count
+    FROM skeleton_connectivity
     WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
+      AND pre_skeleton_id IN (%s)
+      AND post_skeleton_id IN (%s)
+    ''' % (int(project_id), skids, skids))
 
-    cursor.execute('''
-    SELECT tc.connector_id, tc.relation_id, tc.skeleton_id
-    FROM treenode_connector tc
-    WHERE tc.project_id = %s
-      AND tc.skeleton_id IN (%s)
-    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
+    return {'edges': tuple(cursor.fetchall())}
 
-    # stores entire query set in memory, linking pre and post
-    connectors = defaultdict(partial(defaultdict, list))
-    for row in cursor.fetchall():
-        connectors[row[0]][row[1]].append(row[2])
 
-    # Safe to placeholder, half-complete connectors:
-    # only adds the edge if both pre and post exist
-    edges = defaultdict(partial(defaultdict, int))
-    for c in connectors.itervalues():
-        for pre in c[preID]: # should be one or none
-            for post in c[postID]:
-                edges[pre][post] += 1
-
-    return {'edges': tuple((pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems())}
-
-    '''
-    return {'edges': [{'source': pre,
-                       'target': post,
-                       'weight': count} for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
-    '''
-
-    """ Can't get the variable to be set with all the skeleton IDs
-    cursor.execute('''
-    WITH skeletons as (VALUES (%s) UNION ALL)
-    SELECT tc1.skeleton_id, tc2.skeleton_id, count(*)
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.project_id = %s
-      AND tc1.project_id = tc2.project_id
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = %s
-      AND tc2.relation_id = %s
-      AND tc1.skeleton_id IN skeletons
-      AND tc2.skeleton_id IN skeletons
-    ''' % (",".join(str(int(skid)) for skid in skeleton_ids), int(project_id), preID, postID))
-    """
-
-
-def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
+def confidence_split_graph(project_id, skeleton_ids, confidence_threshold, progress=no_progress):
     """ Assumes 0 < confidence_threshold <= 5. """
     cursor = connection.cursor()
     skids = ",".join(str(int(skid)) for skid in skeleton_ids)
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
     # Fetch synapses of all skeletons
@@ -114,27 +65,9 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
     # All nodes of the graph
     nodeIDs = []
 
-    # Read out into memory only one skeleton at a time
-    current_skid = None
-    tree = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+    for i, (skid, chunks) in enumerate(skeleton_arbors(cursor.fetchall(), confidence_threshold)):
+        progress(float(i) / len(skeleton_ids))
+        nodeIDs.extend(split_by_confidence(skid, chunks, stc[skid], connectors))
 
     # Create the edges of the graph from the connectors, which was populated as a side effect of 'split_by_confidence'
     edges = defaultdict(partial(defaultdict, int)) # pre vs post vs count
@@ -147,7 +80,7 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
             'edges': [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
 
 
-def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand):
+def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, progress=no_progress):
     """ Assumes bandwidth > 0 and some skeleton_id in expand. """
     cursor = connection.cursor()
     skeleton_ids = set(skeleton_ids)
@@ -157,13 +90,8 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
 
     skids = ",".join(str(int(skid)) for skid in skeleton_ids)
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
     # Fetch synapses of all skeletons
@@ -196,27 +124,9 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
         ORDER BY skeleton_id
         ''' % (project_id, ",".join(str(int(skid)) for skid in not_to_expand)))
 
-        # Read out into memory only one skeleton at a time
-        current_skid = None
-        tree = None
-        for row in cursor.fetchall():
-            if row[0] == current_skid:
-                # Build the tree, breaking it at the low-confidence edges
-                if row[2] and row[3] >= confidence_threshold:
-                        tree.add_edge(row[2], row[1])
-                continue
-
-            if tree:
-                nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-            # Start the next tree
-            current_skid = row[0]
-            tree = nx.DiGraph()
-            if row[2] and row[3] > confidence_threshold:
-                tree.add_edge(row[2], row[1])
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+        for i, (skid, chunks) in enumerate(skeleton_arbors(cursor.fetchall(), confidence_threshold)):
+            progress(float(i) / len(skeleton_ids))
+            nodeIDs.extend(split_by_confidence(skid, chunks, stc[skid], connectors))
     else:
         # No need to split.
         # Populate connectors from the connections among them
@@ -241,33 +151,9 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
     # list of branch nodes, merely structural
     branch_nodeIDs = []
 
-    # reset
-    current_skid = None
-    tree = None
-    locations = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            locations[row[1]] = row[4:]
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
+    for i, (skid, chunks) in enumerate(skeleton_arbors(cursor.fetchall(), confidence_threshold)):
+        progress(float(len(not_to_expand) + i) / len(skeleton_ids))
+        ns, bs = split_by_both(skid, chunks, bandwidth, stc[skid], connectors, intraedges)
         nodeIDs.extend(ns)
         branch_nodeIDs.extend(bs)
 
@@ -285,6 +171,22 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
             'intraedges': intraedges}
 
 
+def skeleton_arbors(rows, confidence_threshold):
+    """ rows: tuples of skeleton ID, treenode ID, parent ID, confidence and
+    optionally x, y, z, sorted by skeleton ID.
+    Reads out one skeleton at a time and yields tuples of skeleton ID and the
+    list of Arbor instances that results from breaking the skeleton at the
+    low-confidence edges. With locations, the Arbors have a 'location'
+    property. """
+    for skid, srows in groupby(rows, itemgetter(0)):
+        columns = zip(*srows)
+        properties = {}
+        if len(columns) > 4:
+            properties['location'] = np.array(columns[4:7], dtype=np.float64).T
+        tree = Arbor(columns[1], columns[2], properties)
+        yield skid, tree.split(node for node, confidence in izip(columns[1], columns[3]) if confidence < confidence_threshold)
+
+
 def populate_connectors(chunkIDs, chunks, cs, connectors):
     # Build up edges via the connectors
     IDchunks = zip(chunkIDs, chunks)
@@ -296,34 +198,29 @@ def populate_connectors(chunkIDs, chunks, cs, connectors):
                 break
 
 
-def subgraphs(digraph, skeleton_id):
-    chunks = weakly_connected_component_subgraphs(digraph)
+def subgraphs(chunks, skeleton_id):
     if 1 == len(chunks):
         chunkIDs = (str(skeleton_id),)
     else:
         chunkIDs = tuple('%s_%s' % (skeleton_id, (i+1)) for i in xrange(len(chunks)))
-    return chunks, chunkIDs
+    return chunkIDs
 
 
-def split_by_confidence(skeleton_id, digraph, cs, connectors):
+def split_by_confidence(skeleton_id, chunks, cs, connectors):
     """ Split by confidence threshold. Populates connectors (side effect). """
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
+    chunkIDs = subgraphs(chunks, skeleton_id)
     populate_connectors(chunkIDs, chunks, cs, connectors)
     return chunkIDs
 
 
-def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, intraedges):
+def split_by_both(skeleton_id, chunks, bandwidth, cs, connectors, intraedges):
     """ Split by confidence and synapse domain. Populates connectors and intraedges (side effects). """
     nodes = []
     branch_nodes = []
 
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
+    chunkIDs = subgraphs(chunks, skeleton_id)
 
     for i, chunkID, chunk in izip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
         blob = tuple(c for c in cs if c[0] in chunk)
         if 0 == len(blob):
@@ -337,7 +234,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
             continue
 
         # Invoke Casey's magic: split by synapse domain
-        domains = tree_max_density(chunk.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
+        domains = tree_max_density(chunk, treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
 
         # domains is a dictionary of index vs SynapseGroup instance
 
@@ -379,7 +276,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
     return nodes, branch_nodes
 
 
-def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence):
+def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence, progress=no_progress):
     if not expand:
         # Prevent expensive operations that will do nothing
         bandwidth = 0
@@ -388,9 +285,9 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
         return basic_graph(project_id, skeleton_ids)
 
     if 0 == bandwidth:
-        return confidence_split_graph(project_id, skeleton_ids, confidence_threshold)
+        return confidence_split_graph(project_id, skeleton_ids, confidence_threshold, progress)
 
-    return dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand)
+    return dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, progress)
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -407,7 +304,12 @@ def skeleton_graph(request, project_id=None):
     bandwidth = float(request.POST.get('bandwidth', 0)) # in nanometers
     cable_spread = float(request.POST.get('cable_spread', 2500)) # in nanometers
     path_confluence = int(request.POST.get('path_confluence', 10)) # a count
-    expand = set(int(v) for k,v in request.POST.iteritems() if k.startswith('expand['))
+    expand = sorted(int(v) for k,v in request.POST.iteritems() if k.startswith('expand['))
+
+    if 0 == confidence_threshold and (0 == bandwidth or not expand):
+        # A single query of the skeleton_connectivity table is cheap enough
+        return result_response(request, json.dumps(basic_graph(project_id, skeleton_ids)))
 
-    return HttpResponse(json.dumps(_skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence)))
+    return graph_response(request, 'graph2', project_id, skeleton_ids,
+            (confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence))
 
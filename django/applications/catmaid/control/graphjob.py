@@ -0,0 +1,272 @@
+""" Graph analyses of many skeletons as Celery jobs.
+
+The graph widgets request analyses (e.g. splitting skeletons by confidence and
+synapse domains or computing synapse risk) that load every treenode of every
+requested skeleton. For large requests this takes minutes, which shouldn't be
+spent in a web server process. Clients that pass the 'async' parameter get a
+job ID instead of the result. The analysis runs as a Celery task, which reports
+its progress, and the client polls the status of the job until its result is
+available. Jobs can be cancelled by the client.
+
+Results are cached for GRAPH_JOB_RESULT_TIMEOUT seconds. A job is identified
+by the analysis, its parameters and the data revision of the skeletons, i.e.
+the number and the last edition time of their treenodes and links. Repeated
+requests of an unchanged graph are answered from the cache, and identical
+requests of different users share a job.
+
+Job states and results are stored in the cache named GRAPH_JOB_CACHE, which
+has to be shared by the web server and the Celery worker processes (e.g.
+memcached or a database cache). If it isn't (i.e. it is a local-memory cache)
+and Celery doesn't run tasks eagerly, analyses are computed synchronously
+like before.
+"""
+
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+from django.http import HttpResponse
+
+from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import json_error_response
+from catmaid.models import UserRole
+
+from celery.task import task
+
+
+class JobCancelled(Exception):
+    pass
+
+def no_progress(fraction):
+    """ The progress callback of analyses that don't run as a job. """
+    pass
+
+def _analysis(name):
+    """ Returns the function that computes the analysis with the given name.
+    It is called with the project ID, a list of skeleton IDs, the parameters
+    of the analysis and a progress callback. """
+    # Imported here, because the graph modules use this module
+    if 'graph' == name:
+        from catmaid.control.graph import _skeleton_graph_json
+        return _skeleton_graph_json
+    if 'graph2' == name:
+        from catmaid.control.graph2 import _skeleton_graph
+        return _skeleton_graph
+    raise Exception("Unknown graph analysis: %s" % name)
+
+def _job_cache():
+    return get_cache(getattr(settings, 'GRAPH_JOB_CACHE', 'default'))
+
+def _result_timeout():
+    return getattr(settings, 'GRAPH_JOB_RESULT_TIMEOUT', 3600)
+
+def _jobs_available(cache):
+    """ Jobs can only be used if their state is visible to all processes. """
+    if getattr(settings, 'CELERY_ALWAYS_EAGER', False):
+        return True
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+def _status_key(job_id):
+    return 'graphjob_status_%s' % job_id
+
+def _result_key(job_id):
+    return 'graphjob_result_%s' % job_id
+
+def _cancel_key(job_id):
+    return 'graphjob_cancel_%s' % job_id
+
+def _user_key(user_id):
+    return 'graphjob_user_%s' % user_id
+
+def _set_status(cache, job_id, project_id, status, progress, error=None):
+    cache.set(_status_key(job_id), {
+        'project_id': project_id,
+        'status': status,
+        'progress': progress,
+        'error': error}, _result_timeout())
+
+def _data_revision(skeleton_ids):
+    """ Returns a string that changes with every change of the treenodes, the
+    links and the neuron names of the given skeletons. Edition times are
+    updated by triggers and deletions change the counts. """
+    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT count(*), max(edition_time) FROM treenode
+    WHERE skeleton_id IN (%s)
+    UNION ALL
+    SELECT count(*), max(edition_time) FROM treenode_connector
+    WHERE skeleton_id IN (%s)
+    UNION ALL
+    SELECT count(*), max(ci.edition_time)
+    FROM class_instance_class_instance cici, class_instance ci
+    WHERE cici.class_instance_a IN (%s)
+      AND cici.class_instance_b = ci.id
+    ''' % (skids, skids, skids))
+    return repr(cursor.fetchall())
+
+def _job_id(name, project_id, skeleton_ids, args):
+    key = json.dumps([name, project_id, skeleton_ids, args])
+    return hashlib.sha1(key + _data_revision(skeleton_ids)).hexdigest()
+
+def _done_response(result):
+    """ The result is stored as JSON string, which is embedded as is. """
+    return HttpResponse('{"status": "done", "progress": 1, "result": %s}' % result)
+
+def result_response(request, result):
+    """ Responds with the JSON string of a result, which is wrapped like the
+    status of a finished job if the client requested a job. """
+    if request.POST.get('async'):
+        return _done_response(result)
+    return HttpResponse(result)
+
+
+class _Progress(object):
+    """ Records the progress of a job in the cache, at most once per second,
+    and raises JobCancelled if the job has been cancelled in the meantime. """
+    def __init__(self, cache, job_id, project_id):
+        self.cache = cache
+        self.job_id = job_id
+        self.project_id = project_id
+        self.last_update = time.time()
+
+    def __call__(self, fraction):
+        now = time.time()
+        if now - self.last_update < 1:
+            return
+        self.last_update = now
+        if self.cache.get(_cancel_key(self.job_id)):
+            raise JobCancelled()
+        _set_status(self.cache, self.job_id, self.project_id, 'running',
+                round(fraction, 2))
+
+
+@task()
+def process_graph_job(job_id, project_id, name, skeleton_ids, args):
+    """ Computes the analysis and stores its result in the job cache. It is
+    executed as Celery task. """
+    cache = _job_cache()
+    if cache.get(_cancel_key(job_id)):
+        # Cancelled while waiting in the queue
+        _set_status(cache, job_id, project_id, 'cancelled', 0)
+        return
+    _set_status(cache, job_id, project_id, 'running', 0)
+    try:
+        result = _analysis(name)(project_id, skeleton_ids, *args,
+                progress=_Progress(cache, job_id, project_id))
+    except JobCancelled:
+        _set_status(cache, job_id, project_id, 'cancelled', 0)
+        return
+    except Exception as e:
+        _set_status(cache, job_id, project_id, 'error', 0, str(e))
+        raise
+    cache.set(_result_key(job_id), json.dumps(result), _result_timeout())
+    _set_status(cache, job_id, project_id, 'done', 1)
+
+def _submit(cache, request, job_id, project_id, name, skeleton_ids, args):
+    """ Starts a job unless it is queued or running already. A user can have
+    at most GRAPH_JOB_MAX_PER_USER unfinished jobs, so that a single user
+    can't occupy all workers. """
+    status = cache.get(_status_key(job_id))
+    if status and status['status'] in ('queued', 'running'):
+        # Requested again, so a pending cancellation is withdrawn
+        cache.delete(_cancel_key(job_id))
+        return HttpResponse(json.dumps(dict(status, job_id=job_id)))
+
+    user_key = _user_key(request.user.id)
+    user_jobs = [j for j in cache.get(user_key, ()) if j != job_id]
+    unfinished = cache.get_many([_status_key(j) for j in user_jobs])
+    user_jobs = [j for j in user_jobs if unfinished.get(_status_key(j),
+            {}).get('status') in ('queued', 'running')]
+    max_jobs = getattr(settings, 'GRAPH_JOB_MAX_PER_USER', 2)
+    if len(user_jobs) >= max_jobs:
+        return json_error_response("Too many graph analyses are running " \
+                "for you already. Please wait for them to finish or cancel " \
+                "them.")
+    cache.set(user_key, user_jobs + [job_id], _result_timeout())
+
+    cache.delete(_cancel_key(job_id))
+    _set_status(cache, job_id, project_id, 'queued', 0)
+    options = {'task_id': job_id}
+    queue = getattr(settings, 'GRAPH_JOB_QUEUE', None)
+    if queue:
+        options['queue'] = queue
+    process_graph_job.apply_async((job_id, project_id, name, skeleton_ids,
+            args), **options)
+
+    # With eagerly executed tasks, the job is done already
+    status = cache.get(_status_key(job_id))
+    if status and 'done' == status['status']:
+        result = cache.get(_result_key(job_id))
+        if result is not None:
+            return _done_response(result)
+    return HttpResponse(json.dumps(dict(status or {}, job_id=job_id)))
+
+def graph_response(request, name, project_id, skeleton_ids, args):
+    """ Responds with the result of the named analysis of the given skeletons,
+    which is computed in the request if the 'async' parameter isn't set and
+    as a job otherwise. All arguments have to be serializable to JSON. Results
+    are taken from the cache if the skeletons didn't change. """
+    skeleton_ids = sorted(skeleton_ids)
+    if not skeleton_ids:
+        return json_error_response("No skeletons given")
+    cache = _job_cache()
+    job_id = _job_id(name, project_id, skeleton_ids, args)
+    result = cache.get(_result_key(job_id))
+    if result is not None:
+        return result_response(request, result)
+
+    jobs_available = _jobs_available(cache)
+    if request.POST.get('async') and jobs_available:
+        return _submit(cache, request, job_id, project_id, name,
+                skeleton_ids, args)
+
+    max_nodes = getattr(settings, 'GRAPH_SYNC_MAX_NODES', 0)
+    if jobs_available and max_nodes > 0:
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT coalesce(sum(num_nodes), 0) FROM skeleton_summary
+        WHERE skeleton_id IN (%s)
+        ''' % ",".join(str(int(skid)) for skid in skeleton_ids))
+        if cursor.fetchone()[0] > max_nodes:
+            return json_error_response("The skeletons have more than %s " \
+                    "nodes, please request the analysis as job." % max_nodes)
+
+    result = json.dumps(_analysis(name)(project_id, skeleton_ids, *args))
+    cache.set(_result_key(job_id), result, _result_timeout())
+    return result_response(request, result)
+
+def _job_status(cache, project_id, job_id):
+    status = cache.get(_status_key(job_id))
+    if not status or status['project_id'] != int(project_id):
+        raise Exception("Unknown graph analysis job: %s" % job_id)
+    return status
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def job_status(request, project_id=None, job_id=None):
+    """ Returns the status ('queued', 'running', 'done', 'cancelled' or
+    'error') and the progress of a job, along with the result of finished
+    jobs. """
+    cache = _job_cache()
+    status = _job_status(cache, project_id, job_id)
+    if 'done' == status['status']:
+        result = cache.get(_result_key(job_id))
+        if result is not None:
+            return _done_response(result)
+        status = dict(status, status='error', error="The result expired")
+    return HttpResponse(json.dumps(dict(status, job_id=job_id)))
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def cancel_job(request, project_id=None, job_id=None):
+    """ Cancels a queued or running job. Running jobs stop at their next
+    progress report. """
+    cache = _job_cache()
+    status = _job_status(cache, project_id, job_id)
+    if status['status'] in ('queued', 'running'):
+        cache.set(_cancel_key(job_id), True, _result_timeout())
+    return HttpResponse(json.dumps({'job_id': job_id, 'cancelled': True}))
@@ -9,12 +9,21 @@ from django.shortcuts import get_object_or_404
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control import nodecache
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def label_remove(request, project_id=None):
     # check if superuser, then delete label and all associated instances
     class_instance_for_label = int(request.POST['class_instance_id'])
     if request.user.is_superuser:
+        nodecache.invalidate_treenodes(project_id,
+                TreenodeClassInstance.objects.filter(
+                    class_instance=class_instance_for_label).values_list(
+                        'treenode_id', flat=True))
+        nodecache.invalidate_connectors(project_id,
+                ConnectorClassInstance.objects.filter(
+                    class_instance=class_instance_for_label).values_list(
+                        'connector_id', flat=True))
         ClassInstance.objects.filter(id=class_instance_for_label).delete()
         return HttpResponse(json.dumps({'message': 'success'}), mimetype="text/plain")
     return HttpResponse(json.dumps({}), mimetype="text/plain")
@@ -44,67 +53,43 @@ def labels_for_node(request, project_id=None, ntype=None, location_id=None):
         raise Http404('Unknown node type: "%s"' % (ntype,))
     return HttpResponse(json.dumps(list(x.class_instance.name for x in qs)), mimetype="text/plain")
 
+def labels_for_node_ids(cursor, project_id, labeled_as, treenode_ids,
+        connector_ids):
+    """ Returns a dictionary of treenode and connector IDs versus the list of
+    names of the labels they are labeled with. Only the label links are read,
+    which the (relation_id, node ID) indices answer directly. The names are
+    taken from the cached label dictionary of the project. """
+    links = []
+    for table, column, node_ids in (
+            ('treenode_class_instance', 'treenode_id', treenode_ids),
+            ('connector_class_instance', 'connector_id', connector_ids)):
+        if not node_ids:
+            continue
+        cursor.execute('''
+        SELECT %s, class_instance_id
+        FROM %s
+        WHERE relation_id = %s
+          AND %s IN (%s)
+        ''' % (column, table, int(labeled_as), column,
+                ','.join(str(int(node_id)) for node_id in node_ids)))
+        links.extend(cursor.fetchall())
+
+    names = get_label_names(project_id, set(row[1] for row in links))
+    labels = defaultdict(list)
+    for node_id, label_id in links:
+        labels[node_id].append(names[label_id])
+    return labels
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def labels_for_nodes(request, project_id=None):
     # Two POST variables, which are each an array of integers stringed together with commas as separators
     treenode_ids = request.POST['treenode_ids'].strip()
     connector_ids = request.POST['connector_ids'].strip()
-    result = defaultdict(list)
-    cursor = connection.cursor();
-
-    if treenode_ids:
-        # Could use treenode_ids directly as a string, but it is good to sanitize arguments
-        cursor.execute('''
-        SELECT treenode.id, class_instance.name
-        FROM treenode, class_instance, treenode_class_instance, relation
-        WHERE relation.id = treenode_class_instance.relation_id
-          AND relation.relation_name = 'labeled_as'
-          AND treenode_class_instance.treenode_id = treenode.id
-          AND class_instance.id = treenode_class_instance.class_instance_id
-          AND treenode.id IN (%s)
-        ''' % ','.join(str(int(x)) for x in treenode_ids.split(','))) # convoluted to sanitize
-
-        for row in cursor.fetchall():
-            result[row[0]].append(row[1])
-        # The code below:
-        # 1. Is hard to read, compared to plain SQL (see above)
-        # 2. Selects all possible columns, wastefully
-        # 3. If appended with values(...), then returns a dictionary, wastefully
-        # 4. Runs slower than the equivalent code above
-        """
-        qs_treenodes = TreenodeClassInstance.objects.filter(
-            relation__relation_name='labeled_as',
-            class_instance__class_column__class_name='label',
-            treenode__id__in=(int(x) for x in treenode_ids.split(',')),
-            project=project_id).select_related('treenode', 'class_instance').values('treenode_id', 'class_instance__name')
-        for tci in qs_treenodes:
-            result[tci['treenode_id']].append(tci['class_instance__name'])
-        """
-
-    if connector_ids:
-        cursor.execute('''
-        SELECT connector.id, class_instance.name
-        FROM connector, class_instance, connector_class_instance, relation
-        WHERE relation.id = connector_class_instance.relation_id
-          AND relation.relation_name = 'labeled_as'
-          AND connector_class_instance.connector_id = connector.id
-          AND class_instance.id = connector_class_instance.class_instance_id
-          AND connector.id IN (%s)
-        ''' % ','.join(str(int(x)) for x in connector_ids.split(','))) # convoluted to sanitize
-        for row in cursor.fetchall():
-            result[row[0]].append(row[1])
-
-        # See notes above for treenode_ids
-        """
-        qs_connectors = ConnectorClassInstance.objects.filter(
-            relation__relation_name='labeled_as',
-            class_instance__class_column__class_name='label',
-            connector__id__in=(int(x) for x in connector_ids.split(',')),
-            project=project_id).select_related('connector', 'class_instance')
-        for cci in qs_connectors:
-            result[cci.connector.id].append(cci.class_instance.name)
-        """
-
+    relation_map = get_relation_to_id_map(project_id, ('labeled_as',))
+    result = labels_for_node_ids(connection.cursor(), project_id,
+            relation_map['labeled_as'],
+            treenode_ids.split(',') if treenode_ids else (),
+            connector_ids.split(',') if connector_ids else ())
     return HttpResponse(json.dumps(result), mimetype="text/plain")
 
 @requires_user_role(UserRole.Annotate)
@@ -201,6 +186,11 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
                               'reject_action': 'from catmaid.control.label import remove_label\nremove_label(' + str(tci.id) + ', "' + ntype + '")'}).save()
 
 
+    if 'treenode' == ntype:
+        nodecache.invalidate_treenodes(project_id, [node.id])
+    else:
+        nodecache.invalidate_connectors(project_id, [node.id])
+
     return HttpResponse(json.dumps({'message': 'success'}), mimetype='text/json')
 
 
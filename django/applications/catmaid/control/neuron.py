@@ -6,6 +6,7 @@ from django.db import connection
 
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control import nodecache
 from catmaid.models import ClassInstance, ClassInstanceClassInstance, Treenode
 
 import operator
@@ -45,10 +46,8 @@ def delete_neuron(request, project_id=None, neuron_id=None):
     can_edit_class_instance_or_fail(request.user, neuron_id, 'neuron')
 
     # Create class and relation dictionaries
-    classes = dict(Class.objects.filter(
-            project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(
-            project_id=project_id).values_list('relation_name', 'id'))
+    relations = get_relation_to_id_map(project_id,
+            ('model_of', 'annotated_with'))
 
     # Make sure the user has permission to edit all treenodes of all skeletons
     skeleton_ids = ClassInstanceClassInstance.objects.filter(
@@ -105,6 +104,7 @@ def delete_neuron(request, project_id=None, neuron_id=None):
     ClassInstance.objects.filter(id__in=unused_annotation_ids).delete()
 
     # Delete the skeletons (and their treenodes through cascading delete)
+    nodecache.invalidate_skeletons(project_id, skeleton_ids)
     cursor = connection.cursor()
     for skid in skeleton_ids:
         # Because there are constraints used in the database that Django is not
@@ -186,8 +186,9 @@ def create_annotated_entity_list(project, entities_qs, relations, annotations=Tr
 def query_neurons_by_annotations(request, project_id = None):
     p = get_object_or_404(Project, pk = project_id)
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id, ('neuron', 'annotation'))
+    relations = get_relation_to_id_map(project_id,
+            ('annotated_with', 'model_of'))
 
     display_start = int(request.POST.get('display_start', 0))
     display_length = int(request.POST.get('display_length', -1))
@@ -215,8 +216,9 @@ def query_neurons_by_annotations(request, project_id = None):
 def query_neurons_by_annotations_datatable(request, project_id=None):
     p = get_object_or_404(Project, pk = project_id)
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id, ('neuron', 'annotation'))
+    relations = get_relation_to_id_map(project_id,
+            ('annotated_with', 'model_of'))
 
     display_start = int(request.POST.get('iDisplayStart', 0))
     display_length = int(request.POST.get('iDisplayLength', -1))
@@ -401,8 +403,9 @@ def remove_annotation(request, project_id=None, annotation_id=None,
 
 def create_annotation_query(project_id, param_dict):
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id, ('annotation',))
+    relations = get_relation_to_id_map(project_id,
+            ('annotated_with', 'model_of'))
 
     annotation_query = ClassInstance.objects.filter(project_id=project_id,
             class_column__id=classes['annotation'])
@@ -597,8 +600,8 @@ def list_annotations(request, project_id=None):
     return HttpResponse(json.dumps({'annotations': annotations}), mimetype="text/json")
 
 def _fast_co_annotations(request, project_id, display_start, display_length):
-    classIDs = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relationIDs = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classIDs = get_class_to_id_map(project_id, ('annotation', 'neuron'))
+    relationIDs = get_relation_to_id_map(project_id, ('annotated_with',))
     co_annotation_ids = set(int(v) for k, v in request.POST.iteritems() if k.startswith('parallel_annotations'))
 
     select, rest = generate_co_annotation_query(int(project_id), co_annotation_ids, classIDs, relationIDs)
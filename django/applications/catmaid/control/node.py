@@ -3,6 +3,7 @@ import json
 from collections import defaultdict
 from datetime import datetime
 
+from django.conf import settings
 from django.db import connection
 from django.http import HttpResponse
 
@@ -12,13 +13,307 @@ from catmaid.models import *
 from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.label import labels_for_node_ids
 from catmaid.control.treenode import can_edit_treenode_or_fail
+from catmaid.control import binaryformat, nodecache, topologycache
 
 import sys
-try:
-    import networkx as nx
-except:
-    pass
+
+# The number of seconds that node_list_changes looks further back than the
+# revision it is given.
+_REVISION_OVERLAP = 10
+
+
+def _box_filter(table, strict=True):
+    """ Returns an SQL condition, starting with AND, that restricts the
+    locations of the given table to the XY bounding box given by the left,
+    top, right and bottom query parameters. If strict is False, locations on
+    the border of the bounding box are included. """
+    # The point-in-box test lets the query use the GiST index on the XY plane
+    # of treenode locations, the strict comparisons keep the semantics of an
+    # open bounding box.
+    box_filter = '''
+              AND point((%(table)s.location).x, (%(table)s.location).y) <@
+                  box(point(%%(left)s, %%(top)s), point(%%(right)s, %%(bottom)s))'''
+    if strict:
+        box_filter += '''
+              AND (%(table)s.location).x > %%(left)s
+              AND (%(table)s.location).x < %%(right)s
+              AND (%(table)s.location).y > %%(top)s
+              AND (%(table)s.location).y < %%(bottom)s'''
+    return box_filter % {'table': table}
+
+
+def _node_list_rows(cursor, params, strict=True):
+    """ Fetch treenodes which are in the bounding box of section z, along with
+    their parents and children, which may lie in adjacent sections, as well as
+    the connectors related to these treenodes or located in the bounding box.
+    Returns a tuple of treenode rows, connector rows and a boolean that is true
+    if the bounding box contained more treenodes than params['limit']. If
+    strict is False, nodes on the border of the bounding box are included.
+    """
+    # The section query is limited to one node more than the node limit, so
+    # that truncation can be detected reliably.
+    cursor.execute('''
+    WITH section AS (
+        SELECT t.id, t.parent_id
+        FROM treenode t
+        WHERE t.project_id = %%(project_id)s
+          AND (t.location).z = %%(z)s %s
+        LIMIT %%(limit)s + 1
+    )
+    SELECT
+        t.id,
+        t.parent_id,
+        (t.location).x,
+        (t.location).y,
+        (t.location).z,
+        t.confidence,
+        t.radius,
+        t.skeleton_id,
+        t.user_id
+    FROM treenode t
+    WHERE t.id IN (
+        SELECT id FROM section
+        UNION
+        SELECT parent_id FROM section WHERE parent_id IS NOT NULL
+        UNION
+        SELECT c.id FROM treenode c, section s WHERE c.parent_id = s.id)
+    ''' % _box_filter('t', strict), params)
+
+    treenode_rows = cursor.fetchall()
+
+    # The number of retrieved nodes that are within the bounding box of
+    # section z. If it exceeds the limit, the section was truncated.
+    z, left, right = params['z'], params['left'], params['right']
+    top, bottom = params['top'], params['bottom']
+    if strict:
+        n_section_nodes = sum(1 for row in treenode_rows if row[4] == z
+                and left < row[2] < right and top < row[3] < bottom)
+    else:
+        n_section_nodes = sum(1 for row in treenode_rows if row[4] == z
+                and left <= row[2] <= right and top <= row[3] <= bottom)
+
+    # Find connectors related to treenodes in the field of view
+    # Connectors found attached to treenodes
+    crows = []
+
+    if treenode_rows:
+        cursor.execute('''
+        SELECT connector.id,
+            (connector.location).x,
+            (connector.location).y,
+            (connector.location).z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN (%s)
+          AND treenode_connector.connector_id = connector.id
+        ''' % ','.join(str(row[0]) for row in treenode_rows))
+
+        crows = list(cursor.fetchall())
+
+    # Obtain connectors within the field of view that were not captured above.
+    # Uses a LEFT OUTER JOIN to include disconnected connectors,
+    # that is, connectors that aren't referenced from treenode_connector.
+
+    cursor.execute('''
+    SELECT connector.id,
+        (connector.location).x,
+        (connector.location).y,
+        (connector.location).z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE connector.project_id = %%(project_id)s
+      AND (connector.location).z = %%(z)s %s
+    ''' % _box_filter('connector', strict), params)
+
+    crows.extend(cursor.fetchall())
+
+    return treenode_rows, crows, n_section_nodes > params['limit']
+
+
+def _node_list_binary_response(treenodes, connectors, labels, truncated,
+        revision):
+    """ Encodes a node list in the binary format. The relations between
+    connectors and treenodes are returned as a separate table, with relation
+    0 meaning presynaptic_to and 1 meaning postsynaptic_to. """
+    links = []
+    for c in connectors:
+        links.extend((c[0], tnid, 0, confidence) for tnid, confidence in c[5])
+        links.extend((c[0], tnid, 1, confidence) for tnid, confidence in c[6])
+    connectors = [c[0:5] + (c[7],) for c in connectors]
+    return binaryformat.response((
+        ('treenodes', treenodes, (
+            ('id', binaryformat.INT),
+            ('parent_id', binaryformat.INT),
+            ('x', binaryformat.FLOAT64),
+            ('y', binaryformat.FLOAT64),
+            ('z', binaryformat.FLOAT64),
+            ('confidence', binaryformat.INT),
+            ('radius', binaryformat.FLOAT32),
+            ('skeleton_id', binaryformat.INT),
+            ('can_edit', binaryformat.BOOL))),
+        ('connectors', connectors, (
+            ('id', binaryformat.INT),
+            ('x', binaryformat.FLOAT64),
+            ('y', binaryformat.FLOAT64),
+            ('z', binaryformat.FLOAT64),
+            ('confidence', binaryformat.INT),
+            ('can_edit', binaryformat.BOOL))),
+        ('connector_links', links, (
+            ('connector_id', binaryformat.INT),
+            ('treenode_id', binaryformat.INT),
+            ('relation', binaryformat.INT),
+            ('confidence', binaryformat.INT)))),
+        {'labels': labels, 'truncated': truncated, 'revision': revision})
+
+
+def _node_list_format(cursor, treenode_rows, crows, presynaptic_to,
+        is_superuser, user_id, domain, extra_treenode_ids=()):
+    """ Turns treenode and connector rows as returned by _node_list_rows into
+    the treenode and connector tuples sent to the client, which include the
+    editability of each node for the given user. Treenodes that are linked to
+    one of the connectors or are listed in extra_treenode_ids, but are not
+    among the rows, are fetched as well. Returns the lists of treenode and
+    connector tuples. """
+    # A list of tuples, each tuple containing the selected columns for each treenode
+    # The id is the first element of each tuple
+    treenodes = []
+    # A set of unique treenode IDs
+    treenode_ids = set()
+
+    for row in treenode_rows:
+        treenode_ids.add(row[0])
+        treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+
+    connectors = []
+    # A set of missing treenode IDs
+    missing_treenode_ids = set()
+    # Check if the additionally requested treenodes are present; if not,
+    # load them
+    missing_treenode_ids.update(tnid for tnid in extra_treenode_ids
+            if tnid not in treenode_ids)
+    # A set of unique connector IDs
+    connector_ids = set()
+    # The relations between connectors and treenodes, stored
+    # as connector ID keys vs a list of tuples, each with the treenode id,
+    # the type of relation (presynaptic_to or postsynaptic_to), and the confidence.
+    # The list of tuples is generated later from a dict,
+    # so that repeated tnid entries are overwritten.
+    pre = defaultdict(dict)
+    post = defaultdict(dict)
+
+    # Process crows (rows with connectors) which could have repeated connectors
+    # given the join with treenode_connector
+    for row in crows:
+        # Collect treeenode IDs related to connectors but not yet in treenode_ids
+        # because they lay beyond adjacent sections
+        tnid = row[6] # The tnid column is index 7 (see SQL statement above)
+        cid = row[0] # connector ID
+        if tnid is not None:
+            if tnid not in treenode_ids:
+                missing_treenode_ids.add(tnid)
+            # Collect relations between connectors and treenodes
+            # row[5]: treenode_relation_id
+            # row[6]: treenode_id (tnid above)
+            # row[7]: tc_confidence
+            if row[5] == presynaptic_to:
+                pre[cid][tnid] = row[7]
+            else:
+                post[cid][tnid] = row[7]
+
+        # Collect unique connectors
+        if cid not in connector_ids:
+            connectors.append(row)
+            connector_ids.add(cid)
+
+    # Fix connectors to contain only the relevant entries, plus the relations
+    for i in xrange(len(connectors)):
+        c = connectors[i]
+        cid = c[0]
+        connectors[i] = (cid, c[1], c[2], c[3], c[4],
+                [kv for kv in  pre[cid].iteritems()],
+                [kv for kv in post[cid].iteritems()],
+                is_superuser or c[8] == user_id or c[8] in domain)
+
+
+    # Fetch missing treenodes. These are related to connectors
+    # but not in the bounding box of the field of view.
+    # This is so that we can draw arrows from any displayed connector
+    # to all of its connected treenodes, even if one is several slices
+    # below.
+
+    if missing_treenode_ids:
+        cursor.execute('''
+        SELECT id,
+            parent_id,
+            (location).x,
+            (location).y,
+            (location).z,
+            confidence,
+            radius,
+            skeleton_id,
+            user_id
+        FROM treenode
+        WHERE id IN %s''', (tuple(missing_treenode_ids),))
+
+        for row in cursor.fetchall():
+            treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+            treenode_ids.add(row[0])
+
+    return treenodes, connectors
+
+
+def _node_list_params(request, project_id):
+    """ Returns the query parameters of a node list request. """
+    params = {}
+    # z: the section index in calibrated units.
+    # width: the width of the field of view in calibrated units.
+    # height: the height of the field of view in calibrated units.
+    # zres: the resolution in the Z axis, used to determine the thickness of a section.
+    # top: the Y coordinate of the bounding box (field of view) in calibrated units
+    # left: the X coordinate of the bounding box (field of view) in calibrated units
+    for p in ('top', 'left', 'z', 'width', 'height', 'zres'):
+        params[p] = float(request.POST.get(p, 0))
+    # Limit the number of retrieved treenodes within the section
+    params['limit'] = getattr(settings, 'NODE_LIST_MAXIMUM_COUNT', 5000)
+    params['project_id'] = project_id
+    params['bottom'] = params['top'] + params['height']
+    params['right'] = params['left'] + params['width']
+    return params
+
+def _current_revision(cursor):
+    """ Returns a token for the current state of the database: the start time
+    of the current transaction, as seconds since the epoch. """
+    cursor.execute("SELECT extract(epoch FROM now())")
+    return '%.6f' % cursor.fetchone()[0]
+
+def _in_view(table):
+    """ Returns an SQL condition that is true if the location of the given
+    table is in section z and within the field of view. """
+    return '((%s.location).z = %%(z)s %s)' % (table, _box_filter(table))
+
+def _treenode_in_view_or_adjacent(table):
+    """ Returns an SQL condition that is true if the treenode of the given
+    table is part of the node list of the field of view, i.e. if it, its
+    parent or one of its children is in the field of view. """
+    return '''(%s
+        OR EXISTS (SELECT 1 FROM treenode adjacent_child
+                   WHERE adjacent_child.parent_id = %s.id AND %s)
+        OR EXISTS (SELECT 1 FROM treenode adjacent_parent
+                   WHERE adjacent_parent.id = %s.parent_id AND %s))''' % (
+            _in_view(table), table, _in_view('adjacent_child'),
+            table, _in_view('adjacent_parent'))
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -30,34 +325,35 @@ def node_list_tuples(request, project_id=None):
     In this function tuples are used as much as possible for immutable list,
     and uses directly the tuples returned by the database cursor.
     [2] the labels, if requested.
-    [3] a boolean which is true when the node limit has been reached.
+    [3] a boolean which is true when the node limit has been reached in the
+    requested section, i.e. when not all nodes of the field of view could be
+    returned.
+    [4] a revision token, which can be passed to node_list_changes to get
+    only the changes made after this request.
     The returned JSON data is therefore sensitive to indices in the array,
     so care must be taken never to alter the order of the variables in the SQL
     statements without modifying the accesses to said data both in this function
     and in the client that consumes it.
+    If a node list cache is configured, the rows are assembled from cached
+    cells of a fixed grid, see catmaid.control.nodecache.
+    If the 'format' parameter is 'binary', the same data is returned in the
+    binary format of catmaid.control.binaryformat instead of JSON.
     '''
     project_id = int(project_id) # sanitize
-    params = {}
-    # z: the section index in calibrated units.
-    # width: the width of the field of view in calibrated units.
-    # height: the height of the field of view in calibrated units.
-    # zres: the resolution in the Z axis, used to determine the thickness of a section.
+    params = _node_list_params(request, project_id)
     # as: the ID of the active skeleton
-    # top: the Y coordinate of the bounding box (field of view) in calibrated units
-    # left: the X coordinate of the bounding box (field of view) in calibrated units
     atnid = int(request.POST.get('atnid', -1))
-    for p in ('top', 'left', 'z', 'width', 'height', 'zres'):
-        params[p] = float(request.POST.get(p, 0))
-    params['limit'] = 5000  # Limit the number of retrieved treenodes within the section
-    params['project_id'] = project_id
+    with_labels = 'true' == request.POST['labels']
 
     try:
         cursor = connection.cursor()
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+        relation_map = get_relation_to_id_map(project_id,
+                ('labeled_as', 'presynaptic_to'))
+
+        # The revision has to be determined before any node is read, so that
+        # no change is missed by a subsequent request for changes.
+        revision = _current_revision(cursor)
 
         response_on_error = 'Failed to query treenodes'
 
@@ -68,99 +364,165 @@ def node_list_tuples(request, project_id=None):
         # For a superuser, the domain is all users, and implicit.
         domain = None if is_superuser else user_domain(cursor, user_id)
 
-        # Fetch treenodes which are in the bounding box,
-        # which in z it includes the full thickess of the prior section
-        # and of the next section (therefore the '<' and not '<=' for zhigh)
-        params['bottom'] = params['top'] + params['height']
-        params['right'] = params['left'] + params['width']
-        cursor.execute('''
-        SELECT
-            t1.id,
-            t1.parent_id,
-            (t1.location).x,
-            (t1.location).y,
-            (t1.location).z,
-            t1.confidence,
-            t1.radius,
-            t1.skeleton_id,
-            t1.user_id,
-            t2.id,
-            t2.parent_id,
-            (t2.location).x,
-            (t2.location).y,
-            (t2.location).z,
-            t2.confidence,
-            t2.radius,
-            t2.skeleton_id,
-            t2.user_id
-        FROM treenode t1
-             INNER JOIN treenode t2 ON
-               (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
-                OR (t1.parent_id IS NULL AND t1.id = t2.id))
-        WHERE
-            (t1.location).z = %(z)s
-            AND (t1.location).x > %(left)s
-            AND (t1.location).x < %(right)s
-            AND (t1.location).y > %(top)s
-            AND (t1.location).y < %(bottom)s
-            AND t1.project_id = %(project_id)s
-        LIMIT %(limit)s
-        ''', params)
+        # Labels found along with the rows and the IDs of nodes for which
+        # labels have been looked up already.
+        labels = defaultdict(list)
+        labeled_ids = set()
+
+        if nodecache.is_enabled():
+            fetch_labels = None
+            if with_labels:
+                fetch_labels = lambda cursor, treenode_ids, connector_ids: \
+                        labels_for_node_ids(cursor, project_id,
+                                relation_map['labeled_as'], treenode_ids,
+                                connector_ids)
+            treenode_rows, crows, truncated, cached_labels, labeled_ids = \
+                    nodecache.get_node_list(cursor, params, _node_list_rows,
+                            fetch_labels)
+            labels.update(cached_labels)
+        else:
+            treenode_rows, crows, truncated = _node_list_rows(cursor, params)
 
-        # Above, notice that the join is done for:
-        # 1. A parent-child or child-parent pair (where the first one is in section z)
-        # 2. A node with itself when the parent is null
-        # This is by far the fastest way to retrieve all parents and children nodes
-        # of the nodes in section z within the specified 2d bounds.
+        response_on_error = 'Failed to query treenodes from connectors'
+        # If atnid is a connector, it doesn't matter, won't be found in
+        # treenode table.
+        treenodes, connectors = _node_list_format(cursor, treenode_rows, crows,
+                relation_map['presynaptic_to'], is_superuser, user_id, domain,
+                () if -1 == atnid else (atnid,))
 
-        # A list of tuples, each tuple containing the selected columns for each treenode
-        # The id is the first element of each tuple
-        treenodes = []
-        # A set of unique treenode IDs
-        treenode_ids = set()
+        if with_labels:
+            response_on_error = 'Failed to query labels'
+            z0 = params['z']
+            # Collect treenodes and connectors visible in the current section,
+            # whose labels haven't been looked up yet.
+            labels.update(labels_for_node_ids(cursor, project_id,
+                    relation_map['labeled_as'],
+                    [row[0] for row in treenodes
+                            if row[4] == z0 and row[0] not in labeled_ids],
+                    [row[0] for row in connectors
+                            if row[3] == z0 and row[0] not in labeled_ids]))
+
+        if binaryformat.is_requested(request):
+            return _node_list_binary_response(treenodes, connectors, labels,
+                    truncated, revision)
+
+        return HttpResponse(json.dumps((treenodes, connectors, labels, truncated, revision), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+
+    except Exception as e:
+        raise Exception(response_on_error + ':' + str(e))
 
-        n_retrieved_nodes = 0 # at one per row, only those within the section
-        for row in cursor.fetchall():
-          n_retrieved_nodes += 1
-          t1id = row[0]
-          if t1id not in treenode_ids:
-              treenode_ids.add(t1id)
-              treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
-          t2id = row[9]
-          if t2id not in treenode_ids:
-              treenode_ids.add(t2id)
-              treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
-
-
-        # Find connectors related to treenodes in the field of view
-        # Connectors found attached to treenodes
-        crows = []
 
-        if treenode_ids:
-            response_on_error = 'Failed to query connector locations.'
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_list_changes(request, project_id=None):
+    ''' Returns the changes to the node list of a field of view that were
+    made after the revision given as 'since' parameter, which is the revision
+    token returned by node_list_tuples or by a previous call of this function.
+    Apart from that, the parameters are the same as for node_list_tuples.
+    Returns a JSON object with the following fields:
+    revision: the token to use for the next request.
+    treenodes, connectors: created or changed treenodes and connectors, in the
+    format of node_list_tuples.
+    labels: the complete list of labels of each node in section z whose
+    labels changed or that is included above, if labels were requested.
+    removed_treenodes, removed_connectors: the IDs of nodes that were
+    deleted or that were changed but are no longer part of the node list of
+    the field of view.
+    If the revision is not known or is too old, only the new revision and
+    'reload': true are returned and the client is expected to request the
+    complete node list again. The same happens if more nodes than the node
+    list limit changed.
+    '''
+    project_id = int(project_id) # sanitize
+    params = _node_list_params(request, project_id)
+    with_labels = 'true' == request.POST.get('labels', 'false')
+
+    try:
+        cursor = connection.cursor()
+
+        response_on_error = 'Failed to query revision'
+        revision = _current_revision(cursor)
+        since = request.POST.get('since')
+        max_age = getattr(settings, 'NODE_LIST_CHANGES_MAX_AGE', 3600)
+        if not since or float(since) < float(revision) - max_age:
+            return HttpResponse(json.dumps({'revision': revision, 'reload': True}))
+        # Rows are stamped with the start time of the transaction that
+        # changed them, but only become visible once it is committed. Changes
+        # are therefore looked up a bit further back than the revision,
+        # reporting recent changes possibly more than once.
+        params['since'] = float(since) - _REVISION_OVERLAP
+
+        relation_map = get_relation_to_id_map(project_id,
+                ('labeled_as', 'presynaptic_to'))
+
+        is_superuser = request.user.is_superuser
+        user_id = request.user.id
+        domain = None if is_superuser else user_domain(cursor, user_id)
+
+        response_on_error = 'Failed to query deleted nodes'
+        cursor.execute('''
+        SELECT kind, node_id
+        FROM node_deletion_log
+        WHERE project_id = %(project_id)s
+          AND deletion_time > to_timestamp(%(since)s)
+        ''', params)
+        deleted = defaultdict(set)
+        for kind, node_id in cursor.fetchall():
+            deleted[kind].add(node_id)
+
+        response_on_error = 'Failed to query changed treenodes'
+        cursor.execute('''
+        SELECT
+            t.id,
+            t.parent_id,
+            (t.location).x,
+            (t.location).y,
+            (t.location).z,
+            t.confidence,
+            t.radius,
+            t.skeleton_id,
+            t.user_id,
+            %s,
+            %s
+        FROM treenode t
+        WHERE t.project_id = %%(project_id)s
+          AND t.edition_time > to_timestamp(%%(since)s)
+        LIMIT %%(limit)s + 1
+        ''' % (_treenode_in_view_or_adjacent('t'), _in_view('t')), params)
+        changed_rows = cursor.fetchall()
+        if len(changed_rows) > params['limit']:
+            return HttpResponse(json.dumps({'revision': revision, 'reload': True}))
+
+        treenode_rows = [row[0:9] for row in changed_rows if row[9]]
+        removed_treenodes = deleted['treenode'].union(
+                row[0] for row in changed_rows if not row[9])
+
+        # Parents and children of changed treenodes in the field of view may
+        # not be known to the client yet.
+        visible_ids = [row[0] for row in changed_rows if row[10]]
+        adjacent_ids = set(row[1] for row in changed_rows
+                if row[10] and row[1] is not None)
+        if visible_ids:
             cursor.execute('''
-            SELECT connector.id,
-                (connector.location).x,
-                (connector.location).y,
-                (connector.location).z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id
-            FROM treenode_connector,
-                 connector
-            WHERE treenode_connector.treenode_id IN (%s)
-              AND treenode_connector.connector_id = connector.id
-            ''' % ','.join(str(x) for x in treenode_ids))
-
-            crows = list(cursor.fetchall())
-
-        # Obtain connectors within the field of view that were not captured above.
-        # Uses a LEFT OUTER JOIN to include disconnected connectors,
-        # that is, connectors that aren't referenced from treenode_connector.
+            SELECT id FROM treenode WHERE parent_id IN %s
+            ''', (tuple(visible_ids),))
+            adjacent_ids.update(row[0] for row in cursor.fetchall())
 
+        response_on_error = 'Failed to query changed connectors'
+        crows = []
+        removed_connectors = set(deleted['connector'])
+        params['changed_links'] = tuple(deleted['connector_link']) or (-1,)
         cursor.execute('''
+        WITH changed AS (
+            SELECT id FROM connector
+            WHERE project_id = %%(project_id)s
+              AND edition_time > to_timestamp(%%(since)s)
+            UNION
+            SELECT connector_id FROM treenode_connector
+            WHERE project_id = %%(project_id)s
+              AND edition_time > to_timestamp(%%(since)s)
+            UNION
+            SELECT id FROM connector WHERE id IN %%(changed_links)s
+        )
         SELECT connector.id,
             (connector.location).x,
             (connector.location).y,
@@ -169,129 +531,67 @@ def node_list_tuples(request, project_id=None):
             treenode_connector.relation_id,
             treenode_connector.treenode_id,
             treenode_connector.confidence,
-            connector.user_id
-        FROM connector LEFT OUTER JOIN treenode_connector
+            connector.user_id,
+            %s OR EXISTS (
+                SELECT 1 FROM treenode_connector tc, treenode t
+                WHERE tc.connector_id = connector.id
+                  AND t.id = tc.treenode_id
+                  AND %s)
+        FROM changed, connector LEFT OUTER JOIN treenode_connector
                        ON connector.id = treenode_connector.connector_id
-        WHERE connector.project_id = %(project_id)s
-          AND (connector.location).z = %(z)s
-          AND (connector.location).x > %(left)s
-          AND (connector.location).x < %(right)s
-          AND (connector.location).y > %(top)s
-          AND (connector.location).y < %(bottom)s
-        ''', params)
-
-        crows.extend(cursor.fetchall())
-
-        connectors = []
-        # A set of missing treenode IDs
-        missing_treenode_ids = set()
-        # Check if the active treenode is present; if not, load it
-        if -1 != atnid and atnid not in treenode_ids:
-            # If atnid is a connector, it doesn't matter, won't be found in treenode table
-            missing_treenode_ids.add(atnid)
-        # A set of unique connector IDs
-        connector_ids = set()
-        # The relations between connectors and treenodes, stored
-        # as connector ID keys vs a list of tuples, each with the treenode id,
-        # the type of relation (presynaptic_to or postsynaptic_to), and the confidence.
-        # The list of tuples is generated later from a dict,
-        # so that repeated tnid entries are overwritten.
-        pre = defaultdict(dict)
-        post = defaultdict(dict)
-
-        # Process crows (rows with connectors) which could have repeated connectors
-        # given the join with treenode_connector
-        presynaptic_to = relation_map['presynaptic_to']
-        for row in crows:
-            # Collect treeenode IDs related to connectors but not yet in treenode_ids
-            # because they lay beyond adjacent sections
-            tnid = row[6] # The tnid column is index 7 (see SQL statement above)
-            cid = row[0] # connector ID
-            if tnid is not None:
-                if tnid not in treenode_ids:
-                    missing_treenode_ids.add(tnid)
-                # Collect relations between connectors and treenodes
-                # row[5]: treenode_relation_id
-                # row[6]: treenode_id (tnid above)
-                # row[7]: tc_confidence
-                if row[5] == presynaptic_to:
-                    pre[cid][tnid] = row[7]
-                else:
-                    post[cid][tnid] = row[7]
-
-            # Collect unique connectors
-            if cid not in connector_ids:
-                connectors.append(row)
-                connector_ids.add(cid)
-
-        # Fix connectors to contain only the relevant entries, plus the relations
-        for i in xrange(len(connectors)):
-            c = connectors[i]
-            cid = c[0]
-            connectors[i] = (cid, c[1], c[2], c[3], c[4],
-                    [kv for kv in  pre[cid].iteritems()],
-                    [kv for kv in post[cid].iteritems()],
-                    is_superuser or c[8] == user_id or c[8] in domain)
-
-
-        # Fetch missing treenodes. These are related to connectors
-        # but not in the bounding box of the field of view.
-        # This is so that we can draw arrows from any displayed connector
-        # to all of its connected treenodes, even if one is several slices
-        # below.
-
-        if missing_treenode_ids:
-            params['missing'] = tuple(missing_treenode_ids)
-            response_on_error = 'Failed to query treenodes from connectors'
-            cursor.execute('''
-            SELECT id,
-                parent_id,
-                (location).x,
-                (location).y,
-                (location).z,
-                confidence,
-                radius,
-                skeleton_id,
-                user_id
-            FROM treenode
-            WHERE id IN %(missing)s''', params)
-
-            for row in cursor.fetchall():
-                treenodes.append(row)
-                treenode_ids.add(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
-
-        labels = defaultdict(list)
-        if 'true' == request.POST['labels']:
-            z0 = params['z']
-            # Collect treenodes visible in the current section
-            visible = ','.join(str(row[0]) for row in treenodes if row[4] == z0)
-            if visible:
-                cursor.execute('''
-                SELECT treenode.id, class_instance.name
-                FROM treenode, class_instance, treenode_class_instance
-                WHERE treenode_class_instance.relation_id = %s
-                  AND treenode.id IN (%s)
-                  AND treenode_class_instance.treenode_id = treenode.id
-                  AND class_instance.id = treenode_class_instance.class_instance_id
-                ''' % (relation_map['labeled_as'], visible))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
-
-            # Collect connectors visible in the current section
-            visible = ','.join(str(row[0]) for row in connectors if row[3] == z0)
-            if visible:
+        WHERE connector.id = changed.id
+        ''' % (_in_view('connector'), _treenode_in_view_or_adjacent('t')), params)
+        for row in cursor.fetchall():
+            if row[9]:
+                crows.append(row[0:9])
+            else:
+                removed_connectors.add(row[0])
+
+        treenodes, connectors = _node_list_format(cursor, treenode_rows, crows,
+                relation_map['presynaptic_to'], is_superuser, user_id, domain,
+                adjacent_ids)
+
+        labels = {}
+        if with_labels:
+            response_on_error = 'Failed to query changed labels'
+            labeled_as = relation_map['labeled_as']
+            params['labeled_as'] = labeled_as
+            label_ids = {}
+            for kind, table, column in (
+                    ('treenode', 'treenode', 'treenode_id'),
+                    ('connector', 'connector', 'connector_id')):
+                params['removed_labels'] = tuple(deleted[kind + '_label']) or (-1,)
                 cursor.execute('''
-                SELECT connector.id, class_instance.name
-                FROM connector, class_instance, connector_class_instance
-                WHERE connector_class_instance.relation_id = %s
-                  AND connector.id IN (%s)
-                  AND connector_class_instance.connector_id = connector.id
-                  AND class_instance.id = connector_class_instance.class_instance_id
-                ''' % (relation_map['labeled_as'], visible))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
-
-        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+                SELECT n.id
+                FROM %s n
+                WHERE n.id IN (
+                    SELECT %s FROM %s_class_instance
+                    WHERE project_id = %%(project_id)s
+                      AND relation_id = %%(labeled_as)s
+                      AND edition_time > to_timestamp(%%(since)s)
+                    UNION
+                    SELECT id FROM %s WHERE id IN %%(removed_labels)s)
+                  AND %s
+                ''' % (table, column, table, table, _in_view('n')), params)
+                label_ids[kind] = set(row[0] for row in cursor.fetchall())
+            z0 = params['z']
+            label_ids['treenode'].update(row[0] for row in treenodes if row[4] == z0)
+            label_ids['connector'].update(row[0] for row in connectors if row[3] == z0)
+            # Nodes without any label are sent with an empty list, so that
+            # clients can remove labels that were deleted.
+            for node_id in label_ids['treenode'].union(label_ids['connector']):
+                labels[node_id] = []
+            labels.update(labels_for_node_ids(cursor, project_id, labeled_as,
+                    label_ids['treenode'], label_ids['connector']))
+
+        return HttpResponse(json.dumps({
+            'revision': revision,
+            'treenodes': treenodes,
+            'connectors': connectors,
+            'labels': labels,
+            'removed_treenodes': list(removed_treenodes),
+            'removed_connectors': list(removed_connectors)},
+            separators=(',', ':')))
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -326,6 +626,7 @@ def update_confidence(request, project_id=None, node_id=0):
         rows_affected = Treenode.objects.filter(id=tnid).update(confidence=new_confidence,editor=request.user)
 
     if rows_affected > 0:
+        nodecache.invalidate_treenodes(project_id, [tnid])
         location = Location.objects.get(id=tnid).location
         insert_into_log(project_id, request.user.id, "change_confidence", location, "Changed to %s" % new_confidence)
         return HttpResponse(json.dumps({'message': 'success'}), mimetype='text/json')
@@ -366,7 +667,7 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
+def _update(Kind, table, nodes, now, user, project_id, invalidate):
     if not nodes:
         return
     # 0: id
@@ -374,11 +675,14 @@ def _update(Kind, table, nodes, now, user):
     # 2: Y
     # 3: Z
     can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
+    # Cached node lists are invalidated for both the old and the new locations
+    invalidate(project_id, [int(node[0]) for node in nodes.itervalues()])
     for node in nodes.itervalues():
         Kind.objects.filter(id=int(node[0])).update(
             editor=user,
             edition_time=now,
             location=Double3D(float(node[1]), float(node[2]), float(node[3])))
+    invalidate(project_id, [int(node[0]) for node in nodes.itervalues()])
 
 @requires_user_role(UserRole.Annotate)
 def node_update(request, project_id=None):
@@ -399,8 +703,10 @@ def node_update(request, project_id=None):
         node[j] = value
 
     now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    _update(Treenode, 'treenode', nodes['t'], now, request.user, project_id,
+            nodecache.invalidate_treenodes)
+    _update(Connector, 'connector', nodes['c'], now, request.user, project_id,
+            nodecache.invalidate_connectors)
 
     return HttpResponse(json.dumps(len(nodes)))
 
@@ -419,7 +725,7 @@ def node_nearest(request, project_id=None):
         params[p] = float(request.POST.get(p, param_float_defaults[p]))
     for p in param_int_defaults.keys():
         params[p] = int(request.POST.get(p, param_int_defaults[p]))
-    relation_map = get_relation_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('model_of',))
 
     if params['skeleton_id'] < 0 and params['neuron_id'] < 0:
         raise Exception('You must specify either a skeleton or a neuron')
@@ -480,25 +786,6 @@ def node_nearest(request, project_id=None):
         raise Exception(response_on_error + ':' + str(e))
 
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
-
-
 def _fetch_location(treenode_id):
     cursor = connection.cursor()
     cursor.execute('''
@@ -583,20 +870,12 @@ def find_previous_branchnode_or_root(request, project_id=None):
     try:
         tnid = int(request.POST['tnid'])
         alt = 1 == int(request.POST['alt'])
-        skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
-        # Travel upstream until finding a parent node with more than one child 
-        # or reaching the root node
-        seq = [] # Does not include the starting node tnid
-        while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
-                break # Found the root node
+        topology = topologycache.get_topology(connection.cursor(), tnid)
+        # The nodes upstream until a parent node with more than one child
+        # or the root node. Does not include the starting node tnid.
+        seq = topology.previous_branch_or_root(tnid)
+        if seq:
+            tnid = seq[-1]
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -612,11 +891,9 @@ def find_next_branchnode_or_end(request, project_id=None):
         tnid = int(request.POST['tnid'])
         shift = 1 == int(request.POST['shift'])
         alt = 1 == int(request.POST['alt'])
-        skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        topology = topologycache.get_topology(connection.cursor(), tnid)
 
-        children = graph.successors(tnid)
-        if len(children) > 1:
+        if topology.children_of_branch(tnid):
             # Choose one of the children:
             # The closest to 0,0,0 or the furthest if shift is down
             sqDist = 0 if shift else float('inf')
@@ -627,16 +904,11 @@ def find_next_branchnode_or_end(request, project_id=None):
                     sqDist = d
                     tnid = t.id
 
-        # Travel downstream until finding a child node with more than one child
-        # or reaching an end node
-        seq = [] # Does not include the starting node tnid
-        while True:
-            children = graph.successors(tnid)
-            if 1 == len(children):
-                tnid = children[0]
-                seq.append(tnid)
-            else:
-                break # Found an end node or a branch node
+        # The nodes downstream until a child node with more than one child
+        # or an end node. Does not include the starting node tnid.
+        seq = topology.next_branch_or_end(tnid)
+        if seq:
+            tnid = seq[-1]
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -0,0 +1,257 @@
+""" A cache for the node lists requested by the tracing overlay.
+
+The XY plane of each section is divided into a fixed grid of square cells.
+For every cell, the result of the node list queries (treenodes within the
+cell and their parents and children as well as related connectors) is stored
+in the cache backend configured with the NODE_LIST_CACHE setting. Requests
+for a field of view are then assembled from all cells the field of view
+overlaps. Cells are fetched with a limit of their own,
+NODE_LIST_CACHE_CELL_LIMIT treenodes per section. If a cell holds more, the
+field of view is queried directly instead. Write operations on treenodes and
+connectors are expected to invalidate the cells their nodes are located in by
+calling one of the invalidate_* functions below. As these run before the
+transaction of the write is committed, a concurrent request could store the
+old rows again. Invalidated cells are therefore deleted a second time when the
+request is finished, after its transaction has been committed.
+
+The cache is disabled if NODE_LIST_CACHE is None. If CATMAID runs in more
+than one process, the cache has to be backed by a shared cache backend (like
+memcached), otherwise invalidations done in one process would not be seen by
+others.
+"""
+
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.signals import request_finished
+from django.db import connection
+
+# The keys of the cells invalidated by the current thread, which are deleted
+# again once its request is finished.
+_pending = threading.local()
+
+
+def _get_cache():
+    """ Returns the cache backend to use for node lists or None if node list
+    caching is disabled. """
+    alias = getattr(settings, 'NODE_LIST_CACHE', None)
+    return get_cache(alias) if alias else None
+
+def is_enabled():
+    return _get_cache() is not None
+
+def _cell_size():
+    return float(getattr(settings, 'NODE_LIST_CACHE_CELL_SIZE', 8192))
+
+def _cell_key(project_id, z, i, j):
+    return 'catmaid-node-list-%s-%r-%s-%s' % (project_id, float(z), i, j)
+
+def _cell_range(low, high, size):
+    """ Returns the indices of all cells that overlap the closed interval
+    [low, high] along one axis. """
+    return range(int(math.floor(low / size)), int(math.floor(high / size)) + 1)
+
+
+def get_node_list(cursor, params, fetch_rows, fetch_labels=None):
+    """ Assembles the node list of the field of view in params (project_id,
+    z, left, top, right and bottom, all in calibrated units, plus limit) from
+    cached grid cells. Cells not found in the cache are fetched with
+    fetch_rows(cursor, cell_params, strict), which is expected to return a
+    tuple of treenode rows, connector rows and a truncation flag, and are then
+    stored in the cache. If a cell is truncated, the field of view itself is
+    fetched instead and nothing is cached. The field of view is also fetched
+    directly if the cells hold more than params['limit'] treenodes in it, so
+    that the response is bounded like an uncached one. If fetch_labels is given, labels of
+    the nodes in section z are fetched with fetch_labels(cursor, treenode_ids,
+    connector_ids) and cached as well.
+
+    Returns a tuple of treenode rows, connector rows, a truncation flag, a
+    dictionary of labels and the set of node IDs the labels are complete for.
+    """
+    cache = _get_cache()
+    size = _cell_size()
+    project_id, z = params['project_id'], params['z']
+    left, right = params['left'], params['right']
+    top, bottom = params['top'], params['bottom']
+
+    keys = {}
+    for i in _cell_range(left, right, size):
+        for j in _cell_range(top, bottom, size):
+            keys[_cell_key(project_id, z, i, j)] = (i, j)
+
+    cells = cache.get_many(keys.keys())
+    timeout = getattr(settings, 'NODE_LIST_CACHE_TIMEOUT', 300)
+    cell_limit = getattr(settings, 'NODE_LIST_CACHE_CELL_LIMIT', 50000)
+    for key, (i, j) in keys.iteritems():
+        cell = cells.get(key)
+        if cell is not None and (cell['labels'] is not None or not fetch_labels):
+            continue
+        if cell is None:
+            cell_params = dict(params)
+            cell_params.update({
+                'left': i * size,
+                'right': (i + 1) * size,
+                'top': j * size,
+                'bottom': (j + 1) * size,
+                'limit': cell_limit})
+            treenode_rows, connector_rows, truncated = fetch_rows(cursor,
+                    cell_params, False)
+            if truncated:
+                # A partial cell would hide nodes from every field of view
+                # that overlaps it.
+                treenode_rows, connector_rows, truncated = fetch_rows(cursor,
+                        params, True)
+                return treenode_rows, connector_rows, truncated, {}, set()
+            cell = {
+                'treenodes': treenode_rows,
+                'connectors': connector_rows,
+                'labels': None}
+        if fetch_labels:
+            cell['labels'] = fetch_labels(cursor,
+                    set(row[0] for row in cell['treenodes'] if row[4] == z),
+                    set(row[0] for row in cell['connectors'] if row[3] == z))
+        cache.set(key, cell, timeout)
+        cells[key] = cell
+
+    # Collect treenodes in the field of view, along with their parents and
+    # children. Rows may be repeated across cells.
+    treenodes = {}
+    for cell in cells.itervalues():
+        for row in cell['treenodes']:
+            treenodes[row[0]] = row
+    visible = set(row[0] for row in treenodes.itervalues()
+            if row[4] == z and left < row[2] < right and top < row[3] < bottom)
+    if len(visible) > params['limit']:
+        # Too many nodes for a single response. The field of view is queried
+        # directly, so that the response is truncated like an uncached one.
+        treenode_rows, connector_rows, truncated = fetch_rows(cursor, params,
+                True)
+        return treenode_rows, connector_rows, truncated, {}, set()
+    parents = set(treenodes[tnid][1] for tnid in visible)
+    treenode_rows = [row for row in treenodes.itervalues()
+            if row[0] in visible or row[0] in parents or row[1] in visible]
+    treenode_ids = set(row[0] for row in treenode_rows)
+
+    # Collect connector rows that relate to one of the treenodes above or
+    # whose connector is located in the field of view. A row is unique for
+    # its connector and treenode.
+    connectors = {}
+    for cell in cells.itervalues():
+        for row in cell['connectors']:
+            if row[6] in treenode_ids or (row[3] == z and
+                    left < row[1] < right and top < row[2] < bottom):
+                connectors[(row[0], row[6])] = row
+
+    labels = {}
+    labeled_ids = set()
+    if fetch_labels:
+        for cell in cells.itervalues():
+            labels.update(cell['labels'])
+            labeled_ids.update(row[0] for row in cell['treenodes'] if row[4] == z)
+            labeled_ids.update(row[0] for row in cell['connectors'] if row[3] == z)
+
+    return treenode_rows, connectors.values(), False, labels, labeled_ids
+
+
+def _invalidate(project_id, location_query, params):
+    """ Deletes all cached cells that contain one of the locations selected by
+    location_query, which is expected to return x, y and z columns. A
+    location on the border of a cell belongs to all adjacent cells. """
+    cache = _get_cache()
+    if cache is None:
+        return
+    size = _cell_size()
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT DISTINCT l.z,
+           floor(l.x / %%(size)s), ceil(l.x / %%(size)s) - 1,
+           floor(l.y / %%(size)s), ceil(l.y / %%(size)s) - 1
+    FROM (%s) l(x, y, z)
+    ''' % location_query, dict(params, size=size))
+    keys = set()
+    for z, i1, i2, j1, j2 in cursor.fetchall():
+        for i in set((int(i1), int(i2))):
+            for j in set((int(j1), int(j2))):
+                keys.add(_cell_key(project_id, z, i, j))
+    if keys:
+        cache.delete_many(list(keys))
+        if not hasattr(_pending, 'keys'):
+            _pending.keys = set()
+        _pending.keys.update(keys)
+
+def invalidate_pending(**kwargs):
+    """ Deletes the cells invalidated by the current thread again. This is
+    done when a request is finished, after its transaction has been committed,
+    so that cells stored by concurrent requests in the meantime are dropped.
+    """
+    keys = getattr(_pending, 'keys', None)
+    if not keys:
+        return
+    _pending.keys = set()
+    cache = _get_cache()
+    if cache is not None:
+        cache.delete_many(list(keys))
+
+request_finished.connect(invalidate_pending,
+        dispatch_uid='catmaid.control.nodecache.invalidate_pending')
+
+def invalidate_treenodes(project_id, treenode_ids):
+    """ Invalidates the cells of the given treenodes, their parents, their
+    children and the connectors linked to them. To cover moved or deleted
+    treenodes, this has to be called before and after the change. """
+    treenode_ids = tuple(int(tnid) for tnid in treenode_ids)
+    if not treenode_ids:
+        return
+    _invalidate(project_id, '''
+        SELECT (location).x, (location).y, (location).z
+        FROM treenode WHERE id IN %(ids)s
+        UNION
+        SELECT (location).x, (location).y, (location).z
+        FROM treenode WHERE parent_id IN %(ids)s
+        UNION
+        SELECT (p.location).x, (p.location).y, (p.location).z
+        FROM treenode t, treenode p
+        WHERE t.id IN %(ids)s AND p.id = t.parent_id
+        UNION
+        SELECT (c.location).x, (c.location).y, (c.location).z
+        FROM treenode_connector tc, connector c
+        WHERE tc.treenode_id IN %(ids)s AND c.id = tc.connector_id
+        ''', {'ids': treenode_ids})
+
+def invalidate_connectors(project_id, connector_ids):
+    """ Invalidates the cells of the given connectors and the cells of the
+    treenodes linked to them (including parents and children of these). """
+    connector_ids = tuple(int(cid) for cid in connector_ids)
+    if not connector_ids:
+        return
+    _invalidate(project_id, '''
+        SELECT (location).x, (location).y, (location).z
+        FROM connector WHERE id IN %(ids)s
+        UNION
+        SELECT (t.location).x, (t.location).y, (t.location).z
+        FROM treenode_connector tc, treenode t
+        WHERE tc.connector_id IN %(ids)s
+          AND (t.id = tc.treenode_id OR t.parent_id = tc.treenode_id)
+        UNION
+        SELECT (p.location).x, (p.location).y, (p.location).z
+        FROM treenode_connector tc, treenode t, treenode p
+        WHERE tc.connector_id IN %(ids)s
+          AND t.id = tc.treenode_id AND p.id = t.parent_id
+        ''', {'ids': connector_ids})
+
+def invalidate_skeletons(project_id, skeleton_ids):
+    """ Invalidates the cells of all treenodes of the given skeletons and of
+    all connectors linked to them. """
+    skeleton_ids = tuple(int(skid) for skid in skeleton_ids)
+    if not skeleton_ids:
+        return
+    _invalidate(project_id, '''
+        SELECT (location).x, (location).y, (location).z
+        FROM treenode WHERE skeleton_id IN %(ids)s
+        UNION
+        SELECT (c.location).x, (c.location).y, (c.location).z
+        FROM treenode_connector tc, connector c
+        WHERE tc.skeleton_id IN %(ids)s AND c.id = tc.connector_id
+        ''', {'ids': skeleton_ids})
@@ -140,8 +140,8 @@ def list_ontology(request, project_id=None):
         # Parse to int to sanitize
         expand_request = tuple(int(x) for x in expand_request.split(','))
 
-    relation_map = get_relation_to_id_map(project_id)
-    class_map = get_class_to_id_map(project_id)
+    class_map = get_class_to_id_map(project_id,
+            () if root_class is None else (root_class,))
 
     response_on_error = ''
     try:
@@ -0,0 +1,191 @@
+""" Request profiling statistics per view function.
+
+The ProfilingMiddleware (see catmaid.middleware) measures for every request
+the number of SQL queries, the time spent in the database, the time spent
+serializing JSON, the remaining Python time and the size of the response.
+The measurements are recorded here, per view function. For every view, the
+last PROFILING_WINDOW measurements are kept, from which histograms and
+percentiles are computed on demand. This way, the statistics reflect the
+current behavior of a view rather than its whole history.
+
+Statistics are kept per process. They can be looked at in the admin
+interface ("Request profiling"), which can also write them as JSON to a file
+in PROFILING_OUTPUT_PATH, e.g. to compare them across releases or to collect
+them from all server processes. This path isn't served by the web server.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import deque
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+
+# The measured quantities, in the order of the measurement tuples
+METRICS = ('queries', 'db_time', 'python_time', 'json_time', 'size')
+
+# View name vs. (number of requests since reset, deque of measurements)
+_views = {}
+_views_lock = threading.Lock()
+_started = time.time()
+
+# JSON serialization time of the current request of each thread
+_json_timing = threading.local()
+
+def _window():
+    return getattr(settings, 'PROFILING_WINDOW', 1000)
+
+def record(view, queries, db_time, python_time, json_time, size):
+    """ Records the measurements of a request that was handled by the given
+    view. Times are in seconds, the size is in bytes. """
+    with _views_lock:
+        entry = _views.get(view)
+        if entry is None:
+            entry = [0, deque(maxlen=_window())]
+            _views[view] = entry
+        entry[0] += 1
+        entry[1].append((queries, db_time, python_time, json_time, size))
+
+def reset():
+    """ Discards all recorded measurements. """
+    global _started
+    with _views_lock:
+        _views.clear()
+        _started = time.time()
+
+def install_json_timing():
+    """ Replaces json.dumps with a version that adds its time to the JSON
+    serialization time of the current thread, if that is being measured.
+    Views look up json.dumps at call time, so this covers all of them. """
+    if getattr(json.dumps, 'catmaid_timed', False):
+        return
+    dumps = json.dumps
+    def timed_dumps(*args, **kwargs):
+        if getattr(_json_timing, 'seconds', None) is None:
+            return dumps(*args, **kwargs)
+        start = time.time()
+        try:
+            return dumps(*args, **kwargs)
+        finally:
+            _json_timing.seconds += time.time() - start
+    timed_dumps.catmaid_timed = True
+    json.dumps = timed_dumps
+
+def start_json_timing():
+    _json_timing.seconds = 0.0
+
+def stop_json_timing():
+    """ Returns the JSON serialization time since start_json_timing() and
+    stops measuring it. """
+    seconds = getattr(_json_timing, 'seconds', None) or 0.0
+    _json_timing.seconds = None
+    return seconds
+
+def _histogram(values):
+    """ Returns a list of [upper bound, count] pairs, where each count is the
+    number of values that are larger than the previous bound and at most as
+    large as this bound. Bounds are powers of two. """
+    counts = {}
+    for value in values:
+        bound = 1
+        while bound < value:
+            bound *= 2
+        counts[bound] = counts.get(bound, 0) + 1
+    return [[b, counts[b]] for b in sorted(counts)]
+
+def _percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def _summary(values):
+    values = sorted(values)
+    return {
+        'mean': sum(values) / float(len(values)),
+        'p50': _percentile(values, 0.5),
+        'p90': _percentile(values, 0.9),
+        'p99': _percentile(values, 0.99),
+        'max': values[-1],
+        'histogram': _histogram(values),
+    }
+
+def statistics():
+    """ Returns a dictionary of view names vs. their statistics: the number of
+    requests since the last reset, the number of requests in the window and a
+    summary of each metric in the window. Times are given in milliseconds for
+    readability, the histogram bounds of times as well. """
+    with _views_lock:
+        views = dict((view, (entry[0], list(entry[1])))
+                for view, entry in _views.iteritems())
+    result = {}
+    for view, (n_requests, measurements) in views.iteritems():
+        if not measurements:
+            continue
+        stats = {'requests': n_requests, 'window': len(measurements)}
+        for i, metric in enumerate(METRICS):
+            values = [m[i] for m in measurements]
+            if metric.endswith('_time'):
+                values = [1000 * v for v in values]
+            stats[metric] = _summary(values)
+        result[view] = stats
+    return result
+
+def dump(directory=None):
+    """ Writes the statistics of this process as JSON to a new file in the
+    given directory and returns its path. The directory defaults to
+    PROFILING_OUTPUT_PATH, or a folder in the temporary directory if it isn't
+    set. Neither is served by the web server, unlike MEDIA_ROOT. """
+    if directory is None:
+        directory = getattr(settings, 'PROFILING_OUTPUT_PATH', None) or \
+                os.path.join(tempfile.gettempdir(), 'catmaid_profiling')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    now = time.time()
+    path = os.path.join(directory, 'profiling-%s-%d.json' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), os.getpid()))
+    with open(path, 'w') as f:
+        json.dump({
+            'pid': os.getpid(),
+            'started': _started,
+            'dumped': now,
+            'views': statistics(),
+        }, f, indent=1, sort_keys=True)
+    return path
+
+def profiling_admin_view(request, *args, **kwargs):
+    """ Shows the statistics of the views handled by this process, sorted by
+    their total time in the window. With format=json, the statistics are
+    returned as JSON. A POST with action 'dump' writes them to a file, 'reset'
+    discards them. """
+    message = None
+    if 'POST' == request.method:
+        action = request.POST.get('action')
+        if 'dump' == action:
+            message = 'Statistics written to %s' % dump()
+        elif 'reset' == action:
+            reset()
+            message = 'Statistics discarded'
+
+    stats = statistics()
+    if 'json' == request.GET.get('format'):
+        return HttpResponse(json.dumps(stats), mimetype='text/json')
+
+    rows = []
+    for view, s in stats.iteritems():
+        total = s['db_time']['mean'] + s['python_time']['mean'] + \
+                s['json_time']['mean']
+        rows.append((total * s['window'], view, s))
+    rows.sort(reverse=True)
+    return render_to_response('catmaid/profiling.html', {
+        'title': 'Request profiling',
+        'enabled': 'catmaid.middleware.ProfilingMiddleware' in
+                settings.MIDDLEWARE_CLASSES,
+        'message': message,
+        'pid': os.getpid(),
+        'views': [(view, s) for _, view, s in rows],
+    }, context_instance=RequestContext(request))
@@ -10,6 +10,7 @@ from catmaid.control.neuron_annotations import create_annotation_query
 from catmaid.control.neuron_annotations import _annotate_entities
 from catmaid.control.neuron_annotations import _update_neuron_annotations
 from catmaid.control.treenode import _create_interpolated_treenode
+from catmaid.control import nodecache
 from collections import defaultdict
 
 import decimal
@@ -99,19 +100,60 @@ def last_openleaf(request, project_id=None, skeleton_id=None):
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_statistics(request, project_id=None, skeleton_id=None):
-    p = get_object_or_404(Project, pk=project_id)
-    skel = Skeleton( skeleton_id = skeleton_id, project_id = project_id )
-    const_time = skel.measure_construction_time()
+    """ Returns counters of the skeleton, which are read from the
+    skeleton_summary, skeleton_review_summary and skeleton_connectivity
+    tables, along with the time spent on its construction. """
+    skeleton_id = int(skeleton_id)
+    get_object_or_404(ClassInstance, pk=skeleton_id, project=project_id)
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT s.num_nodes, s.cable_length, s.num_presynaptic, s.num_postsynaptic,
+           coalesce(r.num_nodes, 0)
+    FROM skeleton_summary s
+    LEFT OUTER JOIN skeleton_review_summary r
+      ON (r.skeleton_id = s.skeleton_id AND r.reviewer_id = -1)
+    WHERE s.skeleton_id = %s
+    ''', (skeleton_id,))
+    num_nodes, cable_length, num_pre, num_post, num_unreviewed = \
+            cursor.fetchone() or (0, 0.0, 0, 0, 0)
+
+    # The number of distinct upstream and downstream partners
+    cursor.execute('''
+    SELECT (SELECT count(*) FROM skeleton_connectivity
+            WHERE post_skeleton_id = %s),
+           (SELECT count(*) FROM skeleton_connectivity
+            WHERE pre_skeleton_id = %s)
+    ''', (skeleton_id, skeleton_id))
+    input_count, output_count = cursor.fetchone()
+
+    const_time = _construction_time(cursor, skeleton_id)
     construction_time = '{0} minutes {1} seconds'.format( const_time / 60, const_time % 60)
+    num_reviewed = num_nodes - num_unreviewed
+    percentage_reviewed = 100.0 * num_reviewed / num_nodes if num_reviewed else 0.0
     return HttpResponse(json.dumps({
-        'node_count': skel.node_count(),
-        'input_count': skel.input_count(),
-        'output_count': skel.output_count(),
-        'presynaptic_sites': skel.presynaptic_sites_count(),
-        'postsynaptic_sites': skel.postsynaptic_sites_count(),
-        'cable_length': int(skel.cable_length()),
+        'node_count': num_nodes,
+        'input_count': input_count,
+        'output_count': output_count,
+        'presynaptic_sites': num_pre,
+        'postsynaptic_sites': num_post,
+        'cable_length': int(cable_length),
         'measure_construction_time': construction_time,
-        'percentage_reviewed': "%.2f" % skel.percentage_reviewed() }), mimetype='text/json')
+        'percentage_reviewed': "%.2f" % percentage_reviewed }), mimetype='text/json')
+
+def _construction_time(cursor, skeleton_id, threshold=300):
+    """ Measure the amount of time in seconds consumed in creating the
+    skeleton. Only the time between the creation of a node and its parent is
+    counted, and only if it is shorter than the given threshold. """
+    cursor.execute('''
+    SELECT coalesce(sum(seconds), 0)
+    FROM (SELECT floor(abs(extract(epoch FROM t.creation_time - p.creation_time)))
+                 AS seconds
+          FROM treenode t, treenode p
+          WHERE t.skeleton_id = %s
+            AND t.parent_id = p.id) edges
+    WHERE seconds < %s
+    ''', (skeleton_id, threshold))
+    return int(cursor.fetchone()[0])
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_count(request, project_id=None, skeleton_id=None, treenode_id=None):
@@ -119,8 +161,13 @@ def node_count(request, project_id=None, skeleton_id=None, treenode_id=None):
     p = get_object_or_404(Project, pk=project_id)
     if not skeleton_id:
         skeleton_id = Treenode.objects.get(pk=treenode_id).skeleton_id
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT num_nodes FROM skeleton_summary WHERE skeleton_id = %s
+    ''', (int(skeleton_id),))
+    row = cursor.fetchone()
     return HttpResponse(json.dumps({
-        'count': Treenode.objects.filter(skeleton_id=skeleton_id).count(),
+        'count': row[0] if row else 0,
         'skeleton_id': skeleton_id}), mimetype='text/json')
 
 def _get_neuronname_from_skeletonid( project_id, skeleton_id ):
@@ -229,7 +276,7 @@ def split_skeleton(request, project_id=None):
     cursor = connection.cursor()
 
     # Check if the treenode is root!
-    if not treenode.parent:
+    if treenode.parent_id is None:
         return HttpResponse(json.dumps({'error': 'Can\'t split at the root node: it doesn\'t have a parent.'}))
 
     # Check if annotations are valid
@@ -249,26 +296,6 @@ def split_skeleton(request, project_id=None):
     # Make sure the user has permissions to edit
     can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
 
-    # retrieve the id, parent_id of all nodes in the skeleton
-    # with minimal ceremony
-    cursor.execute('''
-    SELECT id, parent_id FROM treenode WHERE skeleton_id=%s
-    ''' % skeleton_id) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -296,17 +323,36 @@ def split_skeleton(request, project_id=None):
     cici.user = skeleton.user # The same user that owned the skeleton to split
     cici.project_id = project_id
     cici.save()
-    # update skeleton_id of list in treenode table
-    # This creates a lazy QuerySet that, upon calling update, returns a new QuerySet
-    # that is then executed. It does NOT create an update SQL query for every treenode.
-    tns = Treenode.objects.filter(id__in=change_list).update(skeleton=new_skeleton)
-    # update the skeleton_id value of the treenode_connector table
-    tc = TreenodeConnector.objects.filter(
-        relation__relation_name__endswith = 'synaptic_to',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
+    # Move the treenode and all nodes downstream of it to the new skeleton,
+    # which are collected by the database.
+    cursor.execute('''
+    UPDATE treenode
+    SET skeleton_id = %s
+    WHERE id IN (
+        WITH RECURSIVE downstream(id) AS (
+            SELECT %s::bigint
+          UNION ALL
+            SELECT t.id
+            FROM treenode t, downstream d
+            WHERE t.parent_id = d.id)
+        SELECT id FROM downstream)
+    ''', (new_skeleton.id, treenode_id))
+    # Update the skeleton_id value of the synapses of the moved treenodes
+    relation_map = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
+    cursor.execute('''
+    UPDATE treenode_connector
+    SET skeleton_id = %s
+    FROM treenode t
+    WHERE treenode_connector.skeleton_id = %s
+      AND treenode_connector.relation_id IN (%s, %s)
+      AND treenode_connector.treenode_id = t.id
+      AND t.skeleton_id = %s
+    ''', (new_skeleton.id, skeleton_id, relation_map['presynaptic_to'],
+            relation_map['postsynaptic_to'], new_skeleton.id))
     # setting new root treenode's parent to null
     Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
+    nodecache.invalidate_skeletons(project_id, [skeleton_id, new_skeleton.id])
 
     # Update annotations of existing neuron to have only over set
     _update_neuron_annotations(project_id, request.user, neuron.id,
@@ -342,7 +388,7 @@ def skeleton_ancestry(request, project_id=None):
     if skeleton_id is None:
         raise Exception('A skeleton id has not been provided!')
 
-    relation_map = get_relation_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('model_of', 'part_of'))
     for rel in ['model_of', 'part_of']:
         if rel not in relation_map:
             raise Exception(' => "Failed to find the required relation %s' % rel)
@@ -403,7 +449,7 @@ def skeleton_ancestry(request, project_id=None):
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
-def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_of_id, cursor):
+def _connected_skeletons(skeleton_ids, op, source_column, partner_column, model_of_id, cursor):
     class Partner:
         def __init__(self):
             self.name = None
@@ -416,20 +462,16 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
+    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by source_column and partner_column:
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t2.relation_id = %s
-    ''' % (','.join(str(skid) for skid in skeleton_ids), int(relation_id_1), int(relation_id_2)))
+    SELECT %s, %s, count
+    FROM skeleton_connectivity
+    WHERE %s IN (%s)
+    ''' % (source_column, partner_column, source_column, ','.join(str(skid) for skid in skeleton_ids)))
 
     # Sum the number of synapses
-    for srcID, partnerID in cursor.fetchall():
-        partners[partnerID].skids[srcID] += 1
+    for srcID, partnerID, count in cursor.fetchall():
+        partners[partnerID].skids[srcID] += count
 
     # There may not be any synapses
     if not partners:
@@ -448,34 +490,21 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
     # Obtain a string with unique skeletons
     skids_string = ','.join(str(x) for x in partners.iterkeys())
 
-    # Count nodes of each partner skeleton
-    cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
-    ''' % skids_string) # no need to sanitize
-    for row in cursor.fetchall():
-        partners[row[0]].num_nodes = row[1]
-
-    # Count reviewed nodes of each skeleton
+    # Count nodes and unreviewed nodes of each partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-      AND reviewer_id=-1
-    GROUP BY skeleton_id
+    SELECT s.skeleton_id, s.num_nodes, r.num_nodes
+    FROM skeleton_summary s
+    LEFT OUTER JOIN skeleton_review_summary r
+      ON (r.skeleton_id = s.skeleton_id AND r.reviewer_id = -1)
+    WHERE s.skeleton_id IN (%s)
     ''' % skids_string) # no need to sanitize
-    seen = set()
-    for row in cursor.fetchall():
-        seen.add(row[0])
-        partner = partners[row[0]]
-        partner.reviewed = int(100.0 * (1 - float(row[1]) / partner.num_nodes))
-    # If 100%, it will not be there, so add it
-    for partnerID in set(partners.keys()) - seen:
-        partner = partners[partnerID]
-        if 0 == partner.reviewed:
-            partner.reviewed = 100
+    for partner in partners.itervalues():
+        partner.reviewed = 100
+    for skid, num_nodes, num_unreviewed in cursor.fetchall():
+        partner = partners[skid]
+        partner.num_nodes = num_nodes
+        if num_unreviewed:
+            partner.reviewed = int(100.0 * (1 - float(num_unreviewed) / num_nodes))
 
     # Obtain name of each skeleton's neuron
     cursor.execute('''
@@ -495,20 +524,12 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
 def _skeleton_info_raw(project_id, skeletons, op):
     cursor = connection.cursor()
 
-    # Obtain the IDs of the 'presynaptic_to', 'postsynaptic_to' and 'model_of' relations
-    cursor.execute('''
-    SELECT relation_name,
-           id
-    FROM relation
-    WHERE project_id=%s
-      AND (relation_name='presynaptic_to'
-        OR relation_name='postsynaptic_to'
-        OR relation_name='model_of')''' % project_id)
-    relation_ids = dict(cursor.fetchall())
+    # Obtain the ID of the 'model_of' relation
+    relation_ids = get_relation_to_id_map(project_id, ('model_of',))
 
     # Obtain partner skeletons and their info
-    incoming = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
-    outgoing = _connected_skeletons(skeletons, op, relation_ids['presynaptic_to'], relation_ids['postsynaptic_to'], relation_ids['model_of'], cursor)
+    incoming = _connected_skeletons(skeletons, op, 'post_skeleton_id', 'pre_skeleton_id', relation_ids['model_of'], cursor)
+    outgoing = _connected_skeletons(skeletons, op, 'pre_skeleton_id', 'post_skeleton_id', relation_ids['model_of'], cursor)
 
     def prepare(partners):
         for partnerID in partners.keys():
@@ -595,10 +616,9 @@ def review_status(request, project_id=None):
     skeleton_ids = set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM treenode
+    SELECT skeleton_id, reviewer_id, num_nodes
+    FROM skeleton_review_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id, reviewer_id
     ''' % ",".join(str(skid) for skid in skeleton_ids))
 
     s = defaultdict(dict)
@@ -652,44 +672,41 @@ def _reroot_skeleton(treenode_id, project_id):
         # Obtain the treenode from the response
         response_on_error = 'An error occured while rerooting. No valid query result.'
         treenode = q_treenode[0]
-        first_parent = treenode.parent
 
         # If no parent found it is assumed this node is already root
-        if first_parent is None:
+        if treenode.parent_id is None:
             return False
 
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parent = treenode
-        new_confidence = treenode.confidence
-        node = first_parent
-
-        while True:
-            response_on_error = 'Failed to update treenode with id %s to have new parent %s' % (node.id, new_parent.id)
-
-            # Store current values to be used in next iteration
-            parent = node.parent
-            confidence = node.confidence
-
-            # Set new values
-            node.parent = new_parent
-            node.confidence = new_confidence
-            node.save()
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        response_on_error = 'Failed to set treenode with ID %s as root.' % treenode.id
+        # Reverse the parent relationships along the chain of parents in a
+        # single statement, so that the selected treenode (with ID
+        # treenode_id) becomes the root. Every node on the path to the old
+        # root gets its former child as parent, along with the confidence of
+        # the edge to that child. The new root gets maximum confidence.
+        response_on_error = 'Failed to reverse the path of treenode %s to the root.' % treenode.id
+        cursor = connection.cursor()
+        cursor.execute('''
+        UPDATE treenode
+        SET parent_id = path.new_parent_id,
+            confidence = path.new_confidence
+        FROM (
+            WITH RECURSIVE path(id, parent_id, confidence, depth) AS (
+                SELECT id, parent_id, confidence, 0
+                FROM treenode
+                WHERE id = %s
+              UNION ALL
+                SELECT t.id, t.parent_id, t.confidence, path.depth + 1
+                FROM treenode t, path
+                WHERE t.id = path.parent_id)
+            SELECT node.id, child.id AS new_parent_id,
+                   coalesce(child.confidence, 5) AS new_confidence
+            FROM path node
+            LEFT OUTER JOIN path child ON (child.depth = node.depth - 1)) path
+        WHERE treenode.id = path.id
+        ''', (treenode.id,))
         treenode.parent = None
-        treenode.confidence = 5 # reset to maximum confidence, now it is root.
-        treenode.save()
+        treenode.confidence = 5
+
+        nodecache.invalidate_skeletons(project_id, [treenode.skeleton_id])
 
         return treenode
 
@@ -814,6 +831,7 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         # Update the parent of to_treenode.
         response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
         Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
+        nodecache.invalidate_skeletons(project_id, [from_skid])
 
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
@@ -1,27 +1,29 @@
 import json
+import zipfile
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 
 from catmaid.models import *
 from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
-from catmaid.control import export_NeuroML_Level3
+from catmaid.control import arbor, binaryformat, export_NeuroML_Level3
 
-import networkx as nx
-from tree_util import edge_count_to_root, partition
+import numpy as np
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
     print "NeuroML is not loading"
 
-from itertools import imap
+from itertools import imap, izip
 from functools import partial
 from collections import defaultdict
-from math import sqrt
 
 def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
+    """ Returns query sets of the treenodes of a skeleton and of the label
+    links of its treenodes and connectors. The exports below read raw rows
+    instead, this is kept for scripts that work with model instances. """
     treenode_qs = Treenode.objects.filter(skeleton_id=skeleton_id)
     if with_labels:
         labels_qs = TreenodeClassInstance.objects.filter(
@@ -36,31 +38,102 @@ def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     return treenode_qs, labels_qs, labelconnector_qs
 
 
-def get_swc_string(treenodes_qs):
-    all_rows = []
-    for tn in treenodes_qs:
-        swc_row = [tn.id]
-        swc_row.append(0)
-        swc_row.append(tn.location.x)
-        swc_row.append(tn.location.y)
-        swc_row.append(tn.location.z)
-        swc_row.append(max(tn.radius, 0))
-        swc_row.append(-1 if tn.parent_id is None else tn.parent_id)
-        all_rows.append(swc_row)
-    result = ""
-    for row in all_rows:
-        result += " ".join(str(x) for x in row) + "\n"
-    return result
+# The nodes of a skeleton, ordered by ID
+_SKELETON_NODES = '''
+    SELECT id, parent_id, user_id, reviewer_id,
+           (location).x, (location).y, (location).z, radius, confidence
+    FROM treenode
+    WHERE skeleton_id = %s
+      AND project_id = %s
+    ORDER BY id
+'''
+
+def _swc_lines(project_id, skeleton_id):
+    """ Yields the nodes of the skeleton as lines of an SWC file: node ID,
+    type (always undefined), x, y, z, radius and the parent ID (-1 for the
+    root node). """
+    for row in stream_rows(_SKELETON_NODES, (skeleton_id, project_id)):
+        yield "%s 0 %s %s %s %s %s\n" % (row[0], row[4], row[5], row[6],
+                max(row[7], 0), -1 if row[1] is None else row[1])
+
+def _json_lines(project_id, skeleton_id):
+    """ Yields the parts of a JSON array of the nodes of the skeleton, with
+    the same fields as the nodes of the compact JSON export: ID, parent ID,
+    user ID, reviewer ID, x, y, z, radius and confidence. """
+    yield '['
+    separator = ''
+    for row in stream_rows(_SKELETON_NODES, (skeleton_id, project_id)):
+        yield separator
+        yield json.dumps(row, separators=(',', ':'))
+        separator = ','
+    yield ']'
+
+_EXPORT_FORMATS = {
+    'swc': (_swc_lines, 'text/plain'),
+    'json': (_json_lines, 'text/json'),
+}
 
 def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
-    treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
-
-    if format == 'swc':
-        return HttpResponse(get_swc_string(treenode_qs), mimetype='text/plain')
-    elif format == 'json':
-        return HttpResponse(get_json_string(treenode_qs), mimetype='text/json')
-    else:
+    """ Streams the nodes of a skeleton in the given format, without holding
+    them in memory. """
+    if format not in _EXPORT_FORMATS:
         raise Exception, "Unknown format ('%s') in export_skeleton_response" % (format,)
+    lines, content_type = _EXPORT_FORMATS[format]
+    return StreamingHttpResponse(chunked(lines(int(project_id),
+            int(skeleton_id))), content_type=content_type)
+
+
+class _ArchiveBuffer(object):
+    """ A write-only file-like object for ZipFile, of which the written data
+    can be taken out in parts. This allows sending an archive while it is
+    written. """
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        return data
+
+def _skeletons_archive(project_id, skeleton_ids, format):
+    """ Yields the parts of a ZIP archive with one file for each skeleton.
+    Only the export of a single skeleton is held in memory at a time. """
+    lines = _EXPORT_FORMATS[format][0]
+    buf = _ArchiveBuffer()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    for skeleton_id in skeleton_ids:
+        archive.writestr('%s.%s' % (skeleton_id, format),
+                ''.join(lines(project_id, skeleton_id)))
+        yield buf.take()
+    archive.close()
+    yield buf.take()
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def export_skeletons_archive(request, project_id=None):
+    """ Streams a ZIP archive with the nodes of all skeletons given as
+    skeleton_ids[] in the format given as 'format' ('swc' or 'json'). """
+    format = request.POST.get('format', 'swc')
+    if format not in _EXPORT_FORMATS:
+        raise Exception("Unknown format: %s" % format)
+    skeleton_ids = sorted(set(int(v) for k,v in request.POST.iteritems()
+            if k.startswith('skeleton_ids[')))
+    if not skeleton_ids:
+        raise Exception("No skeleton IDs given")
+    response = StreamingHttpResponse(_skeletons_archive(int(project_id),
+            skeleton_ids, format), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="skeletons-%s.zip"' % format
+    return response
 
 
 def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=0, all_field=False):
@@ -107,21 +180,21 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
     connectors = []
 
     if 0 == lean: # meaning not lean
-        # Text tags
-        cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-        labeled_as = cursor.fetchall()[0][0]
+        # Text tags, named by the cached label dictionary of the project
+        labeled_as = get_relation_to_id_map(project_id, ('labeled_as',))['labeled_as']
 
         cursor.execute(
-             ''' SELECT treenode_class_instance.treenode_id, class_instance.name
-                 FROM treenode, class_instance, treenode_class_instance
+             ''' SELECT treenode_class_instance.treenode_id, treenode_class_instance.class_instance_id
+                 FROM treenode, treenode_class_instance
                  WHERE treenode.skeleton_id = %s
                    AND treenode.id = treenode_class_instance.treenode_id
-                   AND treenode_class_instance.class_instance_id = class_instance.id
                    AND treenode_class_instance.relation_id = %s
              ''' % (skeleton_id, labeled_as))
 
-        for row in cursor.fetchall():
-            tags[row[1]].append(row[0])
+        rows = cursor.fetchall()
+        label_names = get_label_names(project_id, set(row[1] for row in rows))
+        for row in rows:
+            tags[label_names[row[1]]].append(row[0])
 
         if with_connectors:
             if all_field:
@@ -153,9 +226,43 @@ def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True, lean=
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_for_3d_viewer(request, project_id=None, skeleton_id=None):
+    if binaryformat.is_requested(request):
+        return _skeleton_for_3d_viewer_binary(request, project_id, skeleton_id)
     return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=request.POST.get('with_connectors', True), lean=int(request.POST.get('lean', 0)), all_field=request.POST.get('all_fields', False)), separators=(',', ':')))
 
 
+def _skeleton_for_3d_viewer_binary(request, project_id, skeleton_id):
+    """ Returns the skeleton in the binary format of
+    catmaid.control.binaryformat. The name and the tags are included as
+    additional data. Connector relations are 0 for presynaptic_to and 1 for
+    postsynaptic_to. """
+    if request.POST.get('all_fields', False):
+        raise Exception("The binary format doesn't support all_fields")
+    name, nodes, tags, connectors = _skeleton_for_3d_viewer(skeleton_id,
+            project_id, with_connectors=request.POST.get('with_connectors', True),
+            lean=int(request.POST.get('lean', 0)))
+    return binaryformat.response((
+        ('nodes', nodes, (
+            ('id', binaryformat.INT),
+            ('parent_id', binaryformat.INT),
+            ('user_id', binaryformat.INT),
+            ('reviewer_id', binaryformat.INT),
+            ('x', binaryformat.FLOAT64),
+            ('y', binaryformat.FLOAT64),
+            ('z', binaryformat.FLOAT64),
+            ('radius', binaryformat.FLOAT32),
+            ('confidence', binaryformat.INT))),
+        ('connectors', connectors, (
+            ('treenode_id', binaryformat.INT),
+            ('connector_id', binaryformat.INT),
+            ('relation', binaryformat.INT),
+            ('x', binaryformat.FLOAT64),
+            ('y', binaryformat.FLOAT64),
+            ('z', binaryformat.FLOAT64),
+            ('reviewer_id', binaryformat.INT)))),
+        {'name': name, 'tags': tags})
+
+
 def _measure_skeletons(skeleton_ids):
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
@@ -164,18 +271,20 @@ def _measure_skeletons(skeleton_ids):
 
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location
+    SELECT id, COALESCE(parent_id, -1), skeleton_id,
+           (location).x, (location).y, (location).z
     FROM treenode
     WHERE skeleton_id IN (%s)
     ''' % skids_string)
 
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 6)
+    ids = rows[:, 0].astype(np.int64)
+    parent_ids = rows[:, 1].astype(np.int64)
+    node_skeleton_ids = rows[:, 2].astype(np.int64)
 
     class Skeleton():
         def __init__(self):
-            self.nodes = {}
+            self.n_nodes = 0
             self.raw_cable = 0
             self.smooth_cable = 0
             self.principal_branch_cable = 0
@@ -184,91 +293,16 @@ def _measure_skeletons(skeleton_ids):
             self.n_pre = 0
             self.n_post = 0
 
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        x, y, z = imap(float, row[3][1:-1].split(','))
-        skeleton.nodes[row[0]] = Node(row[1], x, y, z)
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    # Measure all skeletons at once
+    skids, measurements = arbor.measure(ids, parent_ids, node_skeleton_ids,
+            rows[:, 3:6])
+
+    skeletons = {}
+    for i, skid in enumerate(skids.tolist()):
+        skeleton = Skeleton()
+        for name, values in measurements.iteritems():
+            setattr(skeleton, name, values[i].item())
+        skeletons[skid] = skeleton
 
     # Count inputs
     cursor.execute('''
@@ -310,7 +344,7 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_ends, sk.n_branch, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_ends, sk.n_branch, sk.principal_branch_cable)
     return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
 
 
@@ -485,44 +519,30 @@ def skeleton_swc(*args, **kwargs):
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_json(*args, **kwargs):
     kwargs['format'] = 'json'
-    return export_extended_skeleton_response(*args, **kwargs)
+    return export_skeleton_response(*args, **kwargs)
 
 def _export_review_skeleton(project_id=None, skeleton_id=None, format=None):
     treenodes = Treenode.objects.filter(skeleton_id=skeleton_id).values_list('id', 'location', 'parent_id', 'reviewer_id')
 
-    g = nx.DiGraph()
-    reviewed = set()
+    ids, parent_ids, reviewer_ids, xs, ys, zs = [], [], [], [], [], []
     for t in treenodes:
         loc = Double3D.from_str(t[1])
-        # While at it, send the reviewer ID, which is useful to iterate fwd
-        # to the first unreviewed node in the segment.
-        g.add_node(t[0], {'id': t[0], 'x': loc.x, 'y': loc.y, 'z': loc.z, 'rid': t[3]})
-        if -1 != t[3]:
-            reviewed.add(t[0])
-        if t[2]: # if parent
-            g.add_edge(t[2], t[0]) # edge from parent to child
-        else:
-            root_id = t[0]
+        ids.append(t[0])
+        parent_ids.append(t[2])
+        reviewer_ids.append(t[3])
+        xs.append(loc.x)
+        ys.append(loc.y)
+        zs.append(loc.z)
+    reviewed = set(i for i, rid in izip(ids, reviewer_ids) if -1 != rid)
+
+    # While at it, send the reviewer ID, which is useful to iterate fwd
+    # to the first unreviewed node in the segment.
+    tree = arbor.Arbor(ids, parent_ids, {'id': ids, 'x': xs, 'y': ys,
+        'z': zs, 'rid': reviewer_ids})
 
     # Create all sequences, as long as possible and always from end towards root
-    distances = edge_count_to_root(g, root_node=root_id) # distance in number of edges from root
-    seen = set()
-    sequences = []
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = (nID for nID in g.nodes() if 0 == len(g.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [g.node[nodeID]]
-        parents = g.predecessors(nodeID)
-        while parents:
-            parentID = parents[0]
-            sequence.append(g.node[parentID])
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parents = g.predecessors(parentID)
-
-        if len(sequence) > 1:
-            sequences.append(sequence)
+    sequences = [[tree.node[nodeID] for nodeID in sequence]
+            for sequence in tree.partition()]
 
     segments = []
     for sequence in sorted(sequences, key=len, reverse=True):
@@ -1,8 +1,14 @@
 from numpy import array, float32
 from numpy.linalg import norm
+import numpy as np
 import networkx as nx
 from catmaid.objects import *
+from catmaid.control.arbor import Arbor, TreeDistances
 from collections import namedtuple, defaultdict
+from itertools import chain, izip
+
+# The maximum number of node pairs whose distances are computed at once
+_MAX_DISTANCES = 1000000
 
 try:
     from scipy.sparse.csgraph import dijkstra
@@ -17,69 +23,123 @@ def synapse_clustering( skeleton_id, h_list ):
     return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
 
 
+def _weighted_arbor(tree):
+    """ Returns an Arbor and the length of the edge from every node to its
+    parent, from either an Arbor with a 'location' property or an undirected
+    networkx graph with edges weighted by length. """
+    if isinstance(tree, Arbor):
+        positions = np.asarray(tree.properties['location'], dtype=np.float64)
+        has_parent = tree.parents != -1
+        lengths = np.zeros(len(tree))
+        lengths[has_parent] = norm(positions[has_parent] - positions[tree.parents[has_parent]], axis=1)
+        return tree, lengths
+    # Orient the edges of each connected component away from an arbitrary root
+    parent_ids = {}
+    lengths = {}
+    for root in tree:
+        if root in parent_ids:
+            continue
+        parent_ids[root] = -1
+        lengths[root] = 0
+        queue = [root]
+        for node in queue:
+            for nn, props in tree[node].iteritems():
+                if nn not in parent_ids:
+                    parent_ids[nn] = node
+                    lengths[nn] = props.get('weight', 1)
+                    queue.append(nn)
+    ids = parent_ids.keys()
+    return Arbor(ids, [parent_ids[node] for node in ids]), \
+            np.array([lengths[node] for node in ids], dtype=np.float64)
+
 def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+    """ Gwud: networkx graph were the edges are weighted by length, and undirected,
+              or an Arbor with a 'location' property.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        The density at a node is the sum of a gaussian kernel of the path length to
+        every node with synapses. Densities are only computed for the nodes visited
+        while hill climbing, and for all bandwidths in h_list at once.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
-    
+    arbor, lengths = _weighted_arbor(Gwud)
+    distances = TreeDistances(arbor.parents, lengths)
+    ids = arbor.ids.tolist()
+    parents = arbor.parents.tolist()
+    child_offsets = arbor.child_offsets.tolist()
+    child_indices = arbor.child_indices.tolist()
+    synIndices = arbor.indices(synNodes).tolist()
+    uniqueSynIndices = np.unique(synIndices)
+    hh = np.square(np.array(h_list, dtype=np.float64))
+
+    densityField = {}   # densityField stores, for each bandwidth, the height of the hill to be climbed
+    def evaluate(indices):
+        todo = [i for i in indices if i not in densityField]
+        # Bound the size of the distance matrix of each chunk
+        step = max(1, _MAX_DISTANCES / max(1, len(uniqueSynIndices)))
+        for start in xrange(0, len(todo), step):
+            chunk = todo[start:start + step]
+            D2 = np.square(distances.distances(np.array(chunk)[:, np.newaxis], uniqueSynIndices))
+            values = np.empty((len(chunk), len(hh)))
+            for k, h2 in enumerate(hh):
+                values[:, k] = np.sum(np.exp(-1 * D2 / h2), axis=1)
+            for i, v in izip(chunk, values.tolist()):
+                densityField[i] = v
+
+    def neighbors(i):
+        nns = child_indices[child_offsets[i]:child_offsets[i+1]]
+        if -1 != parents[i]:
+            nns.insert(0, parents[i])
+        return nns
+
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-    
+    evaluate(uniqueSynIndices.tolist())
+
+    for k, h in enumerate(h_list):
         targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:    
-                currNode = startNode
-                allOnPath = []
-                
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-    
-                while True:
-                    allOnPath.append(currNode)
-    
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-                    
-                    for nn in Gwud.neighbors( currNode ): 
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-                    
+        # All climbs advance together, one step per round, so that the densities
+        # of the neighbors they need are evaluated in one batch per round
+        paths = {startNode: [startNode] for startNode in set(synIndices)}
+        while paths:
+            #Make sure I have densityField of all neighbors for comparison
+            evaluate(set(chain.from_iterable(neighbors(path[-1]) for path in paths.itervalues()
+                                                                  if path[-1] not in targLoc)))
+
+            for startNode, allOnPath in paths.items():
+                currNode = allOnPath[-1]
+
+                if currNode in targLoc:
+                    currNode = targLoc[ currNode ] # Jump right to the end already.
+                else:
                     prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
+                    for nn in neighbors( currNode ):
+                        if densityField[nn][k] > densityField[currNode][k]:
                             currNode = nn
-                                                    
-                    if currNode == prevNode:
-                        break
-                            
+
+                    if currNode != prevNode:
+                        allOnPath.append(currNode)
+                        continue
+
                 for node in allOnPath:
                     targLoc[node] = currNode
+                del paths[startNode]
 
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+        uniqueTargs = set(targLoc[node] for node in synIndices)
 
         loc2group = {}
 
         synapseGroups[h] = {}
         for ind, val in enumerate(uniqueTargs):
             loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-        
-        for ind, node in enumerate(synNodes):
+            synapseGroups[h][ind] = SynapseGroup([], [], [], ids[val])
+
+        for ind, node in enumerate(synIndices):
             gi = loc2group[targLoc[node]]
-            synapseGroups[h][ gi ].node_ids.append( node )
+            synapseGroups[h][ gi ].node_ids.append( ids[node] )
             synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
             synapseGroups[h][ gi ].relations.append( relations[ind] )
 
@@ -0,0 +1,173 @@
+""" A streaming writer for uncompressed multi-page TIFF files.
+
+Pages are appended one by one and their pixel data is written to the file
+right away, so that only a single page has to be kept in memory, no matter how
+many pages a file has. The image file directories (IFDs) that describe the
+pages are collected and written after the last page. This keeps the pixel
+data of all pages contiguous, which is what ImageJ expects from files with an
+ImageJ description.
+
+The tags written are the ones of baseline TIFF plus the resolution, image
+description and software tags. Files are limited to 4 GiB (no BigTIFF).
+"""
+
+import struct
+
+from fractions import Fraction
+
+# Tag IDs
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+IMAGE_DESCRIPTION = 270
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+X_RESOLUTION = 282
+Y_RESOLUTION = 283
+PLANAR_CONFIGURATION = 284
+RESOLUTION_UNIT = 296
+SOFTWARE = 305
+
+# Field types and the struct format of their numbers
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+_FORMATS = {SHORT: 'H', LONG: 'I', RATIONAL: 'I'}
+
+# Resolution units
+RESOLUTION_UNIT_NONE = 1
+
+def _rational(value):
+    """ Returns a (numerator, denominator) tuple that approximates value with
+    32 bit integers. """
+    f = Fraction(value).limit_denominator(2 ** 32 - 1)
+    return (f.numerator, f.denominator)
+
+class TiffWriter(object):
+    """ Writes 8 bit gray or RGB pages to a TIFF file. The resolution is
+    given in pixels per unit (with no particular unit) and applies to all
+    pages, the description and the software name are stored in every page.
+    Use it as context manager or call close() after the last page.
+    """
+
+    def __init__(self, path, x_resolution=None, y_resolution=None,
+            description=None, software=None):
+        self.path = path
+        self.file = open(path, 'wb')
+        # Little endian header, the offset of the first IFD is set on close
+        self.file.write(struct.pack('<2sHI', 'II', 42, 0))
+        self.pages = []
+        self.x_resolution = x_resolution
+        self.y_resolution = y_resolution
+        self.description = description
+        self.software = software
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write_page(self, width, height, samples_per_pixel, data):
+        """ Appends a page of the given size, whose 8 bit samples are passed
+        as string (row by row, the samples of a pixel next to each other). """
+        if samples_per_pixel not in (1, 3):
+            raise ValueError("Only gray and RGB pages are supported")
+        if len(data) != width * height * samples_per_pixel:
+            raise ValueError("The page data doesn't match its size")
+        offset = self.file.tell()
+        self.file.write(data)
+        self.pages.append((width, height, samples_per_pixel, offset,
+                len(data)))
+
+    def _write_value(self, field_type, values):
+        """ Writes the values of a tag to the current position and returns
+        its offset. Values are aligned to words. """
+        if self.file.tell() % 2:
+            self.file.write('\0')
+        offset = self.file.tell()
+        self.file.write(self._pack(field_type, values))
+        return offset
+
+    def _pack(self, field_type, values):
+        if field_type == ASCII:
+            return values
+        if field_type == RATIONAL:
+            values = [v for pair in values for v in pair]
+        return struct.pack('<%s%s' % (len(values), _FORMATS[field_type]),
+                *values)
+
+    def close(self):
+        """ Writes the IFDs of all pages and closes the file. """
+        if self.file.closed:
+            return
+        # Values that don't fit into an IFD entry are shared by all pages
+        shared = {}
+        if self.description:
+            shared[IMAGE_DESCRIPTION] = (ASCII, 1,
+                    self._write_value(ASCII, self.description + '\0'),
+                    len(self.description) + 1)
+        if self.software:
+            shared[SOFTWARE] = (ASCII, 1,
+                    self._write_value(ASCII, self.software + '\0'),
+                    len(self.software) + 1)
+        if self.x_resolution and self.y_resolution:
+            for tag, value in ((X_RESOLUTION, self.x_resolution),
+                    (Y_RESOLUTION, self.y_resolution)):
+                shared[tag] = (RATIONAL, 1,
+                        self._write_value(RATIONAL, [_rational(value)]), 1)
+        rgb_bits = self._write_value(SHORT, [8, 8, 8])
+
+        if self.file.tell() % 2:
+            self.file.write('\0')
+        next_ifd_position = 4
+        for width, height, samples_per_pixel, offset, size in self.pages:
+            entries = {
+                IMAGE_WIDTH: (LONG, 0, width, 1),
+                IMAGE_LENGTH: (LONG, 0, height, 1),
+                COMPRESSION: (SHORT, 0, 1, 1),
+                PHOTOMETRIC_INTERPRETATION: (SHORT, 0,
+                        1 if samples_per_pixel == 1 else 2, 1),
+                STRIP_OFFSETS: (LONG, 0, offset, 1),
+                SAMPLES_PER_PIXEL: (SHORT, 0, samples_per_pixel, 1),
+                ROWS_PER_STRIP: (LONG, 0, height, 1),
+                STRIP_BYTE_COUNTS: (LONG, 0, size, 1),
+                PLANAR_CONFIGURATION: (SHORT, 0, 1, 1),
+            }
+            if samples_per_pixel == 1:
+                entries[BITS_PER_SAMPLE] = (SHORT, 0, 8, 1)
+            else:
+                entries[BITS_PER_SAMPLE] = (SHORT, 1, rgb_bits, 3)
+            if X_RESOLUTION in shared:
+                entries[RESOLUTION_UNIT] = (SHORT, 0, RESOLUTION_UNIT_NONE, 1)
+            entries.update(shared)
+
+            # Link the previous IFD (or the header) to this one
+            ifd_position = self.file.tell()
+            self.file.seek(next_ifd_position)
+            self.file.write(struct.pack('<I', ifd_position))
+            self.file.seek(ifd_position)
+
+            ifd = [struct.pack('<H', len(entries))]
+            for tag in sorted(entries):
+                field_type, is_offset, value, count = entries[tag]
+                if is_offset:
+                    packed = struct.pack('<I', value)
+                elif field_type == SHORT:
+                    packed = struct.pack('<HH', value, 0)
+                else:
+                    packed = struct.pack('<I', value)
+                ifd.append(struct.pack('<HHI', tag, field_type, count))
+                ifd.append(packed)
+            next_ifd_position = ifd_position + 2 + 12 * len(entries)
+            ifd.append(struct.pack('<I', 0))
+            self.file.write(''.join(ifd))
+        self.file.close()
@@ -1,5 +1,8 @@
 import os
+import threading
+from collections import OrderedDict
 from contextlib import closing
+from StringIO import StringIO
 import h5py
 import json
 import numpy as np
@@ -13,6 +16,121 @@ from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 
+# HDF5 files that tiles are read from are kept open, because opening a file
+# and reading its meta data takes longer than reading a tile. Files are
+# reopened if they have been modified. The least recently used files are
+# closed if there are more than HDF5_TILE_MAX_OPEN_FILES.
+_open_files = OrderedDict()
+
+# Encoded tiles, including empty ones, are kept in a least recently used
+# cache of at most HDF5_TILE_CACHE_SIZE bytes. Their keys contain the
+# modification time of the file.
+_tiles = OrderedDict()
+_tiles_size = 0
+
+# Guards open files and the tile cache. Tiles are read with this lock held,
+# so that files are not closed while they are read, but encoded without it.
+_lock = threading.Lock()
+
+def _open_hdf5(path):
+    """ Opens an HDF5 file read-only, with a chunk cache. Chunks are
+    decompressed as a whole, the chunk cache lets all tiles that overlap a
+    chunk share it. The HDF5_TILE_CHUNK_CACHE_SIZE bytes of all chunk caches
+    are split evenly between the HDF5_TILE_MAX_OPEN_FILES files that can be
+    open at the same time. If h5py supports it, files are opened in SWMR mode
+    (single writer, multiple readers), so that they can be written while they
+    are read.
+    """
+    chunk_cache_size = getattr(settings, 'HDF5_TILE_CHUNK_CACHE_SIZE',
+            64 * 1024 ** 2) / max(getattr(settings,
+            'HDF5_TILE_MAX_OPEN_FILES', 32), 1)
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_cache(0, 10007, chunk_cache_size, 0.75)
+    swmr_read = getattr(h5py.h5f, 'ACC_SWMR_READ', None)
+    if swmr_read is not None:
+        try:
+            return h5py.File(h5py.h5f.open(path,
+                    h5py.h5f.ACC_RDONLY | swmr_read, fapl=fapl))
+        except (IOError, ValueError):
+            # The file isn't written in a format that allows SWMR
+            pass
+    return h5py.File(h5py.h5f.open(path, h5py.h5f.ACC_RDONLY, fapl=fapl))
+
+def _get_file(path, mtime):
+    """ Returns the open HDF5 file at path, as it was at the given
+    modification time. Has to be called with _lock held.
+    """
+    entry = _open_files.pop(path, None)
+    if entry and entry[1] != mtime:
+        entry[0].close()
+        entry = None
+    if entry is None:
+        entry = (_open_hdf5(path), mtime)
+    _open_files[path] = entry
+    max_open_files = getattr(settings, 'HDF5_TILE_MAX_OPEN_FILES', 32)
+    while len(_open_files) > max_open_files:
+        _open_files.popitem(last=False)[1][0].close()
+    return entry[0]
+
+def _read_tile(path, mtime, scale, z, x, y, width, height):
+    """ Returns the data of a tile as height x width array, padded with zeros
+    where it exceeds the data set. Returns None if the file has no data set
+    for the scale and section. Has to be called with _lock held.
+    """
+    hfile = _get_file(path, mtime)
+    hdfpath = '/' + str(scale) + '/' + str(z) + '/data'
+    if not hdfpath in hfile:
+        return None
+    data = hfile[hdfpath][y:y+height,x:x+width]
+    if data.shape != (height, width):
+        padded = np.zeros((height, width), dtype=data.dtype)
+        padded[:data.shape[0],:data.shape[1]] = data
+        data = padded
+    return np.ascontiguousarray(data)
+
+def _get_cached_tile(key):
+    """ Returns the encoded tile with the given key or None if it isn't
+    cached. """
+    with _lock:
+        png = _tiles.pop(key, None)
+        if png is not None:
+            # Mark as recently used
+            _tiles[key] = png
+        return png
+
+def _cache_tile(key, png):
+    """ Stores an encoded tile and removes the least recently used tiles if
+    the cache gets too large. """
+    global _tiles_size
+    max_size = getattr(settings, 'HDF5_TILE_CACHE_SIZE', 64 * 1024 ** 2)
+    with _lock:
+        old = _tiles.pop(key, None)
+        if old is not None:
+            _tiles_size -= len(old)
+        _tiles[key] = png
+        _tiles_size += len(png)
+        while _tiles_size > max_size and _tiles:
+            _tiles_size -= len(_tiles.popitem(last=False)[1])
+
+def _encode_png(data, width, height):
+    pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
+    output = StringIO()
+    pilImage.save(output, "PNG")
+    return output.getvalue()
+
+def _empty_tile(width, height):
+    """ Returns an encoded black tile of the given size. """
+    key = ('empty', width, height)
+    png = _get_cached_tile(key)
+    if png is None:
+        png = _encode_png(np.zeros((height, width), dtype=np.uint8), width,
+                height)
+        _cache_tile(key, png)
+    return png
+
+def _png_response(png):
+    return HttpResponse(png, mimetype="image/png")
+
 def get_tile(request, project_id=None, stack_id=None):
     import sys
 
@@ -30,33 +148,26 @@ def get_tile(request, project_id=None, stack_id=None):
     # need to know the stack name
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
 
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(mimetype="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(mimetype="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(mimetype="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    try:
+        mtime = os.path.getmtime( fpath )
+    except OSError:
+        # The HDF5 file does not exist
+        return _png_response( _empty_tile( width, height ) )
+
+    key = (fpath, mtime, int(scale), z, x, y, width, height)
+    png = _get_cached_tile( key )
+    if png is None:
+        with _lock:
+            data = _read_tile( fpath, mtime, int(scale), z, x, y, width,
+                    height )
+        if data is None:
+            # The HDF5 file does not contain the scale or section
+            png = _empty_tile( width, height )
+        else:
+            png = _encode_png( data, width, height )
+        _cache_tile( key, png )
+
+    return _png_response( png )
 
 def put_tile(request, project_id=None, stack_id=None):
     """ Store labels to HDF5 """
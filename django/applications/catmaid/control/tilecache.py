@@ -0,0 +1,201 @@
+""" Concurrent tile retrieval with a local on-disk tile cache.
+
+Image tiles are fetched by URL. Every tile that has been fetched is stored in
+a cache directory below MEDIA_ROOT (MEDIA_TILE_CACHE_SUBDIRECTORY), so that
+overlapping cropping jobs, ROI images and treenode archives don't request the
+same tiles from the image server again. The cache is bounded by
+TILE_CACHE_MAX_SIZE bytes: if it grows larger, the least recently used tiles
+are removed. A tile is marked as used by updating the modification time of its
+file, which makes the cache usable by more than one process (e.g. the Django
+process and Celery workers) at the same time.
+
+Many tiles can be fetched at once with fetch_tiles(), which downloads them
+with a bounded number of threads (TILE_FETCH_THREADS). This way, crops of many
+tiles are limited by the bandwidth to the image server rather than by the
+latency of each single request.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import urllib2
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+
+class ImageRetrievalError(IOError):
+    def __init__(self, path, error):
+        IOError.__init__(self, "Couldn't access %s" % (path))
+        self.path = path
+        self.error = error
+
+# The cache size as known to this process, None if unknown. It is updated with
+# each stored tile and checked against the disk contents only if it exceeds
+# the maximum size, because other processes may have removed tiles.
+_cache_size = None
+_cache_lock = threading.Lock()
+
+# After the cache grew too large, tiles are removed until it is smaller than
+# this fraction of the maximum size.
+_SHRINK_RATIO = 0.8
+
+def _cache_path():
+    return os.path.join(settings.MEDIA_ROOT,
+            getattr(settings, 'MEDIA_TILE_CACHE_SUBDIRECTORY', 'tile_cache'))
+
+def _max_cache_size():
+    return getattr(settings, 'TILE_CACHE_MAX_SIZE', 1024 ** 3)
+
+def _tile_file(url):
+    """ Returns the cache file name of the tile with the given URL. Files are
+    spread over sub-directories to keep directories small. """
+    key = hashlib.sha1(url).hexdigest()
+    return os.path.join(_cache_path(), key[:2], key)
+
+def _cached_files():
+    """ Returns a list of (modification time, size, file name) tuples of all
+    files in the cache. """
+    files = []
+    for directory, subdirectories, names in os.walk(_cache_path()):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed by another process in the meantime
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+def _shrink(max_size):
+    """ Removes the least recently used tiles from the cache until it is
+    smaller than _SHRINK_RATIO times max_size. Returns the size of the cache
+    afterwards. """
+    files = _cached_files()
+    size = sum(f[1] for f in files)
+    if size <= max_size:
+        return size
+    files.sort()
+    target = max_size * _SHRINK_RATIO
+    for mtime, file_size, path in files:
+        if size <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= file_size
+    return size
+
+def _read_cached(url):
+    """ Returns the data of the cached tile with the given URL or None if it
+    isn't cached. """
+    path = _tile_file(url)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    try:
+        # Mark the tile as recently used
+        os.utime(path, None)
+    except OSError:
+        pass
+    return data
+
+def _store(url, data):
+    """ Stores the data of the tile with the given URL in the cache and removes
+    old tiles if the cache got too large. The file is written under a
+    temporary name and renamed afterwards, so that readers never see
+    incomplete tiles. """
+    global _cache_size
+    max_size = _max_cache_size()
+    if max_size <= 0:
+        return
+    path = _tile_file(url)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    with _cache_lock:
+        if _cache_size is None:
+            _cache_size = sum(f[1] for f in _cached_files())
+        else:
+            _cache_size += len(data)
+        if _cache_size > max_size:
+            _cache_size = _shrink(max_size)
+
+def fetch_tile(url):
+    """ Returns the data of the tile with the given URL, either from the local
+    tile cache or from the image server. Raises an ImageRetrievalError if the
+    tile can't be retrieved. """
+    data = _read_cached(url)
+    if data is not None:
+        return data
+    try:
+        data = urllib2.urlopen(url).read()
+    except urllib2.HTTPError as e:
+        raise ImageRetrievalError(url, "Error code: %s" % e.code)
+    except urllib2.URLError as e:
+        raise ImageRetrievalError(url, e.reason)
+    try:
+        _store(url, data)
+    except (IOError, OSError):
+        # A failing cache shouldn't make the retrieval fail
+        pass
+    return data
+
+def _fetch_tile_or_error(url):
+    """ Like fetch_tile(), but returns retrieval errors instead of raising
+    them. """
+    try:
+        return fetch_tile(url)
+    except ImageRetrievalError as e:
+        return e
+
+def fetch_tiles(urls, n_threads=None, return_errors=False):
+    """ Returns an iterator over the data of the tiles with the given URLs, in
+    the order of the URLs. Tiles are fetched by n_threads threads (defaults to
+    the TILE_FETCH_THREADS setting) ahead of the consumer, but at most a few
+    tiles per thread are kept in memory. Retrieval errors are raised when the
+    failed tile is reached, unless return_errors is set: then the
+    ImageRetrievalError takes the place of the tile's data and the remaining
+    tiles are still fetched. """
+    if n_threads is None:
+        n_threads = getattr(settings, 'TILE_FETCH_THREADS', 8)
+    fetch = _fetch_tile_or_error if return_errors else fetch_tile
+    urls = iter(urls)
+    if n_threads < 2:
+        for url in urls:
+            yield fetch(url)
+        return
+
+    pool = ThreadPool(n_threads)
+    try:
+        pending = deque()
+        window = 4 * n_threads
+        for url in urls:
+            pending.append(pool.apply_async(fetch, (url,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # Don't wait for the remaining downloads if the consumer stopped
+        pool.terminate()
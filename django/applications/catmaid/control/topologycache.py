@@ -0,0 +1,236 @@
+""" A per-process cache of the tree structure of recently navigated skeletons.
+
+Moving to the previous or next branch node is done constantly while tracing.
+Instead of loading the whole skeleton for every step, the structure of a
+skeleton is loaded once and decomposed into segments: chains of nodes that
+start at the root or at a child of a branch node, and in which all nodes but
+the last have exactly one child. The last node of a segment is a branch node
+or an end node. With the segment and the position of every node, each step is
+answered without a walk along the skeleton.
+
+Every change to the structure of a skeleton increments its topology_revision
+in the skeleton_summary table (maintained by a trigger). A cached topology is
+only used as long as its revision matches the one in the database, which
+makes it safe to keep a cache in every process. Nodes appended by this
+process update the cached topology incrementally, all other changes cause it
+to be loaded again. Appended nodes are only added to the topology once they
+are found to be committed, so that a rolled back transaction can't leave
+nodes behind.
+
+At most SKELETON_TOPOLOGY_CACHE_SIZE skeletons are kept, the least recently
+used ones are discarded first.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class SkeletonTopology(object):
+    """ The segments of a skeleton. """
+
+    def __init__(self, skeleton_id, revision, rows):
+        """ Creates the topology from (node ID, parent ID) rows. """
+        self.skeleton_id = skeleton_id
+        self.revision = revision
+        self.lock = threading.Lock()
+        # Segments as lists of node IDs and the parent of their first node
+        self.segments = []
+        self.segment_parents = []
+        # Node ID vs segment index and position within the segment
+        self.positions = {}
+        # Branch node ID vs indices of the segments that start at its children
+        self.branches = {}
+        # Lists of (node ID, parent ID) tuples appended by this process, which
+        # may not have been committed yet
+        self.appended = []
+
+        children = {}
+        for node_id, parent_id in rows:
+            children.setdefault(parent_id, []).append(node_id)
+        # Segments start at the root and at nodes whose parent isn't part of
+        # the skeleton (which would be an inconsistency).
+        node_ids = set(row[0] for row in rows)
+        open_segments = [(node_id, parent_id)
+                for parent_id, child_ids in children.iteritems()
+                if parent_id is None or parent_id not in node_ids
+                for node_id in child_ids]
+
+        while open_segments:
+            node_id, parent_id = open_segments.pop()
+            index = self._add_segment(parent_id)
+            segment = self.segments[index]
+            while True:
+                self.positions[node_id] = (index, len(segment))
+                segment.append(node_id)
+                node_children = children.get(node_id, ())
+                if 1 != len(node_children):
+                    break
+                node_id = node_children[0]
+            if len(node_children) > 1:
+                self.branches[node_id] = []
+                open_segments.extend((child_id, node_id)
+                        for child_id in node_children)
+
+    def _add_segment(self, parent_id):
+        index = len(self.segments)
+        self.segments.append([])
+        self.segment_parents.append(parent_id)
+        if parent_id is not None and parent_id in self.branches:
+            self.branches[parent_id].append(index)
+        return index
+
+    def _position(self, node_id):
+        position = self.positions.get(node_id)
+        if position is None:
+            raise Exception("Node %s is not part of skeleton %s" % (node_id,
+                    self.skeleton_id))
+        return position
+
+    def previous_branch_or_root(self, node_id):
+        """ Returns the nodes upstream of the given node up to the closest
+        branch node or the root, without the given node. The list is empty
+        for the root. """
+        with self.lock:
+            index, i = self._position(node_id)
+            nodes = self.segments[index][i - 1::-1] if i > 0 else []
+            parent_id = self.segment_parents[index]
+            if parent_id is not None and parent_id in self.positions:
+                nodes.append(parent_id)
+            return nodes
+
+    def next_branch_or_end(self, node_id):
+        """ Returns the nodes downstream of the given node up to the closest
+        branch node or end node, without the given node. The list is empty
+        for branch and end nodes. """
+        with self.lock:
+            index, i = self._position(node_id)
+            return self.segments[index][i + 1:]
+
+    def children_of_branch(self, node_id):
+        """ Returns the children of the given node if it is a branch node and
+        an empty list otherwise. """
+        with self.lock:
+            self._position(node_id)
+            return [self.segments[index][0]
+                    for index in self.branches.get(node_id, ())]
+
+    def append(self, node_id, parent_id):
+        """ Adds a new leaf node to the topology. """
+        with self.lock:
+            index, i = self._position(parent_id)
+            segment = self.segments[index]
+            if parent_id in self.branches:
+                # The parent is a branch node already
+                self._add_segment(parent_id)
+            elif i == len(segment) - 1:
+                # The parent was an end node, the segment continues
+                self.positions[node_id] = (index, len(segment))
+                segment.append(node_id)
+                return
+            else:
+                # The parent becomes a branch node: the segment is split after
+                # the parent and both the remainder and the new node start new
+                # segments.
+                self.branches[parent_id] = []
+                remainder = self._add_segment(parent_id)
+                self.segments[remainder] = segment[i + 1:]
+                del segment[i + 1:]
+                for j, moved_id in enumerate(self.segments[remainder]):
+                    self.positions[moved_id] = (remainder, j)
+                self._add_segment(parent_id)
+            new_index = len(self.segments) - 1
+            self.segments[new_index].append(node_id)
+            self.positions[node_id] = (new_index, 0)
+
+
+# Skeleton ID vs SkeletonTopology, in the order of their last use
+_topologies = OrderedDict()
+_topologies_lock = threading.Lock()
+
+def _cache_size():
+    return getattr(settings, 'SKELETON_TOPOLOGY_CACHE_SIZE', 32)
+
+def _cached(skeleton_id):
+    """ Returns the cached topology of the skeleton, if any. """
+    with _topologies_lock:
+        topology = _topologies.pop(skeleton_id, None)
+        if topology is not None:
+            _topologies[skeleton_id] = topology
+        return topology
+
+def _store(topology):
+    with _topologies_lock:
+        _topologies.pop(topology.skeleton_id, None)
+        _topologies[topology.skeleton_id] = topology
+        while len(_topologies) > _cache_size():
+            _topologies.popitem(last=False)
+
+def _apply_appended(cursor, topology, revision):
+    """ Adds the nodes appended by this process to the topology if they
+    account for all changes up to the given revision of the skeleton. Appends
+    whose nodes don't exist (anymore) were rolled back. Returns true if the
+    topology is up to date. """
+    with topology.lock:
+        appended, topology.appended = topology.appended, []
+    if not appended or revision is None:
+        return False
+    cursor.execute('''
+    SELECT id FROM treenode WHERE skeleton_id = %s AND id IN %s
+    ''', (topology.skeleton_id,
+            tuple(node_id for nodes in appended for node_id, _ in nodes)))
+    existing = set(row[0] for row in cursor.fetchall())
+    committed = [nodes for nodes in appended
+            if all(node_id in existing for node_id, _ in nodes)]
+    # Each new node increments the revision once
+    if topology.revision + sum(len(nodes) for nodes in committed) != revision:
+        return False
+    for nodes in committed:
+        for node_id, parent_id in nodes:
+            topology.append(node_id, parent_id)
+    with topology.lock:
+        topology.revision = revision
+    return True
+
+def get_topology(cursor, node_id):
+    """ Returns the topology of the skeleton of the given treenode. This is
+    meant for requests that don't change the skeleton: nodes created by the
+    current transaction would be cached even if it is rolled back. """
+    cursor.execute('''
+    SELECT t.skeleton_id, s.topology_revision
+    FROM treenode t
+    LEFT OUTER JOIN skeleton_summary s ON (s.skeleton_id = t.skeleton_id)
+    WHERE t.id = %s
+    ''', (node_id,))
+    row = cursor.fetchone()
+    if not row:
+        raise Exception("Node %s doesn't exist" % node_id)
+    skeleton_id, revision = row
+    topology = _cached(skeleton_id)
+    if topology and (topology.revision == revision or
+            _apply_appended(cursor, topology, revision)):
+        return topology
+    # The nodes are fetched after the revision: if the skeleton changes in the
+    # meantime, the topology is newer than its revision and is just loaded
+    # again next time.
+    cursor.execute('''
+    SELECT id, parent_id FROM treenode WHERE skeleton_id = %s
+    ''', (skeleton_id,))
+    topology = SkeletonTopology(skeleton_id, revision, cursor.fetchall())
+    if _cache_size() > 0:
+        _store(topology)
+    return topology
+
+def append_nodes(skeleton_id, nodes):
+    """ Records the given (node ID, parent ID) tuples of new leaf nodes, in the
+    order in which they were created, for the cached topology of the skeleton
+    (if any). They are added to it by get_topology, once they are committed.
+    """
+    with _topologies_lock:
+        topology = _topologies.get(skeleton_id)
+    if not topology or not nodes:
+        return
+    with topology.lock:
+        topology.appended.append(list(nodes))
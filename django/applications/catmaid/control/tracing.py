@@ -59,8 +59,10 @@ def check_tracing_setup_detailed(project_id, opt_class_map=None,
     pass already available class and relation maps.
     """
     # Get class and relation data. If available, use the provided one.
-    class_map = opt_class_map or get_class_to_id_map(project_id)
-    relation_map = opt_relation_map or get_relation_to_id_map(project_id)
+    class_map = opt_class_map or get_class_to_id_map(project_id,
+            needed_classes)
+    relation_map = opt_relation_map or get_relation_to_id_map(project_id,
+            needed_relations)
 
     # Check if all classes and relations are available
     all_good = True
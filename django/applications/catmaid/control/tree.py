@@ -15,6 +15,7 @@ from catmaid.control.object import get_annotation_graph
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control import nodecache
 from catmaid.control.tracing import check_tracing_setup_detailed
 
 from collections import defaultdict
@@ -32,14 +33,15 @@ def instance_operation(request, project_id=None):
         # TODO sanitize
         params[k] = request.POST.get(k, 0)
  
-    relation_map = get_relation_to_id_map(project_id)
-    class_map = get_class_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('model_of', 'part_of'))
+    class_map = get_class_to_id_map(project_id, ('root',))
 
     # We avoid many try/except clauses by setting this string to be the
     # response we return if an exception is thrown.
     instance_operation.res_on_err = ''
 
     def remove_skeletons(skeleton_id_list):
+        nodecache.invalidate_skeletons(project_id, skeleton_id_list)
         if request.user.is_superuser:
             instance_operation.res_on_err = 'Failed to delete in treenode for skeletons #%s' % skeleton_id_list
             # TODO this failed at least once, whereas direct deletion of a single skeleton by skeleton_id on the treenode table succeeded. Inspect!
@@ -148,6 +150,10 @@ def instance_operation(request, project_id=None):
         # but only in their staging area.
         can_edit_class_instance_or_fail(request.user, params['parentid'])
 
+        class_map = get_class_to_id_map(project_id,
+                (params['classname'], 'root'))
+        relation_map = get_relation_to_id_map(project_id,
+                (params['relationname'],))
         if params['classname'] not in class_map:
             raise Exception('Failed to select class.')
         instance_operation.res_on_err = 'Failed to insert instance of class.'
@@ -207,6 +213,7 @@ def instance_operation(request, project_id=None):
 
     def has_relations():
         relations = [request.POST.get('relation%s' % i, 0) for i in range(int(params['relationnr']))]
+        relation_map = get_relation_to_id_map(project_id, relations)
         relation_ids = []
         for relation in relations:
             instance_operation.res_on_err = 'Failed to select relation %s' % relation
@@ -242,7 +249,7 @@ def tree_object_expand(request, project_id=None):
     else:
         class_instance_id = int(class_instance_id) # sanitize by casting to int
 
-    relation_map = get_relation_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('model_of', 'part_of'))
 
     # Treenode is element_of class_instance (skeleton), which is model_of (neuron)
     # which is part_of class_instance (?), recursively, until reaching class_instance
@@ -415,8 +422,9 @@ def tree_object_list(request, project_id=None):
 
     max_nodes = 5000  # Limit number of nodes retrievable.
 
-    relation_map = get_relation_to_id_map(project_id)
-    class_map = get_class_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id,
+            ('model_of', 'annotated_with', 'part_of'))
+    class_map = get_class_to_id_map(project_id, ('root',))
 
     # First, check if the tracing system is correctly set-up
     setup_okay, mc, mr, mci = check_tracing_setup_detailed(project_id,
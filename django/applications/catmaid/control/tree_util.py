@@ -1,4 +1,5 @@
-# A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# A 'tree' is a networkx.DiGraph with a single root node (a node without parents),
+# or a catmaid.control.arbor.Arbor, to which the functions below delegate.
 
 from operator import itemgetter
 from networkx import Graph, DiGraph
@@ -6,18 +7,24 @@ from collections import defaultdict
 from math import sqrt
 from itertools import izip, islice, imap
 from catmaid.models import Treenode
-from catmaid.fields import Double3D
+from catmaid.control.arbor import Arbor
+
+import numpy as np
 
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
     Avoids one database lookup. """
+    if isinstance(tree, Arbor):
+        return tree.find_root()
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
 
 def edge_count_to_root(tree, root_node=None):
     """ Return a map of nodeID vs number of edges from the first node that lacks predecessors (aka the root). If root_id is None, it will be searched for."""
+    if isinstance(tree, Arbor):
+        return tree.edge_count_to_root(root_node)
     distances = {}
     count = 1
     current_level = [root_node if root_node else find_root(tree)]
@@ -60,6 +67,8 @@ def find_common_ancestors(tree, node_groups):
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
+    if isinstance(tree, Arbor):
+        return tree.reroot(new_root)
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -76,6 +85,8 @@ def simplify(tree, keepers):
     where only the nodes to keep and the branch points between them are preserved.
     WARNING: will reroot the tree at the first of the keepers.
     WARNING: keepers can't be empty. """
+    if isinstance(tree, Arbor):
+        return tree.simplify(keepers)
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
@@ -126,6 +137,10 @@ def partition(tree, root_node=None):
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
     Each sequence runs from an end node to either the root or a branch node. """
+    if isinstance(tree, Arbor):
+        for sequence in tree.partition(root_node):
+            yield sequence
+        return
     distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
     seen = set()
     # Iterate end nodes sorted from highest to lowest distance to root
@@ -146,7 +161,10 @@ def partition(tree, root_node=None):
 
 def spanning_tree(tree, preserve):
     """ Return a new DiGraph with the spanning tree including the desired nodes.
-    preserve: the set of nodes that delimit the spanning tree. """
+    preserve: the set of nodes that delimit the spanning tree.
+    For an Arbor, the spanning tree is returned as an Arbor as well. """
+    if isinstance(tree, Arbor):
+        return tree.spanning_tree(preserve)
     spanning = DiGraph()
     preserve = set(preserve) # duplicate, will be altered
     if 1 == len(preserve):
@@ -187,15 +205,18 @@ def spanning_tree(tree, preserve):
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
+    if isinstance(tree, Arbor):
+        return tree.cable_length(locations)
     return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
 
 
 def lazy_load_trees(skeleton_ids, node_properties):
-    """ Return a lazy collection of pairs of (long, DiGraph)
+    """ Return a lazy collection of pairs of (long, Arbor)
     representing (skeleton_id, tree).
     The node_properties is a list of strings, each being a name of a column
     in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
+    or skeleton_id. The 'location' property is stored as an array of n x 3
+    floats, all others as lists. """
 
     values_list = ('id', 'parent_id', 'skeleton_id')
     props = tuple(set(node_properties) - set(values_list))
@@ -204,28 +225,28 @@ def lazy_load_trees(skeleton_ids, node_properties):
     ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
             .order_by('skeleton') \
             .values_list(*values_list)
+
+    def make_tree(rows):
+        columns = zip(*rows)
+        properties = {k: list(v) for k, v in izip(props, islice(columns, 3, None))}
+        loc = properties.get('location')
+        if loc:
+            # Hack: why doesn't django parse well the location?
+            properties['location'] = np.array([tuple(imap(float, l[1:-1].split(',')))
+                if isinstance(l, basestring) else (l.x, l.y, l.z) for l in loc],
+                dtype=np.float64)
+        return Arbor(columns[0], columns[1], properties)
+
     skid = None
-    tree = None
+    rows = []
     for t in ts:
         if t[2] != skid:
-            if tree:
-                yield (skid, tree)
+            if rows:
+                yield (skid, make_tree(rows))
             # Prepare for the next one
             skid = t[2]
-            tree = DiGraph()
-
-        props = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-
-        # Hack: why doesn't django parse well the location?
-        loc = props.get('location')
-        if loc:
-            props['location'] = Double3D(*(imap(float, loc[1:-1].split(','))))
-        tree.add_node(t[0], props)
-
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
-
-    if tree:
-        yield (skid, tree)
+            rows = []
+        rows.append(t)
 
+    if rows:
+        yield (skid, make_tree(rows))
@@ -13,6 +13,7 @@ from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control import nodecache, topologycache
 import sys
 import math
 
@@ -70,8 +71,8 @@ def create_treenode(request, project_id=None):
     for p in string_values.keys():
         params[p] = request.POST.get(p, string_values[p])
 
-    relation_map = get_relation_to_id_map(project_id)
-    class_map = get_class_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('model_of',))
+    class_map = get_class_to_id_map(project_id, ('neuron', 'skeleton'))
 
     def insert_new_treenode(parent_id=None, skeleton=None):
         """ If the parent_id is not None and the skeleton_id of the parent does not match with the skeleton.id, then the database will throw an error given that the skeleton_id, being defined as foreign key in the treenode table, will not meet the being-foreign requirement.
@@ -87,6 +88,10 @@ def create_treenode(request, project_id=None):
         if parent_id:
             new_treenode.parent_id = parent_id
         new_treenode.save()
+        nodecache.invalidate_treenodes(project_id, [new_treenode.id])
+        if parent_id:
+            topologycache.append_nodes(skeleton.id,
+                    [(new_treenode.id, parent_id)])
         return new_treenode
 
     def relate_neuron_to_skeleton(neuron, skeleton):
@@ -228,6 +233,8 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
         # Loop the creation of treenodes in z resolution steps until target
         # section is reached
         parent_id = params['parent_id']
+        new_treenode_ids = []
+        new_edges = []
         atn_slice_index = ((parent_z - params['stack_translation_z']) / params['resz']).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_FLOOR)
         for i in range(1, steps + (0 if skip_last else 1)):
             if (atn_slice_index + i * sign) in broken_slices:
@@ -247,7 +254,12 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
             new_treenode.parent_id = parent_id  # This is not a root node.
             new_treenode.save()
 
+            new_edges.append((new_treenode.id, parent_id))
             parent_id = new_treenode.id
+            new_treenode_ids.append(parent_id)
+
+        nodecache.invalidate_treenodes(project_id, new_treenode_ids)
+        topologycache.append_nodes(parent_skeleton_id, new_edges)
 
         # parent_id contains the ID of the last added node
         return parent_id, parent_skeleton_id
@@ -267,6 +279,7 @@ def update_radius(request, project_id=None, treenode_id=None):
     if 0 == option:
         # Update radius only for the treenode
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user, radius=radius)
+        nodecache.invalidate_treenodes(project_id, [treenode_id])
         return HttpResponse(json.dumps({'success': True}))
     
     cursor.execute('''
@@ -287,6 +300,7 @@ def update_radius(request, project_id=None, treenode_id=None):
             c = children[child]
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user, radius=radius)
+        nodecache.invalidate_treenodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
     
     if 2 == option:
@@ -304,6 +318,7 @@ def update_radius(request, project_id=None, treenode_id=None):
             parent = parents[parent]
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user, radius=radius)
+        nodecache.invalidate_treenodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 3 == option:
@@ -317,11 +332,14 @@ def update_radius(request, project_id=None, treenode_id=None):
             parent = parents[parent]
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user, radius=radius)
+        nodecache.invalidate_treenodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 4 == option:
-        # Update radius of all nodes (in a single query)
-        Treenode.objects.filter(skeleton_id=Treenode.objects.filter(pk=treenode_id).values('skeleton_id')).update(editor=request.user, radius=radius)
+        # Update radius of all nodes of the skeleton
+        skeleton_id = Treenode.objects.get(pk=treenode_id).skeleton_id
+        Treenode.objects.filter(skeleton_id=skeleton_id).update(editor=request.user, radius=radius)
+        nodecache.invalidate_skeletons(project_id, [skeleton_id])
         return HttpResponse(json.dumps({'success': True}))
 
 
@@ -338,6 +356,10 @@ def delete_treenode(request, project_id=None):
     treenode = Treenode.objects.get(pk=treenode_id)
     parent_id = treenode.parent_id
 
+    # Invalidate cached node lists that include the treenode, while its
+    # location and links are still known.
+    nodecache.invalidate_treenodes(project_id, [treenode_id])
+
     response_on_error = ''
     try:
         cursor = connection.cursor()
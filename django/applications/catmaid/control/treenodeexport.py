@@ -9,8 +9,7 @@ from django.db.models import Count
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
 from catmaid.control.common import json_error_response, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, process_crop_job
-from catmaid.control.cropping import ImageRetrievalError
+from catmaid.control.cropping import CropJob, extract_windows
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector
 from catmaid.models import Message, User, UserRole, Treenode
 
@@ -20,6 +19,9 @@ import os.path
 import shutil
 import tarfile
 
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
 
 # The path were archive files get stored in
 treenode_output_path = os.path.join(settings.MEDIA_ROOT,
@@ -76,7 +78,8 @@ class TreenodeExporter:
         self.relid_to_rel_folder = {}
 
         # Get relation map
-        self.relation_map = get_relation_to_id_map(job.project_id)
+        self.relation_map = get_relation_to_id_map(job.project_id,
+                ('presynaptic_to', 'postsynaptic_to', 'model_of'))
 
         # Store meta data for each node
         self.metadata = {}
@@ -150,32 +153,77 @@ class TreenodeExporter:
             return Treenode.objects.filter(project_id=self.job.project_id,
                     skeleton_id__in=self.job.skeleton_ids)
 
-    def export_single_node(self, treenode):
-        """ Exports a treenode and expects the output path to be existing
-        and writable.
+    def get_location(self, treenode):
+        """ Returns the location the image window of a node is centered on.
         """
-        # Calculate bounding box for current connector
-        x_min = treenode.location.x - self.job.x_radius
-        x_max = treenode.location.x + self.job.x_radius
-        y_min = treenode.location.y - self.job.y_radius
-        y_max = treenode.location.y + self.job.y_radius
-        z_min = treenode.location.z - self.job.z_radius
-        z_max = treenode.location.z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
+        return treenode.location
 
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
+    def get_output_images(self, treenode, cropped_stack, crop_job, z_min):
+        """ Returns a list of (path, image) tuples with the files the images
+        of a node should be written to. It expects the output path to be
+        existing and writable.
+        """
+        # Save image in output path, named <treenode-id>.tiff. All slices
+        # share this name, the last one is kept.
         output_path = self.create_path(treenode)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named <treenode-id>.tiff
-            image_name = "%s.tiff" % treenode.id
-            treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+        image_name = "%s.tiff" % treenode.id
+        treenode_image_path = os.path.join(output_path, image_name)
+        return [(treenode_image_path, cropped_stack[-1])]
+
+    def export_nodes(self, nodes):
+        """ Exports the image windows of all passed nodes and expects the
+        output path to be existing and writable. Instead of cropping each
+        window separately, the windows are extracted in one batch, which
+        fetches and decodes tiles that are shared by windows only once.
+        Images are written by a pool of TREENODE_EXPORT_WRITE_THREADS threads.
+        Returns a dictionary that maps nodes whose images couldn't be
+        retrieved to their (error, URL) tuple.
+        """
+        windows = []
+        z_mins = []
+        for n, node in enumerate(nodes):
+            location = self.get_location(node)
+            z_min = location.z - self.job.z_radius
+            z_mins.append(z_min)
+            windows.append((n,
+                    location.x - self.job.x_radius,
+                    location.x + self.job.x_radius,
+                    location.y - self.job.y_radius,
+                    location.y + self.job.y_radius,
+                    z_min, location.z + self.job.z_radius))
+        if not windows:
+            return {}
+        rotation_cw = 0
+        zoom_level = 0
+        # Create a single file for each section (instead of a mulipage TIFF).
+        # The bounding box of the job isn't used.
+        crop_job = CropJob(self.job.user, self.job.project_id,
+                self.job.stack_id, 0, 0, 0, 0, 0, 0, rotation_cw, zoom_level,
+                single_channel=True)
+
+        error_urls = {}
+        n_threads = getattr(settings, 'TREENODE_EXPORT_WRITE_THREADS', 4)
+        pool = ThreadPool(n_threads)
+        try:
+            # Don't let written images pile up if writing is slower than
+            # cropping.
+            pending = deque()
+            for n, cropped_stack, error in extract_windows(crop_job, windows):
+                node = nodes[n]
+                if error:
+                    error_urls[node] = (error.error, error.path)
+                    continue
+                for path, img in self.get_output_images(node, cropped_stack,
+                        crop_job, z_mins[n]):
+                    pending.append(pool.apply_async(img.write, (path,)))
+                while len(pending) > 4 * n_threads:
+                    pending.popleft().get()
+            while pending:
+                pending.popleft().get()
+        finally:
+            pool.terminate()
+
+        return error_urls
 
     def post_process(self, nodes):
       """ Create a meta data file for all the nodes passed (usually all of the
@@ -314,38 +362,30 @@ class ConnectorExporter(TreenodeExporter):
 
         return connector_links
 
-    def export_single_node(self, connector_link):
-        """ Exports a single connector and expects the output path to be existing
-        and writable.
+    def get_location(self, connector_link):
+        """ Returns the location of the connector of a link.
         """
-        connector = connector_link.connector
-
-        # Calculate bounding box for current connector
-        x_min = connector.location.x - self.job.x_radius
-        x_max = connector.location.x + self.job.x_radius
-        y_min = connector.location.y - self.job.y_radius
-        y_max = connector.location.y + self.job.y_radius
-        z_min = connector.location.z - self.job.z_radius
-        z_max = connector.location.z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
+        return connector_link.connector.location
 
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
+    def get_output_images(self, connector_link, cropped_stack, crop_job,
+            z_min):
+        """ Returns a list of (path, image) tuples with the files the images
+        of a single connector should be written to. It expects the output
+        path to be existing and writable.
+        """
+        connector = connector_link.connector
         connector_path = self.create_path(connector_link)
+        output_images = []
         for i, img in enumerate(cropped_stack):
             # Save image in output path, named after the image center's coordinates,
             # rounded to full integers.
             x = int(connector.location.x + 0.5)
             y = int(connector.location.y + 0.5)
-            z = int(z_min + i * crop_self.stacks[0].resolution.z  + 0.5)
+            z = int(z_min + i * crop_job.stacks[0].resolution.z  + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
             connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            output_images.append((connector_image_path, img))
+        return output_images
 
     def post_process(self, nodes):
       pass
@@ -356,7 +396,7 @@ def process_export_job(exporter):
     extraction and the creation of all sub-stacks. It can be executed as Celery
     task.
     """
-    nodes = exporter.get_entities_to_export()
+    nodes = list(exporter.get_entities_to_export())
 
     # Abort if there are no nodes to process
     if not nodes:
@@ -371,12 +411,8 @@ def process_export_job(exporter):
     # Store error codes and URLs for unreachable images for each failed link
     error_urls = {}
     try:
-        # Export every node
-        for node in nodes:
-            try:
-                exporter.export_single_node(node)
-            except ImageRetrievalError as e:
-                error_urls[node] = (e.error, e.path)
+        # Export all nodes at once
+        error_urls = exporter.export_nodes(nodes)
         # Create error log, if needed
         if error_urls:
             error_path = os.path.join(exporter.output_path, "error_log.txt")
@@ -9,6 +9,7 @@ from django.db.models import Count
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control import nodecache
 
 
 @requires_user_role(UserRole.Annotate)
@@ -43,6 +44,7 @@ def update_treenode_table(request, project_id=None):
         setattr(treenode, property_name, property_value)
         treenode.user = request.user
         treenode.save()
+        nodecache.invalidate_treenodes(project_id, [treenode_id])
 
         # return HttpResponse(json.dumps({'success': 'Updated %s of treenode %s to %s.' % (property_name, treenode_id, property_value)}))
         return HttpResponse(property_value)
@@ -61,7 +63,7 @@ def list_treenode_table(request, project_id=None):
     filter_nodetype = request.POST.get('sSearch_1', None)
     filter_labels = request.POST.get('sSearch_2', None)
 
-    relation_map = get_relation_to_id_map(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('labeled_as',))
 
     response_on_error = ''
     try:
@@ -9,21 +9,16 @@ from collections import defaultdict, namedtuple
 from itertools import imap
 import json
 from operator import attrgetter
-from networkx import connected_components
 from functools import partial
+import numpy as np
 
 
 def _find_nearest(tree, nodes, loc1):
     """ Returns a tuple of the closest node and the square of the distance. """
-    min_sqdist = float('inf')
-    for node in nodes:
-        loc2 = tree.node[node]['location']
-        dsq = pow(loc1.x - loc2.x, 2) + pow(loc1.y - loc2.y, 2) + pow(loc1.z - loc2.z, 2)
-        if dsq < min_sqdist:
-            min_sqdist = dsq
-            closest = node
-
-    return node, min_sqdist
+    locations = tree.properties['location'][tree.indices(nodes)]
+    sqdists = np.sum(np.square(locations - (loc1.x, loc1.y, loc1.z)), axis=1)
+    i = np.argmin(sqdists)
+    return nodes[i], float(sqdists[i])
 
 def _parse_location(loc):
     return Double3D(*(imap(float, loc[1:-1].split(','))))
@@ -166,10 +161,10 @@ def _evaluate_epochs(epochs, skeleton_id, tree, relations):
                 splits[tree.node[node]['user_id']] += 1
 
             elif 'join_skeleton' == operation_type:
-                edges = tree[node]
-                if edges:
+                parent = tree.parent(node)
+                if parent is not None:
                     # Replace node with its parent
-                    node = edges.iterkeys().next()
+                    node = parent
                 merges[tree.node[node]['user_id']] += 1
 
         # Count nodes created by the reviewer, as well as
@@ -182,17 +177,15 @@ def _evaluate_epochs(epochs, skeleton_id, tree, relations):
         owned = filter(newlyAdded, nodes)
 
         if owned:
-            sub = tree.subgraph(owned)
-            additions = connected_components(sub.to_undirected())
+            additions = tree.components(owned)
             for addition in additions:
                 # Find a node whose parent's creator is not the reviewer, if any
                 # (Could not find any if the reviewer had created that parent node
                 # outside of the review epoch, in which case it does not count
                 # as an error)
                 for node in addition:
-                    edges = tree[node]
-                    if edges:
-                        parent = edges.iterkeys().next()
+                    parent = tree.parent(node)
+                    if parent is not None:
                         creator_id = tree.node[parent]['user_id']
                         if creator_id != reviewer_id:
                             appended[creator_id].append(len(addition))
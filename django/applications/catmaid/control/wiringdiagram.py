@@ -1,56 +1,37 @@
 import json
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import connection
 from django.db.models import Count
 
 from catmaid.models import *
 from catmaid.control.authentication import *
+from catmaid.control.common import stream_rows, chunked
 
 
 def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
 
-    # result dictionary: {connectorid: presyn_skeletonid}
-    tmp={}
-    result={}
-    # get the presynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'presynaptic_to'
-    )
-    for e in qs:
-        if not e.connector_id in tmp:
-            tmp[e.connector_id]=e.skeleton_id
-            result[e.skeleton_id]={}
-        else:
-            # connector with multiple presynaptic connections
-            pass
-
     skeletons={}
     qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
     for e in qs:
         skeletons[ e['skeleton'] ]=e['skeleton__count']
 
-    # get the postsynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'postsynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id in tmp:
-
-            # limit the skeletons to include
-            if skeletons[ tmp[e.connector_id] ] < lower_treenode_number_limit or\
-               skeletons[ e.skeleton_id ] < lower_treenode_number_limit:
-                continue
-
-            # an existing connector, so we add a connection
-            if e.skeleton_id in result[tmp[e.connector_id]]:
-                result[tmp[e.connector_id]][e.skeleton_id] += 1
-            else:
-                result[tmp[e.connector_id]][e.skeleton_id] = 1
-        else:
-            # connector with only postsynaptic connections
-            pass
+    # result dictionary: {presyn_skeletonid: {postsyn_skeletonid: number of synapses}}
+    result={}
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT pre_skeleton_id, post_skeleton_id, count
+    FROM skeleton_connectivity
+    WHERE project_id = %s
+    ''', (int(project_id),))
+    for pre, post, count in cursor.fetchall():
+
+        # limit the skeletons to include
+        if skeletons[ pre ] < lower_treenode_number_limit or\
+           skeletons[ post ] < lower_treenode_number_limit:
+            continue
+
+        result.setdefault(pre, {})[post] = count
 
     nodes_tmp={}
     edges=[]
@@ -104,15 +85,45 @@ def export_wiring_diagram_nx(request, project_id=None):
     return HttpResponse(json_return, mimetype='text/json')
 
 
-@requires_user_role([UserRole.Annotate, UserRole.Browse])
-def export_wiring_diagram(request, project_id=None):
-
-    if request.POST.has_key('lower_skeleton_count'):
-        lower_treenode_number_limit=request.POST['lower_skeleton_count']
-    else:
-        lower_treenode_number_limit=0
-
-    nodes_and_edges=get_wiring_diagram(project_id, lower_treenode_number_limit)
+# Edges between skeletons with at least %(limit)s nodes, along with the node
+# counts of both skeletons
+_WIRING_DIAGRAM_EDGES = '''
+    WITH node_counts AS (
+        SELECT skeleton_id, count(*) AS node_count
+        FROM treenode
+        WHERE project_id = %(project_id)s
+        GROUP BY skeleton_id),
+    edges AS (
+        SELECT sc.pre_skeleton_id, sc.post_skeleton_id, sc.count,
+               pre.node_count AS pre_node_count,
+               post.node_count AS post_node_count
+        FROM skeleton_connectivity sc
+        JOIN node_counts pre ON pre.skeleton_id = sc.pre_skeleton_id
+        JOIN node_counts post ON post.skeleton_id = sc.post_skeleton_id
+        WHERE sc.project_id = %(project_id)s
+          AND pre.node_count >= %(limit)s
+          AND post.node_count >= %(limit)s)
+'''
+
+def _wiring_diagram_params(request, project_id):
+    return {'project_id': int(project_id),
+            'limit': int(request.POST.get('lower_skeleton_count', 0))}
+
+def _wiring_diagram_json(params):
+    """ Yields the wiring diagram as JSON, with the same content as
+    get_wiring_diagram: the nodes, i.e. all skeletons that are part of an
+    edge, and then the edges. """
+    rows = stream_rows(_WIRING_DIAGRAM_EDGES + '''
+        SELECT 0, skeleton_id, NULL, node_count
+        FROM node_counts
+        WHERE skeleton_id IN (SELECT pre_skeleton_id FROM edges
+                              UNION
+                              SELECT post_skeleton_id FROM edges)
+        UNION ALL
+        SELECT 1, pre_skeleton_id, post_skeleton_id, count
+        FROM edges
+        ORDER BY 1
+        ''', params)
 
     nodesDataSchema=[
             {'name':'id','type':'string'},
@@ -125,10 +136,57 @@ def export_wiring_diagram(request, project_id=None):
             {'name': "directed", "type": "boolean", "defValue": True}
     ]
 
-    data={
-        'dataSchema':{'nodes':nodesDataSchema,'edges':edgesDataSchema},
-        'data':{'nodes':nodes_and_edges['nodes'],'edges':nodes_and_edges['edges']}
-    }
+    yield '{"dataSchema": %s, "data": {"nodes": [' % json.dumps(
+            {'nodes': nodesDataSchema, 'edges': edgesDataSchema})
+    separator = ''
+    in_edges = False
+    for kind, skeleton_id, partner_id, count in rows:
+        if 1 == kind and not in_edges:
+            yield '], "edges": ['
+            separator = ''
+            in_edges = True
+        if in_edges:
+            entry = {"id": "%s_%s" % (skeleton_id, partner_id),
+                     "source": str(skeleton_id),
+                     "target": str(partner_id),
+                     "number_of_connector": count}
+        else:
+            entry = {"id": str(skeleton_id),
+                     "label": "Skeleton %s" % skeleton_id,
+                     "node_count": count}
+        yield separator + json.dumps(entry)
+        separator = ','
+    if not in_edges:
+        yield '], "edges": ['
+    yield ']}}'
+
+def _wiring_diagram_csv(params):
+    """ Yields the edges of the wiring diagram as CSV, one line per pair of
+    connected skeletons along with their node counts. """
+    yield 'pre_skeleton_id,post_skeleton_id,number_of_connector,' \
+            'pre_node_count,post_node_count\n'
+    rows = stream_rows(_WIRING_DIAGRAM_EDGES + '''
+        SELECT pre_skeleton_id, post_skeleton_id, count,
+               pre_node_count, post_node_count
+        FROM edges
+        ''', params)
+    for row in rows:
+        yield '%s,%s,%s,%s,%s\n' % row
 
-    json_return = json.dumps(data, sort_keys=True, indent=4)
-    return HttpResponse(json_return, mimetype='text/json')
\ No newline at end of file
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def export_wiring_diagram(request, project_id=None):
+    """ Streams the wiring diagram of the whole project as JSON, without
+    holding it in memory. """
+    params = _wiring_diagram_params(request, project_id)
+    return StreamingHttpResponse(chunked(_wiring_diagram_json(params)),
+            content_type='text/json')
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def export_wiring_diagram_csv(request, project_id=None):
+    """ Streams the edges of the wiring diagram of the whole project as CSV,
+    without holding them in memory. """
+    params = _wiring_diagram_params(request, project_id)
+    response = StreamingHttpResponse(chunked(_wiring_diagram_csv(params)),
+            content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="wiring-diagram-%s.csv"' % params['project_id']
+    return response
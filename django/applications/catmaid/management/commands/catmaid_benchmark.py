@@ -0,0 +1,124 @@
+import json
+import os
+import platform
+import subprocess
+import time
+
+import django
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand, CommandError
+
+from optparse import make_option
+
+from catmaid.benchmark import scenarios
+from catmaid.benchmark.generator import generate_connectome
+from catmaid.models import Project
+
+def _revision():
+    """ Returns the git revision of the CATMAID source tree, if available. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(__file__),
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Command(NoArgsCommand):
+    help = "Run benchmark scenarios of the most important requests on a " \
+            "synthetic connectome and write the results as JSON"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id', type='int',
+            help='Run the scenarios on the data of this project instead ' \
+                    'of generating a new one'),
+        make_option('--user', dest='user_id', type='int',
+            help='The ID of the user who owns the generated data and runs ' \
+                    'the scenarios (defaults to the first super user)'),
+        make_option('--neurons', dest='neurons', default=100, type='int',
+            help='The number of neurons to generate'),
+        make_option('--nodes', dest='nodes', default=5000, type='int',
+            help='The number of nodes of each generated neuron'),
+        make_option('--synapses', dest='synapses', default=200, type='int',
+            help='The number of presynaptic sites of each generated neuron'),
+        make_option('--seed', dest='seed', default=0, type='int',
+            help='The seed of the generated data and the scenario inputs'),
+        make_option('--repeat', dest='repeat', default=5, type='int',
+            help='The number of timed runs of each scenario'),
+        make_option('--scenarios', dest='scenarios', default=None,
+            help='A comma separated list of the scenarios to run, out of: ' + \
+                    ', '.join(name for name, s in scenarios.SCENARIOS)),
+        make_option('--output', dest='output', default=None,
+            help='Write the results as JSON to this file'),
+        )
+
+    def handle_noargs(self, **options):
+        if options['repeat'] < 1:
+            raise CommandError("At least one run per scenario is needed")
+        names = None
+        if options['scenarios']:
+            names = options['scenarios'].split(',')
+            known = set(name for name, s in scenarios.SCENARIOS)
+            unknown = [name for name in names if name not in known]
+            if unknown:
+                raise CommandError("Unknown scenarios: %s" % ', '.join(unknown))
+        if options['user_id']:
+            user = User.objects.get(pk=options['user_id'])
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('id')[0]
+        seed = options['seed']
+
+        dataset = None
+        project_id = options['project_id']
+        if not project_id:
+            project = Project.objects.create(title='Benchmark %s x %s ' \
+                    'nodes (seed %s)' % (options['neurons'], options['nodes'],
+                    seed), public=False)
+            project_id = project.id
+            self.stdout.write("Generating %s neurons with %s nodes each in " \
+                    "project %s" % (options['neurons'], options['nodes'],
+                    project_id))
+            start = time.time()
+            dataset = generate_connectome(project_id, user,
+                    options['neurons'], options['nodes'], seed,
+                    options['synapses'])
+            del dataset['skeleton_ids']
+            dataset['seconds'] = time.time() - start
+            self.stdout.write("Generated in %.1f s" % dataset['seconds'])
+
+        context = scenarios.BenchmarkContext(project_id, user)
+        results = scenarios.run(context, names, options['repeat'], seed)
+
+        for name, s in scenarios.SCENARIOS:
+            if name in results:
+                r = results[name]
+                self.stdout.write("%-30s min %9.1f ms  median %9.1f ms  " \
+                        "%10d bytes" % (name, 1000 * r['min'],
+                        1000 * r['median'], r['response_size']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'time': time.time(),
+                    'revision': _revision(),
+                    'environment': {
+                        'python': platform.python_version(),
+                        'django': django.get_version(),
+                        'platform': platform.platform(),
+                        'database': settings.DATABASES['default']['ENGINE'],
+                    },
+                    'parameters': {
+                        'project_id': project_id,
+                        'seed': seed,
+                        'repeat': options['repeat'],
+                    },
+                    'generated': dataset,
+                    'dataset': {
+                        'skeletons': len(context.skeletons),
+                        'nodes': sum(row[1] for row in context.skeletons),
+                        'annotations': len(context.annotation_ids),
+                    },
+                    'scenarios': results,
+                }, f, indent=1, sort_keys=True)
+            self.stdout.write("Results written to %s" % options['output'])
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from optparse import make_option
+
+from catmaid.benchmark.generator import synthetic_arbors
+from catmaid.control import arbor
+
+class Command(NoArgsCommand):
+    help = "Measure the throughput of skeleton measurements on synthetic " \
+            "skeletons"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--skeletons', dest='skeletons', default=1000, type='int',
+            help='The number of skeletons to measure'),
+        make_option('--nodes', dest='nodes', default=10000, type='int',
+            help='The number of nodes of each skeleton'),
+        make_option('--batch', dest='batch', default=100, type='int',
+            help='The number of skeletons measured in one pass'),
+        )
+
+    def handle_noargs(self, **options):
+        n_skeletons, n_nodes = options['skeletons'], options['nodes']
+        batch = min(options['batch'], n_skeletons)
+        seconds = 0
+        for first in xrange(0, n_skeletons, batch):
+            size = min(batch, n_skeletons - first)
+            arrays = synthetic_arbors(size, n_nodes, first + 1)
+            start = time.time()
+            arbor.measure(*arrays)
+            seconds += time.time() - start
+        n_total = n_skeletons * n_nodes
+        self.stdout.write("Measured %s skeletons with %s nodes each in "
+                "%.2f s: %.0f skeletons/s, %.0f nodes/s" % (n_skeletons,
+                n_nodes, seconds, n_skeletons / seconds, n_total / seconds))
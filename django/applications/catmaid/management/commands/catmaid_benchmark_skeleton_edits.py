@@ -0,0 +1,122 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+
+from optparse import make_option
+
+from catmaid.benchmark.generator import synthetic_arbors
+from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
+from catmaid.control.skeleton import _join_skeleton, _reroot_skeleton, \
+        split_skeleton
+from catmaid.models import ClassInstance, ClassInstanceClassInstance
+
+def create_synthetic_skeleton(project_id, user, n_nodes):
+    """ Creates a neuron with a random skeleton of n_nodes nodes in the
+    database. Returns the skeleton ID and the lists of treenode IDs and parent
+    IDs (None for the root), which are ordered so that parents come before
+    their children. """
+    classes = get_class_to_id_map(project_id, ('skeleton', 'neuron'))
+    relations = get_relation_to_id_map(project_id, ('model_of',))
+    skeleton = ClassInstance.objects.create(user=user, project_id=project_id,
+            class_column_id=classes['skeleton'], name='Benchmark skeleton')
+    neuron = ClassInstance.objects.create(user=user, project_id=project_id,
+            class_column_id=classes['neuron'], name='Benchmark neuron')
+    ClassInstanceClassInstance.objects.create(user=user,
+            project_id=project_id, relation_id=relations['model_of'],
+            class_instance_a=skeleton, class_instance_b=neuron)
+
+    ids, parents, skeleton_ids, positions = synthetic_arbors(1, n_nodes)
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT nextval('concept_id_seq') FROM generate_series(1, %s)
+    ''', (n_nodes,))
+    node_ids = [row[0] for row in cursor.fetchall()]
+    # synthetic_arbors numbers nodes from 1 and marks the root with -1
+    parent_ids = [node_ids[p - 1] if p > 0 else None for p in parents]
+    cursor.execute('''
+    INSERT INTO treenode (id, project_id, user_id, editor_id, location,
+        parent_id, skeleton_id, radius, confidence)
+    SELECT id, %s, %s, %s, ROW(x, y, z)::double3d, parent_id, %s, -1, 5
+    FROM (SELECT unnest(%s::bigint[]) AS id,
+                 unnest(%s::bigint[]) AS parent_id,
+                 unnest(%s::float8[]) AS x,
+                 unnest(%s::float8[]) AS y,
+                 unnest(%s::float8[]) AS z) nodes
+    ''', (project_id, user.id, user.id, skeleton.id, node_ids, parent_ids,
+          positions[:, 0].tolist(), positions[:, 1].tolist(),
+          positions[:, 2].tolist()))
+    return skeleton.id, node_ids, parent_ids
+
+def path_to_deepest_leaf(node_ids, parent_ids):
+    """ Returns the node IDs from the root to the node farthest from it. """
+    parents = dict(zip(node_ids, parent_ids))
+    depths = {}
+    for node_id, parent_id in zip(node_ids, parent_ids):
+        depths[node_id] = 0 if parent_id is None else depths[parent_id] + 1
+    node_id = max(depths, key=depths.get)
+    path = []
+    while node_id is not None:
+        path.append(node_id)
+        node_id = parents[node_id]
+    path.reverse()
+    return path
+
+class Command(NoArgsCommand):
+    help = "Measure the time to reroot, split and join a synthetic skeleton. " \
+            "All changes are rolled back afterwards."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id', type='int',
+            help='The ID of a project that is set up for tracing'),
+        make_option('--user', dest='user_id', type='int',
+            help='The ID of the user who edits the skeleton (defaults to ' \
+                    'the first super user)'),
+        make_option('--nodes', dest='nodes', default=100000, type='int',
+            help='The number of nodes of the skeleton'),
+        )
+
+    def handle_noargs(self, **options):
+        project_id = options['project_id']
+        if not project_id:
+            raise CommandError("A project ID is needed (--project)")
+        if options['user_id']:
+            user = User.objects.get(pk=options['user_id'])
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('id')[0]
+        n_nodes = options['nodes']
+
+        with transaction.atomic():
+            start = time.time()
+            skeleton_id, node_ids, parent_ids = create_synthetic_skeleton(
+                    project_id, user, n_nodes)
+            path = path_to_deepest_leaf(node_ids, parent_ids)
+            self.report("Create skeleton", start, n_nodes)
+
+            # Reroot at the deepest leaf, which reverses the longest path
+            start = time.time()
+            _reroot_skeleton(path[-1], project_id)
+            self.report("Reroot", start, len(path))
+
+            # Split in the middle of the reversed path: the former root ends
+            # up in the new skeleton.
+            split_node_id = path[len(path) / 2]
+            request = RequestFactory().post('/', {'treenode_id': split_node_id})
+            request.user = user
+            start = time.time()
+            split_skeleton(request, project_id=project_id)
+            self.report("Split", start, n_nodes)
+
+            # Join the new skeleton at its former root, which has to be
+            # rerooted first.
+            start = time.time()
+            _join_skeleton(user, path[-1], path[0], project_id, frozenset())
+            self.report("Join", start, n_nodes)
+
+            transaction.set_rollback(True)
+
+    def report(self, operation, start, n_nodes):
+        self.stdout.write("%s (%s nodes): %.3f s" % (operation, n_nodes,
+                time.time() - start))
@@ -0,0 +1,81 @@
+import json
+import random
+import timeit
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from optparse import make_option
+
+from catmaid.control import binaryformat
+from catmaid.control.skeletonexport import _skeleton_for_3d_viewer
+
+# Column definitions of the skeleton nodes as they are sent to the 3D viewer
+NODE_COLUMNS = (
+    ('id', binaryformat.INT),
+    ('parent_id', binaryformat.INT),
+    ('user_id', binaryformat.INT),
+    ('reviewer_id', binaryformat.INT),
+    ('x', binaryformat.FLOAT64),
+    ('y', binaryformat.FLOAT64),
+    ('z', binaryformat.FLOAT64),
+    ('radius', binaryformat.FLOAT32),
+    ('confidence', binaryformat.INT))
+
+def synthetic_nodes(n_nodes):
+    """ Creates rows like the ones of a skeleton with n_nodes nodes and random
+    locations and branches. """
+    nodes = []
+    first_id = 10000000
+    x, y, z = 100000.0, 100000.0, 1000.0
+    for i in xrange(n_nodes):
+        node_id = first_id + i
+        if 0 == i:
+            parent_id = None
+        elif random.random() < 0.05:
+            parent_id = random.randint(first_id, node_id - 1)
+        else:
+            parent_id = node_id - 1
+        x += random.uniform(-40.0, 40.0)
+        y += random.uniform(-40.0, 40.0)
+        z += random.choice((-50.0, 0.0, 50.0))
+        nodes.append((node_id, parent_id, random.randint(1, 20), -1,
+            x, y, z, -1.0, 5))
+    return nodes
+
+class Command(NoArgsCommand):
+    help = "Compare encoding time and size of the JSON and the binary " \
+            "response format for skeleton nodes"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--nodes', dest='nodes', default=100000, type='int',
+            help='The number of nodes of the synthetic skeleton'),
+        make_option('--skeleton', dest='skeleton', default=None,
+            help='Use the nodes of this skeleton instead of synthetic ones'),
+        make_option('--project', dest='project', default=None,
+            help='The project of the skeleton given with --skeleton'),
+        make_option('--repeat', dest='repeat', default=5, type='int',
+            help='The number of times each encoding is repeated'),
+        )
+
+    def handle_noargs(self, **options):
+        if options['skeleton']:
+            if not options['project']:
+                raise CommandError("Please specify the project of the skeleton")
+            nodes = _skeleton_for_3d_viewer(options['skeleton'],
+                    options['project'], lean=1)[1]
+        else:
+            nodes = synthetic_nodes(options['nodes'])
+
+        def encode_json():
+            return json.dumps(nodes, separators=(',', ':'))
+
+        def encode_binary():
+            return binaryformat.encode((('nodes', nodes, NODE_COLUMNS),))
+
+        repeat = options['repeat']
+        self.stdout.write("Encoding %s nodes, best of %s runs" % (len(nodes),
+                repeat))
+        for name, encode in (('json', encode_json), ('binary', encode_binary)):
+            seconds = min(timeit.repeat(encode, number=1, repeat=repeat))
+            self.stdout.write("%-8s %10.2f ms %12d bytes" % (name,
+                    seconds * 1000, len(encode())))
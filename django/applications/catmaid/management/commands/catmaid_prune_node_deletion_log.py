@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+class Command(NoArgsCommand):
+    help = "Remove entries from the node deletion log that are too old to " \
+            "be requested as changes by clients"
+
+    def handle_noargs(self, **options):
+        max_age = getattr(settings, 'NODE_LIST_CHANGES_MAX_AGE', 3600)
+        cursor = connection.cursor()
+        cursor.execute('''
+        DELETE FROM node_deletion_log
+        WHERE deletion_time < now() - %s * interval '1 second'
+        ''', (max_age,))
+        self.stdout.write("Removed %s log entries" % cursor.rowcount)
@@ -0,0 +1,30 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+class Command(NoArgsCommand):
+    help = "Recompute the skeleton_connectivity table from treenode_connector, " \
+            "e.g. after links have been changed with triggers disabled"
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute('LOCK TABLE treenode_connector IN SHARE MODE')
+            cursor.execute('DELETE FROM skeleton_connectivity')
+            cursor.execute('''
+            INSERT INTO skeleton_connectivity (project_id, pre_skeleton_id,
+                post_skeleton_id, count)
+            SELECT tc1.project_id, tc1.skeleton_id, tc2.skeleton_id, count(*)
+            FROM treenode_connector tc1,
+                 treenode_connector tc2,
+                 relation r1,
+                 relation r2
+            WHERE tc1.connector_id = tc2.connector_id
+              AND tc1.skeleton_id IS NOT NULL
+              AND tc2.skeleton_id IS NOT NULL
+              AND tc1.relation_id = r1.id
+              AND r1.relation_name = 'presynaptic_to'
+              AND tc2.relation_id = r2.id
+              AND r2.relation_name = 'postsynaptic_to'
+            GROUP BY tc1.project_id, tc1.skeleton_id, tc2.skeleton_id
+            ''')
+        self.stdout.write("Stored %s skeleton pairs" % cursor.rowcount)
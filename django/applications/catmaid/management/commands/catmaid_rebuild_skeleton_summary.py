@@ -0,0 +1,84 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+class Command(NoArgsCommand):
+    help = "Recompute the skeleton_summary and skeleton_review_summary tables " \
+            "from treenode and treenode_connector, e.g. after nodes or links " \
+            "have been changed with triggers disabled"
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute('LOCK TABLE treenode, treenode_connector IN SHARE MODE')
+            # The summaries are computed into a temporary table first, so
+            # that existing rows can be updated in place: their topology
+            # revisions have to keep increasing, otherwise cached topologies
+            # would be valid again after a number of further changes.
+            cursor.execute('''
+            CREATE TEMPORARY TABLE new_skeleton_summary ON COMMIT DROP AS
+            WITH nodes AS (
+                SELECT t.skeleton_id, min(t.project_id) AS project_id,
+                       count(*) AS num_nodes,
+                       sum(CASE WHEN p.id IS NULL THEN 0 ELSE
+                               sqrt(((t.location).x - (p.location).x) ^ 2
+                                  + ((t.location).y - (p.location).y) ^ 2
+                                  + ((t.location).z - (p.location).z) ^ 2)
+                           END) AS cable_length
+                FROM treenode t
+                LEFT OUTER JOIN treenode p ON p.id = t.parent_id
+                WHERE t.skeleton_id IS NOT NULL
+                GROUP BY t.skeleton_id),
+            links AS (
+                SELECT tc.skeleton_id, min(tc.project_id) AS project_id,
+                       sum(CASE WHEN r.relation_name = 'presynaptic_to'
+                           THEN 1 ELSE 0 END) AS num_presynaptic,
+                       sum(CASE WHEN r.relation_name = 'postsynaptic_to'
+                           THEN 1 ELSE 0 END) AS num_postsynaptic
+                FROM treenode_connector tc, relation r
+                WHERE tc.relation_id = r.id
+                  AND tc.skeleton_id IS NOT NULL
+                  AND r.relation_name IN ('presynaptic_to', 'postsynaptic_to')
+                GROUP BY tc.skeleton_id)
+            SELECT coalesce(n.skeleton_id, l.skeleton_id) AS skeleton_id,
+                   coalesce(n.project_id, l.project_id) AS project_id,
+                   coalesce(n.num_nodes, 0) AS num_nodes,
+                   coalesce(n.cable_length, 0) AS cable_length,
+                   coalesce(l.num_presynaptic, 0) AS num_presynaptic,
+                   coalesce(l.num_postsynaptic, 0) AS num_postsynaptic
+            FROM nodes n
+            FULL OUTER JOIN links l ON l.skeleton_id = n.skeleton_id''')
+            cursor.execute('''
+            DELETE FROM skeleton_summary s
+            WHERE NOT EXISTS (SELECT 1 FROM new_skeleton_summary n
+                              WHERE n.skeleton_id = s.skeleton_id)''')
+            # The structure of skeletons may have changed without their
+            # revision being incremented.
+            cursor.execute('''
+            UPDATE skeleton_summary s
+            SET project_id = n.project_id,
+                num_nodes = n.num_nodes,
+                cable_length = n.cable_length,
+                num_presynaptic = n.num_presynaptic,
+                num_postsynaptic = n.num_postsynaptic,
+                topology_revision = s.topology_revision + 1
+            FROM new_skeleton_summary n
+            WHERE n.skeleton_id = s.skeleton_id''')
+            cursor.execute('''
+            INSERT INTO skeleton_summary (skeleton_id, project_id, num_nodes,
+                cable_length, num_presynaptic, num_postsynaptic)
+            SELECT skeleton_id, project_id, num_nodes, cable_length,
+                   num_presynaptic, num_postsynaptic
+            FROM new_skeleton_summary n
+            WHERE NOT EXISTS (SELECT 1 FROM skeleton_summary s
+                              WHERE s.skeleton_id = n.skeleton_id)''')
+            cursor.execute('SELECT count(*) FROM new_skeleton_summary')
+            n_skeletons = cursor.fetchone()[0]
+            cursor.execute('DELETE FROM skeleton_review_summary')
+            cursor.execute('''
+            INSERT INTO skeleton_review_summary (skeleton_id, reviewer_id,
+                num_nodes)
+            SELECT skeleton_id, reviewer_id, count(*)
+            FROM treenode
+            WHERE skeleton_id IS NOT NULL
+            GROUP BY skeleton_id, reviewer_id''')
+        self.stdout.write("Stored summaries of %s skeletons" % n_skeletons)
@@ -0,0 +1,208 @@
+import glob
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from optparse import make_option
+
+# The libuuid import is a workaround for a bug with GraphicsMagick
+# which expects the library to be loaded already. Therefore, it
+# has to be loaded before pgmagick.
+import libuuid
+from pgmagick import Blob, Geometry, Image
+
+# The number of rows of a zoom level that are downsampled at once
+_BAND_HEIGHT = 512
+
+def tile_path(output_path, tile_source_type, z, zoom_level, row, col,
+        file_extension):
+    """ Returns the path of a tile in the layout of the given tile source
+    type, like CropJob.get_tile_path_*. """
+    if tile_source_type == 1:
+        return os.path.join(output_path, str(z), "%s_%s_%s.%s" % (row, col,
+                zoom_level, file_extension))
+    elif tile_source_type == 4:
+        return os.path.join(output_path, str(z), str(zoom_level),
+                "%s_%s.%s" % (row, col, file_extension))
+    elif tile_source_type == 5:
+        return os.path.join(output_path, str(zoom_level), str(z), str(row),
+                "%s.%s" % (col, file_extension))
+    raise ValueError("Tile source type %s is not supported" % tile_source_type)
+
+def overview_path(output_path, tile_source_type, z, file_extension):
+    """ Returns the path of the overview thumbnail of a section. """
+    if tile_source_type == 5:
+        return os.path.join(output_path, "small", "%s.%s" % (z,
+                file_extension))
+    return os.path.join(output_path, str(z), "small.%s" % file_extension)
+
+def read_section(path, color):
+    """ Reads an image as rows x columns array of 8 bit gray values or, if
+    color is true, as rows x columns x 3 array of RGB values. """
+    image = Image(path)
+    blob = Blob()
+    image.write(blob, "RGB" if color else "GRAY", 8)
+    size = image.size()
+    shape = (size.height(), size.width())
+    if color:
+        shape += (3,)
+    return np.frombuffer(blob.data, dtype=np.uint8).reshape(shape)
+
+def array_image(samples):
+    """ Creates a pgmagick image from an array of 8 bit gray or RGB values. """
+    magick = "GRAY" if samples.ndim == 2 else "RGB"
+    return Image(Blob(np.ascontiguousarray(samples).tostring()),
+            Geometry(samples.shape[1], samples.shape[0]), 8, magick)
+
+def downsample(level):
+    """ Returns the next zoom level of a level, with half its width and
+    height. Each pixel is the mean of a 2 x 2 box, an odd last row or column
+    is dropped. Rows are processed in bands to limit the memory needed. """
+    height, width = level.shape[0] / 2, level.shape[1] / 2
+    result = np.empty((height, width) + level.shape[2:], dtype=np.uint8)
+    for top in xrange(0, height, _BAND_HEIGHT):
+        bottom = min(top + _BAND_HEIGHT, height)
+        band = level[2 * top:2 * bottom, :2 * width].astype(np.uint16)
+        result[top:bottom] = (band[0::2, 0::2] + band[1::2, 0::2] +
+                band[0::2, 1::2] + band[1::2, 1::2] + 2) / 4
+    return result
+
+def write_image(image, path, quality):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(directory):
+                raise
+    image.quality(quality)
+    image.write(str(path))
+
+def tile_section(task):
+    """ Reads a section and writes the tiles of all its zoom levels and its
+    overview thumbnail. Only the current zoom level is kept in memory, each
+    level is computed from the previous one. Tiles at the right and bottom
+    border are filled up with black. Returns the section number and the
+    number of zoom levels. """
+    (path, z, output_path, tile_source_type, tile_size, file_extension,
+            quality, thumbnail_size, color) = task
+    level = read_section(path, color)
+    zoom_level = 0
+    thumbnail_source = level
+    while True:
+        height, width = level.shape[:2]
+        for row in xrange((height + tile_size - 1) / tile_size):
+            for col in xrange((width + tile_size - 1) / tile_size):
+                samples = level[row * tile_size:(row + 1) * tile_size,
+                        col * tile_size:(col + 1) * tile_size]
+                if samples.shape[:2] != (tile_size, tile_size):
+                    tile = np.zeros((tile_size, tile_size) + level.shape[2:],
+                            dtype=np.uint8)
+                    tile[:samples.shape[0], :samples.shape[1]] = samples
+                    samples = tile
+                write_image(array_image(samples), tile_path(output_path,
+                        tile_source_type, z, zoom_level, row, col,
+                        file_extension), quality)
+        # The last level fits into a single tile
+        if (width <= tile_size and height <= tile_size) or \
+                width < 2 or height < 2:
+            break
+        level = downsample(level)
+        zoom_level += 1
+        # The thumbnail is created from the smallest level that is still
+        # larger than the thumbnail.
+        if max(level.shape[:2]) >= thumbnail_size:
+            thumbnail_source = level
+
+    if thumbnail_size > 0:
+        thumbnail = array_image(thumbnail_source)
+        thumbnail.scale("%sx%s" % (thumbnail_size, thumbnail_size))
+        write_image(thumbnail, overview_path(output_path, tile_source_type,
+                z, file_extension), quality)
+
+    return z, zoom_level + 1
+
+class Command(NoArgsCommand):
+    help = "Create the tiles of all zoom levels of a stack of section " \
+            "images. Sections are tiled in parallel by a pool of processes."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--input', dest='input', default=None,
+            help='A file name pattern of the section images, e.g. ' \
+                    '"sections/*.tif". Sections are numbered in the order ' \
+                    'of their file names.'),
+        make_option('--output', dest='output', default='.',
+            help='The folder to write tiles to (the image base of the stack)'),
+        make_option('--tile-source-type', dest='tile_source_type', default=1,
+            type='int', help='The tile layout: tile source type 1, 4 or 5'),
+        make_option('--tile-size', dest='tile_size', default=256, type='int',
+            help='The width and height of tiles'),
+        make_option('--file-extension', dest='file_extension', default='jpg',
+            help='The file extension and format of tiles'),
+        make_option('--quality', dest='quality', default=75, type='int',
+            help='The compression quality of tiles (for JPEG)'),
+        make_option('--thumbnail-size', dest='thumbnail_size', default=192,
+            type='int', help='The size of the overview thumbnail of each ' \
+                    'section, 0 for none'),
+        make_option('--color', dest='color', default=False,
+            action='store_true',
+            help='Keep the colors of the sections instead of using gray values'),
+        make_option('--first-section', dest='first_section', default=0,
+            type='int', help='The number of the first section'),
+        make_option('--processes', dest='processes', default=None,
+            type='int', help='The number of sections tiled in parallel ' \
+                    '(defaults to the number of CPUs)'),
+        )
+
+    def handle_noargs(self, **options):
+        if not options['input']:
+            raise CommandError("A file name pattern of the sections is " \
+                    "needed (--input)")
+        paths = sorted(glob.glob(options['input']))
+        if not paths:
+            raise CommandError("No files match %s" % options['input'])
+        tile_source_type = options['tile_source_type']
+        if tile_source_type not in (1, 4, 5):
+            raise CommandError("Only tile source types 1, 4 and 5 are " \
+                    "supported")
+        if options['tile_size'] < 1:
+            raise CommandError("The tile size has to be positive")
+        processes = options['processes'] or multiprocessing.cpu_count()
+
+        tasks = [(path, options['first_section'] + i, options['output'],
+                tile_source_type, options['tile_size'],
+                options['file_extension'], options['quality'],
+                options['thumbnail_size'], options['color'])
+                for i, path in enumerate(paths)]
+
+        start = time.time()
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.imap_unordered(tile_section, tasks)
+                zoom_levels = self.report(results, len(tasks))
+                pool.close()
+            finally:
+                pool.terminate()
+        else:
+            zoom_levels = self.report((tile_section(t) for t in tasks),
+                    len(tasks))
+
+        self.stdout.write("Tiled %s sections in %.1f s, they have %s zoom " \
+                "levels" % (len(tasks), time.time() - start,
+                " or ".join(str(n) for n in sorted(zoom_levels))))
+
+    def report(self, results, n_sections):
+        """ Reports the progress of finished sections and returns the set of
+        their numbers of zoom levels. """
+        zoom_levels = set()
+        for i, (z, n_zoom_levels) in enumerate(results):
+            zoom_levels.add(n_zoom_levels)
+            self.stdout.write("Section %s done (%s of %s)" % (z, i + 1,
+                    n_sections))
+        return zoom_levels
@@ -1,10 +1,16 @@
 import json
+import time
 
 from django.http import HttpResponse
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db import connections
 from traceback import format_exc
 
+from catmaid.control import profiling
+from catmaid.control.authentication import reset_permission_query_count, \
+        get_permission_query_count
+
 class AnonymousAuthenticationMiddleware(object):
     """ This middleware class tests whether the current user is the
     anonymous user. If so, it replaces the request.user object with
@@ -18,6 +24,73 @@ class AnonymousAuthenticationMiddleware(object):
             request.user.is_authenticated = lambda: False
         return None
 
+class PermissionQueryCountMiddleware(object):
+    """ This middleware class reports the number of permission lookups
+    (project permissions and user domains) that couldn't be answered from the
+    permission cache and had to query the database while handling a request.
+    The number is sent in the X-Permission-Queries response header. It isn't
+    enabled by default, but can be added to MIDDLEWARE_CLASSES for testing.
+    """
+    def process_request(self, request):
+        reset_permission_query_count()
+        return None
+
+    def process_response(self, request, response):
+        response['X-Permission-Queries'] = str(get_permission_query_count())
+        return response
+
+class ProfilingMiddleware(object):
+    """ This middleware class measures, for each request, the number of SQL
+    queries, the time spent in the database, the time spent serializing JSON,
+    the remaining Python time and the size of the response. Measurements are
+    aggregated per view function by catmaid.control.profiling. Queries are
+    timed by Django's debug cursor, which is switched on for the duration of
+    the request. To include the work of all other middleware, this class
+    should be the first one in MIDDLEWARE_CLASSES.
+    """
+    def __init__(self):
+        profiling.install_json_timing()
+
+    def process_request(self, request):
+        request._profiling = {
+            'start': time.time(),
+            'view': None,
+            'connections': [(c, c.use_debug_cursor, len(c.queries))
+                    for c in connections.all()],
+        }
+        for c in connections.all():
+            c.use_debug_cursor = True
+        profiling.start_json_timing()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_profiling'):
+            request._profiling['view'] = '%s.%s' % (view_func.__module__,
+                    view_func.__name__)
+        return None
+
+    def process_response(self, request, response):
+        state = getattr(request, '_profiling', None)
+        if state is None:
+            return response
+        total_time = time.time() - state['start']
+        json_time = profiling.stop_json_timing()
+        n_queries, db_time = 0, 0.0
+        for c, use_debug_cursor, n_before in state['connections']:
+            queries = c.queries[n_before:]
+            n_queries += len(queries)
+            db_time += sum(float(q['time']) for q in queries)
+            c.use_debug_cursor = use_debug_cursor
+            if not settings.DEBUG:
+                # Without DEBUG, queries are only logged for profiling
+                del c.queries[n_before:]
+        if state['view']:
+            size = 0 if response.streaming else len(response.content)
+            profiling.record(state['view'], n_queries, db_time,
+                    max(0.0, total_time - db_time - json_time), json_time,
+                    size)
+        return response
+
 class AjaxExceptionMiddleware(object):
 
     def process_exception(self, request, exception):
@@ -248,14 +248,18 @@ class Migration(DataMigration):
                 else:
                     log("Looking at project #%s: %s" % (p.id, p.title))
 
-                class_map = get_class_to_id_map(p.id)
-                relation_map = get_relation_to_id_map(p.id)
+                class_map = get_class_to_id_map(p.id,
+                        ('root', 'annotation', 'neuron'))
+                relation_map = get_relation_to_id_map(p.id,
+                        ('annotated_with', 'part_of'))
 
                 try:
                   self.test_tracing_setup(orm, p, class_map, relation_map)
                   # If any where added new, update
-                  class_map = get_class_to_id_map(p.id)
-                  relation_map = get_relation_to_id_map(p.id)
+                  class_map = get_class_to_id_map(p.id,
+                          ('root', 'annotation', 'neuron'))
+                  relation_map = get_relation_to_id_map(p.id,
+                          ('annotated_with', 'part_of'))
                 except RuntimeError as e:
                   log(e.message, 1)
                   continue
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+from catmaid.migration_utils import get_public_indexes
+
+
+class Migration(SchemaMigration):
+
+    # Tables for which deletions are logged, along with the kind of the
+    # logged change and the column that holds the node ID to log.
+    logged_tables = (
+        ('treenode', 'treenode', 'id'),
+        ('connector', 'connector', 'id'),
+        ('treenode_connector', 'connector_link', 'connector_id'),
+        ('treenode_class_instance', 'treenode_label', 'treenode_id'),
+        ('connector_class_instance', 'connector_label', 'connector_id'),
+    )
+
+    def forwards(self, orm):
+        # The node deletion log records deleted treenodes and connectors as
+        # well as removed links and labels, so that clients can be told
+        # about them. Created and edited rows are found through their
+        # edition_time.
+        db.execute('''
+            CREATE TABLE node_deletion_log (
+                id bigserial PRIMARY KEY,
+                project_id integer NOT NULL,
+                kind varchar(16) NOT NULL,
+                node_id bigint NOT NULL,
+                deletion_time timestamp with time zone DEFAULT now() NOT NULL
+            )''')
+        db.execute('''
+            CREATE INDEX node_deletion_log_project_id_deletion_time_index
+            ON node_deletion_log (project_id, deletion_time)''')
+
+        branches = []
+        for table, kind, column in Migration.logged_tables:
+            branches.append('''
+                %sIF TG_TABLE_NAME = '%s' THEN
+                    INSERT INTO node_deletion_log (project_id, kind, node_id)
+                    VALUES (OLD.project_id, '%s', OLD.%s);''' % (
+                    'ELS' if branches else '', table, kind, column))
+        db.execute('''
+            CREATE FUNCTION log_node_deletion() RETURNS trigger
+            LANGUAGE plpgsql
+            AS $$BEGIN
+                %s
+                END IF;
+                RETURN OLD;
+            END;
+            $$;''' % ''.join(branches))
+
+        statement_fmt = '''CREATE TRIGGER on_delete_log_%s
+                        AFTER DELETE ON %s
+                        FOR EACH ROW EXECUTE PROCEDURE log_node_deletion()'''
+        for table, kind, column in Migration.logged_tables:
+            db.execute(statement_fmt % (table, table))
+
+        # Let changes since a given time be found without scanning the
+        # whole project.
+        existing = get_public_indexes(db)
+        statement_fmt = 'CREATE INDEX %s ON %s (project_id, edition_time)'
+        for table, kind, column in Migration.logged_tables:
+            index_and_table = ('%s_project_id_edition_time_index' % table, table)
+            if index_and_table not in existing:
+                db.execute(statement_fmt % index_and_table)
+
+    def backwards(self, orm):
+        for table, kind, column in Migration.logged_tables:
+            db.execute('DROP INDEX IF EXISTS %s_project_id_edition_time_index' % table)
+            db.execute('DROP TRIGGER on_delete_log_%s ON %s' % (table, table))
+        db.execute('DROP FUNCTION log_node_deletion()')
+        db.execute('DROP TABLE node_deletion_log')
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'catmaid.apikey': {
+            'Meta': {'object_name': 'ApiKey'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        'catmaid.brokenslice': {
+            'Meta': {'object_name': 'BrokenSlice', 'db_table': "'broken_slice'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'index': ('django.db.models.fields.IntegerField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"})
+        },
+        'catmaid.cardinalityrestriction': {
+            'Meta': {'object_name': 'CardinalityRestriction', 'db_table': "'cardinality_restriction'"},
+            'cardinality_type': ('django.db.models.fields.IntegerField', [], {}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'value': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'catmaid.changerequest': {
+            'Meta': {'object_name': 'ChangeRequest', 'db_table': "'change_request'"},
+            'approve_action': ('django.db.models.fields.TextField', [], {}),
+            'completion_time': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'change_recipient'", 'db_column': "'recipient_id'", 'to': "orm['auth.User']"}),
+            'reject_action': ('django.db.models.fields.TextField', [], {}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Treenode']"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'validate_action': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.class': {
+            'Meta': {'object_name': 'Class', 'db_table': "'class'"},
+            'class_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.classclass': {
+            'Meta': {'object_name': 'ClassClass', 'db_table': "'class_class'"},
+            'class_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_a'", 'db_column': "'class_a'", 'to': "orm['catmaid.Class']"}),
+            'class_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_b'", 'db_column': "'class_b'", 'to': "orm['catmaid.Class']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.classinstance': {
+            'Meta': {'object_name': 'ClassInstance', 'db_table': "'class_instance'"},
+            'class_column': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Class']", 'db_column': "'class_id'"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.classinstanceclassinstance': {
+            'Meta': {'object_name': 'ClassInstanceClassInstance', 'db_table': "'class_instance_class_instance'"},
+            'class_instance_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_a'", 'db_column': "'class_instance_a'", 'to': "orm['catmaid.ClassInstance']"}),
+            'class_instance_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_b'", 'db_column': "'class_instance_b'", 'to': "orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.concept': {
+            'Meta': {'object_name': 'Concept', 'db_table': "'concept'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.connector': {
+            'Meta': {'object_name': 'Connector', 'db_table': "'connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'connector_editor'", 'db_column': "'editor_id'", 'to': "orm['auth.User']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'reviewer_id': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.connectorclassinstance': {
+            'Meta': {'object_name': 'ConnectorClassInstance', 'db_table': "'connector_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.dataview': {
+            'Meta': {'ordering': "('position',)", 'object_name': 'DataView', 'db_table': "'data_view'"},
+            'comment': ('django.db.models.fields.TextField', [], {'default': "''", 'null': 'True', 'blank': 'True'}),
+            'config': ('django.db.models.fields.TextField', [], {'default': "'{}'"}),
+            'data_view_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.DataViewType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'position': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.dataviewtype': {
+            'Meta': {'object_name': 'DataViewType', 'db_table': "'data_view_type'"},
+            'code_type': ('django.db.models.fields.TextField', [], {}),
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.deprecatedappliedmigrations': {
+            'Meta': {'object_name': 'DeprecatedAppliedMigrations', 'db_table': "'applied_migrations'"},
+            'id': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'})
+        },
+        'catmaid.deprecatedsession': {
+            'Meta': {'object_name': 'DeprecatedSession', 'db_table': "'sessions'"},
+            'data': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_accessed': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'session_id': ('django.db.models.fields.CharField', [], {'max_length': '26'})
+        },
+        'catmaid.location': {
+            'Meta': {'object_name': 'Location', 'db_table': "'location'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'location_editor'", 'db_column': "'editor_id'", 'to': "orm['auth.User']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'reviewer_id': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.log': {
+            'Meta': {'object_name': 'Log', 'db_table': "'log'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'freetext': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'operation_type': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.message': {
+            'Meta': {'object_name': 'Message', 'db_table': "'message'"},
+            'action': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'read': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'New message'", 'null': 'True', 'blank': 'True'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.overlay': {
+            'Meta': {'object_name': 'Overlay', 'db_table': "'overlay'"},
+            'default_opacity': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'file_extension': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.project': {
+            'Meta': {'object_name': 'Project', 'db_table': "'project'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'public': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'stacks': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['catmaid.Stack']", 'through': "orm['catmaid.ProjectStack']", 'symmetrical': 'False'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.projectstack': {
+            'Meta': {'object_name': 'ProjectStack', 'db_table': "'project_stack'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'orientation': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"}),
+            'translation': ('catmaid.fields.Double3DField', [], {'default': '(0, 0, 0)'})
+        },
+        'catmaid.regionofinterest': {
+            'Meta': {'object_name': 'RegionOfInterest', 'db_table': "'region_of_interest'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'height': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'rotation_cw': ('django.db.models.fields.FloatField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'width': ('django.db.models.fields.FloatField', [], {}),
+            'zoom_level': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'catmaid.regionofinterestclassinstance': {
+            'Meta': {'object_name': 'RegionOfInterestClassInstance', 'db_table': "'region_of_interest_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'region_of_interest': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.RegionOfInterest']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.relation': {
+            'Meta': {'object_name': 'Relation', 'db_table': "'relation'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'isreciprocal': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'uri': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.relationinstance': {
+            'Meta': {'object_name': 'RelationInstance', 'db_table': "'relation_instance'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.restriction': {
+            'Meta': {'object_name': 'Restriction', 'db_table': "'restriction'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.settings': {
+            'Meta': {'object_name': 'Settings', 'db_table': "'settings'"},
+            'key': ('django.db.models.fields.TextField', [], {'primary_key': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'null': 'True'})
+        },
+        'catmaid.stack': {
+            'Meta': {'object_name': 'Stack', 'db_table': "'stack'"},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'dimension': ('catmaid.fields.Integer3DField', [], {}),
+            'file_extension': ('django.db.models.fields.TextField', [], {'default': "'jpg'", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'metadata': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'num_zoom_levels': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'resolution': ('catmaid.fields.Double3DField', [], {}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'trakem2_project': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'catmaid.textlabel': {
+            'Meta': {'object_name': 'Textlabel', 'db_table': "'textlabel'"},
+            'colour': ('catmaid.fields.RGBAField', [], {'default': '(1, 0.5, 0, 1)'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'font_name': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'font_size': ('django.db.models.fields.FloatField', [], {'default': '32'}),
+            'font_style': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'scaling': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'Edit this text ...'"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'})
+        },
+        'catmaid.textlabellocation': {
+            'Meta': {'object_name': 'TextlabelLocation', 'db_table': "'textlabel_location'"},
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'textlabel': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Textlabel']"})
+        },
+        'catmaid.treenode': {
+            'Meta': {'object_name': 'Treenode', 'db_table': "'treenode'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'treenode_editor'", 'db_column': "'editor_id'", 'to': "orm['auth.User']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'children'", 'null': 'True', 'to': "orm['catmaid.Treenode']"}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'radius': ('django.db.models.fields.FloatField', [], {}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'reviewer_id': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.treenodeclassinstance': {
+            'Meta': {'object_name': 'TreenodeClassInstance', 'db_table': "'treenode_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.treenodeconnector': {
+            'Meta': {'object_name': 'TreenodeConnector', 'db_table': "'treenode_connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'color': ('catmaid.fields.RGBAField', [], {'default': '(0, 1, 0, 1)'}),
+            'display_stack_reference_lines': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'independent_ontology_workspace_is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'inverse_mouse_wheel': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_cropping_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_ontology_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_segmentation_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tagging_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_text_label_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tracing_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'taggit.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        'taggit.taggeditem': {
+            'Meta': {'object_name': 'TaggedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_tagged_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_items'", 'to': "orm['taggit.Tag']"})
+        }
+    }
+
+    complete_apps = ['catmaid']
\ No newline at end of file
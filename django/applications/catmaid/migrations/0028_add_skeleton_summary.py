@@ -0,0 +1,750 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Per skeleton counters: the number of nodes, the cable length (the
+        # sum of the distances of all nodes to their parents) and the number
+        # of presynaptic and postsynaptic links.
+        db.execute('''
+            CREATE TABLE skeleton_summary (
+                skeleton_id bigint PRIMARY KEY,
+                project_id integer NOT NULL,
+                num_nodes integer NOT NULL,
+                cable_length double precision NOT NULL,
+                num_presynaptic integer NOT NULL,
+                num_postsynaptic integer NOT NULL
+            )''')
+        db.execute('''
+            CREATE INDEX skeleton_summary_project_id_index
+            ON skeleton_summary (project_id)''')
+        # The number of nodes of each skeleton per reviewer, including the
+        # unreviewed nodes with a reviewer ID of -1.
+        db.execute('''
+            CREATE TABLE skeleton_review_summary (
+                skeleton_id bigint NOT NULL,
+                reviewer_id integer NOT NULL,
+                num_nodes integer NOT NULL,
+                PRIMARY KEY (skeleton_id, reviewer_id)
+            )''')
+
+        # Add deltas to the counters of a skeleton, removing its row if
+        # nothing is left. Nodes and links without skeleton are ignored.
+        db.execute('''
+            CREATE FUNCTION add_skeleton_summary(p_project_id integer,
+                    p_skeleton_id bigint, d_nodes integer,
+                    d_cable_length double precision, d_presynaptic integer,
+                    d_postsynaptic integer) RETURNS void
+            LANGUAGE plpgsql
+            AS $$BEGIN
+                IF p_skeleton_id IS NULL THEN
+                    RETURN;
+                END IF;
+                LOOP
+                    UPDATE skeleton_summary
+                    SET num_nodes = num_nodes + d_nodes,
+                        cable_length = cable_length + d_cable_length,
+                        num_presynaptic = num_presynaptic + d_presynaptic,
+                        num_postsynaptic = num_postsynaptic + d_postsynaptic
+                    WHERE skeleton_id = p_skeleton_id;
+                    IF FOUND THEN
+                        DELETE FROM skeleton_summary
+                        WHERE skeleton_id = p_skeleton_id
+                          AND num_nodes <= 0
+                          AND num_presynaptic <= 0
+                          AND num_postsynaptic <= 0;
+                        RETURN;
+                    END IF;
+                    IF d_nodes <= 0 AND d_presynaptic <= 0
+                            AND d_postsynaptic <= 0 THEN
+                        RETURN;
+                    END IF;
+                    BEGIN
+                        INSERT INTO skeleton_summary (skeleton_id, project_id,
+                            num_nodes, cable_length, num_presynaptic,
+                            num_postsynaptic)
+                        VALUES (p_skeleton_id, p_project_id, d_nodes,
+                            d_cable_length, d_presynaptic, d_postsynaptic);
+                        RETURN;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- Inserted concurrently, try to update again
+                    END;
+                END LOOP;
+            END;
+            $$;''')
+        db.execute('''
+            CREATE FUNCTION add_skeleton_review_summary(p_skeleton_id bigint,
+                    p_reviewer_id integer, delta integer) RETURNS void
+            LANGUAGE plpgsql
+            AS $$BEGIN
+                IF p_skeleton_id IS NULL THEN
+                    RETURN;
+                END IF;
+                LOOP
+                    UPDATE skeleton_review_summary
+                    SET num_nodes = num_nodes + delta
+                    WHERE skeleton_id = p_skeleton_id
+                      AND reviewer_id = p_reviewer_id;
+                    IF FOUND THEN
+                        DELETE FROM skeleton_review_summary
+                        WHERE skeleton_id = p_skeleton_id
+                          AND reviewer_id = p_reviewer_id
+                          AND num_nodes <= 0;
+                        RETURN;
+                    END IF;
+                    IF delta <= 0 THEN
+                        RETURN;
+                    END IF;
+                    BEGIN
+                        INSERT INTO skeleton_review_summary (skeleton_id,
+                            reviewer_id, num_nodes)
+                        VALUES (p_skeleton_id, p_reviewer_id, delta);
+                        RETURN;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- Inserted concurrently, try to update again
+                    END;
+                END LOOP;
+            END;
+            $$;''')
+
+        # The cable of a node is the distance to its parent, or zero for a
+        # root node and for a node whose parent doesn't exist (anymore or
+        # yet) while a statement deletes or inserts many nodes.
+        db.execute('''
+            CREATE FUNCTION treenode_cable_length(node treenode)
+                    RETURNS double precision
+            LANGUAGE plpgsql
+            AS $$DECLARE
+                parent_location double3d;
+            BEGIN
+                IF node.parent_id IS NULL THEN
+                    RETURN 0;
+                END IF;
+                SELECT location INTO parent_location
+                FROM treenode WHERE id = node.parent_id;
+                IF NOT FOUND THEN
+                    RETURN 0;
+                END IF;
+                RETURN sqrt(((node.location).x - parent_location.x) ^ 2
+                          + ((node.location).y - parent_location.y) ^ 2
+                          + ((node.location).z - parent_location.z) ^ 2);
+            END;
+            $$;''')
+
+        # Add the change of the cable of the children of a node if the node
+        # moves from old_location to new_location. A NULL location stands
+        # for a node that doesn't exist.
+        db.execute('''
+            CREATE FUNCTION update_children_cable_length(node_id bigint,
+                    old_location double3d, new_location double3d)
+                    RETURNS void
+            LANGUAGE plpgsql
+            AS $$DECLARE
+                child record;
+            BEGIN
+                FOR child IN
+                    SELECT project_id, skeleton_id,
+                        sum(CASE WHEN new_location IS NULL THEN 0 ELSE
+                                sqrt(((location).x - new_location.x) ^ 2
+                                   + ((location).y - new_location.y) ^ 2
+                                   + ((location).z - new_location.z) ^ 2) END
+                          - CASE WHEN old_location IS NULL THEN 0 ELSE
+                                sqrt(((location).x - old_location.x) ^ 2
+                                   + ((location).y - old_location.y) ^ 2
+                                   + ((location).z - old_location.z) ^ 2) END)
+                            AS delta
+                    FROM treenode
+                    WHERE parent_id = node_id
+                    GROUP BY project_id, skeleton_id
+                LOOP
+                    PERFORM add_skeleton_summary(child.project_id,
+                        child.skeleton_id, 0, child.delta, 0, 0);
+                END LOOP;
+            END;
+            $$;''')
+
+        # Like the connectivity triggers, these row triggers see the changes
+        # of the rows processed before them in the same statement. Every node
+        # accounts for the cable to its parent and the counters therefore
+        # stay right if e.g. a split or join moves many nodes at once.
+        db.execute('''
+            CREATE FUNCTION on_change_treenode_update_summary()
+            RETURNS trigger
+            LANGUAGE plpgsql
+            AS $$DECLARE
+                old_cable double precision;
+                new_cable double precision;
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM add_skeleton_summary(NEW.project_id,
+                        NEW.skeleton_id, 1, treenode_cable_length(NEW), 0, 0);
+                    PERFORM add_skeleton_review_summary(NEW.skeleton_id,
+                        NEW.reviewer_id, 1);
+                    PERFORM update_children_cable_length(NEW.id, NULL,
+                        NEW.location);
+                    RETURN NEW;
+                ELSIF TG_OP = 'DELETE' THEN
+                    PERFORM add_skeleton_summary(OLD.project_id,
+                        OLD.skeleton_id, -1, -treenode_cable_length(OLD), 0, 0);
+                    PERFORM add_skeleton_review_summary(OLD.skeleton_id,
+                        OLD.reviewer_id, -1);
+                    PERFORM update_children_cable_length(OLD.id, OLD.location,
+                        NULL);
+                    RETURN OLD;
+                END IF;
+                IF NEW.skeleton_id IS DISTINCT FROM OLD.skeleton_id
+                        OR NEW.parent_id IS DISTINCT FROM OLD.parent_id
+                        OR NEW.location IS DISTINCT FROM OLD.location THEN
+                    old_cable := treenode_cable_length(OLD);
+                    new_cable := treenode_cable_length(NEW);
+                    IF NEW.skeleton_id IS DISTINCT FROM OLD.skeleton_id THEN
+                        PERFORM add_skeleton_summary(OLD.project_id,
+                            OLD.skeleton_id, -1, -old_cable, 0, 0);
+                        PERFORM add_skeleton_summary(NEW.project_id,
+                            NEW.skeleton_id, 1, new_cable, 0, 0);
+                    ELSIF new_cable <> old_cable THEN
+                        PERFORM add_skeleton_summary(NEW.project_id,
+                            NEW.skeleton_id, 0, new_cable - old_cable, 0, 0);
+                    END IF;
+                    IF NEW.location IS DISTINCT FROM OLD.location THEN
+                        PERFORM update_children_cable_length(NEW.id,
+                            OLD.location, NEW.location);
+                    END IF;
+                END IF;
+                IF NEW.skeleton_id IS DISTINCT FROM OLD.skeleton_id
+                        OR NEW.reviewer_id <> OLD.reviewer_id THEN
+                    PERFORM add_skeleton_review_summary(OLD.skeleton_id,
+                        OLD.reviewer_id, -1);
+                    PERFORM add_skeleton_review_summary(NEW.skeleton_id,
+                        NEW.reviewer_id, 1);
+                END IF;
+                RETURN NEW;
+            END;
+            $$;''')
+        db.execute('''
+            CREATE TRIGGER on_change_treenode_update_summary
+            BEFORE INSERT OR UPDATE OR DELETE ON treenode
+            FOR EACH ROW EXECUTE PROCEDURE
+            on_change_treenode_update_summary()''')
+
+        # Count presynaptic and postsynaptic links
+        db.execute('''
+            CREATE FUNCTION update_skeleton_summary_links(link treenode_connector,
+                    delta integer) RETURNS void
+            LANGUAGE plpgsql
+            AS $$DECLARE
+                link_relation text;
+            BEGIN
+                IF link.skeleton_id IS NULL THEN
+                    RETURN;
+                END IF;
+                SELECT relation_name INTO link_relation
+                FROM relation WHERE id = link.relation_id;
+                IF link_relation = 'presynaptic_to' THEN
+                    PERFORM add_skeleton_summary(link.project_id,
+                        link.skeleton_id, 0, 0, delta, 0);
+                ELSIF link_relation = 'postsynaptic_to' THEN
+                    PERFORM add_skeleton_summary(link.project_id,
+                        link.skeleton_id, 0, 0, 0, delta);
+                END IF;
+            END;
+            $$;''')
+        db.execute('''
+            CREATE FUNCTION on_change_treenode_connector_update_summary()
+            RETURNS trigger
+            LANGUAGE plpgsql
+            AS $$BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM update_skeleton_summary_links(NEW, 1);
+                    RETURN NEW;
+                ELSIF TG_OP = 'DELETE' THEN
+                    PERFORM update_skeleton_summary_links(OLD, -1);
+                    RETURN OLD;
+                END IF;
+                IF NEW.skeleton_id IS DISTINCT FROM OLD.skeleton_id
+                        OR NEW.relation_id <> OLD.relation_id THEN
+                    PERFORM update_skeleton_summary_links(OLD, -1);
+                    PERFORM update_skeleton_summary_links(NEW, 1);
+                END IF;
+                RETURN NEW;
+            END;
+            $$;''')
+        db.execute('''
+            CREATE TRIGGER on_change_treenode_connector_update_summary
+            BEFORE INSERT OR UPDATE OR DELETE ON treenode_connector
+            FOR EACH ROW EXECUTE PROCEDURE
+            on_change_treenode_connector_update_summary()''')
+
+        # Fill the tables with the existing skeletons
+        db.execute('''
+            INSERT INTO skeleton_summary (skeleton_id, project_id, num_nodes,
+                cable_length, num_presynaptic, num_postsynaptic)
+            WITH nodes AS (
+                SELECT t.skeleton_id, min(t.project_id) AS project_id,
+                       count(*) AS num_nodes,
+                       sum(CASE WHEN p.id IS NULL THEN 0 ELSE
+                               sqrt(((t.location).x - (p.location).x) ^ 2
+                                  + ((t.location).y - (p.location).y) ^ 2
+                                  + ((t.location).z - (p.location).z) ^ 2)
+                           END) AS cable_length
+                FROM treenode t
+                LEFT OUTER JOIN treenode p ON p.id = t.parent_id
+                WHERE t.skeleton_id IS NOT NULL
+                GROUP BY t.skeleton_id),
+            links AS (
+                SELECT tc.skeleton_id, min(tc.project_id) AS project_id,
+                       sum(CASE WHEN r.relation_name = 'presynaptic_to'
+                           THEN 1 ELSE 0 END) AS num_presynaptic,
+                       sum(CASE WHEN r.relation_name = 'postsynaptic_to'
+                           THEN 1 ELSE 0 END) AS num_postsynaptic
+                FROM treenode_connector tc, relation r
+                WHERE tc.relation_id = r.id
+                  AND tc.skeleton_id IS NOT NULL
+                  AND r.relation_name IN ('presynaptic_to', 'postsynaptic_to')
+                GROUP BY tc.skeleton_id)
+            SELECT coalesce(n.skeleton_id, l.skeleton_id),
+                   coalesce(n.project_id, l.project_id),
+                   coalesce(n.num_nodes, 0), coalesce(n.cable_length, 0),
+                   coalesce(l.num_presynaptic, 0),
+                   coalesce(l.num_postsynaptic, 0)
+            FROM nodes n
+            FULL OUTER JOIN links l ON l.skeleton_id = n.skeleton_id''')
+        db.execute('''
+            INSERT INTO skeleton_review_summary (skeleton_id, reviewer_id,
+                num_nodes)
+            SELECT skeleton_id, reviewer_id, count(*)
+            FROM treenode
+            WHERE skeleton_id IS NOT NULL
+            GROUP BY skeleton_id, reviewer_id''')
+
+    def backwards(self, orm):
+        db.execute('''DROP TRIGGER on_change_treenode_connector_update_summary
+                      ON treenode_connector''')
+        db.execute('DROP FUNCTION on_change_treenode_connector_update_summary()')
+        db.execute('DROP FUNCTION update_skeleton_summary_links(treenode_connector, integer)')
+        db.execute('DROP TRIGGER on_change_treenode_update_summary ON treenode')
+        db.execute('DROP FUNCTION on_change_treenode_update_summary()')
+        db.execute('DROP FUNCTION update_children_cable_length(bigint, double3d, double3d)')
+        db.execute('DROP FUNCTION treenode_cable_length(treenode)')
+        db.execute('DROP FUNCTION add_skeleton_review_summary(bigint, integer, integer)')
+        db.execute('DROP FUNCTION add_skeleton_summary(integer, bigint, integer, double precision, integer, integer)')
+        db.execute('DROP TABLE skeleton_review_summary')
+        db.execute('DROP TABLE skeleton_summary')
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'catmaid.apikey': {
+            'Meta': {'object_name': 'ApiKey'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        'catmaid.brokenslice': {
+            'Meta': {'object_name': 'BrokenSlice', 'db_table': "'broken_slice'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'index': ('django.db.models.fields.IntegerField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"})
+        },
+        'catmaid.cardinalityrestriction': {
+            'Meta': {'object_name': 'CardinalityRestriction', 'db_table': "'cardinality_restriction'"},
+            'cardinality_type': ('django.db.models.fields.IntegerField', [], {}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'value': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'catmaid.changerequest': {
+            'Meta': {'object_name': 'ChangeRequest', 'db_table': "'change_request'"},
+            'approve_action': ('django.db.models.fields.TextField', [], {}),
+            'completion_time': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'change_recipient'", 'db_column': "'recipient_id'", 'to': "orm['auth.User']"}),
+            'reject_action': ('django.db.models.fields.TextField', [], {}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Treenode']"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'validate_action': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.class': {
+            'Meta': {'object_name': 'Class', 'db_table': "'class'"},
+            'class_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.classclass': {
+            'Meta': {'object_name': 'ClassClass', 'db_table': "'class_class'"},
+            'class_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_a'", 'db_column': "'class_a'", 'to': "orm['catmaid.Class']"}),
+            'class_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_b'", 'db_column': "'class_b'", 'to': "orm['catmaid.Class']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.classinstance': {
+            'Meta': {'object_name': 'ClassInstance', 'db_table': "'class_instance'"},
+            'class_column': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Class']", 'db_column': "'class_id'"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.classinstanceclassinstance': {
+            'Meta': {'object_name': 'ClassInstanceClassInstance', 'db_table': "'class_instance_class_instance'"},
+            'class_instance_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_a'", 'db_column': "'class_instance_a'", 'to': "orm['catmaid.ClassInstance']"}),
+            'class_instance_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_b'", 'db_column': "'class_instance_b'", 'to': "orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.concept': {
+            'Meta': {'object_name': 'Concept', 'db_table': "'concept'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.connector': {
+            'Meta': {'object_name': 'Connector', 'db_table': "'connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'connector_editor'", 'db_column': "'editor_id'", 'to': "orm['auth.User']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'reviewer_id': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.connectorclassinstance': {
+            'Meta': {'object_name': 'ConnectorClassInstance', 'db_table': "'connector_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.dataview': {
+            'Meta': {'ordering': "('position',)", 'object_name': 'DataView', 'db_table': "'data_view'"},
+            'comment': ('django.db.models.fields.TextField', [], {'default': "''", 'null': 'True', 'blank': 'True'}),
+            'config': ('django.db.models.fields.TextField', [], {'default': "'{}'"}),
+            'data_view_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.DataViewType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'position': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.dataviewtype': {
+            'Meta': {'object_name': 'DataViewType', 'db_table': "'data_view_type'"},
+            'code_type': ('django.db.models.fields.TextField', [], {}),
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.deprecatedappliedmigrations': {
+            'Meta': {'object_name': 'DeprecatedAppliedMigrations', 'db_table': "'applied_migrations'"},
+            'id': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'})
+        },
+        'catmaid.deprecatedsession': {
+            'Meta': {'object_name': 'DeprecatedSession', 'db_table': "'sessions'"},
+            'data': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_accessed': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'session_id': ('django.db.models.fields.CharField', [], {'max_length': '26'})
+        },
+        'catmaid.location': {
+            'Meta': {'object_name': 'Location', 'db_table': "'location'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'location_editor'", 'db_column': "'editor_id'", 'to': "orm['auth.User']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'reviewer_id': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.log': {
+            'Meta': {'object_name': 'Log', 'db_table': "'log'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'freetext': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'operation_type': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.message': {
+            'Meta': {'object_name': 'Message', 'db_table': "'message'"},
+            'action': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'read': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'New message'", 'null': 'True', 'blank': 'True'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.overlay': {
+            'Meta': {'object_name': 'Overlay', 'db_table': "'overlay'"},
+            'default_opacity': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'file_extension': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.project': {
+            'Meta': {'object_name': 'Project', 'db_table': "'project'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'public': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'stacks': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['catmaid.Stack']", 'through': "orm['catmaid.ProjectStack']", 'symmetrical': 'False'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        'catmaid.projectstack': {
+            'Meta': {'object_name': 'ProjectStack', 'db_table': "'project_stack'"},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'orientation': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"}),
+            'translation': ('catmaid.fields.Double3DField', [], {'default': '(0, 0, 0)'})
+        },
+        'catmaid.regionofinterest': {
+            'Meta': {'object_name': 'RegionOfInterest', 'db_table': "'region_of_interest'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'height': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'rotation_cw': ('django.db.models.fields.FloatField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Stack']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'width': ('django.db.models.fields.FloatField', [], {}),
+            'zoom_level': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'catmaid.regionofinterestclassinstance': {
+            'Meta': {'object_name': 'RegionOfInterestClassInstance', 'db_table': "'region_of_interest_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'region_of_interest': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.RegionOfInterest']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.relation': {
+            'Meta': {'object_name': 'Relation', 'db_table': "'relation'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'isreciprocal': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'uri': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.relationinstance': {
+            'Meta': {'object_name': 'RelationInstance', 'db_table': "'relation_instance'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.restriction': {
+            'Meta': {'object_name': 'Restriction', 'db_table': "'restriction'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.settings': {
+            'Meta': {'object_name': 'Settings', 'db_table': "'settings'"},
+            'key': ('django.db.models.fields.TextField', [], {'primary_key': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'null': 'True'})
+        },
+        'catmaid.stack': {
+            'Meta': {'object_name': 'Stack', 'db_table': "'stack'"},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'dimension': ('catmaid.fields.Integer3DField', [], {}),
+            'file_extension': ('django.db.models.fields.TextField', [], {'default': "'jpg'", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'metadata': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'num_zoom_levels': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'resolution': ('catmaid.fields.Double3DField', [], {}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'trakem2_project': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'catmaid.textlabel': {
+            'Meta': {'object_name': 'Textlabel', 'db_table': "'textlabel'"},
+            'colour': ('catmaid.fields.RGBAField', [], {'default': '(1, 0.5, 0, 1)'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'font_name': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'font_size': ('django.db.models.fields.FloatField', [], {'default': '32'}),
+            'font_style': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'scaling': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'Edit this text ...'"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'})
+        },
+        'catmaid.textlabellocation': {
+            'Meta': {'object_name': 'TextlabelLocation', 'db_table': "'textlabel_location'"},
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'textlabel': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Textlabel']"})
+        },
+        'catmaid.treenode': {
+            'Meta': {'object_name': 'Treenode', 'db_table': "'treenode'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'treenode_editor'", 'db_column': "'editor_id'", 'to': "orm['auth.User']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'children'", 'null': 'True', 'to': "orm['catmaid.Treenode']"}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'radius': ('django.db.models.fields.FloatField', [], {}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'reviewer_id': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.treenodeclassinstance': {
+            'Meta': {'object_name': 'TreenodeClassInstance', 'db_table': "'treenode_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.treenodeconnector': {
+            'Meta': {'object_name': 'TreenodeConnector', 'db_table': "'treenode_connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Relation']"}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.ClassInstance']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'catmaid.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'color': ('catmaid.fields.RGBAField', [], {'default': '(0, 1, 0, 1)'}),
+            'display_stack_reference_lines': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'independent_ontology_workspace_is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'inverse_mouse_wheel': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_cropping_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_ontology_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_segmentation_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tagging_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_text_label_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tracing_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'taggit.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        'taggit.taggeditem': {
+            'Meta': {'object_name': 'TaggedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_tagged_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_items'", 'to': "orm['taggit.Tag']"})
+        }
+    }
+
+    complete_apps = ['catmaid']
\ No newline at end of file
@@ -68,6 +68,7 @@ CompartmentGraphWidget.prototype.getSkeletonColor = function(skeleton_id) {
 };
 
 CompartmentGraphWidget.prototype.destroy = function() {
+  this.cancelGraphJob();
   this.unregisterInstance();
   this.unregisterSource();
 };
@@ -690,7 +691,8 @@ CompartmentGraphWidget.prototype.load = function(skeleton_ids, models) {
   }
   var post = {skeleton_list: skeleton_ids,
               confidence_threshold: this.confidence_threshold,
-              risk: this.compute_risk ? 1 : 0};
+              risk: this.compute_risk ? 1 : 0,
+              async: 1};
   if (this.clustering_bandwidth > 0) {
     var selected = Object.keys(this.cy.nodes().toArray().reduce(function(m, node) {
       if (node.selected()) m[node.data('skeleton_id')] = true;
@@ -702,20 +704,80 @@ CompartmentGraphWidget.prototype.load = function(skeleton_ids, models) {
     }
   }
 
-  requestQueue.replace(django_url + project.id + "/skeletongroup/skeletonlist_confidence_compartment_subgraph",
-      "POST",
-      post,
-      (function (status, text) {
-          if (200 !== status) return;
-          var json = $.parseJSON(text);
-          if (json.error) {
-            if ('REPLACED' === json.error) return;
-            alert(json.error);
+  // A previous job is obsolete. Requests are sent in order, so the new request
+  // resumes the job if it asks for the same graph.
+  this.cancelGraphJob();
+
+  var request = this.graph_request;
+  var submit = (function() {
+    requestQueue.replace(django_url + project.id + "/skeletongroup/skeletonlist_confidence_compartment_subgraph",
+        "POST",
+        post,
+        (function (status, text) {
+            if (200 !== status || request !== this.graph_request) return;
+            var json = $.parseJSON(text);
+            if (json.error) {
+              if ('REPLACED' === json.error) return;
+              alert(json.error);
+              return;
+            }
+            this.handleGraphJob(json, models, request, submit);
+        }).bind(this),
+        "graph_widget_request");
+  }).bind(this);
+  submit();
+};
+
+/** Updates the graph with the result of a finished job, or polls the status of
+ * a queued or running job until it is finished. Responses to a request that
+ * has been cancelled or replaced in the meantime are ignored. A job that was
+ * cancelled although its request is still current has been cancelled by a
+ * replaced request for the same graph, and is submitted again. */
+CompartmentGraphWidget.prototype.handleGraphJob = function(json, models, request, submit) {
+  if (request !== this.graph_request) return; // cancelled or replaced
+  if ('done' === json.status) {
+    this.graph_job = null;
+    this.updateGraph(json.result, models);
+    return;
+  }
+  if ('cancelled' === json.status) {
+    this.graph_job = null;
+    submit();
+    return;
+  }
+  if ('queued' !== json.status && 'running' !== json.status) {
+    this.graph_job = null;
+    if ('error' === json.status) alert(json.error);
+    return;
+  }
+  this.graph_job = json.job_id;
+  statusBar.replaceLast("Computing graph: " + Math.round(json.progress * 100) + "%");
+  setTimeout((function() {
+    if (request !== this.graph_request) return; // cancelled or replaced
+    requestQueue.register(django_url + project.id + "/graphjob/" + json.job_id + "/status",
+        "GET",
+        undefined,
+        (function(status, text) {
+          if (200 !== status || request !== this.graph_request) return;
+          var json2 = $.parseJSON(text);
+          if (json2.error) {
+            this.graph_job = null;
+            alert(json2.error);
             return;
           }
-          this.updateGraph(json, models);
-      }).bind(this),
-      "graph_widget_request");
+          this.handleGraphJob(json2, models, request, submit);
+        }).bind(this));
+  }).bind(this), 1000);
+};
+
+/** Cancels the job that computes the graph, if any. Pending responses of the
+ * current request are ignored from now on. */
+CompartmentGraphWidget.prototype.cancelGraphJob = function() {
+  this.graph_request = (this.graph_request || 0) + 1;
+  if (!this.graph_job) return;
+  requestQueue.register(django_url + project.id + "/graphjob/" + this.graph_job + "/cancel",
+      "POST", {}, function() {});
+  this.graph_job = null;
 };
 
 CompartmentGraphWidget.prototype.highlight = function(skeleton_id) {
@@ -1098,7 +1098,8 @@ SkeletonAnnotations.SVGOverlay.prototype.refreshNodesFromTuples = function (jso,
 
   // Warn about nodes not retrieved because of limit
   if (true === jso[3]) {
-    var msg = "Did not retrieve all visible nodes--too many! Zoom in to constrain the field of view.";
+    var msg = "Did not retrieve all visible nodes of the section at z=" +
+        pz + "--too many! Zoom in to constrain the field of view.";
     statusBar.replaceLast("*WARNING*: " + msg);
     growlAlert('WARNING', msg);
   }
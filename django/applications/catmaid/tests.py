@@ -13,6 +13,7 @@ from models import Project, Stack, ProjectStack
 from models import ClassInstance, Log, Message, TextlabelLocation
 from models import Treenode, Connector, TreenodeConnector, User
 from models import Textlabel, TreenodeClassInstance, ClassInstanceClassInstance
+from models import Relation
 from .fields import Double3D, Integer3D
 from control.common import get_relation_to_id_map, get_class_to_id_map
 
@@ -161,6 +162,17 @@ class RelationQueryTests(TestCase):
 
     def setUp(self):
         self.test_project_id = 3
+        self.clear_caches()
+
+    def tearDown(self):
+        self.clear_caches()
+
+    def clear_caches(self):
+        # Renamed relations and labels are rolled back after each test, but
+        # the caches of this process would keep them.
+        from control import common
+        common.invalidate_id_maps(self.test_project_id)
+        common._label_names.pop(self.test_project_id, None)
 
     def test_find_all_neurons(self):
         all_neurons = ClassInstance.objects.filter(class_column__class_name='neuron',
@@ -196,6 +208,38 @@ class RelationQueryTests(TestCase):
         upstreams = list(downstream.all_neurons_upstream(self.test_project_id, skeletons))
         self.assertEqual(upstreams[0]['name'], "branched neuron / skeleton 235")
 
+    def test_relation_map_cache(self):
+        from control.common import get_relation_to_id_map
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertEqual(23, relations['presynaptic_to'])
+        # The map is cached, changing the returned copy has no effect
+        del relations['presynaptic_to']
+        self.assertNumQueries(0, lambda: get_relation_to_id_map(self.test_project_id))
+        self.assertEqual(23, get_relation_to_id_map(self.test_project_id)['presynaptic_to'])
+
+        # Renaming a relation through its model invalidates the cached map
+        relation = Relation.objects.get(pk=23)
+        relation.relation_name = 'renamed_presynaptic_to'
+        relation.save()
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertFalse('presynaptic_to' in relations)
+        self.assertEqual(23, relations['renamed_presynaptic_to'])
+
+    def test_label_name_cache(self):
+        from control.common import get_label_names
+        self.assertEqual('TODO', get_label_names(self.test_project_id)[351])
+        self.assertNumQueries(0,
+                lambda: get_label_names(self.test_project_id, (351,)))
+
+        # Renaming a label through its model updates the cached dictionary
+        label = ClassInstance.objects.get(pk=351)
+        label.name = 'DONE'
+        label.save()
+        self.assertEqual('DONE', get_label_names(self.test_project_id)[351])
+        # The cache outlives the test's transaction
+        label.name = 'TODO'
+        label.save()
+
 swc_output_for_skeleton_235 = '''237 0 1065 3035 0 0 -1
 417 0 4990 4200 0 0 415
 415 0 5810 3950 0 0 289
@@ -289,17 +333,187 @@ class ViewPageTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(expected_result, parsed_response)
 
+    def test_project_permission_cache(self):
+        from guardian.shortcuts import assign_perm, remove_perm
+        from control.authentication import project_permissions
+        user = User.objects.get(username='temporary')
+        project = Project.objects.get(pk=self.test_project_id)
+        perms = project_permissions(user, self.test_project_id)
+        self.assertFalse('can_administer' in perms)
+        # The permissions are cached
+        self.assertNumQueries(0,
+                lambda: project_permissions(user, self.test_project_id))
+
+        # Assigning and removing permissions invalidates the cache
+        assign_perm('can_administer', user, project)
+        perms = project_permissions(user, self.test_project_id)
+        self.assertTrue('can_administer' in perms)
+        remove_perm('can_administer', user, project)
+        perms = project_permissions(user, self.test_project_id)
+        self.assertFalse('can_administer' in perms)
+
+        # With the PermissionQueryCountMiddleware, every response reports the
+        # number of permission lookups that queried the database.
+        from django.conf import settings
+        middleware = tuple(settings.MIDDLEWARE_CLASSES) + \
+                ('catmaid.middleware.PermissionQueryCountMiddleware',)
+        with self.settings(MIDDLEWARE_CLASSES=middleware):
+            client = Client()
+            client.login(username='temporary', password='temporary')
+            url = '/%d/skeleton/235/swc' % (self.test_project_id,)
+            response = client.get(url)
+            self.assertEqual('0', response['X-Permission-Queries'])
+        # It isn't installed by default
+        self.fake_authentication()
+        self.assertFalse(self.client.get(url).has_header(
+                'X-Permission-Queries'))
+
+    def test_skeleton_graph_cache(self):
+        self.fake_authentication()
+        url = '/%d/skeletongroup/skeletonlist_confidence_compartment_subgraph' % \
+                (self.test_project_id,)
+        post = {'skeleton_list[0]': 235, 'skeleton_list[1]': 373,
+                'confidence_threshold': 1}
+        response = self.client.post(url, post)
+        self.assertEqual(response.status_code, 200)
+        graph = json.loads(response.content)
+        self.assertEqual([['235', '373', 2]], graph['edges'])
+
+        # The same graph is taken from the cache and is wrapped like a
+        # finished job if a job is requested.
+        post['async'] = 1
+        response = self.client.post(url, post)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('done', parsed_response['status'])
+        self.assertEqual(graph, parsed_response['result'])
+
+        # Changing a skeleton changes the revision of the cached graph
+        Treenode.objects.filter(pk=405).update(confidence=0)
+        response = self.client.post(url, post)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(3, len(parsed_response['result']['nodes']))
+
+        # The graph with synapse risk has its own route, which answers job
+        # requests in the same way.
+        url = '/%d/skeletongroup/skeletonlist_risk_subgraph' % \
+                (self.test_project_id,)
+        response = self.client.post(url, dict(post, risk=1))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('done', parsed_response['status'])
+        self.assertEqual(3, len(parsed_response['result']['nodes']))
+
+    def test_profiling_middleware(self):
+        from django.conf import settings
+        from control import profiling
+        profiling.reset()
+        middleware = ('catmaid.middleware.ProfilingMiddleware',) + \
+                tuple(settings.MIDDLEWARE_CLASSES)
+        with self.settings(MIDDLEWARE_CLASSES=middleware):
+            client = Client()
+            client.login(username='temporary', password='temporary')
+            response = client.post('/%d/skeleton/373/node_count' %
+                    self.test_project_id)
+            self.assertEqual(response.status_code, 200)
+
+        stats = profiling.statistics()['catmaid.control.skeleton.node_count']
+        self.assertEqual(1, stats['requests'])
+        self.assertTrue(stats['queries']['max'] > 0)
+        self.assertEqual(len(response.content), stats['size']['max'])
+
+        # Statistics are written to PROFILING_OUTPUT_PATH, not to MEDIA_ROOT
+        import shutil
+        import tempfile
+        root = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(root, 'profiling')
+            with self.settings(PROFILING_OUTPUT_PATH=output_path):
+                path = profiling.dump()
+            self.assertEqual(output_path, os.path.dirname(path))
+            with open(path) as f:
+                dumped = json.load(f)
+            self.assertEqual(1, dumped['views'][
+                    'catmaid.control.skeleton.node_count']['requests'])
+        finally:
+            shutil.rmtree(root)
+        profiling.reset()
+
+    def test_branch_navigation(self):
+        from control import topologycache
+        topologycache._topologies.clear()
+        self.fake_authentication()
+        url = '/%d/node/previous_branch_or_root' % self.test_project_id
+        response = self.client.post(url, {'tnid': 409, 'alt': 0})
+        self.assertEqual(377, json.loads(response.content)[0])
+        # The topology of the skeleton is cached until it changes
+        cursor = connection.cursor()
+        topology = topologycache.get_topology(cursor, 409)
+        self.assertNumQueries(1,
+                lambda: topologycache.get_topology(cursor, 405))
+        self.assertEqual([403, 405], sorted(topology.children_of_branch(377)))
+
+        # A new node is appended to the cached topology
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5, 'y': 10, 'z': 15, 'confidence': 5, 'parent_id': 409,
+            'radius': 2})
+        new_node_id = json.loads(response.content)['treenode_id']
+        self.assertTrue(topology is topologycache.get_topology(cursor, 409))
+        url = '/%d/node/next_branch_or_end' % self.test_project_id
+        response = self.client.post(url, {'tnid': 405, 'shift': 0, 'alt': 0})
+        self.assertEqual(new_node_id, json.loads(response.content)[0])
+
+        # Other changes cause the topology to be loaded again
+        Treenode.objects.filter(pk=new_node_id).update(parent=403)
+        response = self.client.post(url, {'tnid': 405, 'shift': 0, 'alt': 0})
+        self.assertEqual(409, json.loads(response.content)[0])
+
+        # Appended nodes that were rolled back are never added, even if the
+        # skeleton changed as often in the meantime.
+        topology = topologycache.get_topology(cursor, 409)
+        topologycache.append_nodes(topology.skeleton_id, [(10 ** 9, 409)])
+        cursor.execute('''
+            UPDATE skeleton_summary SET topology_revision = topology_revision + 1
+            WHERE skeleton_id = %s''', (topology.skeleton_id,))
+        reloaded = topologycache.get_topology(cursor, 409)
+        self.assertFalse(reloaded is topology)
+        self.assertEqual([], reloaded.next_branch_or_end(409))
+
     def test_swc_file(self):
         self.fake_authentication()
         for url in ['/%d/skeleton/235/swc' % (self.test_project_id,),
                     '/%d/skeleton-for-treenode/245/swc' % (self.test_project_id,)]:
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
-            self.compare_swc_data(response.content, swc_output_for_skeleton_235)
-        # One query is to check the session, one is to get the user
-        # for that session, and the third is actually retrieving the
-        # treenodes:
-        self.assertNumQueries(3, lambda: self.client.get('/%d/skeleton/235/swc' % (self.test_project_id,)))
+            self.compare_swc_data(''.join(response.streaming_content),
+                    swc_output_for_skeleton_235)
+        # One query is to check the session and one is to get the user for
+        # that session. The treenodes are read from a server-side cursor
+        # while the response is streamed.
+        self.assertNumQueries(2, lambda: ''.join(self.client.get('/%d/skeleton/235/swc' % (self.test_project_id,)).streaming_content))
+
+    def test_skeletons_archive(self):
+        import zipfile
+        from StringIO import StringIO
+        self.fake_authentication()
+        url = '/%d/skeletons/archive' % (self.test_project_id,)
+        response = self.client.post(url, {
+            'skeleton_ids[0]': 235,
+            'skeleton_ids[1]': 373,
+            'format': 'swc'})
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        self.assertEqual(['235.swc', '373.swc'], archive.namelist())
+        self.compare_swc_data(archive.read('235.swc'),
+                swc_output_for_skeleton_235)
+        self.assertEqual(5, len(archive.read('373.swc').splitlines()))
+
+        response = self.client.post(url, {
+            'skeleton_ids[0]': 373,
+            'format': 'json'})
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        nodes = json.loads(archive.read('373.json'))
+        self.assertEqual(5, len(nodes))
+        self.assertEqual(1, sum(1 for n in nodes if n[1] is None))
 
     def test_labels(self):
         self.fake_authentication()
@@ -2043,6 +2257,31 @@ class ViewPageTests(TestCase):
         assertHasParent(377, 405)
         assertHasParent(407, None)
 
+    def test_split_skeleton(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id,
+                {'treenode_id': 405})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({}, json.loads(response.content))
+
+        split_node = get_object_or_404(Treenode, id=405)
+        new_skeleton_id = split_node.skeleton_id
+        self.assertNotEqual(373, new_skeleton_id)
+        self.assertEqual(None, split_node.parent_id)
+        for treenode_id in (407, 409):
+            self.assertEqual(new_skeleton_id,
+                    get_object_or_404(Treenode, id=treenode_id).skeleton_id)
+        for treenode_id in (377, 403):
+            self.assertEqual(373,
+                    get_object_or_404(Treenode, id=treenode_id).skeleton_id)
+
+        self.assertEqual(new_skeleton_id,
+                get_object_or_404(TreenodeConnector, id=429).skeleton_id)
+        self.assertEqual(373,
+                get_object_or_404(TreenodeConnector, id=382).skeleton_id)
+
     def test_reroot_and_link_treenodes(self):
         self.fake_authentication()
 
@@ -2438,6 +2677,210 @@ class ViewPageTests(TestCase):
         for row in expected_result:
             self.assertTrue(row in parsed_response)
 
+    def test_node_list_changes(self):
+        self.fake_authentication()
+        params = {
+            'z': 0,
+            'top': 4625,
+            'left': 2860,
+            'width': 8000,
+            'height': 3450,
+            'zres': 9,
+            'labels': 'false'}
+        url = '/%d/node/list/changes' % (self.test_project_id,)
+
+        # Without a revision, the client is asked to reload everything
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertTrue(parsed_response['reload'])
+        params['since'] = parsed_response['revision']
+
+        # Change a treenode in the field of view and delete one of the
+        # skeletons in it.
+        treenode = Treenode.objects.get(id=2394)
+        treenode.confidence = 2
+        treenode.save()
+        Treenode.objects.filter(skeleton_id=2411).delete()
+
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertFalse('reload' in parsed_response)
+        changed = dict((row[0], row) for row in parsed_response['treenodes'])
+        self.assertTrue(2394 in changed)
+        self.assertEqual(2, changed[2394][5])
+        self.assertTrue(set([2415, 2417, 2419, 2423]).issubset(
+                parsed_response['removed_treenodes']))
+
+    def decode_binary_rows(self, response, table, columns, nullable=()):
+        """ Decodes a binary response and returns the rows of one of its
+        tables, with -1 in nullable columns replaced by None, along with the
+        additional data. """
+        from control import binaryformat
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(binaryformat.CONTENT_TYPE, response['Content-Type'])
+        tables, data = binaryformat.decode(response.content)
+        rows = zip(*[tables[table][c].tolist() for c in columns])
+        return [[None if c in nullable and -1 == v else v
+                for c, v in zip(columns, row)] for row in rows], data
+
+    def test_node_list_binary(self):
+        import numpy as np
+        self.fake_authentication()
+        params = {
+            'z': 0,
+            'top': 4625,
+            'left': 2860,
+            'width': 8000,
+            'height': 3450,
+            'zres': 9,
+            'labels': 'true'}
+        url = '/%d/node/list' % (self.test_project_id,)
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        treenodes, connectors, labels, truncated, revision = \
+                json.loads(response.content)
+
+        response = self.client.post(url, dict(params, format='binary'))
+        columns = ('id', 'parent_id', 'x', 'y', 'z', 'confidence', 'radius',
+                'skeleton_id', 'can_edit')
+        binary_treenodes, data = self.decode_binary_rows(response,
+                'treenodes', columns, ('parent_id',))
+        # Radii are sent as 32 bit floats
+        for row in treenodes:
+            row[6] = float(np.float32(row[6]))
+        for row in binary_treenodes:
+            row[8] = bool(row[8])
+        self.assertEqual(sorted(treenodes), sorted(binary_treenodes))
+        self.assertEqual(labels, data['labels'])
+        self.assertEqual(truncated, data['truncated'])
+
+        # Connector links are a table of their own
+        links = self.decode_binary_rows(response, 'connector_links',
+                ('connector_id', 'treenode_id', 'relation', 'confidence'))[0]
+        binary_connectors = self.decode_binary_rows(response, 'connectors',
+                ('id', 'x', 'y', 'z', 'confidence', 'can_edit'))[0]
+        binary_connectors = [row[:5] + [
+                sorted([l[1], l[3]] for l in links if l[0] == row[0] and 0 == l[2]),
+                sorted([l[1], l[3]] for l in links if l[0] == row[0] and 1 == l[2]),
+                bool(row[5])] for row in binary_connectors]
+        connectors = [row[:5] + [sorted(row[5]), sorted(row[6]), row[7]]
+                for row in connectors]
+        self.assertTrue(len(connectors) > 0)
+        self.assertEqual(sorted(connectors), sorted(binary_connectors))
+
+    def test_skeleton_for_3d_viewer_binary(self):
+        import numpy as np
+        self.fake_authentication()
+        url = '/%d/skeleton/235/compact-json' % (self.test_project_id,)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        name, nodes, tags, connectors = json.loads(response.content)
+
+        response = self.client.post(url, {'format': 'binary'})
+        binary_nodes, data = self.decode_binary_rows(response, 'nodes',
+                ('id', 'parent_id', 'user_id', 'reviewer_id', 'x', 'y', 'z',
+                        'radius', 'confidence'), ('parent_id', 'reviewer_id'))
+        binary_connectors = self.decode_binary_rows(response, 'connectors',
+                ('treenode_id', 'connector_id', 'relation', 'x', 'y', 'z',
+                        'reviewer_id'), ('reviewer_id',))[0]
+        self.assertEqual(name, data['name'])
+        self.assertEqual(tags, data['tags'])
+        for row in nodes:
+            row[7] = float(np.float32(row[7]))
+        self.assertEqual(sorted(nodes), sorted(binary_nodes))
+        self.assertTrue(len(connectors) > 0)
+        self.assertEqual(sorted(connectors), sorted(binary_connectors))
+
+    def test_node_list_cache_invalidation(self):
+        from django.core.cache import get_cache
+        from django.test.utils import override_settings
+        self.fake_authentication()
+        User.objects.filter(username='temporary').update(is_superuser=True)
+        params = {
+            'z': 0,
+            'top': 4625,
+            'left': 2860,
+            'width': 8000,
+            'height': 3450,
+            'zres': 9,
+            'labels': 'false'}
+
+        def node_list():
+            response = self.client.post(
+                    '/%d/node/list' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            return dict((row[0], row) for row in parsed_response[0])
+
+        with override_settings(NODE_LIST_CACHE='default'):
+            get_cache('default').clear()
+            nodes = node_list()
+            self.assertEqual(-1, nodes[2394][6])
+            self.assertTrue(2396 in nodes)
+            self.assertTrue(2419 in nodes)
+
+            # Edit a treenode
+            response = self.client.post('/%d/treenode/%d/radius' % (
+                    self.test_project_id, 2394), {'radius': 7, 'option': 0})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(7, node_list()[2394][6])
+
+            # Move a treenode out of the field of view
+            response = self.client.post(
+                    '/%d/node/update' % self.test_project_id, {
+                        't[0][0]': 2396,
+                        't[0][1]': 100,
+                        't[0][2]': 100,
+                        't[0][3]': 0})
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(2396 in node_list())
+
+            # Delete a treenode
+            response = self.client.post(
+                    '/%d/treenode/delete' % self.test_project_id,
+                    {'treenode_id': 2419})
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(2419 in node_list())
+
+    def test_node_list_cache_invalidated_after_request(self):
+        from django.core.cache import get_cache
+        from django.core.signals import request_finished
+        from django.test.utils import override_settings
+        from control import nodecache
+        with override_settings(NODE_LIST_CACHE='default'):
+            cache = get_cache('default')
+            key = nodecache._cell_key(self.test_project_id, 0, 0, 0)
+            nodecache.invalidate_treenodes(self.test_project_id, [2394])
+            # A concurrent request stores the cell again before the
+            # invalidating transaction is committed.
+            cache.set(key, {'treenodes': [], 'connectors': [],
+                    'labels': None})
+            request_finished.send(sender=self.__class__)
+            self.assertEqual(None, cache.get(key))
+
+    def test_export_wiring_diagram(self):
+        self.fake_authentication()
+        url = '/%d/wiringdiagram/json' % (self.test_project_id,)
+        response = self.client.post(url, {'lower_skeleton_count': 5})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(''.join(response.streaming_content))
+        # Skeletons 2388 and 2411 have fewer than five nodes
+        self.assertEqual(['235', '361', '373'],
+                sorted(n['id'] for n in parsed_response['data']['nodes']))
+        self.assertEqual({'235_361': 1, '235_373': 2},
+                dict((e['id'], e['number_of_connector'])
+                    for e in parsed_response['data']['edges']))
+
+        url = '/%d/wiringdiagram/csv' % (self.test_project_id,)
+        response = self.client.post(url, {'lower_skeleton_count': 5})
+        self.assertEqual(response.status_code, 200)
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual('pre_skeleton_id,post_skeleton_id,'
+                'number_of_connector,pre_node_count,post_node_count', lines[0])
+        self.assertEqual(['235,361,1,28,9', '235,373,2,28,5'], sorted(lines[1:]))
+
     def test_textlabels_empty(self):
         self.fake_authentication()
         expected_result = {}
@@ -2539,3 +2982,657 @@ class TreenodeTests(TestCase):
         connectors = Connector.objects.filter(
             treenodeconnector__treenode__treenodeclassinstance__class_instance=skeleton)
         self.assertEqual(len(connectors), 3)
+
+
+class NodeListCacheTests(TestCase):
+
+    def setUp(self):
+        from django.core.cache import get_cache
+        get_cache('default').clear()
+
+    def fetch_rows(self, cursor, params, strict):
+        # Two treenodes in section 0 (one child of the other) and one in
+        # section 1, plus a free connector and one linked to treenode 2.
+        self.fetched.append((params['left'], params['top']))
+        treenodes = [
+            (1, None, 100.0, 100.0, 0.0, 5, -1, 10, 3),
+            (2, 1, 9000.0, 100.0, 0.0, 5, -1, 10, 3),
+            (3, 2, 9100.0, 150.0, 40.0, 5, -1, 10, 3)]
+        connectors = [
+            (20, 9050.0, 120.0, 0.0, 5, 7, 2, 5, 3),
+            (21, 300.0, 300.0, 0.0, 5, None, None, None, 3)]
+        def inside(x, y):
+            return params['left'] <= x <= params['right'] and \
+                    params['top'] <= y <= params['bottom']
+        visible = set(r[0] for r in treenodes if inside(r[2], r[3]) and r[4] == 0)
+        treenodes = [r for r in treenodes if r[0] in visible or r[1] in visible
+                or any(r[0] == t[1] for t in treenodes if t[0] in visible)]
+        tnids = set(r[0] for r in treenodes)
+        connectors = [c for c in connectors
+                if inside(c[1], c[2]) or c[6] in tnids]
+        return treenodes, connectors, False
+
+    def test_node_list_assembled_from_cells(self):
+        from django.test.utils import override_settings
+        from control import nodecache
+        self.fetched = []
+        params = {'project_id': 3, 'z': 0.0, 'left': 0.0, 'top': 0.0,
+                'right': 1000.0, 'bottom': 1000.0, 'limit': 10}
+        with override_settings(NODE_LIST_CACHE='default',
+                NODE_LIST_CACHE_CELL_SIZE=8192):
+            treenodes, connectors, truncated = \
+                    nodecache.get_node_list(None, params, self.fetch_rows)[:3]
+            # Only the first cell is needed and node 1 is its only visible
+            # treenode. Its child 2 is included, the grandchild 3 is not.
+            self.assertEqual([(0.0, 0.0)], self.fetched)
+            self.assertEqual([1, 2], sorted(r[0] for r in treenodes))
+            self.assertEqual([20, 21], sorted(c[0] for c in connectors))
+            self.assertFalse(truncated)
+
+            # A second request for the same field of view is served from
+            # the cache.
+            nodecache.get_node_list(None, params, self.fetch_rows)
+            self.assertEqual(1, len(self.fetched))
+
+            # A field of view spanning two cells only fetches the new one.
+            params['right'] = 9500.0
+            treenodes, connectors, truncated = \
+                    nodecache.get_node_list(None, params, self.fetch_rows)[:3]
+            self.assertEqual([(0.0, 0.0), (8192.0, 0.0)], self.fetched)
+            self.assertEqual([1, 2, 3], sorted(r[0] for r in treenodes))
+
+    def test_truncated_cell_not_cached(self):
+        from django.test.utils import override_settings
+        from control import nodecache
+        self.fetched = []
+        params = {'project_id': 3, 'z': 0.0, 'left': 0.0, 'top': 0.0,
+                'right': 1000.0, 'bottom': 1000.0, 'limit': 10}
+        fetch_rows = self.fetch_rows
+        def fetch_truncated_cells(cursor, params, strict):
+            treenodes, connectors, truncated = fetch_rows(cursor, params,
+                    strict)
+            return treenodes, connectors, not strict
+        with override_settings(NODE_LIST_CACHE='default',
+                NODE_LIST_CACHE_CELL_SIZE=8192, NODE_LIST_CACHE_CELL_LIMIT=1):
+            # The truncated cell is dropped in favor of the field of view,
+            # which isn't truncated by the view's own limit.
+            treenodes, connectors, truncated = nodecache.get_node_list(None,
+                    params, fetch_truncated_cells)[:3]
+            self.assertEqual([(0.0, 0.0), (0.0, 0.0)], self.fetched)
+            self.assertEqual([1, 2], sorted(r[0] for r in treenodes))
+            self.assertFalse(truncated)
+            # Nothing was cached
+            nodecache.get_node_list(None, params, fetch_truncated_cells)
+            self.assertEqual(4, len(self.fetched))
+
+    def test_cached_node_list_limit(self):
+        from django.test.utils import override_settings
+        from control import nodecache
+        self.fetched = []
+        params = {'project_id': 3, 'z': 0.0, 'left': 0.0, 'top': 0.0,
+                'right': 9500.0, 'bottom': 1000.0, 'limit': 10}
+        fetch_rows = self.fetch_rows
+        def fetch_limited(cursor, params, strict):
+            treenodes, connectors, truncated = fetch_rows(cursor, params,
+                    strict)
+            return treenodes, connectors, strict
+        with override_settings(NODE_LIST_CACHE='default',
+                NODE_LIST_CACHE_CELL_SIZE=8192):
+            nodecache.get_node_list(None, params, fetch_limited)
+            self.assertEqual(2, len(self.fetched))
+            # The cached cells hold two visible treenodes, more than the
+            # limit allows. The field of view is queried directly, like it
+            # is without the cache.
+            params['limit'] = 1
+            truncated = nodecache.get_node_list(None, params,
+                    fetch_limited)[2]
+            self.assertEqual(3, len(self.fetched))
+            self.assertEqual((0.0, 0.0), self.fetched[-1])
+            self.assertTrue(truncated)
+
+
+class BinaryFormatTests(TestCase):
+    def test_encode_decode(self):
+        from control import binaryformat
+        rows = [(1, None, 3.5, -1.0, True),
+                (2, 1, 1.25, 2.5, False),
+                (3, 2**40, 0.0, 0.0, True)]
+        content = binaryformat.encode((
+            ('nodes', rows, (
+                ('id', binaryformat.INT),
+                ('parent_id', binaryformat.INT),
+                ('x', binaryformat.FLOAT64),
+                ('radius', binaryformat.FLOAT32),
+                ('can_edit', binaryformat.BOOL))),
+            ('empty', [], (('id', binaryformat.INT),))),
+            {'truncated': False})
+        tables, data = binaryformat.decode(content)
+        self.assertEqual({'truncated': False}, data)
+        nodes = tables['nodes']
+        self.assertEqual('<i4', nodes['id'].dtype.str)
+        self.assertEqual([1, 2, 3], nodes['id'].tolist())
+        # NULL values are encoded as -1, large IDs as 64 bit integers
+        self.assertEqual('<i8', nodes['parent_id'].dtype.str)
+        self.assertEqual([-1, 1, 2**40], nodes['parent_id'].tolist())
+        self.assertEqual([3.5, 1.25, 0.0], nodes['x'].tolist())
+        self.assertEqual([-1.0, 2.5, 0.0], nodes['radius'].tolist())
+        self.assertEqual([1, 0, 1], nodes['can_edit'].tolist())
+        self.assertEqual(0, len(tables['empty']['id']))
+
+
+class ArborMeasurementTests(TestCase):
+    def test_measure(self):
+        import numpy as np
+        from control import arbor
+        ids = np.array([1, 2, 3, 4, 10, 11, 12])
+        parent_ids = np.array([-1, 1, 2, 2, -1, 10, 11])
+        skeleton_ids = np.array([5, 5, 5, 5, 9, 9, 9])
+        positions = np.array([(0, 0, 0), (1, 0, 0), (2, 0, 0), (1, 1, 0),
+                (0, 0, 0), (3, 0, 0), (3, 4, 0)], dtype=np.float64)
+        skids, measurements = arbor.measure(ids, parent_ids, skeleton_ids,
+                positions)
+        self.assertEqual([5, 9], skids.tolist())
+        self.assertEqual([4, 3], measurements['n_nodes'].tolist())
+        self.assertEqual([3, 2], measurements['n_ends'].tolist())
+        self.assertEqual([1, 0], measurements['n_branch'].tolist())
+        self.assertEqual([3.0, 7.0], measurements['raw_cable'].tolist())
+        # Only node 11 is a slab node. It moves towards the average position
+        # of its neighbors, weighted by the edge lengths 3 and 4.
+        smooth = positions[5] * 0.4 + (positions[4] * 3 + positions[6] * 4) / 7 * 0.6
+        smooth_cable = np.linalg.norm(smooth - positions[4]) + \
+                np.linalg.norm(positions[6] - smooth)
+        self.assertAlmostEqual(3.0, measurements['smooth_cable'][0])
+        self.assertAlmostEqual(smooth_cable, measurements['smooth_cable'][1])
+        # Both end nodes of the first skeleton are two edges away from the
+        # root, the one with the lower ID is part of the principal branch.
+        self.assertAlmostEqual(2.0, measurements['principal_branch_cable'][0])
+        self.assertAlmostEqual(smooth_cable,
+                measurements['principal_branch_cable'][1])
+
+    def test_arbor(self):
+        from control.arbor import Arbor
+        # 1 - 2 - 3 - 4
+        #      \
+        #       5 - 6
+        tree = Arbor([3, 1, 2, 4, 5, 6], [2, None, 1, 3, 2, 5],
+                {'radius': [3, 1, 2, 4, 5, 6]})
+        self.assertEqual(1, tree.find_root())
+        self.assertEqual([3, 5], sorted(tree.successors(2)))
+        self.assertEqual(None, tree.parent(1))
+        self.assertEqual(5, tree.node[5]['radius'])
+        self.assertEqual({1: 1, 2: 2, 3: 3, 4: 4, 5: 3, 6: 4},
+                tree.edge_count_to_root())
+        self.assertEqual({5: 1, 6: 2}, tree.edge_count_to_root(5))
+        self.assertEqual([[4, 3, 2, 1], [6, 5, 2]], list(tree.partition()))
+        spanning = tree.spanning_tree([3, 6])
+        self.assertEqual([(2, 3), (2, 5), (5, 6)], sorted(spanning.edges()))
+        self.assertEqual([], tree.spanning_tree([]).nodes())
+        self.assertEqual([[1, 2, 3, 4], [5, 6]],
+                sorted(sorted(a.nodes()) for a in tree.split([5])))
+        self.assertEqual([[3, 4], [6]],
+                sorted(sorted(c) for c in tree.components([3, 4, 6])))
+        tree.reroot(6)
+        self.assertEqual(6, tree.find_root())
+        self.assertEqual([(2, 1), (2, 3), (3, 4), (5, 2), (6, 5)],
+                sorted(tree.edges()))
+
+    def test_tree_distances(self):
+        import numpy as np
+        from control.arbor import TreeDistances
+        # 0 - 1 - 2 - 3    5 - 6
+        #      \
+        #       4
+        parents = np.array([-1, 0, 1, 2, 1, -1, 5])
+        lengths = np.array([0, 1, 2, 3, 4, 0, 5], dtype=np.float64)
+        distances = TreeDistances(parents, lengths)
+        self.assertEqual([1, 1, 0, 5], distances.lca([3, 4, 2, 6], [4, 3, 0, 5]).tolist())
+        self.assertEqual([9.0, 9.0, 3.0, 0.0, 5.0],
+                distances.distances([3, 4, 2, 2, 6], [4, 3, 0, 2, 5]).tolist())
+        self.assertEqual(np.inf, distances.distances(3, 6))
+
+    def test_tree_max_density(self):
+        import numpy as np
+        from control.arbor import Arbor
+        from control.synapseclustering import tree_max_density
+        # A straight line of nodes 10 nm apart, with two groups of synapses
+        # far apart from each other
+        ids = range(1, 101)
+        tree = Arbor(ids, [None] + ids[:-1],
+                {'location': np.array([(10.0 * i, 0, 0) for i in ids])})
+        synapse_nodes = [2, 3, 5, 95, 97, 98]
+        groups = tree_max_density(tree, synapse_nodes, range(6), [1] * 6,
+                [20.0])[20.0]
+        self.assertEqual([[2, 3, 5], [95, 97, 98]],
+                sorted(sorted(g.node_ids) for g in groups.itervalues()))
+        self.assertEqual([3, 97], sorted(g.local_max for g in groups.itervalues()))
+
+
+class SkeletonConnectivityTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def connectivity(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT pre_skeleton_id, post_skeleton_id, count
+            FROM skeleton_connectivity
+            ORDER BY pre_skeleton_id, post_skeleton_id''')
+        return cursor.fetchall()
+
+    def test_links_update_connectivity(self):
+        self.assertEqual([(235, 361, 1), (235, 373, 2), (2388, 2364, 1),
+                (2411, 2364, 1)], self.connectivity())
+
+        TreenodeConnector.objects.get(pk=429).delete()
+        self.assertEqual([(235, 361, 1), (235, 373, 1), (2388, 2364, 1),
+                (2411, 2364, 1)], self.connectivity())
+
+        TreenodeConnector.objects.filter(pk=382).update(skeleton=361)
+        self.assertEqual([(235, 361, 2), (2388, 2364, 1), (2411, 2364, 1)],
+                self.connectivity())
+
+        TreenodeConnector.objects.create(user_id=3, project_id=3,
+                relation_id=24, treenode_id=377, connector_id=432,
+                skeleton_id=373)
+        self.assertEqual([(235, 361, 2), (235, 373, 1), (2388, 2364, 1),
+                (2411, 2364, 1)], self.connectivity())
+
+
+class SkeletonSummaryTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def summary(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT skeleton_id, num_nodes, round(cable_length::numeric, 3),
+                   num_presynaptic, num_postsynaptic
+            FROM skeleton_summary
+            ORDER BY skeleton_id''')
+        summary = cursor.fetchall()
+        cursor.execute('''
+            SELECT skeleton_id, reviewer_id, num_nodes
+            FROM skeleton_review_summary
+            ORDER BY skeleton_id, reviewer_id''')
+        return summary, cursor.fetchall()
+
+    def test_changes_update_summary(self):
+        from django.core.management import call_command
+        summary, review_summary = self.summary()
+        counts = dict((r[0], (r[1], r[3], r[4])) for r in summary)
+        self.assertEqual((28, 3, 0), counts[235])
+        self.assertEqual((5, 0, 2), counts[373])
+        self.assertTrue((373, -1, 5) in review_summary)
+
+        Treenode.objects.filter(pk=405).update(location=Double3D(1000, 2000, 0))
+        Treenode.objects.filter(pk=403).update(reviewer_id=3)
+        Treenode.objects.get(pk=409).delete()
+        Treenode.objects.filter(pk__in=[405, 407]).update(skeleton=361)
+        summary, review_summary = self.summary()
+        counts = dict((r[0], (r[1], r[3], r[4])) for r in summary)
+        self.assertEqual((2, 0, 1), counts[373])
+        self.assertEqual(11, counts[361][0])
+        self.assertTrue((373, 3, 1) in review_summary)
+
+        # The incrementally maintained summary equals a recomputed one
+        cursor = connection.cursor()
+        cursor.execute('SELECT skeleton_id, topology_revision FROM skeleton_summary')
+        revisions = dict(cursor.fetchall())
+        call_command('catmaid_rebuild_skeleton_summary')
+        self.assertEqual((summary, review_summary), self.summary())
+        # Topology revisions keep increasing
+        cursor.execute('SELECT skeleton_id, topology_revision FROM skeleton_summary')
+        self.assertEqual(dict((skid, revision + 1)
+                for skid, revision in revisions.iteritems()),
+                dict(cursor.fetchall()))
+
+
+class BenchmarkTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.test_project_id = 3
+        self.user = User.objects.create_superuser('benchmark',
+                'benchmark@example.com', 'benchmark')
+
+    def test_generate_and_run(self):
+        from benchmark import scenarios
+        from benchmark.generator import generate_connectome
+        generated = generate_connectome(self.test_project_id, self.user, 3,
+                40, synapses_per_neuron=5)
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT num_nodes FROM skeleton_summary
+            WHERE skeleton_id IN (%s)''' % ','.join(
+                str(skid) for skid in generated['skeleton_ids']))
+        self.assertEqual([40, 40, 40], [row[0] for row in cursor.fetchall()])
+        cursor.execute('''
+            SELECT count(*) FROM treenode
+            WHERE skeleton_id IN (%s) AND parent_id IS NULL''' % ','.join(
+                str(skid) for skid in generated['skeleton_ids']))
+        self.assertEqual(3, cursor.fetchone()[0])
+
+        context = scenarios.BenchmarkContext(self.test_project_id, self.user)
+        results = scenarios.run(context, repeat=2)
+        self.assertEqual(set(name for name, s in scenarios.SCENARIOS),
+                set(results.keys()))
+        for result in results.values():
+            self.assertEqual(2, len(result['times']))
+            self.assertTrue(result['response_size'] > 0)
+
+
+class TileCacheTests(TestCase):
+    def test_fetch_tiles(self):
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+        from control import tilecache
+        root = tempfile.mkdtemp()
+        try:
+            urls = []
+            for i in range(5):
+                path = os.path.join(root, 'tile%s.jpg' % i)
+                with open(path, 'wb') as f:
+                    f.write(str(i) * 1000)
+                urls.append('file://' + path)
+            with override_settings(MEDIA_ROOT=root, TILE_CACHE_MAX_SIZE=3500,
+                    TILE_FETCH_THREADS=3):
+                tiles = list(tilecache.fetch_tiles(urls + urls[:2]))
+                self.assertEqual([str(i) * 1000 for i in range(5) + [0, 1]],
+                        tiles)
+                # The least recently used tiles have been removed from the
+                # cache to keep it below its maximum size.
+                cached = tilecache._cached_files()
+                self.assertTrue(sum(f[1] for f in cached) <= 3500)
+                # Cached tiles are used even if the original is gone
+                tilecache.fetch_tile(urls[1])
+                os.remove(urls[1][len('file://'):])
+                self.assertEqual('1' * 1000, tilecache.fetch_tile(urls[1]))
+                self.assertRaises(tilecache.ImageRetrievalError,
+                        tilecache.fetch_tile, 'file://' + root + '/missing')
+                # Errors can take the place of tiles that can't be retrieved
+                tiles = list(tilecache.fetch_tiles([urls[0],
+                        'file://' + root + '/missing', urls[2]],
+                        return_errors=True))
+                self.assertEqual('0' * 1000, tiles[0])
+                self.assertTrue(isinstance(tiles[1],
+                        tilecache.ImageRetrievalError))
+                self.assertEqual('2' * 1000, tiles[2])
+        finally:
+            shutil.rmtree(root)
+
+
+class TiffWriterTests(TestCase):
+    def test_write_pages(self):
+        import struct
+        import tempfile
+        from control.tiffwriter import TiffWriter
+        fd, path = tempfile.mkstemp(suffix='.tiff')
+        os.close(fd)
+        try:
+            pages = ['\x01' * 12, '\x02' * 12]
+            with TiffWriter(path, 0.25, 0.25, 'ImageJ=1.45p\n') as writer:
+                for page in pages:
+                    writer.write_page(4, 3, 1, page)
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.assertEqual('II*\0', data[:4])
+            # The pixel data of all pages is stored contiguously
+            self.assertEqual(''.join(pages), data[8:32])
+            # Walk the linked IFDs and read the strip of each page
+            strips = []
+            offset = struct.unpack('<I', data[4:8])[0]
+            while offset:
+                n_entries = struct.unpack('<H', data[offset:offset + 2])[0]
+                entries = {}
+                for i in range(n_entries):
+                    entry = data[offset + 2 + 12 * i:offset + 14 + 12 * i]
+                    tag, field_type, count = struct.unpack('<HHI', entry[:8])
+                    entries[tag] = struct.unpack('<I', entry[8:])[0] \
+                            if field_type == 4 else \
+                            struct.unpack('<H', entry[8:10])[0]
+                self.assertEqual(4, entries[256])
+                self.assertEqual(3, entries[257])
+                strips.append(data[entries[273]:entries[273] + entries[279]])
+                offset = struct.unpack('<I', data[offset + 2 +
+                        12 * n_entries:offset + 6 + 12 * n_entries])[0]
+            self.assertEqual(pages, strips)
+        finally:
+            os.remove(path)
+
+
+class HDF5TileTests(TestCase):
+    def test_get_tile(self):
+        import h5py
+        import numpy as np
+        import shutil
+        import tempfile
+        from contextlib import closing
+        from PIL import Image
+        from StringIO import StringIO
+        from django.test.utils import override_settings
+        from control import tile
+        root = tempfile.mkdtemp()
+        try:
+            data = np.arange(100 * 100, dtype=np.uint8).reshape(100, 100)
+            with closing(h5py.File(os.path.join(root, '3_1_raw.hdf'),
+                    'w')) as f:
+                f.create_dataset('/0/5/data', data=data, chunks=(32, 32))
+            url = '/3/stack/1/tile?scale=0&z=%s&x=90&y=40&width=20&height=10'
+            with override_settings(HDF5_STORAGE_PATH=root):
+                response = self.client.get(url % 5)
+                self.assertEqual(200, response.status_code)
+                image = np.asarray(Image.open(StringIO(response.content)))
+                self.assertEqual((10, 20, 4), image.shape)
+                # Pixels beyond the data set are black
+                self.assertTrue((image[:, :10, 0] == data[40:50, 90:]).all())
+                self.assertTrue((image[:, 10:, 0] == 0).all())
+                # The second request is answered from the tile cache
+                self.assertEqual(response.content,
+                        self.client.get(url % 5).content)
+                # Missing sections are empty
+                empty = np.asarray(Image.open(StringIO(
+                        self.client.get(url % 6).content)))
+                self.assertTrue((empty[:, :, 0] == 0).all())
+        finally:
+            # Close the files the tile view keeps open
+            with tile._lock:
+                while tile._open_files:
+                    tile._open_files.popitem()[1][0].close()
+            shutil.rmtree(root)
+
+
+class TileStackCommandTests(TestCase):
+    def test_tile_stack(self):
+        import shutil
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from pgmagick import Color, Geometry, Image
+        root = tempfile.mkdtemp()
+        try:
+            for i in range(2):
+                Image(Geometry(600, 300), Color('gray')).write(
+                        str(os.path.join(root, 'section%s.png' % i)))
+            output = os.path.join(root, 'tiles')
+            call_command('catmaid_tile_stack', input=os.path.join(root,
+                    '*.png'), output=output, tile_source_type=5,
+                    processes=1, stdout=StringIO())
+            for z in range(2):
+                # Three zoom levels: 600 x 300, 300 x 150 and 150 x 75
+                for zoom_level, rows, cols in ((0, 2, 3), (1, 1, 2),
+                        (2, 1, 1)):
+                    for row in range(rows):
+                        for col in range(cols):
+                            path = os.path.join(output, str(zoom_level),
+                                    str(z), str(row), '%s.jpg' % col)
+                            self.assertTrue(os.path.exists(path))
+                            # Border tiles are filled up to the tile size
+                            self.assertEqual(256, Image(str(path)).size()
+                                    .width())
+                self.assertFalse(os.path.exists(os.path.join(output, '3')))
+                self.assertTrue(os.path.exists(os.path.join(output, 'small',
+                        '%s.jpg' % z)))
+        finally:
+            shutil.rmtree(root)
+
+
+class CroppingTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        from control import cropping
+        self.cropping = cropping
+        # A 256 x 256 pixel stack of 4 x 4 tiles, whose pixel values grow
+        # along both axes, so that rotations can be told apart.
+        self.stack = Stack(title='Synthetic stack', image_base='/synthetic/',
+                dimension=Integer3D(x=256, y=256, z=2),
+                resolution=Double3D(x=1.0, y=1.0, z=1.0), tile_width=64,
+                tile_height=64, tile_source_type=1, file_extension='png')
+        self.stack.save()
+        ProjectStack(project_id=3, stack=self.stack,
+                translation=Double3D(x=0.0, y=0.0, z=0.0)).save()
+        self.requested = []
+        self.failing = set()
+        self.fetch_tiles = cropping.fetch_tiles
+        self.map_coordinates = cropping.map_coordinates
+        cropping.fetch_tiles = self.fetch_synthetic_tiles
+
+    def tearDown(self):
+        self.cropping.fetch_tiles = self.fetch_tiles
+        self.cropping.map_coordinates = self.map_coordinates
+
+    def synthetic_tile(self, x, y):
+        import numpy as np
+        from pgmagick import Blob
+        rows, cols = np.mgrid[0:64, 0:64]
+        samples = 20 + (x * 64 + cols + 2 * (y * 64 + rows)) / 4
+        blob = Blob()
+        self.cropping._array_image(samples.astype(np.uint8)).write(blob,
+                'PNG')
+        return blob.data
+
+    def fetch_synthetic_tiles(self, paths, return_errors=False):
+        """ Stands in for tilecache.fetch_tiles() and records the (x, y, z)
+        coordinates of the requested tiles. Tiles of the coordinates in
+        self.failing can't be retrieved. """
+        paths = list(paths)
+        for path in paths:
+            z, y, x = re.match(r'^/synthetic/(\d+)/(\d+)_(\d+)_0\.png$',
+                    path).groups()
+            tile = (int(x), int(y), int(z))
+            self.requested.append(tile)
+            if tile in self.failing:
+                error = self.cropping.ImageRetrievalError(path, 'missing')
+                if not return_errors:
+                    raise error
+                yield error
+            else:
+                yield self.synthetic_tile(tile[0], tile[1])
+
+    def job(self, x_min, x_max, y_min, y_max, rotation_cw, z_max=0):
+        return self.cropping.CropJob(None, 3, self.stack.id, x_min, x_max,
+                y_min, y_max, 0, z_max, rotation_cw, 0)
+
+    def samples(self, image):
+        import numpy as np
+        from pgmagick import Blob
+        blob = Blob()
+        image.write(blob, 'RGB', 8)
+        size = image.size()
+        return np.frombuffer(blob.data, dtype=np.uint8).reshape(
+                size.height(), size.width(), 3)[:, :, 0].astype(np.float64)
+
+    def test_rotated_crop_matches_fallback(self):
+        import numpy as np
+        box = (78, 178, 98, 158)
+        rotated = self.samples(self.cropping.extract_substack(
+                self.job(*(box + (30,))))[0])
+        self.assertEqual((60, 100), rotated.shape)
+        # Without SciPy, GraphicsMagick rotates the enlarged box
+        self.cropping.map_coordinates = None
+        fallback = self.samples(self.cropping.extract_substack(
+                self.job(*(box + (30,))))[0])
+        mirrored = self.samples(self.cropping.extract_substack(
+                self.job(*(box + (330,))))[0])
+        # Both paths may differ by a pixel at the border and in their
+        # interpolation, but the content has the same orientation.
+        def difference(a, b):
+            rows = min(a.shape[0], b.shape[0]) - 3
+            cols = min(a.shape[1], b.shape[1]) - 3
+            return np.abs(a[3:rows, 3:cols] - b[3:rows, 3:cols]).mean()
+        self.assertTrue(abs(fallback.shape[0] - 60) <= 1)
+        self.assertTrue(abs(fallback.shape[1] - 100) <= 1)
+        self.assertTrue(difference(rotated, fallback) < 2)
+        self.assertTrue(difference(rotated, mirrored) > 6)
+
+    def test_rotated_crop_outside_stack(self):
+        # A box around the stack's origin: the corner that is rotated out of
+        # the stack is black, the opposite one has content.
+        rotated = self.samples(self.cropping.extract_substack(
+                self.job(-40, 40, -40, 40, 30))[0])
+        self.assertEqual((80, 80), rotated.shape)
+        self.assertEqual(0, rotated[5, 5])
+        self.assertTrue(rotated[75, 75] > 20)
+
+    def test_rotated_crop_fetches_covered_tiles(self):
+        # A thin box along the diagonal of the stack from (22, 22) to
+        # (234, 234) only needs tiles on and next to the diagonal, not
+        # the whole bounding box of 4 x 4 tiles.
+        self.cropping.extract_substack(self.job(-22, 278, 126, 130, 45))
+        self.assertEqual(len(self.requested), len(set(self.requested)))
+        for x, y in ((0, 0), (1, 1), (2, 2), (3, 3)):
+            self.assertTrue((x, y, 0) in self.requested)
+        for x, y, z in self.requested:
+            self.assertEqual(0, z)
+            self.assertTrue(abs(x - y) <= 1)
+
+    def test_extract_windows(self):
+        # Windows a and b overlap on the first two tiles of a row, window c
+        # needs a single tile that is missing on the second section.
+        self.failing.add((3, 0, 1))
+        windows = [('a', 10, 70, 10, 20, 0, 1), ('b', 50, 120, 10, 20, 0, 1),
+                ('c', 200, 230, 10, 20, 0, 1)]
+        results = dict((key, (images, error)) for key, images, error in
+                self.cropping.extract_windows(self.job(0, 0, 0, 0, 0),
+                windows))
+        # Every tile is fetched once, no matter how many windows need it
+        self.assertEqual(6, len(self.requested))
+        self.assertEqual(set((x, 0, z) for x in (0, 1, 3) for z in (0, 1)),
+                set(self.requested))
+        for key, value in (('a', 27), ('b', 37)):
+            images, error = results[key]
+            self.assertEqual(None, error)
+            self.assertEqual(2, len(images))
+            self.assertEqual(value, self.samples(images[0])[0, 0])
+        images, error = results['c']
+        self.assertEqual(None, images)
+        self.assertEqual('/synthetic/1/0_3_0.png', error.path)
+
+    def test_export_nodes(self):
+        import shutil
+        import tempfile
+        from control.treenodeexport import SkeletonExportJob, \
+                TreenodeExporter
+        class Node(object):
+            def __init__(self, id, x, y, z):
+                self.id = id
+                self.location = Double3D(x=x, y=y, z=z)
+        self.failing.add((3, 0, 1))
+        nodes = [Node(1, 40, 15, 0), Node(2, 85, 15, 0), Node(3, 215, 15, 1)]
+        job = SkeletonExportJob(None, 3, self.stack.id, [1], 30, 5, 0, False)
+        exporter = TreenodeExporter(job)
+        root = tempfile.mkdtemp()
+        try:
+            exporter.get_output_images = lambda node, cropped_stack, \
+                    crop_job, z_min: [(os.path.join(root, '%s.tiff' %
+                    node.id), cropped_stack[-1])]
+            error_urls = exporter.export_nodes(nodes)
+            # Both windows share the tiles of the first section
+            self.assertEqual([(0, 0, 0), (1, 0, 0), (3, 0, 1)],
+                    sorted(self.requested))
+            self.assertEqual({nodes[2]: ('missing',
+                    '/synthetic/1/0_3_0.png')}, error_urls)
+            self.assertTrue(os.path.exists(os.path.join(root, '1.tiff')))
+            self.assertTrue(os.path.exists(os.path.join(root, '2.tiff')))
+            self.assertFalse(os.path.exists(os.path.join(root, '3.tiff')))
+        finally:
+            shutil.rmtree(root)
@@ -140,6 +140,7 @@ urlpatterns += patterns('catmaid.control.node',
     (r'^(?P<project_id>\d+)/node/nearest$', 'node_nearest'),
     (r'^(?P<project_id>\d+)/node/update$', 'node_update'),
     (r'^(?P<project_id>\d+)/node/list$', 'node_list_tuples'),
+    (r'^(?P<project_id>\d+)/node/list/changes$', 'node_list_changes'),
     (r'^(?P<project_id>\d+)/node/previous_branch_or_root$', 'find_previous_branchnode_or_root'),
     (r'^(?P<project_id>\d+)/node/next_branch_or_end$', 'find_next_branchnode_or_end'),
     (r'^(?P<project_id>\d+)/node/get_location$', 'get_location'),
@@ -187,6 +188,7 @@ urlpatterns += patterns('catmaid.control.skeletonexport',
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/compact-json$', 'skeleton_for_3d_viewer'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/review$', 'export_review_skeleton'),
     (r'^(?P<project_id>\d+)/skeletons/measure$', 'measure_skeletons'),
+    (r'^(?P<project_id>\d+)/skeletons/archive$', 'export_skeletons_archive'),
     (r'^(?P<project_id>\d+)/skeleton/connectors-by-partner$', 'skeleton_connectors_by_partner'),
 )
 
@@ -361,6 +363,9 @@ urlpatterns += patterns('catmaid.control',
 
     # Graphs
     (r'^(?P<project_id>\d+)/skeletongroup/skeletonlist_confidence_compartment_subgraph', 'graph2.skeleton_graph'),
+    (r'^(?P<project_id>\d+)/skeletongroup/skeletonlist_risk_subgraph$', 'graph.skeleton_graph'),
+    (r'^(?P<project_id>\d+)/graphjob/(?P<job_id>[0-9a-f]+)/status$', 'graphjob.job_status'),
+    (r'^(?P<project_id>\d+)/graphjob/(?P<job_id>[0-9a-f]+)/cancel$', 'graphjob.cancel_job'),
 
     # Circles
     (r'^(?P<project_id>\d+)/graph/circlesofhell', 'circles.circles_of_hell'),
@@ -375,6 +380,7 @@ urlpatterns += patterns('catmaid.control',
     # Wiring diagram export
     (r'^(?P<project_id>\d+)/wiringdiagram/json$', 'wiringdiagram.export_wiring_diagram'),
     (r'^(?P<project_id>\d+)/wiringdiagram/nx_json$', 'wiringdiagram.export_wiring_diagram_nx'),
+    (r'^(?P<project_id>\d+)/wiringdiagram/csv$', 'wiringdiagram.export_wiring_diagram_csv'),
 
     # Annotation graph export
     (r'^(?P<project_id>\d+)/annotationdiagram/nx_json$', 'object.convert_annotations_to_networkx'),
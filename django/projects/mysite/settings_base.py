@@ -98,6 +98,69 @@ PROFILE_SHOW_ONTOLOGY_TOOL = False
 # such an image will be created when requested.
 ROI_AUTO_CREATE_IMAGE = False
 
+# The maximum number of treenodes the tracing overlay retrieves for a single
+# section. If a field of view contains more nodes, the response is truncated
+# and the client is informed about it.
+NODE_LIST_MAXIMUM_COUNT = 5000
+
+# The node lists requested by the tracing overlay can be cached in cells of a
+# fixed grid (with the given edge length in calibrated units) for each
+# section. To enable this cache, set NODE_LIST_CACHE to the name of a cache
+# defined in the CACHES setting. If more than one process serves CATMAID, this
+# cache has to be shared between processes (e.g. memcached). Cells expire
+# after NODE_LIST_CACHE_TIMEOUT seconds, even if no write invalidated them.
+# Cells with more than NODE_LIST_CACHE_CELL_LIMIT treenodes in a section are
+# not cached, node lists that overlap them are queried directly.
+NODE_LIST_CACHE = None
+NODE_LIST_CACHE_CELL_SIZE = 8192
+NODE_LIST_CACHE_TIMEOUT = 300
+NODE_LIST_CACHE_CELL_LIMIT = 50000
+
+# The permissions of users on projects and the sets of users whose work a
+# user can edit are cached for PERMISSION_CACHE_TIMEOUT seconds in the cache
+# named by PERMISSION_CACHE. Permission changes invalidate the cache, which
+# only reaches other processes if the cache is shared between processes (e.g.
+# memcached). Otherwise, they see changes only after the timeout. A timeout
+# of 0 disables the cache.
+PERMISSION_CACHE = 'default'
+PERMISSION_CACHE_TIMEOUT = 60
+
+# Clients can ask for the changes to a node list since a previous request.
+# Revisions older than NODE_LIST_CHANGES_MAX_AGE seconds are not accepted and
+# the client has to request the complete node list again. Deletions older
+# than this are removed from the deletion log by the
+# catmaid_prune_node_deletion_log management command.
+NODE_LIST_CHANGES_MAX_AGE = 3600
+
+# The relation and class name to ID maps of projects are cached by each
+# process. Changes made through the models (e.g. by the ontology editor)
+# invalidate the maps of the process that made them, other processes retrieve
+# them again after ID_MAP_CACHE_TIMEOUT seconds, or as soon as a name is
+# requested that they don't know.
+ID_MAP_CACHE_TIMEOUT = 300
+
+# Each process keeps the tree structure of the SKELETON_TOPOLOGY_CACHE_SIZE
+# most recently navigated skeletons, so that moving to the previous or next
+# branch node doesn't load the whole skeleton. Cached structures are checked
+# against a revision that is maintained by the database, 0 disables the cache.
+SKELETON_TOPOLOGY_CACHE_SIZE = 32
+
+# Graph analyses of many skeletons can be requested as Celery jobs. Their
+# states and results are kept in the cache named by GRAPH_JOB_CACHE, which has
+# to be shared by the web server and the Celery workers (e.g. memcached),
+# otherwise analyses are computed within the request. Results are kept for
+# GRAPH_JOB_RESULT_TIMEOUT seconds and are reused as long as the skeletons
+# don't change. A user can have GRAPH_JOB_MAX_PER_USER unfinished jobs. If
+# GRAPH_JOB_QUEUE is set, jobs are sent to this Celery queue, which can be
+# served by dedicated workers so that other tasks don't wait for analyses.
+# Analyses of skeletons with more than GRAPH_SYNC_MAX_NODES nodes are only
+# run as jobs if jobs are available, 0 disables this limit.
+GRAPH_JOB_CACHE = 'default'
+GRAPH_JOB_RESULT_TIMEOUT = 3600
+GRAPH_JOB_MAX_PER_USER = 2
+GRAPH_JOB_QUEUE = None
+GRAPH_SYNC_MAX_NODES = 200000
+
 # Default importer tile width and height
 IMPORTER_DEFAULT_TILE_WIDTH = 256
 IMPORTER_DEFAULT_TILE_HEIGHT = 256
@@ -110,11 +173,49 @@ MEDIA_HDF5_SUBDIRECTORY = 'hdf5'
 MEDIA_CROPPING_SUBDIRECTORY = 'cropping'
 MEDIA_ROI_SUBDIRECTORY = 'roi'
 MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
+MEDIA_TILE_CACHE_SUBDIRECTORY = 'tile_cache'
+
+# Cropping, ROI images and treenode archives fetch the image tiles they need
+# with TILE_FETCH_THREADS concurrent requests and keep them in a tile cache in
+# MEDIA_TILE_CACHE_SUBDIRECTORY. If the cache grows larger than
+# TILE_CACHE_MAX_SIZE bytes, the least recently used tiles are removed. A
+# maximum size of 0 disables the cache.
+TILE_FETCH_THREADS = 8
+TILE_CACHE_MAX_SIZE = 1024 ** 3
+
+# Treenode and connector archives crop the images of all nodes in one batch
+# and write them with TREENODE_EXPORT_WRITE_THREADS concurrent threads.
+TREENODE_EXPORT_WRITE_THREADS = 4
+
+# HDF5 tiles are read from files that are kept open, at most
+# HDF5_TILE_MAX_OPEN_FILES per process. The chunk caches of all open files
+# share HDF5_TILE_CHUNK_CACHE_SIZE bytes per process, each file gets an equal
+# part. Encoded tiles are kept in a cache of HDF5_TILE_CACHE_SIZE bytes per
+# process.
+HDF5_TILE_MAX_OPEN_FILES = 32
+HDF5_TILE_CHUNK_CACHE_SIZE = 64 * 1024 ** 2
+HDF5_TILE_CACHE_SIZE = 64 * 1024 ** 2
+
+# The number of permission lookups that weren't answered from the permission
+# cache is sent with every response in the X-Permission-Queries header if
+# 'catmaid.middleware.PermissionQueryCountMiddleware' is added to
+# MIDDLEWARE_CLASSES. This is meant for testing and debugging.
+
+# Request profiling is enabled by adding 'catmaid.middleware.ProfilingMiddleware'
+# as first entry to MIDDLEWARE_CLASSES. It records the number of queries, the
+# database, Python and JSON serialization times and the response size of the
+# last PROFILING_WINDOW requests of every view. The statistics can be looked
+# at in the admin interface, which writes them to files in PROFILING_OUTPUT_PATH
+# on request. This local path should not be served by the web server, because
+# the statistics reveal the views and timings of the server. If it isn't set,
+# a folder in the system's temporary directory is used.
+PROFILING_WINDOW = 1000
 
 # A sequence of modules that contain Celery tasks which we want Celery to know
 # about automatically.
 CELERY_IMPORTS = (
     'catmaid.control.cropping',
+    'catmaid.control.graphjob',
     'catmaid.control.roi',
     'catmaid.control.treenodeexport',
 )